@@ -8,6 +8,7 @@ import html
 import inspect
 import json
 import subprocess
+import tempfile
 import time
 import urllib.parse
 from concurrent.futures import ThreadPoolExecutor
@@ -19,11 +20,25 @@ from telegram.ext import (Application, CommandHandler, CallbackQueryHandler,
                            PreCheckoutQueryHandler)
 from telegram.error import TimedOut, BadRequest, Forbidden
 import database as db
+import database_async as adb
+import game_assets
+import game_events
+import http_json
+import leaderboard
+import media_cache
+import rate_limit
+import sync_coalesce
 import os
 import pytz
 import httpx
 import ui_texts as txt
-from game_security import validate_webapp_init_data, is_stale_sync_token
+from game_security import (
+    game_session_expires_at,
+    init_data_cache_stats,
+    issue_game_session_token,
+    validate_webapp_init_data,
+    verify_game_session_token,
+)
 
 
 def _tname(t) -> str | None:
@@ -112,6 +127,16 @@ _low_priority_db_executor = ThreadPoolExecutor(
 _low_priority_db_inflight = 0
 
 
+def _db_pool_maxconn() -> int:
+    """Сколько потоков могут одновременно держать соединение с БД.
+
+    default executor asyncio.to_thread есть и у loop polling-а, и у loop HTTP-потока,
+    плюс low-priority executor. Сверху размер ограничивает DB_POOL_MAX.
+    """
+    default_workers = min(32, (os.cpu_count() or 1) + 4)
+    return default_workers * 2 + ACTIVITY_LOG_WORKERS
+
+
 async def run_low_priority_db_background(label: str, fn, *args) -> None:
     """Best-effort DB work that cannot saturate the default executor."""
     global _low_priority_db_inflight
@@ -150,35 +175,51 @@ async def log_user_activity_background(user_id: int, action: str,
     )
 
 
-def _instrument_db_calls() -> None:
-    """Wrap db functions once to log slow calls globally."""
-    if getattr(db, "_slow_wrapped", False):
+def _instrument_db_calls(module=db) -> None:
+    """Wrap db functions once to log slow calls globally.
+
+    Для database_async оборачиваются нативные корутины; функции,
+    которые он отдаёт через to_thread, логируются обёртками самого db.
+    """
+    if getattr(module, "_slow_wrapped", False):
         return
-    for name in dir(db):
+    for name in dir(module):
         if name.startswith("_"):
             continue
-        fn = getattr(db, name, None)
-        if not inspect.isfunction(fn):
+        fn = getattr(module, name, None)
+        if not inspect.isfunction(fn) or fn.__module__ != module.__name__:
             continue
         if getattr(fn, "_slow_wrapped", False):
             continue
 
-        @functools.wraps(fn)
-        def wrapped(*args, __fn=fn, __name=name, **kwargs):
-            started = time.perf_counter()
-            try:
-                return __fn(*args, **kwargs)
-            finally:
-                elapsed_ms = (time.perf_counter() - started) * 1000
-                if elapsed_ms >= SLOW_DB_MS:
-                    logger.warning(f"slow-db {__name}: {elapsed_ms:.1f} ms")
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapped(*args, __fn=fn, __name=name, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await __fn(*args, **kwargs)
+                finally:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    if elapsed_ms >= SLOW_DB_MS:
+                        logger.warning(f"slow-db {__name}: {elapsed_ms:.1f} ms")
+        else:
+            @functools.wraps(fn)
+            def wrapped(*args, __fn=fn, __name=name, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return __fn(*args, **kwargs)
+                finally:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    if elapsed_ms >= SLOW_DB_MS:
+                        logger.warning(f"slow-db {__name}: {elapsed_ms:.1f} ms")
 
         wrapped._slow_wrapped = True
-        setattr(db, name, wrapped)
-    db._slow_wrapped = True
+        setattr(module, name, wrapped)
+    module._slow_wrapped = True
 
 
-_instrument_db_calls()
+_instrument_db_calls(db)
+_instrument_db_calls(adb)
 
 # ══════════════════════════════════════════════════════════
 #  ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ
@@ -253,6 +294,25 @@ elif PROJECT_AUTHOR_URL and not PROJECT_AUTHOR_URL.startswith('http'):
 GAME_BETA = os.environ.get('GAME_BETA', '0').strip() == '1'
 GAME_AUTH_REQUIRED = os.environ.get('GAME_AUTH_REQUIRED', '1').strip() != '0'
 GAME_AUTH_TTL_SEC = _env_int('GAME_AUTH_TTL_SEC', 86400)
+# Срок жизни подписанного токена сессии игры (выдаётся /game_state вместо повторной отправки init_data).
+GAME_SESSION_TTL_SEC = _env_int('GAME_SESSION_TTL_SEC', 3600)
+# 0 — API Mini App в потоке процесса бота; N > 0 — N отдельных процессов на общем порту.
+GAME_API_WORKERS = max(0, _env_int('GAME_API_WORKERS', 0))
+# Ответы API игры короче порога не сжимаются (см. http_json.encode_body).
+GAME_COMPRESS_MIN_BYTES = max(0, _env_int('GAME_COMPRESS_MIN_BYTES', 1024))
+# Дисковый кэш треков /game_media (см. media_cache.py); 0 МБ — только прокси.
+GAME_MEDIA_CACHE_DIR = os.environ.get('GAME_MEDIA_CACHE_DIR', '').strip() or os.path.join(
+    tempfile.gettempdir(), 'game_media_cache')
+GAME_MEDIA_CACHE_MB = max(0, _env_int('GAME_MEDIA_CACHE_MB', 256))
+# Push-события /game_events (см. game_events.py): memory — один процесс API,
+# postgres — LISTEN/NOTIFY между ботом и воркерами; auto — postgres при GAME_API_WORKERS > 0.
+GAME_EVENTS_BACKEND = os.environ.get('GAME_EVENTS_BACKEND', 'auto').strip().lower() or 'auto'
+GAME_EVENTS_MAX_CLIENTS = max(0, _env_int('GAME_EVENTS_MAX_CLIENTS', 2000))
+GAME_EVENTS_TICK_SEC = max(1, _env_int('GAME_EVENTS_TICK_SEC', 5))
+GAME_EVENTS_HEARTBEAT_SEC = 25
+# Окно слияния прогресс-тиков /game_sync (см. sync_coalesce.py); 0 — каждый тик пишется сразу.
+# По умолчанию выключено при GAME_API_WORKERS > 0: запросы игрока могут прийти в разные процессы.
+GAME_SYNC_COALESCE_MS = max(0, _env_int('GAME_SYNC_COALESCE_MS', 0 if GAME_API_WORKERS > 0 else 1500))
 # Кэш тестеров (обновляется при изменениях из бота)
 _beta_cache: set = set()
 _beta_cache_ts: float = 0
@@ -284,7 +344,7 @@ async def is_bot_admin_async(user_id: int) -> bool:
     if cached and (now_ts - cached[1] <= _BOT_ADMIN_TTL):
         return cached[0]
     try:
-        val = bool(await asyncio.to_thread(db.is_bot_admin_db, user_id))
+        val = bool(await adb.is_bot_admin_db(user_id))
         _bot_admin_cache[user_id] = (val, now_ts)
         if val:
             _bot_admin_last_true.add(user_id)
@@ -300,7 +360,7 @@ async def is_bot_admin_async(user_id: int) -> bool:
 async def get_admin_ids() -> list:
     """Возвращает список user_id всех бот-администраторов из bot_admins."""
     try:
-        rows = await asyncio.to_thread(db.get_all_bot_admins)
+        rows = await adb.get_all_bot_admins()
         return [r[0] for r in rows]
     except Exception:
         return []
@@ -311,7 +371,7 @@ async def get_maintenance_status_cached(force: bool = False) -> dict:
     global _maintenance_cache
     now = datetime.now()
     if force or (now - _maintenance_cache['last_check']).total_seconds() > MAINTENANCE_TTL:
-        status = await asyncio.to_thread(db.get_maintenance_status)
+        status = await adb.get_maintenance_status()
         status['last_check'] = now
         _maintenance_cache = status
     return _maintenance_cache
@@ -323,7 +383,7 @@ async def get_season_mode_cached(force: bool = False) -> str:
     now = datetime.now()
     if force or (now - _season_mode_cache['last_check']).total_seconds() > SEASON_MODE_TTL:
         try:
-            mode = await asyncio.to_thread(db.get_season_mode)
+            mode = await adb.get_season_mode()
         except Exception:
             mode = _season_mode_cache.get('mode', 'auto')
         mode = str(mode or 'auto').strip().lower()
@@ -341,7 +401,7 @@ async def is_game_privileged_async(user_id: int, *, bot_admin: bool | None = Non
     """True, если пользователь может входить в игру в техрежиме."""
     if game_role is None:
         try:
-            game_role = await asyncio.to_thread(db.get_game_role, user_id)
+            game_role = await adb.get_game_role(user_id)
         except Exception:
             game_role = None
     if game_role == 'admin':
@@ -1352,8 +1412,8 @@ async def format_day_schedule(class_name: str, day: str,
     lessons = sorted(lessons, key=lambda x: x[0])
     subs = {}
     if target_date:
-        raw = await asyncio.to_thread(
-            db.get_substitutions_for_class_date, class_name, target_date
+        raw = await adb.get_substitutions_for_class_date(
+            class_name, target_date
         )
         for s in raw:
             subs[s[3]] = {
@@ -1423,8 +1483,7 @@ async def format_teacher_schedule_text(teacher_name: str, schedule: dict) -> str
     cur_lesson_num = cur_info.get('number') if cur_info['status'] == 'lesson' else None
 
     # Замены на 30 дней
-    subs_raw = await asyncio.to_thread(
-        db.get_teacher_substitutions_between,
+    subs_raw = await adb.get_teacher_substitutions_between(
         teacher_name,
         today.strftime('%Y-%m-%d'),
         (today + timedelta(days=30)).strftime('%Y-%m-%d')
@@ -1667,7 +1726,7 @@ async def check_maintenance(update: Update, context: CallbackContext,
 #  УВЕДОМЛЕНИЯ
 # ══════════════════════════════════════════════════════════
 async def notify_teacher_substitution(context, teacher_name: str, sub_data: dict):
-    tid = await asyncio.to_thread(db.get_teacher_telegram_id, teacher_name)
+    tid = await adb.get_teacher_telegram_id(teacher_name)
     if not tid:
         for a in (await get_admin_ids()):
             try:
@@ -1707,7 +1766,7 @@ async def notify_teacher_substitution(context, teacher_name: str, sub_data: dict
 
 async def notify_class_substitution(context, class_name: str, sub_data: dict):
     """Уведомляет всех подписчиков класса о замене."""
-    subscribers = await asyncio.to_thread(db.get_class_subscribers, class_name)
+    subscribers = await adb.get_class_subscribers(class_name)
     if not subscribers:
         return
 
@@ -1735,7 +1794,7 @@ async def notify_class_substitution(context, class_name: str, sub_data: dict):
 
 async def notify_new_news(context, title: str, scope: str = 'bot'):
     """Рассылка уведомления о новой новости всем пользователям (с ограничением скорости)."""
-    users = await asyncio.to_thread(db.get_all_users)
+    users = await adb.get_all_users()
     news_scope = normalize_news_scope(scope)
     scope_label = NEWS_SCOPE_LABELS.get(news_scope, NEWS_SCOPE_LABELS[NEWS_SCOPE_BOT])
     msg = (
@@ -1770,7 +1829,7 @@ async def notify_new_news(context, title: str, scope: str = 'bot'):
 async def menu_register(query, context):
     """Главный экран регистрации — выбор роли."""
     uid = query.from_user.id
-    profile = await asyncio.to_thread(db.get_user_profile, uid)
+    profile = await adb.get_user_profile(uid)
 
     if profile:
         await show_profile(query, context)
@@ -1794,7 +1853,7 @@ async def menu_register(query, context):
 async def reg_role_teacher(query, context):
     """Учитель выбирает своё имя из списка."""
     uid = query.from_user.id
-    already = _tname(await asyncio.to_thread(db.find_teacher_by_telegram_id, uid))
+    already = _tname(await adb.find_teacher_by_telegram_id(uid))
     if already:
         await safe_edit(query,
             f"✅ Вы уже зарегистрированы как <b>{already}</b>.\n\n"
@@ -1805,7 +1864,7 @@ async def reg_role_teacher(query, context):
     page = context.user_data.get('reg_teacher_page', 0)
 
     # Убираем уже зарегистрированных из списка
-    registered = await asyncio.to_thread(db.get_registered_teacher_names)
+    registered = await adb.get_registered_teacher_names()
     available = [t for t in ALL_TEACHERS if t not in registered]
 
     if not available:
@@ -1853,8 +1912,8 @@ async def reg_role_student(query, context):
 
     # Уже зарегистрирован в любой роли — блокируем
     profile, _at = await asyncio.gather(
-        asyncio.to_thread(db.get_user_profile, uid),
-        asyncio.to_thread(db.find_teacher_by_telegram_id, uid),
+        adb.get_user_profile(uid),
+        adb.find_teacher_by_telegram_id(uid),
     )
     already_teacher = _tname(_at)
     if profile or already_teacher:
@@ -1883,8 +1942,8 @@ async def reg_role_parent(query, context):
 
     # Уже зарегистрирован в любой роли — блокируем
     profile, _at = await asyncio.gather(
-        asyncio.to_thread(db.get_user_profile, uid),
-        asyncio.to_thread(db.find_teacher_by_telegram_id, uid),
+        adb.get_user_profile(uid),
+        adb.find_teacher_by_telegram_id(uid),
     )
     already_teacher = _tname(_at)
     if profile or already_teacher:
@@ -1952,10 +2011,10 @@ async def reg_save(query, context, class_name: str):
     role = context.user_data.get('reg_role', 'student')
     name = context.user_data.get('reg_name', '')
 
-    ok = await asyncio.to_thread(db.save_user_profile, uid, role, name, class_name)
+    ok = await adb.save_user_profile(uid, role, name, class_name)
     if ok:
         # Автоматически подписываем на замены класса
-        await asyncio.to_thread(db.subscribe_class, uid, class_name)
+        await adb.subscribe_class(uid, class_name)
 
         role_emojis = {'student': '👨‍🎓', 'parent': '👨‍👩‍👧'}
         role_labels = {'student': 'Ученик', 'parent': 'Родитель'}
@@ -1998,8 +2057,8 @@ async def show_profile(query, context):
     """Показывает профиль пользователя."""
     uid = query.from_user.id
     profile, _t_raw = await asyncio.gather(
-        asyncio.to_thread(db.get_user_profile, uid),
-        asyncio.to_thread(db.find_teacher_by_telegram_id, uid),
+        adb.get_user_profile(uid),
+        adb.find_teacher_by_telegram_id(uid),
     )
     teacher_name = _tname(_t_raw)
 
@@ -2061,7 +2120,7 @@ async def reg_delete_confirm(query, context):
 
 async def reg_delete_do(query, context):
     uid = query.from_user.id
-    await asyncio.to_thread(db.delete_user_profile, uid)
+    await adb.delete_user_profile(uid)
     context.user_data.pop('profile_cache', None)
     context.user_data.pop('profile_cache_id', None)
     await safe_edit(query,
@@ -2074,7 +2133,7 @@ async def reg_delete_do(query, context):
 async def teacher_change_name(query, context):
     """Показывает список доступных имён для смены."""
     uid = query.from_user.id
-    t_data  = await asyncio.to_thread(db.find_teacher_by_telegram_id, uid)
+    t_data  = await adb.find_teacher_by_telegram_id(uid)
     current = _tname(t_data)
     if not current:
         await safe_edit(query, "❌ Вы не зарегистрированы как учитель.",
@@ -2082,7 +2141,7 @@ async def teacher_change_name(query, context):
         return
 
     # Список: все учителя кроме уже занятых (кроме текущего — его показываем с меткой)
-    registered = await asyncio.to_thread(db.get_registered_teacher_names)
+    registered = await adb.get_registered_teacher_names()
     # Убираем из заблокированных текущее имя — его можно "переподтвердить"
     registered.discard(current)
 
@@ -2125,7 +2184,7 @@ async def teacher_change_name(query, context):
 async def chname_pick(query, context, idx: int):
     """Подтверждение смены имени."""
     uid = query.from_user.id
-    t_data  = await asyncio.to_thread(db.find_teacher_by_telegram_id, uid)
+    t_data  = await adb.find_teacher_by_telegram_id(uid)
     current = _tname(t_data)
     if idx >= len(ALL_TEACHERS):
         await query.answer("❌ Ошибка", show_alert=True)
@@ -2140,7 +2199,7 @@ async def chname_pick(query, context, idx: int):
         return
 
     # Проверяем что имя ещё свободно
-    registered = await asyncio.to_thread(db.get_registered_teacher_names)
+    registered = await adb.get_registered_teacher_names()
     registered.discard(current)
     if new_name in registered:
         await safe_edit(query,
@@ -2163,7 +2222,7 @@ async def chname_pick(query, context, idx: int):
 async def chname_confirm(query, context, idx: int):
     """Выполняет смену имени."""
     uid     = query.from_user.id
-    t_data  = await asyncio.to_thread(db.find_teacher_by_telegram_id, uid)
+    t_data  = await adb.find_teacher_by_telegram_id(uid)
     current = _tname(t_data)   # строка
     if idx >= len(ALL_TEACHERS):
         await query.answer("❌ Ошибка", show_alert=True)
@@ -2172,7 +2231,7 @@ async def chname_confirm(query, context, idx: int):
     new_name = ALL_TEACHERS[idx]
 
     # Финальная проверка на занятость
-    registered = await asyncio.to_thread(db.get_registered_teacher_names)
+    registered = await adb.get_registered_teacher_names()
     registered.discard(current)
     if new_name in registered:
         await safe_edit(query,
@@ -2181,8 +2240,8 @@ async def chname_confirm(query, context, idx: int):
         return
 
     # Сбрасываем старое имя и регистрируем новое
-    await asyncio.to_thread(db.unregister_teacher, current)
-    ok = await asyncio.to_thread(db.register_teacher, new_name, uid)
+    await adb.unregister_teacher(current)
+    ok = await adb.register_teacher(new_name, uid)
 
     if ok:
         _teacher_schedule_cache.pop(current, None)
@@ -2219,7 +2278,7 @@ async def chname_confirm(query, context, idx: int):
 async def teacher_unlink_confirm(query, context):
     """Подтверждение отвязки аккаунта учителя."""
     uid = query.from_user.id
-    name = _tname(await asyncio.to_thread(db.find_teacher_by_telegram_id, uid))
+    name = _tname(await adb.find_teacher_by_telegram_id(uid))
     kb = [
         [btn("✅ Да, отвязать", 'teacher_unlink_do')],
         [btn("❌ Отмена",       'menu_profile')],
@@ -2234,10 +2293,10 @@ async def teacher_unlink_confirm(query, context):
 async def teacher_unlink_do(query, context):
     """Отвязывает Telegram ID от имени учителя."""
     uid    = query.from_user.id
-    t_data = await asyncio.to_thread(db.find_teacher_by_telegram_id, uid)
+    t_data = await adb.find_teacher_by_telegram_id(uid)
     name   = _tname(t_data)   # строка, не dict
     if name:
-        await asyncio.to_thread(db.unregister_teacher, name)
+        await adb.unregister_teacher(name)
         _teacher_schedule_cache.pop(name, None)
         # Сбрасываем кэш меню
         if context:
@@ -2342,8 +2401,8 @@ async def show_main_menu_msg(update: Update, context: CallbackContext):
     status_line = _main_menu_status_line(now, info, season_mode)
 
     profile, t_data = await asyncio.gather(
-        asyncio.to_thread(db.get_user_profile, user.id),
-        asyncio.to_thread(db.find_teacher_by_telegram_id, user.id),
+        adb.get_user_profile(user.id),
+        adb.find_teacher_by_telegram_id(user.id),
     )
     teacher_name = _tname(t_data)
     context.user_data['profile_cache'] = profile
@@ -2387,8 +2446,8 @@ async def show_main_menu_edit(query, context=None):
         teacher_name = context.user_data.get('teacher_name_cache')
     else:
         profile, t_data = await asyncio.gather(
-            asyncio.to_thread(db.get_user_profile, uid),
-            asyncio.to_thread(db.find_teacher_by_telegram_id, uid),
+            adb.get_user_profile(uid),
+            adb.find_teacher_by_telegram_id(uid),
         )
         teacher_name = _tname(t_data)
         if context:
@@ -2492,8 +2551,8 @@ async def global_error_handler(update: object, context: CallbackContext):
 
 async def cmd_start(update: Update, context: CallbackContext):
     user = update.effective_user
-    await asyncio.to_thread(
-        db.update_user_and_log, user.id, 'start', None,
+    await adb.update_user_and_log(
+        user.id, 'start', None,
         user.username, user.first_name, user.last_name, user.language_code
     )
     if await check_maintenance(update, context):
@@ -2522,8 +2581,8 @@ async def cmd_start(update: Update, context: CallbackContext):
         referrer_id = _to_int(start_param[4:], 0)
         if referrer_id > 0:
             try:
-                ref_result = await asyncio.to_thread(
-                    db.attach_game_referral, referrer_id, user.id, user.first_name
+                ref_result = await adb.attach_game_referral(
+                    referrer_id, user.id, user.first_name
                 )
                 status = str((ref_result or {}).get('status') or '')
                 if status == 'attached':
@@ -2550,7 +2609,7 @@ async def cmd_start(update: Update, context: CallbackContext):
         await update.message.reply_text(referral_notice, parse_mode='HTML')
 
     # Уведомление о новых новостях
-    new_cnt = await asyncio.to_thread(db.count_new_news_since, user.id)
+    new_cnt = await adb.count_new_news_since(user.id)
     if new_cnt > 0 and not context.user_data.get('news_shown'):
         context.user_data['news_shown'] = True
         kb = [
@@ -2573,7 +2632,7 @@ async def cmd_start(update: Update, context: CallbackContext):
 async def cmd_teacher(update: Update, context: CallbackContext):
     """Учитель вводит /teacher и своё имя для привязки Telegram-ID."""
     user = update.effective_user
-    already = _tname(await asyncio.to_thread(db.find_teacher_by_telegram_id, user.id))
+    already = _tname(await adb.find_teacher_by_telegram_id(user.id))
     if already:
         await update.message.reply_text(
             f"✅ Вы уже зарегистрированы как <b>{already}</b>.\n"
@@ -2584,7 +2643,7 @@ async def cmd_teacher(update: Update, context: CallbackContext):
 
     context.user_data['registering_teacher'] = True
     # Показываем список
-    teachers_db = await asyncio.to_thread(db.get_all_teachers_db)
+    teachers_db = await adb.get_all_teachers_db()
     names = [t[0] for t in teachers_db]
     if not names:
         await update.message.reply_text("❌ Список учителей ещё не заполнен.")
@@ -2753,8 +2812,7 @@ async def show_current_lesson(query, context):
         nxt_lesson = next((l for l in lessons if l[0] == nxt), None)
         if nxt_lesson:
             text += f"📚 <b>{nxt_lesson[1]}</b>\n👨‍🏫 {nxt_lesson[2]}\n"
-            subs = await asyncio.to_thread(db.get_substitutions_for_class_date,
-                                           class_name, today_str)
+            subs = await adb.get_substitutions_for_class_date(class_name, today_str)
             sub = next((s for s in subs if s[3] == nxt), None)
             if sub:
                 text += f"⚠️ <b>ЗАМЕНА:</b> {sub[5]} — {sub[7]}\n"
@@ -2768,8 +2826,7 @@ async def show_current_lesson(query, context):
         cur_lesson = next((l for l in lessons if l[0] == num), None)
         if cur_lesson:
             text += f"📚 <b>{cur_lesson[1]}</b>\n👨‍🏫 {cur_lesson[2]}\n"
-            subs = await asyncio.to_thread(db.get_substitutions_for_class_date,
-                                           class_name, today_str)
+            subs = await adb.get_substitutions_for_class_date(class_name, today_str)
             sub = next((s for s in subs if s[3] == num), None)
             if sub:
                 text += f"⚠️ <b>ЗАМЕНА:</b> {sub[5]} — {sub[7]}\n"
@@ -2826,7 +2883,7 @@ async def menu_day_schedule(query, context):
     lessons = SCHEDULE_STRUCTURED.get(cls, {}).get(day, [])
     text = await format_day_schedule(cls, day, lessons, target_str)
 
-    is_fav = await asyncio.to_thread(db.is_favorite, query.from_user.id, 'class', cls)
+    is_fav = await adb.is_favorite(query.from_user.id, 'class', cls)
     fav_text = "🗑 Убрать из избранного" if is_fav else "⭐ В избранное"
 
     kb = [
@@ -2844,7 +2901,7 @@ async def menu_week_schedule(query, context):
     context.user_data['sel_class'] = cls
     text = format_week_schedule(cls)
 
-    is_fav = await asyncio.to_thread(db.is_favorite, query.from_user.id, 'class', cls)
+    is_fav = await adb.is_favorite(query.from_user.id, 'class', cls)
     fav_text = "🗑 Убрать из избранного" if is_fav else "⭐ В избранное"
 
     kb = [
@@ -2894,7 +2951,7 @@ async def show_teacher(query, context, teacher_name: str):
     schedule = get_teacher_schedule(teacher_name)
     text = await format_teacher_schedule_text(teacher_name, schedule)
 
-    is_fav = await asyncio.to_thread(db.is_favorite, query.from_user.id, 'teacher', teacher_name)
+    is_fav = await adb.is_favorite(query.from_user.id, 'teacher', teacher_name)
     fav_text = "🗑 Убрать из избранного" if is_fav else "⭐ В избранное"
     idx = ALL_TEACHERS.index(teacher_name)
 
@@ -2910,7 +2967,7 @@ async def show_teacher(query, context, teacher_name: str):
 # ══════════════════════════════════════════════════════════
 async def menu_my(query, context):
     uid = query.from_user.id
-    favs = await asyncio.to_thread(db.get_user_favorites, uid)
+    favs = await adb.get_user_favorites(uid)
     if not favs:
         kb = [
             [btn("📚 Классы", 'menu_schedule'), btn("👨‍🏫 Учителя", 'menu_teacher')],
@@ -2970,7 +3027,7 @@ async def show_subs_for_date(query, context):
     target = today + timedelta(days=offsets.get(query.data, 0))
     target_str = target.strftime('%Y-%m-%d')
 
-    subs = await asyncio.to_thread(db.get_substitutions_for_date, target_str)
+    subs = await adb.get_substitutions_for_date(target_str)
     wd = target.weekday()
     day_name = DAYS_OF_WEEK[wd] if wd < 5 else ("Суббота" if wd == 5 else "Воскресенье")
 
@@ -2992,7 +3049,7 @@ async def show_subs_for_date(query, context):
 async def show_all_subs(query, context):
     if await _season_block_if_summer(query, "Замены"):
         return
-    subs = await asyncio.to_thread(db.get_all_substitutions, 100)
+    subs = await adb.get_all_substitutions(100)
     if not subs:
         text = "Замен нет."
     else:
@@ -3095,7 +3152,7 @@ async def menu_news_scope(query, context, scope: str, page: int = 0):
 
     per_page = 8
     offset = page * per_page
-    news_list, total = await asyncio.to_thread(db.get_news_page_with_count, offset, per_page, scope)
+    news_list, total = await adb.get_news_page_with_count(offset, per_page, scope)
     total_pages = max(1, -(-total // per_page))
 
     kb = [[*news_scope_switch_row(scope)]]
@@ -3144,10 +3201,10 @@ async def show_news_full(query, context, news_id: int, scope: str | None = None,
     resolved_page = page
     if resolved_page is None:
         resolved_page = int(context.user_data.get(f'news_page_{resolved_scope}', 0) or 0)
-    news = await asyncio.to_thread(db.get_news_detail_and_increment, news_id, query.from_user.id, resolved_scope)
+    news = await adb.get_news_detail_and_increment(news_id, query.from_user.id, resolved_scope)
     if not news:
         # Новость могла быть перенесена в другой раздел — ищем без фильтра.
-        news = await asyncio.to_thread(db.get_news_detail_and_increment, news_id, query.from_user.id)
+        news = await adb.get_news_detail_and_increment(news_id, query.from_user.id)
         if not news:
             await query.answer("❌ Новость не найдена", show_alert=True)
             return
@@ -3183,7 +3240,7 @@ async def show_news_full(query, context, news_id: int, scope: str | None = None,
 async def move_news_scope(query, context, news_id: int, target_scope: str):
     """Переносит новость между разделами «школа/бот»."""
     target = normalize_news_scope(target_scope, NEWS_SCOPE_BOT)
-    ok = await asyncio.to_thread(db.update_news_scope, news_id, target)
+    ok = await adb.update_news_scope(news_id, target)
     if not ok:
         await query.answer("❌ Не удалось перенести новость", show_alert=True)
         return
@@ -3362,10 +3419,9 @@ def build_git_project_changes(limit: int = 12) -> list[dict]:
 async def seed_git_project_update_log():
     git_changes = await asyncio.to_thread(build_git_project_changes)
     active_keys = [item['dedupe_key'] for item in git_changes]
-    await asyncio.to_thread(db.mark_stale_project_changes_used_by_source, 'git', active_keys)
+    await adb.mark_stale_project_changes_used_by_source('git', active_keys)
     for item in git_changes:
-        await asyncio.to_thread(
-            db.add_project_change,
+        await adb.add_project_change(
             item['scope'],
             item['title'],
             item['details'],
@@ -3379,8 +3435,7 @@ async def seed_git_project_update_log():
 async def seed_project_update_log():
     """Записывает встроенные изменения в БД один раз, чтобы автоновость не зависела от git."""
     for item in PROJECT_UPDATES:
-        await asyncio.to_thread(
-            db.add_project_change,
+        await adb.add_project_change(
             item.get('scope') or 'bot',
             item.get('title') or 'Обновление',
             item.get('text') or '',
@@ -3415,8 +3470,8 @@ async def build_auto_news_draft():
     """Собирает заголовок, текст и id изменений для автоматического черновика новости."""
     await seed_project_update_log()
     changes, recent_news = await asyncio.gather(
-        asyncio.to_thread(db.get_project_changes, 20, True),
-        asyncio.to_thread(db.get_recent_news, 50, NEWS_SCOPE_BOT),
+        adb.get_project_changes(20, True),
+        adb.get_recent_news(50, NEWS_SCOPE_BOT),
     )
     if not changes:
         return None, None, []
@@ -3558,9 +3613,9 @@ async def do_publish_news(query, context, send_to_all: bool):
         _clear_flow(context)
         return
 
-    news_id = await asyncio.to_thread(db.add_news, title, content, news_scope)
+    news_id = await adb.add_news(title, content, news_scope)
     if auto_change_ids and news_scope == NEWS_SCOPE_BOT:
-        await asyncio.to_thread(db.mark_project_changes_used, auto_change_ids)
+        await adb.mark_project_changes_used(auto_change_ids)
     _clear_flow(context)
 
     result_text = (
@@ -3584,7 +3639,7 @@ async def do_publish_news(query, context, send_to_all: bool):
 #  НОВОСТИ: РЕДАКТИРОВАНИЕ (АДМИН)
 # ══════════════════════════════════════════════════════════
 async def start_edit_news(query, context, news_id: int):
-    news = await asyncio.to_thread(db.get_news_detail, news_id)
+    news = await adb.get_news_detail(news_id)
     if not news:
         await query.answer("❌ Новость не найдена", show_alert=True)
         return
@@ -3628,7 +3683,7 @@ async def handle_edit_news_input(update: Update, context: CallbackContext):
             return
         new_title = context.user_data['edit_new_title']
         old_scope = normalize_news_scope(context.user_data.get('edit_old_scope'), NEWS_SCOPE_BOT)
-        success = await asyncio.to_thread(db.update_news, news_id, new_title, text, old_scope)
+        success = await adb.update_news(news_id, new_title, text, old_scope)
         _clear_flow(context)
         if success:
             kb = [[btn("📰 К новостям", f'news_scope_{old_scope}')]]
@@ -3647,7 +3702,7 @@ async def _get_cached_game_mode() -> str:
     import time
     global _game_mode_cache, _game_mode_cache_ts
     if time.time() - _game_mode_cache_ts > 30:
-        _game_mode_cache = await asyncio.to_thread(db.get_game_access_mode)
+        _game_mode_cache = await adb.get_game_access_mode()
         _game_mode_cache_ts = time.time()
     if _game_mode_cache not in ('beta', 'open', 'closed'):
         _game_mode_cache = 'beta'
@@ -3665,7 +3720,7 @@ async def is_game_allowed(user_id: int) -> bool:
 
     game_role = None
     try:
-        game_role = await asyncio.to_thread(db.get_game_role, user_id)
+        game_role = await adb.get_game_role(user_id)
     except Exception:
         game_role = None
 
@@ -3682,7 +3737,7 @@ async def is_game_allowed(user_id: int) -> bool:
 
     # beta mode
     if time.time() - _beta_cache_ts > 60:
-        rows = await asyncio.to_thread(db.get_beta_users)
+        rows = await adb.get_beta_users()
         _beta_cache = {r[0] for r in rows}
         _beta_cache_ts = time.time()
     return user_id in _beta_cache
@@ -3712,8 +3767,8 @@ async def menu_game(query, context):
 
     # Регистрируем при первом открытии + получаем роль
     try:
-        reg_task  = asyncio.to_thread(db.register_game_player, user.id, user.first_name)
-        role_task = asyncio.to_thread(db.get_game_role, user.id)
+        reg_task  = adb.register_game_player(user.id, user.first_name)
+        role_task = adb.get_game_role(user.id)
         _, current_role = await asyncio.gather(reg_task, role_task)
     except Exception as e:
         logger.warning(f"menu_game: DB error registering player: {e}")
@@ -3721,7 +3776,7 @@ async def menu_game(query, context):
     if not current_role:
         role = 'player'
         try:
-            await asyncio.to_thread(db.set_game_role, user.id, role)
+            await adb.set_game_role(user.id, role)
         except Exception:
             pass
         current_role = role
@@ -3734,12 +3789,12 @@ async def menu_game(query, context):
     }
     try:
         tasks = [
-            asyncio.to_thread(db.get_game_result, user.id),
-            asyncio.to_thread(db.get_chapter_schedule_for_game),
+            adb.get_game_result(user.id),
+            adb.get_chapter_schedule_for_game(),
         ]
         if current_role == 'player':
-            tasks.append(asyncio.to_thread(db.get_game_player_rank, user.id))
-            tasks.append(asyncio.to_thread(db.get_referral_summary, user.id))
+            tasks.append(adb.get_game_player_rank(user.id))
+            tasks.append(adb.get_referral_summary(user.id))
         gathered = await asyncio.gather(*tasks)
         my_result = gathered[0]
         chapter_schedule = gathered[1]
@@ -3765,13 +3820,13 @@ async def menu_game(query, context):
     else:  # player
         # Только индивидуально + глобально открытые
         try:
-            accessible = await asyncio.to_thread(db.get_player_accessible_chapters, user.id)
+            accessible = await adb.get_player_accessible_chapters(user.id)
         except Exception:
             accessible = set()
         # Если у игрока нет доступных глав — автоматически открываем главу 1
         if not accessible:
             try:
-                await asyncio.to_thread(db.open_chapter, 1)
+                await adb.open_chapter(1)
                 accessible = {1}
                 logger.info(f"Auto-opened chapter 1 for player {user.id} (no chapters accessible)")
             except Exception as e:
@@ -3783,7 +3838,7 @@ async def menu_game(query, context):
 
     # Leaderboard — только для рейтинга (игроки)
     try:
-        lb_rows = await asyncio.to_thread(db.get_game_leaderboard, 20)
+        lb_rows = await adb.get_game_leaderboard(20)
     except Exception:
         lb_rows = []
 
@@ -3799,7 +3854,7 @@ async def menu_game(query, context):
     restart_mode = None
     if my_result:
         try:
-            restart_mode = await asyncio.to_thread(db.get_restart_mode, user.id)
+            restart_mode = await adb.get_restart_mode(user.id)
         except Exception:
             restart_mode = None
         my_data = {
@@ -3986,7 +4041,7 @@ async def game_ref_invite(query, context):
         )
         return
 
-    summary = await asyncio.to_thread(db.get_referral_summary, uid)
+    summary = await adb.get_referral_summary(uid)
     invited_count = int(summary.get('invited_count', 0) or 0)
     bonus_points = int(summary.get('bonus_points', 0) or 0)
     active_count = int(summary.get('active_count', 0) or 0)
@@ -4033,8 +4088,8 @@ async def game_ref_stats(query, context):
     """Shows referral stats and invited players list."""
     uid = query.from_user.id
     summary, agents = await asyncio.gather(
-        asyncio.to_thread(db.get_referral_summary, uid),
-        asyncio.to_thread(db.get_referral_agents, uid, 15),
+        adb.get_referral_summary(uid),
+        adb.get_referral_agents(uid, 15),
     )
     invited_count = int(summary.get('invited_count', 0) or 0)
     bonus_points = int(summary.get('bonus_points', 0) or 0)
@@ -4078,7 +4133,9 @@ async def game_restart_select(query, context, uid, mode):
     if query.from_user.id != uid:
         await query.answer("⛔ Это не ваша кнопка"); return
     await query.answer()
-    ok = await asyncio.to_thread(db.reset_game_result_soft, uid, mode)
+    ok = await adb.reset_game_result_soft(uid, mode)
+    if ok:
+        game_events.publish_user(uid, 'reset')
     if ok:
         label = "🔥 Режим +10 сек установлен" if mode == 'penalty' else "👁 Режим без очков установлен"
         await safe_edit(query,
@@ -4092,7 +4149,7 @@ async def game_restart_select(query, context, uid, mode):
 async def game_admin_self_reset(query, context):
     """Сброс собственного рейтинга для администратора."""
     uid = query.from_user.id
-    role = await asyncio.to_thread(db.get_game_role, uid)
+    role = await adb.get_game_role(uid)
     if role != 'admin':
         await query.answer("⛔ Только администратор может сбросить свой рейтинг", show_alert=True)
         return
@@ -4113,12 +4170,14 @@ async def game_admin_self_reset(query, context):
 async def game_admin_self_reset_confirm(query, context, drop_referrals: bool = False):
     """Подтверждение сброса рейтинга администратора."""
     uid = query.from_user.id
-    role = await asyncio.to_thread(db.get_game_role, uid)
+    role = await adb.get_game_role(uid)
     if role != 'admin':
         await query.answer("⛔ Только администратор", show_alert=True)
         return
     await query.answer()
-    ok = await asyncio.to_thread(db.reset_game_result_full, uid, drop_referrals)
+    ok = await adb.reset_game_result_full(uid, drop_referrals)
+    if ok:
+        game_events.publish_user(uid, 'reset')
     mode_label = "с агентами" if drop_referrals else "без удаления агентов"
     await safe_edit(query,
         f"✅ <b>Ваш рейтинг сброшен ({mode_label}).</b>\n\n"
@@ -4131,8 +4190,8 @@ async def game_leaderboard(query, context):
     """Таблица лидеров из БД — актуальные данные."""
     await query.answer()
     lb, total = await asyncio.gather(
-        asyncio.to_thread(db.get_game_leaderboard_with_roles, 20),
-        asyncio.to_thread(db.get_game_players_count),
+        adb.get_game_leaderboard_with_roles(20),
+        adb.get_game_players_count(),
     )
     uid_me = query.from_user.id
 
@@ -4169,7 +4228,7 @@ async def game_leaderboard(query, context):
     # Позиция текущего игрока если не в топ-20
     my_pos = next((i+1 for i,(uid,*_) in enumerate(lb) if uid==uid_me), None)
     if not my_pos:
-        my_res = await asyncio.to_thread(db.get_game_result, uid_me)
+        my_res = await adb.get_game_result(uid_me)
         if my_res:
             _, _, my_score, my_comp, *_ = my_res
             pct = round((my_comp / 6) * 100)
@@ -4211,19 +4270,18 @@ async def handle_web_app_data(update: Update, context: CallbackContext):
 
     # Сохраняем в БД + проверяем роль параллельно
     _, current_role = await asyncio.gather(
-        asyncio.to_thread(
-            db.save_game_result,
+        adb.save_game_result(
             user.id, user_name, chapter, score, total_score,
             completed, game_over, failed
         ),
-        asyncio.to_thread(db.get_game_role, user.id),
+        adb.get_game_role(user.id),
     )
     logger.info(f"game_result saved: user={user.id} ({user_name}), type={event_type}, "
                 f"chapter={chapter}, score={score}, total={total_score}, completed={completed}")
 
     # Автоматически назначаем роль
     if not current_role:
-        await asyncio.to_thread(db.set_game_role, user.id, 'player')
+        await adb.set_game_role(user.id, 'player')
 
     if event_type == 'chapter_complete':
         ch_title = data.get('chapter_title', f'Глава {chapter}')
@@ -4287,8 +4345,8 @@ async def menu_ai(query, context):
             BACK_TO_MAIN)
         return
 
-    is_teacher = await asyncio.to_thread(
-        db.find_teacher_by_telegram_id, query.from_user.id
+    is_teacher = await adb.find_teacher_by_telegram_id(
+        query.from_user.id
     )
     role_text = "педагога" if is_teacher else "школьника"
     hist_size = len(AI_HISTORY.get(query.from_user.id, []))
@@ -4363,7 +4421,8 @@ async def set_maintenance(query, context, duration: str):
     elif duration == 'tomorrow':
         until = (now + timedelta(days=1)).replace(hour=8, minute=0).strftime('%d.%m %H:%M')
 
-    await asyncio.to_thread(db.set_maintenance_mode, True, until, None)
+    await adb.set_maintenance_mode(True, until, None)
+    game_events.publish_settings('maintenance')
     global _maintenance_cache
     _maintenance_cache = {'enabled': True, 'until': until, 'message': None,
                           'last_check': datetime.min}
@@ -4375,7 +4434,8 @@ async def set_maintenance(query, context, duration: str):
 
 
 async def admin_disable_maintenance(query, context):
-    await asyncio.to_thread(db.set_maintenance_mode, False)
+    await adb.set_maintenance_mode(False)
+    game_events.publish_settings('maintenance')
     global _maintenance_cache
     _maintenance_cache = {'enabled': False, 'until': None, 'message': None,
                           'last_check': datetime.min}
@@ -4429,7 +4489,7 @@ async def admin_set_season_mode(query, context, mode: str):
         await query.answer("⛔"); return
 
     mode_norm = _normalize_season_mode(mode)
-    ok = await asyncio.to_thread(db.set_season_mode, mode_norm)
+    ok = await adb.set_season_mode(mode_norm)
     global _season_mode_cache
     _season_mode_cache = {
         'mode': mode_norm if ok else 'auto',
@@ -4519,7 +4579,7 @@ async def handle_sub_flow(query, context):
                 'sub_old_teacher': lesson[2].split('/')[0].strip(),
                 'sub_step': 'new_teacher',
             })
-        teachers_db = await asyncio.to_thread(db.get_all_teachers_db)
+        teachers_db = await adb.get_all_teachers_db()
         names = [t[0] for t in teachers_db]
         kb = []
         for i in range(0, len(names), 2):
@@ -4547,8 +4607,7 @@ async def handle_sub_flow(query, context):
         subject     = context.user_data['sub_subject']
         old_teacher = context.user_data['sub_old_teacher']
 
-        await asyncio.to_thread(
-            db.add_substitution,
+        await adb.add_substitution(
             date_str, day, num, subject, subject, old_teacher, new_teacher, cls
         )
         sub_data = {
@@ -4587,7 +4646,7 @@ async def admin_roles_panel(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    players = await asyncio.to_thread(db.get_game_leaderboard_with_roles, 50)
+    players = await adb.get_game_leaderboard_with_roles(50)
     if not players:
         await safe_edit(query,
             "🎭 <b>РОЛИ ИГРОКОВ</b>\n\nПока никто не играл.",
@@ -4612,8 +4671,8 @@ async def admin_role_pick(query, context, uid):
         await query.answer("⛔"); return
     await query.answer()
 
-    current = await asyncio.to_thread(db.get_game_role, uid)
-    result  = await asyncio.to_thread(db.get_game_result_detail, uid)
+    current = await adb.get_game_role(uid)
+    result  = await adb.get_game_result_detail(uid)
     name    = result[1] if result else f"ID {uid}"
 
     role_icon = {'admin': '👑', 'tester': '🧪', 'player': '🎮'}
@@ -4639,9 +4698,11 @@ async def admin_role_set(query, context, uid, role):
         await query.answer("⛔"); return
     await query.answer()
 
-    ok = await asyncio.to_thread(db.set_game_role, uid, role)
+    ok = await adb.set_game_role(uid, role)
+    if ok:
+        game_events.publish_user(uid, 'role')
     role_icon = {'admin': '👑', 'tester': '🧪', 'player': '🎮'}
-    result    = await asyncio.to_thread(db.get_game_result_detail, uid)
+    result    = await adb.get_game_result_detail(uid)
     name      = result[1] if result else f"ID {uid}"
 
     await safe_edit(query,
@@ -4668,7 +4729,7 @@ async def admin_chapters_panel(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    chapters = await asyncio.to_thread(db.get_chapters_status)
+    chapters = await adb.get_chapters_status()
     tz = pytz.timezone('Europe/Minsk')
 
     lines = ["📖 <b>УПРАВЛЕНИЕ ГЛАВАМИ</b>\n"]
@@ -4703,7 +4764,9 @@ async def admin_chapters_open_all(query, context):
     if not await is_bot_admin_async(query.from_user.id):
         await query.answer("⛔"); return
     await query.answer()
-    ok = await asyncio.to_thread(db.open_all_chapters)
+    ok = await adb.open_all_chapters()
+    if ok:
+        game_events.publish_settings('chapters')
     await safe_edit(query,
         "✅ Все 6 глав открыты для всех игроков!",
         [[btn("↩️ Управление главами", 'admin_chapters_panel'), btn("🏠 Меню", 'back_to_main')]])
@@ -4717,7 +4780,9 @@ async def handle_chapter_action(query, context, data):
 
     if data.startswith('ach_open_'):
         ch_id = int(data.replace('ach_open_', ''))
-        ok = await asyncio.to_thread(db.open_chapter, ch_id)
+        ok = await adb.open_chapter(ch_id)
+        if ok:
+            game_events.publish_settings('chapters')
         name = CHAPTER_NAMES.get(ch_id, f"Глава {ch_id}")
         await safe_edit(query,
             f"✅ Глава {ch_id} «{name}» открыта для всех игроков!",
@@ -4725,7 +4790,9 @@ async def handle_chapter_action(query, context, data):
 
     elif data.startswith('ach_close_'):
         ch_id = int(data.replace('ach_close_', ''))
-        ok = await asyncio.to_thread(db.close_chapter, ch_id)
+        ok = await adb.close_chapter(ch_id)
+        if ok:
+            game_events.publish_settings('chapters')
         name = CHAPTER_NAMES.get(ch_id, f"Глава {ch_id}")
         await safe_edit(query,
             f"🔒 Глава {ch_id} «{name}» закрыта.",
@@ -4754,7 +4821,9 @@ async def handle_schedule_input(update, context, text):
     try:
         dt_naive = datetime.strptime(text.strip(), '%d.%m.%Y %H:%M')
         dt_aware = tz.localize(dt_naive)
-        ok = await asyncio.to_thread(db.schedule_chapter, ch_id, dt_aware)
+        ok = await adb.schedule_chapter(ch_id, dt_aware)
+        if ok:
+            game_events.publish_settings('chapters')
         name = CHAPTER_NAMES.get(ch_id, f"Глава {ch_id}")
         dt_str = dt_aware.strftime('%d.%m.%Y в %H:%M')
         await update.message.reply_text(
@@ -4779,7 +4848,7 @@ async def admin_player_chapters(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    players = await asyncio.to_thread(db.get_players_only, 50)
+    players = await adb.get_players_only(50)
     if not players:
         await safe_edit(query,
             "🔑 <b>ДОСТУП К ГЛАВАМ</b>\n\nОбычных игроков пока нет.",
@@ -4804,18 +4873,18 @@ async def admin_player_chapters_view(query, context, target_uid):
     await query.answer()
 
     admin_uid = query.from_user.id
-    uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+    uinfo = await adb.get_user_info(target_uid)
     name = (uinfo.get('first_name') or uinfo.get('username') or str(target_uid)) if uinfo else str(target_uid)
 
     # Открытые этому игроку главы (индивидуально)
-    individual = await asyncio.to_thread(db.get_player_chapter_access_map, target_uid)
+    individual = await adb.get_player_chapter_access_map(target_uid)
     # Глобально открытые
-    global_open = await asyncio.to_thread(db.get_open_chapters)
+    global_open = await adb.get_open_chapters()
     # Итоговые доступные
     accessible = individual | global_open
 
     tz = pytz.timezone('Europe/Minsk')
-    chapters_status = await asyncio.to_thread(db.get_chapters_status)
+    chapters_status = await adb.get_chapters_status()
     chapter_sched = {r[0]: r for r in chapters_status}
 
     lines = [f"🔑 <b>ДОСТУП К ГЛАВАМ: {name}</b>\n",
@@ -4865,8 +4934,10 @@ async def handle_player_chapter_action(query, context, data):
 
     if data.startswith('apc_grant_all_'):
         target_uid = int(data.replace('apc_grant_all_', ''))
-        ok = await asyncio.to_thread(db.grant_all_chapters_to_player, target_uid, admin_uid)
-        uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+        ok = await adb.grant_all_chapters_to_player(target_uid, admin_uid)
+        if ok:
+            game_events.publish_user(target_uid, 'chapters')
+        uinfo = await adb.get_user_info(target_uid)
         name = (uinfo.get('first_name') or str(target_uid)) if uinfo else str(target_uid)
         await safe_edit(query,
             f"✅ Все 6 глав открыты для игрока <b>{name}</b>." if ok else "❌ Ошибка.",
@@ -4875,8 +4946,10 @@ async def handle_player_chapter_action(query, context, data):
     elif data.startswith('apc_revoke_all_confirm_'):
         # Подтверждение — ОБЯЗАТЕЛЬНО до apc_revoke_all_
         target_uid = int(data.replace('apc_revoke_all_confirm_', ''))
-        ok = await asyncio.to_thread(db.revoke_all_chapters_from_player, target_uid)
-        uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+        ok = await adb.revoke_all_chapters_from_player(target_uid)
+        if ok:
+            game_events.publish_user(target_uid, 'chapters')
+        uinfo = await adb.get_user_info(target_uid)
         name = (uinfo.get('first_name') or str(target_uid)) if uinfo else str(target_uid)
         await safe_edit(query,
             f"✅ Индивидуальный доступ к главам для <b>{name}</b> закрыт." if ok else "❌ Ошибка.",
@@ -4885,7 +4958,7 @@ async def handle_player_chapter_action(query, context, data):
     elif data.startswith('apc_revoke_all_'):
         # Запрос подтверждения — после confirm_
         target_uid = int(data.replace('apc_revoke_all_', ''))
-        uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+        uinfo = await adb.get_user_info(target_uid)
         name = (uinfo.get('first_name') or str(target_uid)) if uinfo else str(target_uid)
         await safe_edit(query,
             f"⚠️ Закрыть ВСЕ индивидуальные главы для <b>{name}</b>?\n\n"
@@ -4899,8 +4972,10 @@ async def handle_player_chapter_action(query, context, data):
         # apc_grant_{uid}_{ch_id}
         parts = data.replace('apc_grant_', '').split('_')
         target_uid, ch_id = int(parts[0]), int(parts[1])
-        ok = await asyncio.to_thread(db.grant_chapter_to_player, target_uid, ch_id, admin_uid)
-        uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+        ok = await adb.grant_chapter_to_player(target_uid, ch_id, admin_uid)
+        if ok:
+            game_events.publish_user(target_uid, 'chapters')
+        uinfo = await adb.get_user_info(target_uid)
         name = (uinfo.get('first_name') or str(target_uid)) if uinfo else str(target_uid)
         ch_name = CHAPTER_NAMES.get(ch_id, f"Глава {ch_id}")
         await safe_edit(query,
@@ -4911,8 +4986,10 @@ async def handle_player_chapter_action(query, context, data):
         # apc_revoke_{uid}_{ch_id}
         parts = data.replace('apc_revoke_', '').split('_')
         target_uid, ch_id = int(parts[0]), int(parts[1])
-        ok = await asyncio.to_thread(db.revoke_chapter_from_player, target_uid, ch_id)
-        uinfo = await asyncio.to_thread(db.get_user_info, target_uid)
+        ok = await adb.revoke_chapter_from_player(target_uid, ch_id)
+        if ok:
+            game_events.publish_user(target_uid, 'chapters')
+        uinfo = await adb.get_user_info(target_uid)
         name = (uinfo.get('first_name') or str(target_uid)) if uinfo else str(target_uid)
         ch_name = CHAPTER_NAMES.get(ch_id, f"Глава {ch_id}")
         await safe_edit(query,
@@ -4930,7 +5007,7 @@ async def admin_game_roles(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    rows = await asyncio.to_thread(db.get_game_leaderboard, 30)
+    rows = await adb.get_game_leaderboard(30)
     if not rows:
         await safe_edit(query, "ℹ️ Нет игроков.", [[btn("↩️ Назад", 'game_leaderboard')]])
         return
@@ -4965,7 +5042,9 @@ async def handle_game_role_action(query, context, data):
     role  = parts[1]         # admin / tester / player
     uid   = int(parts[2])    # user_id
 
-    ok = await asyncio.to_thread(db.set_game_role, uid, role)
+    ok = await adb.set_game_role(uid, role)
+    if ok:
+        game_events.publish_user(uid, 'role')
     role_name = {'admin': 'Администратор 👑', 'tester': 'Тестировщик 🧪', 'player': 'Игрок 🎮'}.get(role, role)
     await safe_edit(query,
         f"✅ Роль изменена\nID: <code>{uid}</code>\nНовая роль: <b>{role_name}</b>",
@@ -4981,7 +5060,7 @@ async def admin_beta_panel(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    users = await asyncio.to_thread(db.get_beta_users)
+    users = await adb.get_beta_users()
     beta_on = len(users) > 0
 
     if beta_on:
@@ -5027,7 +5106,7 @@ async def admin_beta_remove(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    users = await asyncio.to_thread(db.get_beta_users)
+    users = await adb.get_beta_users()
     if not users:
         await safe_edit(query, "ℹ️ Список тестеров пуст.",
             [[btn("↩️ Бета-панель", 'admin_beta_panel')]]); return
@@ -5061,7 +5140,7 @@ async def admin_beta_clear_do(query, context):
     # Сбрасываем кэш
     global _beta_cache, _beta_cache_ts
     _beta_cache = set(); _beta_cache_ts = 0
-    deleted = await asyncio.to_thread(db.clear_beta_list)
+    deleted = await adb.clear_beta_list()
     await safe_edit(query,
         f"✅ Белый список очищен ({deleted} тестеров удалено).\n"
         f"Игра теперь <b>доступна всем</b>.",
@@ -5077,11 +5156,11 @@ async def handle_beta_add_input(update, context, text):
         try:
             uid = int(part)
             # Пробуем найти имя в БД пользователей
-            uinfo = await asyncio.to_thread(db.get_user_info, uid) if hasattr(db, 'get_user_info') else None
+            uinfo = await adb.get_user_info(uid) if hasattr(db, 'get_user_info') else None
             uname = None
             if uinfo and isinstance(uinfo, dict):
                 uname = uinfo.get('first_name') or uinfo.get('username')
-            ok = await asyncio.to_thread(db.add_beta_user, uid, uname)
+            ok = await adb.add_beta_user(uid, uname)
             if ok: added.append(str(uid))
             else:  failed.append(str(uid))
         except ValueError:
@@ -5109,9 +5188,9 @@ async def admin_game_panel(query, context):
     await query.answer()
 
     rows, access_mode, beta_users = await asyncio.gather(
-        asyncio.to_thread(db.get_game_leaderboard_admin, 50),
-        asyncio.to_thread(db.get_game_access_mode),
-        asyncio.to_thread(db.get_beta_users),
+        adb.get_game_leaderboard_admin(50),
+        adb.get_game_access_mode(),
+        adb.get_beta_users(),
     )
     total = len(rows)
     finished = sum(1 for r in rows if r[4])
@@ -5170,7 +5249,7 @@ async def admin_set_game_mode(query, context, mode: str):
     if not await is_bot_admin_async(query.from_user.id):
         await query.answer("⛔"); return
     await query.answer()
-    ok = await asyncio.to_thread(db.set_game_access_mode, mode)
+    ok = await adb.set_game_access_mode(mode)
     global _game_mode_cache, _game_mode_cache_ts, _beta_cache, _beta_cache_ts
     _game_mode_cache = mode if ok else _game_mode_cache
     _game_mode_cache_ts = 0
@@ -5186,7 +5265,7 @@ async def admin_game_leaderboard(query, context):
         await query.answer("⛔ Доступ запрещён"); return
     await query.answer()
 
-    rows = await asyncio.to_thread(db.get_game_leaderboard_admin, 30)
+    rows = await adb.get_game_leaderboard_admin(30)
     if not rows:
         await safe_edit(query,
             "🎮 <b>Игроков пока нет</b>\n\nНикто не начал игру.",
@@ -5213,7 +5292,7 @@ async def admin_game_view_player(query, context, uid):
         await query.answer("⛔"); return
     await query.answer()
 
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     if not r:
         await safe_edit(query, "❌ Игрок не найден.",
             [[btn("↩️ Список", 'admin_game_leaderboard'), btn("🏠 Меню", 'back_to_main')]]); return
@@ -5252,7 +5331,7 @@ async def admin_game_reset_player(query, context, uid):
         await query.answer("⛔"); return
     await query.answer()
 
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = (r[1] if r else str(uid)) or str(uid)
     game_over = r[4] if r and len(r) > 4 else False
 
@@ -5292,10 +5371,12 @@ async def admin_game_restart_penalty(query, context, uid):
     if not await is_bot_admin_async(query.from_user.id):
         await query.answer("⛔"); return
     await query.answer()
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = (r[1] if r else str(uid)) or str(uid)
     # Сбрасываем game_over но оставляем флаг retry_penalty в БД
-    ok = await asyncio.to_thread(db.reset_game_result_soft, uid, 'penalty')
+    ok = await adb.reset_game_result_soft(uid, 'penalty')
+    if ok:
+        game_events.publish_user(uid, 'reset')
     text = (
         f"✅ Игрок <b>{name}</b> может начать заново.\n"
         f"Режим: 🔥 <b>+10 сек к каждому заданию</b>, очки считаются."
@@ -5310,9 +5391,11 @@ async def admin_game_restart_nopts(query, context, uid):
     if not await is_bot_admin_async(query.from_user.id):
         await query.answer("⛔"); return
     await query.answer()
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = (r[1] if r else str(uid)) or str(uid)
-    ok = await asyncio.to_thread(db.reset_game_result_soft, uid, 'nopts')
+    ok = await adb.reset_game_result_soft(uid, 'nopts')
+    if ok:
+        game_events.publish_user(uid, 'reset')
     text = (
         f"✅ Игрок <b>{name}</b> может пройти заново.\n"
         f"Режим: 👁 <b>Без очков</b> — только практика."
@@ -5327,9 +5410,11 @@ async def admin_game_reset_confirm(query, context, uid, drop_referrals: bool = F
     if not await is_bot_admin_async(query.from_user.id):
         await query.answer("⛔"); return
     await query.answer()
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = (r[1] if r else str(uid)) or str(uid)
-    ok = await asyncio.to_thread(db.reset_game_result_full, uid, drop_referrals)
+    ok = await adb.reset_game_result_full(uid, drop_referrals)
+    if ok:
+        game_events.publish_user(uid, 'reset')
     mode_label = "с агентами" if drop_referrals else "без удаления агентов"
     text = (
         f"✅ Прогресс игрока <b>{name}</b> полностью сброшен (<b>{mode_label}</b>)."
@@ -5345,9 +5430,11 @@ async def admin_game_ban_player(query, context, uid):
         await query.answer("⛔"); return
     await query.answer()
 
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = r[1] if r else str(uid)
-    ok = await asyncio.to_thread(db.ban_game_user, uid)
+    ok = await adb.ban_game_user(uid)
+    if ok:
+        game_events.publish_user(uid, 'ban')
 
     text = (
         f"{'🚫 Игрок <b>' + (name or str(uid)) + '</b> забанен. Очки обнулены.' if ok else '❌ Не удалось забанить.'}"
@@ -5365,9 +5452,11 @@ async def admin_game_unban_player(query, context, uid):
         await query.answer("⛔"); return
     await query.answer()
 
-    r = await asyncio.to_thread(db.get_game_result_detail, uid)
+    r = await adb.get_game_result_detail(uid)
     name = r[1] if r else str(uid)
-    ok = await asyncio.to_thread(db.unban_game_user, uid)
+    ok = await adb.unban_game_user(uid)
+    if ok:
+        game_events.publish_user(uid, 'unban')
 
     text = (
         f"{'✅ Бан с игрока <b>' + (name or str(uid)) + '</b> снят.' if ok else '❌ Не удалось разбанить.'}"
@@ -5399,7 +5488,8 @@ async def admin_game_reset_all_confirm(query, context, drop_referrals: bool = Fa
         await query.answer("⛔"); return
     await query.answer()
 
-    deleted = await asyncio.to_thread(db.reset_all_game_results, drop_referrals)
+    deleted = await adb.reset_all_game_results(drop_referrals)
+    game_events.publish_settings('reset_all')
     mode_label = "с удалением агентов" if drop_referrals else "без удаления агентов"
     await safe_edit(query,
         f"✅ Сброшено игроков: <b>{deleted}</b>\nРежим: <b>{mode_label}</b>",
@@ -5415,7 +5505,7 @@ async def admin_manage_bot_admins(query, context):
         await query.answer("⛔"); return
     await query.answer()
 
-    admins = await asyncio.to_thread(db.get_all_bot_admins)
+    admins = await adb.get_all_bot_admins()
     lines = ["👑 <b>АДМИНИСТРАТОРЫ БОТА</b>\n"]
     for uid_a, granted_at in admins:
         ts = granted_at.strftime('%d.%m.%Y') if granted_at else '—'
@@ -5462,7 +5552,7 @@ async def handle_bot_admin_input(update, context, text):
         context.user_data.pop('awaiting_add_bot_admin')
         try:
             target = int(text.strip())
-            ok = await asyncio.to_thread(db.add_bot_admin, target, admin_uid)
+            ok = await adb.add_bot_admin(target, admin_uid)
             await update.message.reply_text(
                 f"{'✅ Администратор добавлен' if ok else '❌ Ошибка'}: <code>{target}</code>\n"
                 f"Пользователю нужно нажать /start чтобы увидеть Админку.",
@@ -5475,7 +5565,7 @@ async def handle_bot_admin_input(update, context, text):
         context.user_data.pop('awaiting_remove_bot_admin')
         try:
             target = int(text.strip())
-            ok = await asyncio.to_thread(db.remove_bot_admin, target)
+            ok = await adb.remove_bot_admin(target)
             await update.message.reply_text(
                 f"{'✅ Удалён из администраторов' if ok else '❌ Ошибка'}: <code>{target}</code>",
                 parse_mode='HTML',
@@ -5490,7 +5580,7 @@ async def admin_my_game_role(query, context):
     if not await is_bot_admin_async(uid):
         await query.answer("⛔"); return
     await query.answer()
-    current = await asyncio.to_thread(db.get_game_role, uid) or 'admin'
+    current = await adb.get_game_role(uid) or 'admin'
     role_desc = {
         'admin':  '👑 Все главы открыты, бесконечные жизни, не в рейтинге',
         'tester': '🧪 Все главы открыты, 5 жизней, не в рейтинге',
@@ -5517,7 +5607,9 @@ async def admin_set_my_role(query, context, role):
     if not await is_bot_admin_async(uid):
         await query.answer("⛔"); return
     await query.answer()
-    ok = await asyncio.to_thread(db.set_game_role, uid, role)
+    ok = await adb.set_game_role(uid, role)
+    if ok:
+        game_events.publish_user(uid, 'role')
     role_icons = {'admin': '👑', 'tester': '🧪', 'player': '🎮'}
     icon = role_icons.get(role, '🎮')
     await safe_edit(query,
@@ -5533,8 +5625,8 @@ async def admin_set_my_role(query, context, role):
 async def cmd_claim_admin(update: Update, context: CallbackContext):
     """/claim_admin — получить права администратора бота если в системе ещё нет ни одного."""
     user = update.effective_user
-    await asyncio.to_thread(db.migrate_bot_admins_table)
-    ok = await asyncio.to_thread(db.claim_first_bot_admin, user.id)
+    await adb.migrate_bot_admins_table()
+    ok = await adb.claim_first_bot_admin(user.id)
     if not ok:
         await update.message.reply_text(
             "⛔ Команда недоступна — в системе уже есть администратор.\n"
@@ -5582,7 +5674,7 @@ async def admin_system_panel(query, context):
         await safe_edit(query, "⛔ Доступ запрещён.", BACK_TO_MAIN)
         return
 
-    maint = await asyncio.to_thread(db.get_maintenance_status)
+    maint = await adb.get_maintenance_status()
     if maint['enabled']:
         maint_btn = btn(
             f"🛑 Выкл. техрежим (до {maint['until'] or '∞'})",
@@ -5616,7 +5708,7 @@ async def admin_system_panel(query, context):
 
 async def get_games_access_modes() -> str:
     """Возвращает режим доступа к игре «Шифровальщик»."""
-    cipher_mode = await asyncio.to_thread(db.get_game_access_mode)
+    cipher_mode = await adb.get_game_access_mode()
     if cipher_mode not in ('open', 'beta', 'closed'):
         cipher_mode = 'beta'
     return str(cipher_mode)
@@ -5629,7 +5721,7 @@ async def admin_games_panel(query, context):
         return
 
     cipher_mode = await get_games_access_modes()
-    pending = await asyncio.to_thread(db.get_beta_access_requests, 'pending', 50)
+    pending = await adb.get_beta_access_requests('pending', 50)
     pending_count = len(pending)
 
     text = (
@@ -5657,7 +5749,7 @@ async def beta_request_access(query, context, game_key: str):
         return
 
     try:
-        mode = await asyncio.to_thread(db.get_game_access_mode)
+        mode = await adb.get_game_access_mode()
     except Exception:
         mode = 'beta'
     if mode != 'beta':
@@ -5673,7 +5765,7 @@ async def beta_request_access(query, context, game_key: str):
         return
 
     user_name = (user.full_name or user.first_name or user.username or 'Игрок').strip()
-    result = await asyncio.to_thread(db.add_beta_access_request, game_key, user.id, user_name)
+    result = await adb.add_beta_access_request(game_key, user.id, user_name)
     if result.get('error'):
         await query.answer("Не удалось отправить заявку. Попробуйте позже.", show_alert=True)
         return
@@ -5714,7 +5806,7 @@ async def admin_beta_requests(query, context):
         await safe_edit(query, "⛔ Доступ запрещён.", BACK_TO_MAIN)
         return
 
-    requests = await asyncio.to_thread(db.get_beta_access_requests, 'pending', 20)
+    requests = await adb.get_beta_access_requests('pending', 20)
     if not requests:
         await safe_edit(
             query,
@@ -5750,7 +5842,7 @@ async def resolve_beta_request(query, context, request_id: int, approve: bool):
         return
 
     status = 'approved' if approve else 'rejected'
-    row = await asyncio.to_thread(db.resolve_beta_access_request, request_id, status, query.from_user.id)
+    row = await adb.resolve_beta_access_request(request_id, status, query.from_user.id)
     if not row:
         await safe_edit(
             query,
@@ -5766,7 +5858,7 @@ async def resolve_beta_request(query, context, request_id: int, approve: bool):
     grant_ok = True
     if approve:
         note = f"Заявка #{req_id}"
-        grant_ok = await asyncio.to_thread(db.add_beta_user, user_id, user_name, note)
+        grant_ok = await adb.add_beta_user(user_id, user_name, note)
         _beta_cache = set()
         _beta_cache_ts = 0
 
@@ -5808,7 +5900,7 @@ async def show_admin_panel(query):
         await safe_edit(query, "⛔ Доступ запрещён.", BACK_TO_MAIN)
         return
 
-    maint = await asyncio.to_thread(db.get_maintenance_status)
+    maint = await adb.get_maintenance_status()
     season_mode = _normalize_season_mode(await get_season_mode_cached())
     season_badge = {'auto': '🗓 авто', 'summer': '☀️ лето', 'school': '🎓 школа'}.get(season_mode, season_mode)
     maint_badge = f"🔧 техрежим: {'вкл' if maint.get('enabled') else 'выкл'}"
@@ -5829,7 +5921,7 @@ async def show_admin_panel(query):
 
 
 async def admin_view_subs(query, context):
-    subs = await asyncio.to_thread(db.get_all_substitutions, 50)
+    subs = await adb.get_all_substitutions(50)
     if not subs:
         text = "В базе замен нет."
     else:
@@ -5845,7 +5937,7 @@ async def admin_view_subs(query, context):
 
 
 async def admin_manage_news(query, context):
-    news_list = await asyncio.to_thread(db.get_recent_news, 15)
+    news_list = await adb.get_recent_news(15)
     if not news_list:
         kb = [[btn("↩️ Контент", 'admin_content_panel'), btn("🏠 Меню", 'back_to_main')]]
         await safe_edit(query, "📭 Новостей нет.", kb)
@@ -5868,7 +5960,7 @@ async def admin_manage_news(query, context):
 
 
 async def confirm_delete_news(query, context, news_id: int):
-    news = await asyncio.to_thread(db.get_news_by_id, news_id)
+    news = await adb.get_news_by_id(news_id)
     if not news:
         await query.answer("❌ Не найдена", show_alert=True)
         return
@@ -5882,15 +5974,15 @@ async def confirm_delete_news(query, context, news_id: int):
 
 
 async def do_delete_news(query, context, news_id: int):
-    news = await asyncio.to_thread(db.get_news_by_id, news_id)
+    news = await adb.get_news_by_id(news_id)
     title = news[1] if news else f"ID {news_id}"
-    await asyncio.to_thread(db.delete_news, news_id)
+    await adb.delete_news(news_id)
     await query.answer(f"✅ «{title}» удалена", show_alert=True)
     await admin_manage_news(query, context)
 
 
 async def admin_confirm_clear_subs(query, context):
-    subs = await asyncio.to_thread(db.get_all_substitutions)
+    subs = await adb.get_all_substitutions()
     kb = [
         [btn("✅ Да, удалить все", 'admin_clear_confirm'),
          btn("❌ Отмена", 'admin_content_panel')],
@@ -5902,20 +5994,20 @@ async def admin_confirm_clear_subs(query, context):
 
 
 async def admin_do_clear_subs(query, context):
-    subs = await asyncio.to_thread(db.get_all_substitutions)
+    subs = await adb.get_all_substitutions()
     cnt = len(subs)
-    await asyncio.to_thread(db.clear_all_substitutions)
+    await adb.clear_all_substitutions()
     kb = [[btn("↩️ Контент", 'admin_content_panel'), btn("🏠 Меню", 'back_to_main')]]
     await safe_edit(query, f"✅ Удалено замен: {cnt}", kb)
 
 
 async def show_analytics(query, context):
     active_24h, total_users, pop_classes, peak_hours, total_subs_list = await asyncio.gather(
-        asyncio.to_thread(db.get_active_users_24h),
-        asyncio.to_thread(db.get_user_count),
-        asyncio.to_thread(db.get_popular_classes),
-        asyncio.to_thread(db.get_peak_hours),
-        asyncio.to_thread(db.get_all_substitutions),
+        adb.get_active_users_24h(),
+        adb.get_user_count(),
+        adb.get_popular_classes(),
+        adb.get_peak_hours(),
+        adb.get_all_substitutions(),
     )
 
     text = (
@@ -5935,8 +6027,8 @@ async def show_analytics(query, context):
 
 
 async def show_users_stats(query, context, page: int = 0):
-    total = await asyncio.to_thread(db.get_user_count)
-    users = await asyncio.to_thread(db.get_all_users)
+    total = await adb.get_user_count()
+    users = await adb.get_all_users()
 
     page_size = 20
     total_pages = max(1, (total + page_size - 1) // page_size)
@@ -6005,7 +6097,7 @@ async def do_broadcast(query, context):
         _clear_flow(context)
         return
 
-    users = await asyncio.to_thread(db.get_all_users)
+    users = await adb.get_all_users()
     total = len(users)
     sent = failed = 0
 
@@ -6149,7 +6241,7 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
         name = ALL_TEACHERS[idx]
 
         # Двойная проверка — вдруг учитель зарегистрировался пока пользователь листал список
-        registered = await asyncio.to_thread(db.get_registered_teacher_names)
+        registered = await adb.get_registered_teacher_names()
         if name in registered:
             await safe_edit(query,
                 f"⛔ <b>{name}</b> уже зарегистрирован другим пользователем.\n\n"
@@ -6157,7 +6249,7 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
                 [[btn("↩️ К списку", 'reg_role_teacher')], BACK_TO_MAIN[0]])
             return
 
-        ok = await asyncio.to_thread(db.register_teacher, name, user.id)
+        ok = await adb.register_teacher(name, user.id)
         if ok:
             _teacher_schedule_cache.pop(name, None)
             await safe_edit(query,
@@ -6184,12 +6276,12 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
     # ── Избранное ──
     if d.startswith('fav_cls_'):
         cls = d.replace('fav_cls_', '')
-        is_fav = await asyncio.to_thread(db.is_favorite, user.id, 'class', cls)
+        is_fav = await adb.is_favorite(user.id, 'class', cls)
         if is_fav:
-            await asyncio.to_thread(db.remove_favorite, user.id, 'class', cls)
+            await adb.remove_favorite(user.id, 'class', cls)
             await query.answer(f"Класс {cls.upper()} удалён из избранного")
         else:
-            await asyncio.to_thread(db.add_favorite, user.id, 'class', cls)
+            await adb.add_favorite(user.id, 'class', cls)
             await query.answer(f"Класс {cls.upper()} добавлен в избранное")
         await menu_week_schedule(query, context)
         return
@@ -6197,19 +6289,19 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
     if d.startswith('fav_tch_'):
         idx = int(d.replace('fav_tch_', ''))
         name = ALL_TEACHERS[idx]
-        is_fav = await asyncio.to_thread(db.is_favorite, user.id, 'teacher', name)
+        is_fav = await adb.is_favorite(user.id, 'teacher', name)
         if is_fav:
-            await asyncio.to_thread(db.remove_favorite, user.id, 'teacher', name)
+            await adb.remove_favorite(user.id, 'teacher', name)
             await query.answer(f"{name} удалён из избранного")
         else:
-            await asyncio.to_thread(db.add_favorite, user.id, 'teacher', name)
+            await adb.add_favorite(user.id, 'teacher', name)
             await query.answer(f"{name} добавлен в избранное")
         await show_teacher(query, context, name)
         return
 
     if d.startswith('del_fav_cls_'):
         cls = d.replace('del_fav_cls_', '')
-        await asyncio.to_thread(db.remove_favorite, user.id, 'class', cls)
+        await adb.remove_favorite(user.id, 'class', cls)
         await query.answer(f"Удалено из избранного")
         await menu_my(query, context)
         return
@@ -6217,7 +6309,7 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
     if d.startswith('del_fav_tch_'):
         idx = int(d.replace('del_fav_tch_', ''))
         name = ALL_TEACHERS[idx]
-        await asyncio.to_thread(db.remove_favorite, user.id, 'teacher', name)
+        await adb.remove_favorite(user.id, 'teacher', name)
         await query.answer("Удалено из избранного")
         await menu_my(query, context)
         return
@@ -6313,7 +6405,7 @@ async def _button_handler_impl(update: Update, context: CallbackContext):
             uid = int(d.replace('abeta_rm_', ''))
             global _beta_cache, _beta_cache_ts
             _beta_cache = set(); _beta_cache_ts = 0
-            ok = await asyncio.to_thread(db.remove_beta_user, uid)
+            ok = await adb.remove_beta_user(uid)
             await safe_edit(query,
                 f"{'✅ Тестер удалён из списка.' if ok else '❌ Не найден.'}",
                 [[btn("↩️ Бета-панель", 'admin_beta_panel')]])
@@ -6628,8 +6720,8 @@ async def handle_message(update: Update, context: CallbackContext):
     user = update.effective_user
     if not user:
         return
-    asyncio.create_task(asyncio.to_thread(
-        db.update_user_and_log, user.id, 'message', None,
+    asyncio.create_task(adb.update_user_and_log(
+        user.id, 'message', None,
         user.username, user.first_name, user.last_name, user.language_code
     ))
 
@@ -6689,7 +6781,7 @@ async def handle_message(update: Update, context: CallbackContext):
     if context.user_data.get('deleting_sub') and await is_bot_admin_async(user.id):
         try:
             sub_id = int(text)
-            await asyncio.to_thread(db.delete_substitution, sub_id)
+            await adb.delete_substitution(sub_id)
             kb = [[btn("↩️ Контент", 'admin_content_panel'), btn("🏠 Меню", 'back_to_main')]]
             await update.message.reply_text(
                 f"✅ Замена ID {sub_id} удалена.",
@@ -6738,7 +6830,7 @@ async def handle_message(update: Update, context: CallbackContext):
     # ── ИИ — проверяем последним, чтобы не перехватывать другие флоу ──
     if context.user_data.get('awaiting_ai'):
         thinking = await update.message.reply_text("🤔 Думаю...")
-        is_teacher = _tname(await asyncio.to_thread(db.find_teacher_by_telegram_id, user.id)) is not None
+        is_teacher = _tname(await adb.find_teacher_by_telegram_id(user.id)) is not None
         answer = await ask_ai(text, user.id, is_teacher)
         try:
             await thinking.edit_text(answer, parse_mode='HTML')
@@ -6765,7 +6857,7 @@ async def handle_teacher_mentions(update: Update, context: CallbackContext):
     msg_text = update.message.text
     user = update.message.from_user
     found = []
-    teachers_db = await asyncio.to_thread(db.get_all_teachers_db)
+    teachers_db = await adb.get_all_teachers_db()
 
     for name, tid, registered in teachers_db:
         if not registered or not tid:
@@ -7111,8 +7203,7 @@ async def save_photo_subs(query, context):
             continue
 
         try:
-            await asyncio.to_thread(
-                db.add_substitution,
+            await adb.add_substitution(
                 date_iso, day_name, int(lesson),
                 subject, subject, old_t, new_t, cls
             )
@@ -7166,16 +7257,25 @@ def _unauthorized_game_response(headers: dict, reason: str):
     )
 
 
-def _authorize_game_request(user_id: int, init_data_raw: str) -> tuple[bool, str]:
+def _authorize_game_request(user_id: int, init_data_raw: str, session_token: str = '') -> tuple[bool, str, int | None]:
+    """Проверяет токен сессии (быстрый путь без разбора init_data), иначе — init_data.
+    reason == 'session' — запрос пришёл с токеном, 'ok' — с проверенным init_data
+    (тогда третье значение — его auth_date, иначе None)."""
     if not GAME_AUTH_REQUIRED:
-        return True, 'auth_disabled'
-    ok, reason, _ = validate_webapp_init_data(
+        return True, 'auth_disabled', None
+    if session_token:
+        ok, reason = verify_game_session_token(session_token, TOKEN, user_id)
+        if ok:
+            return True, 'session', None
+        if not init_data_raw:
+            return False, reason, None
+    ok, reason, _, auth_date = validate_webapp_init_data(
         init_data_raw=init_data_raw or '',
         bot_token=TOKEN,
         expected_user_id=user_id,
         max_age_sec=GAME_AUTH_TTL_SEC,
     )
-    return ok, reason
+    return ok, reason, auth_date
 
 
 def _resolve_game_cors_origin(request) -> str:
@@ -7198,6 +7298,34 @@ def _game_cors_headers(request, methods: str) -> dict[str, str]:
     }
 
 
+# Крупные разделы ответов: клиент присылает их версии (have), совпавшие не передаются.
+GAME_SYNC_SECTIONS = {
+    'ref': ('ref_summary', 'ref_agents'),
+    'secret': ('secret_mode', 'secret_summary', 'secret_missions'),
+}
+GAME_STATE_SECTIONS = dict(GAME_SYNC_SECTIONS, schedule=('chapter_schedule', 'chapters'))
+
+
+def _game_json_response(request, payload, status: int = 200, headers: dict | None = None, etag: bool = False):
+    """json_response для крупных ответов API игры: энкодер http_json и
+    gzip/deflate по Accept-Encoding для тел от GAME_COMPRESS_MIN_BYTES.
+    etag=True — слабый ETag и 304 на совпавший If-None-Match."""
+    raw = http_json.dumps(payload)
+    out_headers = dict(headers or {})
+    out_headers['Vary'] = 'Origin, Accept-Encoding'
+    if etag:
+        tag = http_json.etag_for(raw)
+        out_headers['ETag'] = tag
+        out_headers['Cache-Control'] = 'private, no-cache'
+        if status == 200 and http_json.etag_matches(request.headers.get('If-None-Match'), tag):
+            return aiohttp_web.Response(status=304, headers=out_headers)
+    body, encoding = http_json.compress_body(
+        raw, request.headers.get('Accept-Encoding'), GAME_COMPRESS_MIN_BYTES)
+    if encoding:
+        out_headers['Content-Encoding'] = encoding
+    return aiohttp_web.Response(body=body, status=status, content_type='application/json', headers=out_headers)
+
+
 def _extract_user_name_from_init_data(init_data_raw: str) -> str | None:
     try:
         pairs = urllib.parse.parse_qsl(
@@ -7247,22 +7375,26 @@ def _to_bool(value) -> bool:
     return False
 
 
-_GAME_RATE_STATE: dict[tuple[str, int], list[float]] = {}
+def _build_game_rate_limiter() -> rate_limit.RateLimiter:
+    """GAME_RATE_LIMIT_BACKEND=memory (один процесс) | postgres (общий лимит для нескольких воркеров)."""
+    backend_name = os.environ.get('GAME_RATE_LIMIT_BACKEND', 'memory').strip().lower()
+    if backend_name == 'postgres':
+        backend = rate_limit.SharedBackend(
+            lambda *args: adb.rate_limit_hit(*args),
+            lambda: db.purge_rate_limits(),
+        )
+    else:
+        backend = rate_limit.MemoryBackend()
+    limits = rate_limit.parse_limits(os.environ.get('GAME_RATE_LIMITS', ''))
+    return rate_limit.RateLimiter(backend, limits)
+
+
+GAME_RATE_LIMITER = _build_game_rate_limiter()
 
 
-def _is_game_rate_limited(endpoint: str, user_id: int, limit: int, window_sec: int = 60) -> bool:
-    now_ts = time.time()
-    key = (endpoint, user_id)
-    events = _GAME_RATE_STATE.get(key, [])
-    events = [ts for ts in events if now_ts - ts < window_sec]
-    events.append(now_ts)
-    _GAME_RATE_STATE[key] = events
-    # Ленивая очистка старых ключей.
-    if len(_GAME_RATE_STATE) > 5000:
-        stale_keys = [k for k, vals in _GAME_RATE_STATE.items() if not vals or now_ts - vals[-1] > window_sec * 2]
-        for stale_key in stale_keys:
-            _GAME_RATE_STATE.pop(stale_key, None)
-    return len(events) > limit
+async def _is_game_rate_limited(endpoint: str, user_id: int) -> bool:
+    """Лимиты по endpoint — rate_limit.DEFAULT_LIMITS / GAME_RATE_LIMITS."""
+    return await GAME_RATE_LIMITER.is_limited(endpoint, user_id)
 
 
 async def handle_game_reset(request):
@@ -7280,13 +7412,14 @@ async def handle_game_reset(request):
     user_id = data.get('user_id')
     drop_referrals = _to_bool(data.get('drop_referrals') or data.get('reset_with_agents'))
     init_data_raw = data.get('init_data', '')
+    session_token = str(data.get('session', '') or '')
     if not user_id:
         return aiohttp_web.json_response({'ok': False, 'error': 'no user_id'}, headers=headers)
     try:
         user_id = _to_int(user_id, 0)
         if user_id <= 0:
             return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
-        auth_ok, auth_reason = _authorize_game_request(user_id, init_data_raw)
+        auth_ok, auth_reason, _ = _authorize_game_request(user_id, init_data_raw, session_token)
         if not auth_ok:
             logger.warning(f"game_reset auth failed: user={user_id}, reason={auth_reason}")
             return _unauthorized_game_response(headers, auth_reason)
@@ -7305,12 +7438,15 @@ async def handle_game_reset(request):
             )
 
         # Проверяем что только admin может сбросить свой рейтинг сам
-        role = await asyncio.to_thread(db.get_game_role, user_id)
+        role = await adb.get_game_role(user_id)
         if role != 'admin':
             return aiohttp_web.json_response(
                 {'ok': False, 'error': 'only admin can self-reset'},
                 status=403, headers=headers)
-        ok = await asyncio.to_thread(db.reset_game_result_full, user_id, drop_referrals)
+        coalescer = request.app.get('sync_coalescer')
+        if coalescer is not None:
+            coalescer.forget(user_id)
+        ok = await adb.reset_game_result_full(user_id, drop_referrals)
         logger.info(
             "game_reset (admin self-reset): user=%s ok=%s drop_referrals=%s",
             user_id, ok, drop_referrals
@@ -7321,6 +7457,99 @@ async def handle_game_reset(request):
         return aiohttp_web.json_response({'ok': False, 'error': str(e)[:100]}, headers=headers)
 
 
+# Версии разделов /game_state, известные без чтения данных:
+#   ref      — в кэше рефералов (db.get_referral_section_version), сбрасывается вместе с ним;
+#   secret   — (updated_at строки game_secret_state, версия) последнего прочитанного состояния;
+#   schedule — в кэше расписания глав (сбрасывается событием settings/chapters).
+CHAPTER_SCHEDULE_TTL = 15  # сек
+_chapter_schedule_cache: dict = {'schedule': None, 'chapters': None, 'version': None, 'until': 0.0}
+_chapter_schedule_gen = 0  # растёт на каждом сбросе: чтение, начатое до сброса, не кэшируется
+_SECRET_SECTION_VERSIONS_MAX = 20000
+_secret_section_versions: dict[int, tuple] = {}
+
+
+def _chapters_payload(schedule: list) -> list:
+    """Раздел chapters ответа /game_state по расписанию глав."""
+    chapters = []
+    for row in schedule or []:
+        ch_open_at = row.get('open_at')
+        chapters.append({
+            'id': int(row.get('id', 0)),
+            'open': bool(row.get('open')),
+            'scheduled_open_at': ch_open_at,
+            'open_label': 'по расписанию' if ch_open_at else '',
+        })
+    return chapters
+
+
+async def get_chapter_schedule_cached(force: bool = False) -> tuple[list, list, str]:
+    """(расписание, chapters, версия раздела schedule) с TTL-кэшем.
+    Запись живёт не дольше ближайшего open_at: по времени глава открывается без записи в БД."""
+    global _chapter_schedule_cache
+    now_ts = time.time()
+    cache = _chapter_schedule_cache
+    if force or cache['schedule'] is None or now_ts >= cache['until']:
+        gen = _chapter_schedule_gen
+        schedule = await adb.get_chapter_schedule_for_game()
+        chapters = _chapters_payload(schedule)
+        # Пустое расписание — ошибка чтения (глав всегда 6): не кэшируем.
+        until = now_ts + CHAPTER_SCHEDULE_TTL if schedule and gen == _chapter_schedule_gen else 0.0
+        for row in schedule:
+            if row.get('open_at'):
+                try:
+                    until = min(until, datetime.fromisoformat(row['open_at']).timestamp())
+                except (TypeError, ValueError):
+                    pass
+        cache = {
+            'schedule': schedule,
+            'chapters': chapters,
+            'version': http_json.section_version([schedule, chapters]),
+            'until': until,
+        }
+        _chapter_schedule_cache = cache
+    return cache['schedule'], cache['chapters'], cache['version']
+
+
+def _on_settings_event(event: dict) -> None:
+    """Слушатель game_events: главы открыты/закрыты/перепланированы — расписание перечитать."""
+    global _chapter_schedule_gen
+    if event.get('reason') in ('chapters', 'reset_all'):
+        _chapter_schedule_gen += 1
+        _chapter_schedule_cache['until'] = 0.0
+
+
+game_events.hub.add_listener(game_events.SETTINGS_TOPIC, _on_settings_event)
+
+
+async def _game_state_ref(user_id: int, have_version: str | None):
+    """(сводка, агенты) рефералов или None — версия have_version у клиента актуальна."""
+    if have_version and db.get_referral_section_version(user_id) == have_version:
+        return None
+    summary, agents = await asyncio.gather(
+        adb.get_referral_summary(user_id),
+        adb.get_referral_agents(user_id, 12),
+    )
+    return summary, agents
+
+
+async def _game_state_secret(user_id: int, have_version: str | None):
+    """Состояние секретных миссий или None — версия have_version у клиента актуальна:
+    вместо миссий читается только updated_at их строки."""
+    known = _secret_section_versions.get(user_id) if have_version else None
+    if known is not None and known[1] == have_version:
+        stamp = await adb.get_secret_missions_stamp(user_id)
+        if stamp is not None and stamp == known[0]:
+            return None
+    return await adb.get_secret_missions_state(user_id)
+
+
+def _remember_secret_section_version(user_id: int, stamp, version: str) -> None:
+    _secret_section_versions.pop(user_id, None)
+    _secret_section_versions[user_id] = (stamp, version)
+    while len(_secret_section_versions) > _SECRET_SECTION_VERSIONS_MAX:
+        _secret_section_versions.pop(next(iter(_secret_section_versions)))
+
+
 async def handle_game_state(request):
     """GET /game_state?user_id=... — возвращает текущее состояние игрока из БД.
     Учитывает роль: admin/tester/player — разные права доступа к главам.
@@ -7331,13 +7560,15 @@ async def handle_game_state(request):
 
     user_id = request.rel_url.query.get('user_id')
     init_data_raw = request.rel_url.query.get('init_data', '')
+    session_token = request.rel_url.query.get('session', '')
+    have = http_json.parse_have(request.rel_url.query.get('have', ''))
     if not user_id:
         return aiohttp_web.json_response({'ok': False, 'error': 'no user_id'}, headers=headers)
     try:
         user_id = _to_int(user_id, 0)
         if user_id <= 0:
             return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
-        auth_ok, auth_reason = _authorize_game_request(user_id, init_data_raw)
+        auth_ok, auth_reason, auth_date = _authorize_game_request(user_id, init_data_raw, session_token)
         if not auth_ok:
             logger.warning(f"game_state auth failed: user={user_id}, reason={auth_reason}")
             return _unauthorized_game_response(headers, auth_reason)
@@ -7360,7 +7591,7 @@ async def handle_game_state(request):
                 },
                 headers=headers,
             )
-        if _is_game_rate_limited('game_state', user_id, limit=60):
+        if await _is_game_rate_limited('game_state', user_id):
             return aiohttp_web.json_response(
                 {'ok': False, 'error': 'rate_limited'},
                 status=429,
@@ -7371,11 +7602,16 @@ async def handle_game_state(request):
         access_mode = await _get_cached_game_mode()
         access_reason = access_mode if not allowed else None
 
+        # Отложенный прогресс-тик игрока — в БД до чтения (read-your-writes).
+        coalescer = request.app.get('sync_coalescer')
+        if coalescer is not None:
+            await coalescer.flush(user_id)
+
         # Получаем всё параллельно
-        result, role, chapter_schedule = await asyncio.gather(
-            asyncio.to_thread(db.get_game_result, user_id),
-            asyncio.to_thread(db.get_game_role, user_id),
-            asyncio.to_thread(db.get_chapter_schedule_for_game),
+        result, role, (chapter_schedule, chapters_payload, schedule_version) = await asyncio.gather(
+            adb.get_game_result(user_id),
+            adb.get_game_role(user_id),
+            get_chapter_schedule_cached(),
         )
 
         banned = bool(result[6]) if result and len(result) > 6 else False
@@ -7393,7 +7629,7 @@ async def handle_game_state(request):
         restart_mode = None
         if result:
             try:
-                rm = await asyncio.to_thread(db.get_restart_mode, user_id)
+                rm = await adb.get_restart_mode(user_id)
                 restart_mode = rm
             except Exception:
                 pass
@@ -7403,11 +7639,15 @@ async def handle_game_state(request):
             'inviter_percent': 0, 'invitee_percent': 1, 'invitee_bonus_points': 0, 'referrer_id': 0,
         }
         ref_agents = []
+        ref_read = False
+        ref_token = db.referral_section_token()
         secret_state = {
             'mode': 'none',
             'summary': {'completed': 0, 'total': 15, 'bonus_points': 0},
             'missions': [],
         }
+        # Разделы, которые не читались: их версия у клиента актуальна.
+        current = {}
 
         # ── Доступ к главам по роли ──────────────────────────────
         if role == 'admin':
@@ -7417,7 +7657,7 @@ async def handle_game_state(request):
             tester_mode   = False
             in_rating     = False
             try:
-                secret_state = await asyncio.to_thread(db.get_secret_missions_state, user_id)
+                secret_state = await _game_state_secret(user_id, have.get('secret'))
             except Exception:
                 secret_state = {
                     'mode': 'none',
@@ -7431,7 +7671,7 @@ async def handle_game_state(request):
             tester_mode   = True
             in_rating     = False
             try:
-                secret_state = await asyncio.to_thread(db.get_secret_missions_state, user_id)
+                secret_state = await _game_state_secret(user_id, have.get('secret'))
             except Exception:
                 secret_state = {
                     'mode': 'none',
@@ -7440,36 +7680,34 @@ async def handle_game_state(request):
                 }
         else:  # player
             # Только открытые индивидуально + глобально + реферальная статистика
-            accessible, ref_summary, ref_agents, secret_state = await asyncio.gather(
-                asyncio.to_thread(db.get_player_accessible_chapters, user_id),
-                asyncio.to_thread(db.get_referral_summary, user_id),
-                asyncio.to_thread(db.get_referral_agents, user_id, 12),
-                asyncio.to_thread(db.get_secret_missions_state, user_id),
+            accessible, ref_state, secret_state = await asyncio.gather(
+                adb.get_player_accessible_chapters(user_id),
+                _game_state_ref(user_id, have.get('ref')),
+                _game_state_secret(user_id, have.get('secret')),
             )
-            safe_agents = []
-            for agent in ref_agents or []:
-                if not isinstance(agent, dict):
-                    continue
-                safe_agents.append({
-                    'user_id': int(agent.get('user_id', 0) or 0),
-                    'name': str(agent.get('name') or 'Игрок')[:64],
-                    'completed': int(agent.get('completed', 0) or 0),
-                    'bonus_points': int(agent.get('bonus_points', 0) or 0),
-                    'invitee_bonus_points': int(agent.get('invitee_bonus_points', 0) or 0),
-                    'invitee_percent': int(agent.get('invitee_percent', 1) or 1),
-                    'inviter_percent': int(agent.get('inviter_percent', 0) or 0),
-                })
-            ref_agents = safe_agents
-            if not isinstance(secret_state, dict):
-                secret_state = {
-                    'mode': 'none',
-                    'summary': {'completed': 0, 'total': 15, 'bonus_points': 0},
-                    'missions': [],
-                }
+            if ref_state is None:
+                current['ref'] = have['ref']
+            else:
+                ref_summary, ref_agents = ref_state
+                ref_read = True
+                safe_agents = []
+                for agent in ref_agents or []:
+                    if not isinstance(agent, dict):
+                        continue
+                    safe_agents.append({
+                        'user_id': int(agent.get('user_id', 0) or 0),
+                        'name': str(agent.get('name') or 'Игрок')[:64],
+                        'completed': int(agent.get('completed', 0) or 0),
+                        'bonus_points': int(agent.get('bonus_points', 0) or 0),
+                        'invitee_bonus_points': int(agent.get('invitee_bonus_points', 0) or 0),
+                        'invitee_percent': int(agent.get('invitee_percent', 1) or 1),
+                        'inviter_percent': int(agent.get('inviter_percent', 0) or 0),
+                    })
+                ref_agents = safe_agents
             # Если у игрока нет доступных глав — автоматически открываем главу 1
             if not accessible:
                 try:
-                    await asyncio.to_thread(db.open_chapter, 1)
+                    await adb.open_chapter(1)
                     accessible = {1}
                 except Exception:
                     accessible = {1}
@@ -7478,24 +7716,16 @@ async def handle_game_state(request):
             tester_mode = False
             in_rating   = True
 
-        if not isinstance(secret_state, dict):
+        if secret_state is None:
+            current['secret'] = have['secret']
+        elif not isinstance(secret_state, dict):
             secret_state = {
                 'mode': 'none',
                 'summary': {'completed': 0, 'total': 15, 'bonus_points': 0},
                 'missions': [],
             }
-
-        chapters_payload = []
-        for row in chapter_schedule or []:
-            ch_id = int(row.get('id', 0))
-            ch_open = bool(row.get('open'))
-            ch_open_at = row.get('open_at')
-            chapters_payload.append({
-                'id': ch_id,
-                'open': ch_open,
-                'scheduled_open_at': ch_open_at,
-                'open_label': 'по расписанию' if ch_open_at else '',
-            })
+        if have.get('schedule') == schedule_version:
+            current['schedule'] = schedule_version
 
         resp = {
             'ok':           True,
@@ -7510,25 +7740,63 @@ async def handle_game_state(request):
             'tester_mode':  tester_mode,
             'in_rating':    in_rating,
             'open_chapters': open_chapters,
-            'chapter_schedule': chapter_schedule,
-            'chapters': chapters_payload,
             'reset_token':  reset_token,
             'retreat_count': retreat_count,
-            'ref_summary': ref_summary,
-            'ref_agents': ref_agents,
-            'secret_mode': secret_state.get('mode', 'none') if isinstance(secret_state, dict) else 'none',
-            'secret_summary': secret_state.get('summary') if isinstance(secret_state, dict) else {'completed': 0, 'total': 15, 'bonus_points': 0},
-            'secret_missions': secret_state.get('missions', []) if isinstance(secret_state, dict) else [],
         }
+        if 'schedule' not in current:
+            resp['chapter_schedule'] = chapter_schedule
+            resp['chapters'] = chapters_payload
+        if 'ref' not in current:
+            resp['ref_summary'] = ref_summary
+            resp['ref_agents'] = ref_agents
+        if 'secret' not in current:
+            resp['secret_mode'] = secret_state.get('mode', 'none')
+            resp['secret_summary'] = secret_state.get('summary')
+            resp['secret_missions'] = secret_state.get('missions', [])
         if restart_mode:
             resp['restart_mode'] = restart_mode
-
-        return aiohttp_web.json_response(resp, headers=headers)
+        if auth_reason == 'ok':
+            # Дальше клиент шлёт короткий токен вместо init_data. Срок — не позже
+            # срока самого init_data, округлён вниз до 5 минут: токен (и ETag
+            # ответа) не меняется каждую секунду.
+            expires_at = game_session_expires_at(auth_date, GAME_AUTH_TTL_SEC, GAME_SESSION_TTL_SEC)
+            if expires_at > int(time.time()):
+                resp['session_token'] = issue_game_session_token(user_id, TOKEN, expires_at=expires_at)
+                resp['session_expires_at'] = expires_at
+
+        http_json.apply_section_versions(resp, GAME_STATE_SECTIONS, have, current)
+        versions = resp.get('versions') or {}
+        if ref_read and 'ref' in versions:
+            db.put_referral_section_version(user_id, ref_token, versions['ref'])
+        if 'secret' not in current and secret_state.get('stamp') is not None and 'secret' in versions:
+            _remember_secret_section_version(user_id, secret_state['stamp'], versions['secret'])
+        return _game_json_response(request, resp, headers=headers, etag=True)
     except Exception as e:
         logger.error(f"handle_game_state error: {e}")
         return aiohttp_web.json_response({'ok': False, 'error': str(e)[:100]}, headers=headers)
 
 
+async def _game_leaderboard_payload(limit: int = 50) -> dict:
+    """Топ рейтинга и число игроков — общий для /game_leaderboard и push-события leaderboard."""
+    rows, players_count = await asyncio.gather(
+        adb.get_game_leaderboard(limit),
+        adb.get_game_players_count(),
+    )
+    leaderboard_rows = [
+        {
+            'uid': str(r[0]),
+            'name': r[1] or 'Игрок',
+            'score': int(r[2] or 0),
+            'completed': int(r[3] or 0),
+            'role': (r[5] if len(r) > 5 else 'player') or 'player',
+            'achievementCount': int(r[6] or 0) if len(r) > 6 else 0,
+            'achievementPts': int(r[7] or 0) if len(r) > 7 else 0,
+        }
+        for r in (rows or [])
+    ]
+    return {'leaderboard': leaderboard_rows, 'players_count': int(players_count or 0)}
+
+
 async def handle_game_leaderboard(request):
     """GET /game_leaderboard?user_id=... — актуальный рейтинг из БД."""
     headers = _game_cors_headers(request, 'GET, OPTIONS')
@@ -7537,6 +7805,7 @@ async def handle_game_leaderboard(request):
 
     user_id = request.rel_url.query.get('user_id')
     init_data_raw = request.rel_url.query.get('init_data', '')
+    session_token = request.rel_url.query.get('session', '')
     if not user_id:
         return aiohttp_web.json_response({'ok': False, 'error': 'no user_id'}, headers=headers)
 
@@ -7544,7 +7813,7 @@ async def handle_game_leaderboard(request):
         user_id = _to_int(user_id, 0)
         if user_id <= 0:
             return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
-        auth_ok, auth_reason = _authorize_game_request(user_id, init_data_raw)
+        auth_ok, auth_reason, _ = _authorize_game_request(user_id, init_data_raw, session_token)
         if not auth_ok:
             logger.warning(f"game_leaderboard auth failed: user={user_id}, reason={auth_reason}")
             return _unauthorized_game_response(headers, auth_reason)
@@ -7562,31 +7831,261 @@ async def handle_game_leaderboard(request):
                 headers=headers,
             )
 
-        rows, players_count = await asyncio.gather(
-            asyncio.to_thread(db.get_game_leaderboard, 50),
-            asyncio.to_thread(db.get_game_players_count),
-        )
-        leaderboard_payload = [
-            {
-                'uid': str(r[0]),
-                'name': r[1] or 'Игрок',
-                'score': int(r[2] or 0),
-                'completed': int(r[3] or 0),
-                'role': (r[5] if len(r) > 5 else 'player') or 'player',
-                'achievementCount': int(r[6] or 0) if len(r) > 6 else 0,
-                'achievementPts': int(r[7] or 0) if len(r) > 7 else 0,
-            }
-            for r in (rows or [])
-        ]
-        return aiohttp_web.json_response(
-            {'ok': True, 'leaderboard': leaderboard_payload, 'players_count': int(players_count or 0)},
-            headers=headers,
-        )
+        payload = await _game_leaderboard_payload()
+        return _game_json_response(request, dict(payload, ok=True), headers=headers)
     except Exception as e:
         logger.error(f"handle_game_leaderboard error: {e}")
         return aiohttp_web.json_response({'ok': False, 'error': str(e)[:100]}, headers=headers)
 
 
+def _parse_game_sync_event(data: dict) -> dict:
+    """Нормализует поля одного события /game_sync."""
+    return {
+        'total_score': _clamp_int(data.get('total_score', 0), 0, 999999),
+        'completed': _clamp_int(data.get('completed', 0), 0, 6),
+        'chapter': _clamp_int(data.get('chapter', 0), 0, 6),
+        'score': _clamp_int(data.get('score', 0), 0, 50000),
+        'game_over': _to_bool(data.get('game_over', False)),
+        'event_type': str(data.get('type', '') or ''),
+        'chapter_idx': _clamp_int(data.get('chapter_idx', -1), -1, 999),
+        'cipher_idx': _clamp_int(data.get('cipher_idx', -1), -1, 9999),
+        'chapter_in_progress': _to_bool(data.get('chapter_in_progress', False)),
+        'achievement_count': _clamp_int(data.get('achievement_count', 0), 0, 500),
+        'achievement_pts': _clamp_int(data.get('achievement_pts', 0), 0, 50000),
+        'restart_penalty_points': _clamp_int(data.get('restart_penalty_points', 0), 0, 50000),
+        'client_reset_token': _clamp_int(data.get('reset_token', 0), 0, 2147483647),
+        'secret_mode': str(data.get('secret_mode', 'none') or 'none').strip().lower(),
+        'mission_answer_token': _clamp_int(data.get('mission_answer_token', 0), 0, 2147483647),
+        'mission_break_token': _clamp_int(data.get('mission_break_token', 0), 0, 2147483647),
+        'mission_last_answer_elapsed': _clamp_int(data.get('mission_last_answer_elapsed', 0), 0, 9999),
+        'mission_last_answer_no_hint': _to_bool(data.get('mission_last_answer_no_hint', False)),
+        'mission_last_answer_one_life': _to_bool(data.get('mission_last_answer_one_life', False)),
+        'mission_last_answer_type': str(data.get('mission_last_answer_type', '') or '').strip().lower()[:24],
+        'mission_last_answer_streak': _clamp_int(data.get('mission_last_answer_streak', 0), 0, 200),
+        'chapter_hints': _clamp_int(data.get('chapter_hints', 0), 0, 999),
+        'chapter_errors': _clamp_int(data.get('chapter_errors', 0), 0, 999),
+        'lives': _clamp_int(data.get('lives', 0), -1, 99),
+    }
+
+
+async def _apply_game_sync(user_id: int, init_data_raw: str, event: dict) -> tuple[dict, int]:
+    """Применяет событие /game_sync; возвращает (ответ, HTTP-статус).
+
+    Вся работа с БД — один вызов adb.save_game_sync_result (серверная функция
+    game_sync_apply + секретные миссии в той же транзакции). Реферальный шаг и
+    секретные миссии откатываются там до своих SAVEPOINT: их ошибка не даёт 500
+    и не отменяет очки (ref_failed / secret = None в ответе БД)."""
+    event_type = event['event_type']
+    chapter_idx = event['chapter_idx']
+    cipher_idx = event['cipher_idx']
+    chapter_in_progress = event['chapter_in_progress']
+    client_reset_token = event['client_reset_token']
+
+    synced = await adb.save_game_sync_result(
+        user_id, _extract_user_name_from_init_data(init_data_raw) or None,
+        event['chapter'], event['score'], event['total_score'],
+        event['completed'], event['game_over'], False,
+        event_type, chapter_idx, cipher_idx, chapter_in_progress, event['restart_penalty_points'],
+        client_reset_token=client_reset_token,
+        achievement_count=event['achievement_count'],
+        achievement_pts=event['achievement_pts'],
+        secret_payload={
+            'type': event_type,
+            'event_type': event_type,
+            'secret_mode': event['secret_mode'],
+            'chapter_score': event['score'],
+            'chapter_errors': event['chapter_errors'],
+            'chapter_hints': event['chapter_hints'],
+            'lives': event['lives'],
+            'mission_answer_token': event['mission_answer_token'],
+            'mission_break_token': event['mission_break_token'],
+            'mission_last_answer_elapsed': event['mission_last_answer_elapsed'],
+            'mission_last_answer_no_hint': event['mission_last_answer_no_hint'],
+            'mission_last_answer_one_life': event['mission_last_answer_one_life'],
+            'mission_last_answer_type': event['mission_last_answer_type'],
+            'mission_last_answer_streak': event['mission_last_answer_streak'],
+        },
+        agents_limit=12,
+    )
+    if not synced or not synced.get('ok'):
+        return {'ok': False, 'error': 'save_failed'}, 500
+
+    db_score = _clamp_int(synced.get('db_score', 0), 0, 999999)
+    db_completed = _clamp_int(synced.get('db_completed', 0), 0, 6)
+    db_reset_token = _to_int(synced.get('db_reset_token', 0), 0)
+    banned = bool(synced.get('banned'))
+    current_role = synced.get('role') or 'player'
+
+    # Защита от перезаписи после админ-сброса:
+    # клиент обязан присылать актуальный reset_token из /game_state.
+    if synced.get('stale'):
+        logger.info(
+            "game_sync stale token: user=%s client_token=%s db_token=%s",
+            user_id, client_reset_token, db_reset_token
+        )
+        return (
+            {'ok': True, 'stale': True,
+             'saved': {'score': db_score, 'completed': db_completed},
+             'banned': banned, 'db_score': db_score, 'db_completed': db_completed,
+             'db_reset_token': db_reset_token, 'role': current_role},
+            200,
+        )
+
+    if synced.get('restart_mode_cleared'):
+        logger.info(
+            "game_sync cleared restart_mode: user=%s mode=%s type=%s chapter_idx=%s cipher_idx=%s in_progress=%s",
+            user_id, synced.get('restart_mode_cleared'), event_type, chapter_idx, cipher_idx, chapter_in_progress
+        )
+
+    if synced.get('ref_failed'):
+        logger.warning("game_sync referral step rolled back: user=%s type=%s", user_id, event_type)
+
+    server_penalty_applied = _clamp_int(synced.get('server_penalty_applied', 0), 0, 50000)
+    retreat_count = _clamp_int(synced.get('retreat_count', 0), 0, 999999)
+    ref_award_points_inviter = _clamp_int(synced.get('ref_award_inviter', 0), 0, 999999)
+    ref_award_points_invitee = _clamp_int(synced.get('ref_award_invitee', 0), 0, 999999)
+    ref_award_points_upstream = _clamp_int(synced.get('ref_award_upstream', 0), 0, 999999)
+    ref_award_chapters = _clamp_int(synced.get('ref_award_chapters', 0), 0, 6)
+    ref_inviter_percent = _clamp_int(synced.get('ref_inviter_percent', 0), 0, 100)
+    ref_invitee_percent = _clamp_int(synced.get('ref_invitee_percent', 1), 1, 100, 1)
+    ref_invited_count = _clamp_int(synced.get('ref_invited_count', 0), 0, 1000000)
+    ref_award_points = ref_award_points_inviter + ref_award_points_invitee
+    ref_summary = synced.get('ref_summary') if isinstance(synced.get('ref_summary'), dict) else {
+        'invited_count': 0, 'active_count': 0, 'rewarded_chapters': 0, 'bonus_points': 0,
+        'inviter_percent': 0, 'invitee_percent': 1, 'invitee_bonus_points': 0, 'referrer_id': 0,
+    }
+    ref_agents = []
+    for agent in synced.get('ref_agents') or []:
+        if not isinstance(agent, dict):
+            continue
+        ref_agents.append({
+            'user_id': int(agent.get('user_id', 0) or 0),
+            'name': str(agent.get('name') or 'Игрок')[:64],
+            'completed': int(agent.get('completed', 0) or 0),
+            'bonus_points': int(agent.get('bonus_points', 0) or 0),
+            'invitee_bonus_points': int(agent.get('invitee_bonus_points', 0) or 0),
+            'invitee_percent': int(agent.get('invitee_percent', 1) or 1),
+            'inviter_percent': int(agent.get('inviter_percent', 0) or 0),
+        })
+
+    secret_mode_saved = 'none'
+    secret_summary = {'completed': 0, 'total': 15, 'bonus_points': 0}
+    secret_missions = []
+    secret_awards = []
+    secret_awarded_points = 0
+    secret_sync = synced.get('secret')
+    if isinstance(secret_sync, dict):
+        secret_mode_saved = str(secret_sync.get('mode', 'none') or 'none')
+        if isinstance(secret_sync.get('summary'), dict):
+            secret_summary = secret_sync.get('summary')
+        if isinstance(secret_sync.get('missions'), list):
+            secret_missions = secret_sync.get('missions')
+        if isinstance(secret_sync.get('awards'), list):
+            secret_awards = secret_sync.get('awards')
+        secret_awarded_points = _clamp_int(secret_sync.get('awarded_points', 0), 0, 999999)
+
+    logger.info(
+        "game_sync OK: user=%s role=%s total_score=%s completed=%s chapter=%s score=%s chapter_idx=%s cipher_idx=%s in_progress=%s type=%s penalty=%s retreats=%s banned=%s ref_bonus_inviter=%s ref_bonus_invitee=%s ref_bonus_upstream=%s ref_chapters=%s secret_bonus=%s secret_mode=%s",
+        user_id, current_role, event['total_score'], event['completed'], event['chapter'], event['score'], chapter_idx, cipher_idx,
+        chapter_in_progress, event_type, server_penalty_applied, retreat_count, banned,
+        ref_award_points_inviter, ref_award_points_invitee, ref_award_points_upstream, ref_award_chapters, secret_awarded_points, secret_mode_saved
+    )
+    return (
+        {'ok': True, 'saved': {'score': db_score, 'completed': db_completed},
+          'banned': banned, 'db_score': db_score, 'db_completed': db_completed,
+          'db_reset_token': db_reset_token, 'stale': False, 'role': current_role,
+          'server_penalty_applied': server_penalty_applied,
+          'retreat_count': retreat_count,
+          'ref_bonus_awarded': ref_award_points,
+          'ref_bonus_awarded_inviter': ref_award_points_inviter,
+          'ref_bonus_awarded_invitee': ref_award_points_invitee,
+          'ref_bonus_awarded_upstream': ref_award_points_upstream,
+          'ref_bonus_chapters': ref_award_chapters,
+          'ref_inviter_percent': ref_inviter_percent,
+          'ref_invitee_percent': ref_invitee_percent,
+          'ref_invited_count': ref_invited_count,
+          'ref_summary': ref_summary,
+          'ref_agents': ref_agents,
+          'secret_mode': secret_mode_saved,
+          'secret_summary': secret_summary,
+          'secret_missions': secret_missions,
+          'secret_awards': secret_awards,
+          'secret_awarded_points': secret_awarded_points,
+          'force_state': bool(server_penalty_applied > 0)},
+        200,
+    )
+
+
+_SYNC_EVENT_ID_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._:-')
+
+
+def _parse_sync_event_id(value) -> str:
+    """Ключ идемпотентности события от клиента; '' — нет или некорректный."""
+    if not isinstance(value, str) or not 0 < len(value) <= 64:
+        return ''
+    return value if _SYNC_EVENT_ID_CHARS.issuperset(value) else ''
+
+
+async def _apply_game_sync_events(user_id: int, init_data_raw: str, events: list) -> tuple:
+    """Применяет события [(seq, event, event_ids)] по порядку в одной транзакции.
+
+    event_ids — ключи идемпотентности события и слитых в него тиков
+    (sync_coalesce.collapse). Событие, ответ на которое уже сохранён (повтор
+    после таймаута), не применяется заново: в сводку идёт сохранённый ответ.
+    Новый ответ записывается под всеми ключами в той же транзакции. Если тот
+    же ключ параллельно сохранил другой запрос, транзакция откатывается и
+    пачка проходит ещё раз — уже с его ответом. Ответ не 200 (ошибка основной
+    записи очков) откатывает всё: клиент повторит пачку. Сбой реферального шага
+    или секретных миссий пачку не откатывает (см. _apply_game_sync).
+
+    Возвращает (ответ, status, применено, last_seq, из сохранённых).
+    """
+    for _ in range(2):
+        merged, status, applied, last_seq, replayed, conflict = None, 200, 0, None, 0, False
+        unit = adb.session()
+        async with unit:
+            for seq, event, event_ids in events:
+                payload = None
+                for event_id in event_ids:
+                    payload = await adb.get_sync_response(user_id, event_id)
+                    if payload is not None:
+                        break
+                if payload is not None:
+                    replayed += 1
+                else:
+                    payload, status = await _apply_game_sync(user_id, init_data_raw, event)
+                    if status != 200:
+                        await unit.close(commit=False)
+                        merged = payload
+                        break
+                    for event_id in event_ids:
+                        if await adb.save_sync_response(user_id, event_id, payload) is False:
+                            conflict = True
+                            break
+                    if conflict:
+                        await unit.close(commit=False)
+                        break
+                merged = _merge_game_sync_batch(merged, payload)
+                applied += 1
+                last_seq = seq
+                # После админ-сброса остальные события пачки устарели так же.
+                if payload.get('stale') or payload.get('banned'):
+                    break
+        if conflict:
+            continue
+        if status == 200 and unit.failed:
+            logger.warning(f"game_sync transaction rolled back: user={user_id}, events={len(events)}")
+            return {'ok': False, 'error': 'save_failed'}, 500, 0, None, 0
+        return merged, status, applied, last_seq, replayed
+    return {'ok': False, 'error': 'save_failed'}, 500, 0, None, 0
+
+
+async def _apply_coalesced_sync(user_id: int, init_data_raw: str, event: dict, event_ids: tuple) -> tuple:
+    """Запись отложенного тика для SyncCoalescer."""
+    payload, status, _, _, _ = await _apply_game_sync_events(user_id, init_data_raw, [(0, event, event_ids)])
+    return payload, status
+
+
 async def handle_game_sync(request):
     """Принимает POST /game_sync от игры и сохраняет результат в БД."""
     headers = _game_cors_headers(request, 'POST, OPTIONS')
@@ -7600,30 +8099,9 @@ async def handle_game_sync(request):
 
     user_id = data.get('user_id')
     init_data_raw = data.get('init_data', '')
-    total_score = _clamp_int(data.get('total_score', 0), 0, 999999)
-    completed = _clamp_int(data.get('completed', 0), 0, 6)
-    chapter = _clamp_int(data.get('chapter', 0), 0, 6)
-    score = _clamp_int(data.get('score', 0), 0, 50000)
-    game_over = _to_bool(data.get('game_over', False))
-    event_type = str(data.get('type', '') or '')
-    chapter_idx = _clamp_int(data.get('chapter_idx', -1), -1, 999)
-    cipher_idx = _clamp_int(data.get('cipher_idx', -1), -1, 9999)
-    chapter_in_progress = _to_bool(data.get('chapter_in_progress', False))
-    achievement_count = _clamp_int(data.get('achievement_count', 0), 0, 500)
-    achievement_pts = _clamp_int(data.get('achievement_pts', 0), 0, 50000)
-    restart_penalty_points = _clamp_int(data.get('restart_penalty_points', 0), 0, 50000)
-    client_reset_token = _clamp_int(data.get('reset_token', 0), 0, 2147483647)
-    secret_mode = str(data.get('secret_mode', 'none') or 'none').strip().lower()
-    mission_answer_token = _clamp_int(data.get('mission_answer_token', 0), 0, 2147483647)
-    mission_break_token = _clamp_int(data.get('mission_break_token', 0), 0, 2147483647)
-    mission_last_answer_elapsed = _clamp_int(data.get('mission_last_answer_elapsed', 0), 0, 9999)
-    mission_last_answer_no_hint = _to_bool(data.get('mission_last_answer_no_hint', False))
-    mission_last_answer_one_life = _to_bool(data.get('mission_last_answer_one_life', False))
-    mission_last_answer_type = str(data.get('mission_last_answer_type', '') or '').strip().lower()[:24]
-    mission_last_answer_streak = _clamp_int(data.get('mission_last_answer_streak', 0), 0, 200)
-    chapter_hints = _clamp_int(data.get('chapter_hints', 0), 0, 999)
-    chapter_errors = _clamp_int(data.get('chapter_errors', 0), 0, 999)
-    lives = _clamp_int(data.get('lives', 0), -1, 99)
+    session_token = str(data.get('session', '') or '')
+    event = _parse_game_sync_event(data)
+    event_id = _parse_sync_event_id(data.get('event_id'))
 
     if not user_id:
         return aiohttp_web.json_response(
@@ -7633,7 +8111,7 @@ async def handle_game_sync(request):
         user_id = _to_int(user_id, 0)
         if user_id <= 0:
             return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
-        auth_ok, auth_reason = _authorize_game_request(user_id, init_data_raw)
+        auth_ok, auth_reason, _ = _authorize_game_request(user_id, init_data_raw, session_token)
         if not auth_ok:
             logger.warning(f"game_sync auth failed: user={user_id}, reason={auth_reason}")
             return _unauthorized_game_response(headers, auth_reason)
@@ -7650,238 +8128,160 @@ async def handle_game_sync(request):
                 status=503,
                 headers=headers,
             )
-        if _is_game_rate_limited('game_sync', user_id, limit=30):
+        if await _is_game_rate_limited('game_sync', user_id):
             return aiohttp_web.json_response(
                 {'ok': False, 'error': 'rate_limited'},
                 status=429,
                 headers=headers,
             )
 
-        # Проверяем текущий серверный счёт ДО сохранения
-        current_result = await asyncio.to_thread(db.get_game_result, user_id)
-        db_score_before = current_result[2] if current_result else 0
-        db_completed_before = current_result[3] if current_result else 0
-        db_reset_token_before = _game_reset_token(current_result)
-        restart_mode_before = None
-        try:
-            restart_mode_before = await asyncio.to_thread(db.get_restart_mode, user_id)
-        except Exception:
-            restart_mode_before = None
-        trusted_user_name = (
-            _extract_user_name_from_init_data(init_data_raw)
-            or (current_result[1] if current_result and len(current_result) > 1 and current_result[1] else None)
-            or 'Игрок'
-        )
+        coalescer = request.app.get('sync_coalescer')
+        if coalescer is None:
+            payload, status, _, _, replayed = await _apply_game_sync_events(
+                user_id, init_data_raw, [(0, event, (event_id,) if event_id else ())])
+        else:
+            async with coalescer.lock(user_id):
+                payload, status, replayed = coalescer.try_defer(user_id, init_data_raw, event, event_id), 200, 0
+                if payload is None:
+                    await coalescer.flush_locked(user_id)
+                    payload, status, _, _, replayed = await _apply_game_sync_events(
+                        user_id, init_data_raw, [(0, event, (event_id,) if event_id else ())])
+                    if status == 200:
+                        coalescer.remember(user_id, event, payload)
+        if replayed:
+            payload['replayed'] = True
+        if status == 200:
+            http_json.apply_section_versions(payload, GAME_SYNC_SECTIONS, http_json.parse_have(data.get('have')))
+        return _game_json_response(request, payload, status=status, headers=headers)
+    except Exception as e:
+        logger.error(f"game_sync error: {e}")
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': str(e)}, status=500, headers=headers)
 
-        # Защита от перезаписи после админ-сброса:
-        # клиент обязан присылать актуальный reset_token из /game_state.
-        if is_stale_sync_token(client_reset_token, db_reset_token_before):
-            current_role = await asyncio.to_thread(db.get_game_role, user_id)
-            banned = bool(current_result[6]) if current_result and len(current_result) > 6 else False
-            logger.info(
-                "game_sync stale token: user=%s client_token=%s db_token=%s",
-                user_id, client_reset_token, db_reset_token_before
-            )
-            return aiohttp_web.json_response(
-                {'ok': True, 'stale': True,
-                 'saved': {'score': db_score_before, 'completed': db_completed_before},
-                 'banned': banned, 'db_score': db_score_before, 'db_completed': db_completed_before,
-                 'db_reset_token': db_reset_token_before, 'role': current_role},
-                headers=headers)
 
-        sync_saved = await asyncio.to_thread(
-            db.save_game_sync_result,
-            user_id, trusted_user_name, chapter, score, total_score,
-            completed, game_over, False,
-            event_type, chapter_idx, cipher_idx, chapter_in_progress, restart_penalty_points
-        )
-        if not sync_saved or not sync_saved.get('ok'):
+# Сколько событий принимает один POST /game_sync_batch.
+GAME_SYNC_BATCH_MAX = 25
+
+
+def _merge_game_sync_batch(merged: dict | None, payload: dict) -> dict:
+    """Сводит ответы событий пачки: состояние — по последнему событию,
+    начисления и награды — суммой по всем."""
+    if merged is None:
+        return dict(payload)
+    result = dict(payload)
+    for key in sync_coalesce.AWARD_FIELDS:
+        result[key] = int(merged.get(key, 0) or 0) + int(payload.get(key, 0) or 0)
+    result['ref_bonus_chapters'] = max(
+        int(merged.get('ref_bonus_chapters', 0) or 0), int(payload.get('ref_bonus_chapters', 0) or 0))
+    result['secret_awards'] = list(merged.get('secret_awards') or []) + list(payload.get('secret_awards') or [])
+    result['force_state'] = bool(merged.get('force_state')) or bool(payload.get('force_state'))
+    return result
+
+
+async def handle_game_sync_batch(request):
+    """POST /game_sync_batch — очередь событий клиента одним запросом.
+
+    Тело: {user_id, init_data, events: [{seq, type, ...поля /game_sync}]}.
+    События применяются по возрастанию seq в одной транзакции (adb.session)
+    теми же _apply_game_sync, что и /game_sync; подряд идущие прогресс-тики
+    сливаются в последний (sync_coalesce.collapse). Ответ — сводное состояние
+    после последнего события и last_seq, до которого очередь подтверждена.
+    """
+    headers = _game_cors_headers(request, 'POST, OPTIONS')
+    if request.method == 'OPTIONS':
+        return aiohttp_web.Response(headers=headers)
+    try:
+        data = await request.json()
+    except Exception:
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'invalid json'}, status=400, headers=headers)
+    if not isinstance(data, dict):
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'invalid json'}, status=400, headers=headers)
+
+    user_id = data.get('user_id')
+    init_data_raw = data.get('init_data', '')
+    session_token = str(data.get('session', '') or '')
+    raw_events = data.get('events')
+    if not user_id:
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'no user_id'}, status=400, headers=headers)
+    if not isinstance(raw_events, list) or not raw_events:
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'no events'}, status=400, headers=headers)
+    if len(raw_events) > GAME_SYNC_BATCH_MAX:
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'batch_too_large', 'max_events': GAME_SYNC_BATCH_MAX},
+            status=413, headers=headers)
+
+    events = []
+    seen_seq = set()
+    for pos, raw in enumerate(raw_events):
+        if not isinstance(raw, dict):
+            continue
+        seq = _clamp_int(raw.get('seq', pos), 0, 2147483647)
+        if seq in seen_seq:
+            continue
+        seen_seq.add(seq)
+        event_id = _parse_sync_event_id(raw.get('event_id'))
+        events.append((seq, _parse_game_sync_event(raw), (event_id,) if event_id else ()))
+    events.sort(key=lambda item: item[0])
+    if not events:
+        return aiohttp_web.json_response(
+            {'ok': False, 'error': 'no events'}, status=400, headers=headers)
+
+    try:
+        user_id = _to_int(user_id, 0)
+        if user_id <= 0:
+            return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
+        auth_ok, auth_reason, _ = _authorize_game_request(user_id, init_data_raw, session_token)
+        if not auth_ok:
+            logger.warning(f"game_sync_batch auth failed: user={user_id}, reason={auth_reason}")
+            return _unauthorized_game_response(headers, auth_reason)
+        blocked, maint = await is_game_blocked_by_maintenance(user_id)
+        if blocked:
             return aiohttp_web.json_response(
-                {'ok': False, 'error': 'save_failed'},
-                status=500,
-                headers=headers
+                {
+                    'ok': False,
+                    'error': 'maintenance',
+                    'allowed': False,
+                    'access_reason': 'maintenance',
+                    'maintenance_until': maint.get('until'),
+                },
+                status=503,
+                headers=headers,
             )
-
-        server_penalty_applied = _clamp_int(sync_saved.get('server_penalty_applied', 0), 0, 50000)
-        retreat_count_saved = _clamp_int(sync_saved.get('retreat_count', 0), 0, 999999)
-        db_score_after_save = _clamp_int(sync_saved.get('db_score', db_score_before), 0, 999999)
-        db_completed_after_save = _clamp_int(sync_saved.get('db_completed', db_completed_before), 0, 6)
-        # reset_token уже защищает от устаревшего sync после админ-сброса.
-        # Поэтому достижения сохраняем при наличии реального прогресса
-        # (до или после текущего sync), чтобы не терять их на первом проходе.
-        has_progress = (db_score_before > 0) or (db_score_after_save > 0) or (completed > 0) or (db_completed_after_save > 0)
-        if (achievement_count > 0 or achievement_pts > 0) and has_progress:
-            await asyncio.to_thread(
-                db.update_achievement_stats, user_id, achievement_count, achievement_pts
+        if await _is_game_rate_limited('game_sync_batch', user_id):
+            return aiohttp_web.json_response(
+                {'ok': False, 'error': 'rate_limited'},
+                status=429,
+                headers=headers,
             )
-        # restart_mode должен быть одноразовым:
-        # после первого успешного sync очищаем флаг, чтобы клиент не сбрасывал прогресс повторно.
-        if restart_mode_before in ('penalty', 'nopts'):
-            try:
-                await asyncio.to_thread(db.clear_restart_mode, user_id)
-                logger.info(
-                    "game_sync cleared restart_mode: user=%s mode=%s type=%s chapter_idx=%s cipher_idx=%s in_progress=%s",
-                    user_id, restart_mode_before, event_type, chapter_idx, cipher_idx, chapter_in_progress
-                )
-            except Exception as clear_err:
-                logger.warning(f"game_sync clear_restart_mode failed: user={user_id}, err={clear_err}")
-        current_role = await asyncio.to_thread(db.get_game_role, user_id)
-        if not current_role or current_role == 'player':
-            # Назначаем роль только при первом входе
-            if not current_role:
-                role = 'player'
-                await asyncio.to_thread(db.set_game_role, user_id, role)
-                current_role = role
-        # Проверяем бан — игра должна знать об этом сразу
-        result = await asyncio.to_thread(db.get_game_result, user_id)
-        banned = bool(result[6]) if result and len(result) > 6 else False
-        db_score = result[2] if result else 0
-        db_completed = result[3] if result else 0
-        db_reset_token = _game_reset_token(result)
-        retreat_count = int(result[12]) if result and len(result) > 12 else retreat_count_saved
-        ref_award_points = 0
-        ref_award_points_inviter = 0
-        ref_award_points_invitee = 0
-        ref_award_points_upstream = 0
-        ref_award_chapters = 0
-        ref_inviter_percent = 0
-        ref_invitee_percent = 1
-        ref_invited_count = 0
-        ref_summary = {
-            'invited_count': 0, 'active_count': 0, 'rewarded_chapters': 0, 'bonus_points': 0,
-            'inviter_percent': 0, 'invitee_percent': 1, 'invitee_bonus_points': 0, 'referrer_id': 0,
-        }
-        ref_agents = []
-        secret_mode_saved = 'none'
-        secret_summary = {'completed': 0, 'total': 15, 'bonus_points': 0}
-        secret_missions = []
-        secret_awards = []
-        secret_awarded_points = 0
-        if current_role == 'player':
-            try:
-                ref_award = await asyncio.to_thread(
-                    db.apply_referral_bonus_for_completed,
-                    user_id,
-                    db_completed,
-                    db_score,
-                )
-                ref_award_points_upstream = _clamp_int(
-                    ref_award.get('awarded_points_to_referrer', ref_award.get('awarded_points_inviter', 0)),
-                    0,
-                    999999,
-                )
-                ref_award_points_invitee = _clamp_int(ref_award.get('awarded_points_invitee', 0), 0, 999999)
-                ref_award_chapters = _clamp_int(ref_award.get('awarded_chapters', 0), 0, 6)
-                ref_invitee_percent = _clamp_int(ref_award.get('invitee_percent', 1), 1, 100, 1)
-            except Exception as ref_err:
-                logger.warning(f"game_sync referral bonus failed: user={user_id}, err={ref_err}")
-            try:
-                ref_refresh = await asyncio.to_thread(db.refresh_referrer_bonus, user_id)
-                ref_award_points_inviter = _clamp_int(ref_refresh.get('awarded_points', 0), 0, 999999)
-                ref_inviter_percent = _clamp_int(ref_refresh.get('inviter_percent', 0), 0, 100)
-                ref_invited_count = _clamp_int(ref_refresh.get('invited_count', 0), 0, 1000000)
-            except Exception as ref_refresh_err:
-                logger.warning(f"game_sync referrer refresh failed: user={user_id}, err={ref_refresh_err}")
-            ref_award_points = ref_award_points_inviter + ref_award_points_invitee
-            if ref_award_points_inviter > 0 or ref_award_points_invitee > 0:
-                result = await asyncio.to_thread(db.get_game_result, user_id)
-                db_score = result[2] if result else db_score
-                db_completed = result[3] if result else db_completed
-                db_reset_token = _game_reset_token(result)
-                retreat_count = int(result[12]) if result and len(result) > 12 else retreat_count
-            try:
-                ref_summary, ref_agents = await asyncio.gather(
-                    asyncio.to_thread(db.get_referral_summary, user_id),
-                    asyncio.to_thread(db.get_referral_agents, user_id, 12),
-                )
-                safe_agents = []
-                for agent in ref_agents or []:
-                    if not isinstance(agent, dict):
-                        continue
-                    safe_agents.append({
-                        'user_id': int(agent.get('user_id', 0) or 0),
-                        'name': str(agent.get('name') or 'Игрок')[:64],
-                        'completed': int(agent.get('completed', 0) or 0),
-                        'bonus_points': int(agent.get('bonus_points', 0) or 0),
-                        'invitee_bonus_points': int(agent.get('invitee_bonus_points', 0) or 0),
-                        'invitee_percent': int(agent.get('invitee_percent', 1) or 1),
-                        'inviter_percent': int(agent.get('inviter_percent', 0) or 0),
-                    })
-                ref_agents = safe_agents
-            except Exception as ref_state_err:
-                logger.warning(f"game_sync referral state load failed: user={user_id}, err={ref_state_err}")
 
-        if current_role in ('player', 'tester', 'admin'):
-            try:
-                secret_sync = await asyncio.to_thread(
-                    db.apply_secret_missions_sync,
-                    user_id,
-                    {
-                        'type': event_type,
-                        'event_type': event_type,
-                        'secret_mode': secret_mode,
-                        'chapter_score': score,
-                        'chapter_errors': chapter_errors,
-                        'chapter_hints': chapter_hints,
-                        'lives': lives,
-                        'mission_answer_token': mission_answer_token,
-                        'mission_break_token': mission_break_token,
-                        'mission_last_answer_elapsed': mission_last_answer_elapsed,
-                        'mission_last_answer_no_hint': mission_last_answer_no_hint,
-                        'mission_last_answer_one_life': mission_last_answer_one_life,
-                        'mission_last_answer_type': mission_last_answer_type,
-                        'mission_last_answer_streak': mission_last_answer_streak,
-                    },
-                )
-                if isinstance(secret_sync, dict):
-                    secret_mode_saved = str(secret_sync.get('mode', 'none') or 'none')
-                    if isinstance(secret_sync.get('summary'), dict):
-                        secret_summary = secret_sync.get('summary')
-                    if isinstance(secret_sync.get('missions'), list):
-                        secret_missions = secret_sync.get('missions')
-                    if isinstance(secret_sync.get('awards'), list):
-                        secret_awards = secret_sync.get('awards')
-                    secret_awarded_points = _clamp_int(secret_sync.get('awarded_points', 0), 0, 999999)
-            except Exception as secret_err:
-                logger.warning(f"game_sync secret missions failed: user={user_id}, err={secret_err}")
-
-        if secret_awarded_points > 0:
-            result = await asyncio.to_thread(db.get_game_result, user_id)
-            db_score = result[2] if result else db_score
-            db_completed = result[3] if result else db_completed
-            db_reset_token = _game_reset_token(result)
-            retreat_count = int(result[12]) if result and len(result) > 12 else retreat_count
-        logger.info(
-            "game_sync OK: user=%s role=%s total_score=%s completed=%s chapter=%s score=%s chapter_idx=%s cipher_idx=%s in_progress=%s type=%s penalty=%s retreats=%s banned=%s ref_bonus_inviter=%s ref_bonus_invitee=%s ref_bonus_upstream=%s ref_chapters=%s secret_bonus=%s secret_mode=%s",
-            user_id, current_role, total_score, completed, chapter, score, chapter_idx, cipher_idx,
-            chapter_in_progress, event_type, server_penalty_applied, retreat_count, banned,
-            ref_award_points_inviter, ref_award_points_invitee, ref_award_points_upstream, ref_award_chapters, secret_awarded_points, secret_mode_saved
-        )
-        return aiohttp_web.json_response(
-            {'ok': True, 'saved': {'score': db_score, 'completed': db_completed},
-              'banned': banned, 'db_score': db_score, 'db_completed': db_completed,
-              'db_reset_token': db_reset_token, 'stale': False, 'role': current_role,
-              'server_penalty_applied': server_penalty_applied,
-              'retreat_count': retreat_count,
-              'ref_bonus_awarded': ref_award_points,
-              'ref_bonus_awarded_inviter': ref_award_points_inviter,
-              'ref_bonus_awarded_invitee': ref_award_points_invitee,
-              'ref_bonus_awarded_upstream': ref_award_points_upstream,
-              'ref_bonus_chapters': ref_award_chapters,
-              'ref_inviter_percent': ref_inviter_percent,
-              'ref_invitee_percent': ref_invitee_percent,
-              'ref_invited_count': ref_invited_count,
-              'ref_summary': ref_summary,
-              'ref_agents': ref_agents,
-              'secret_mode': secret_mode_saved,
-              'secret_summary': secret_summary,
-              'secret_missions': secret_missions,
-              'secret_awards': secret_awards,
-              'secret_awarded_points': secret_awarded_points,
-              'force_state': bool(server_penalty_applied > 0)},
-            headers=headers)
+        collapsed = sync_coalesce.collapse(events)
+        coalescer = request.app.get('sync_coalescer')
+        if coalescer is None:
+            merged, status, applied, last_seq, replayed = await _apply_game_sync_events(
+                user_id, init_data_raw, collapsed)
+        else:
+            async with coalescer.lock(user_id):
+                await coalescer.flush_locked(user_id)
+                merged, status, applied, last_seq, replayed = await _apply_game_sync_events(
+                    user_id, init_data_raw, collapsed)
+                if status == 200 and last_seq == collapsed[-1][0]:
+                    coalescer.remember(user_id, collapsed[-1][1], merged)
+        if status != 200:
+            return aiohttp_web.json_response(merged, status=status, headers=headers)
+        # Слитые тики подтверждены вместе с последним.
+        applied = sum(1 for seq, _, _ in events if last_seq is not None and seq <= last_seq)
+        merged['applied'] = applied
+        merged['last_seq'] = last_seq
+        merged['skipped'] = len(events) - applied
+        merged['replayed'] = replayed
+        http_json.apply_section_versions(merged, GAME_SYNC_SECTIONS, http_json.parse_have(data.get('have')))
+        return _game_json_response(request, merged, headers=headers)
     except Exception as e:
-        logger.error(f"game_sync error: {e}")
+        logger.error(f"game_sync_batch error: {e}")
         return aiohttp_web.json_response(
             {'ok': False, 'error': str(e)}, status=500, headers=headers)
 
@@ -7897,131 +8297,420 @@ async def handle_game_media(request):
     if not src_url:
         return aiohttp_web.Response(text='Track not found', status=404, headers=headers)
 
+    cache = request.app.get('media_cache')
+    if cache is not None:
+        try:
+            cached = await cache.get(track_id, src_url)
+        except Exception as e:
+            logger.warning(f"game_media cache fill failed: track={track_id}, err={e}")
+            cached = None
+        if cached is not None:
+            path, meta = cached
+            out_headers = dict(headers)
+            out_headers['Content-Type'] = meta.get('content_type') or 'application/octet-stream'
+            out_headers['Accept-Ranges'] = 'bytes'
+            out_headers['Cache-Control'] = 'public, max-age=86400'
+            # Range/If-Range FileResponse обрабатывает сам, тело идёт через sendfile.
+            return aiohttp_web.FileResponse(path, headers=out_headers)
+
     req_headers = {}
     range_header = request.headers.get('Range')
     if range_header:
         req_headers['Range'] = range_header
 
+    # Трек не в кэше (крупнее лимита или кэш недоступен) — проксируем потоком,
+    # не держа файл целиком в памяти.
+    resp = None
     try:
-        timeout = httpx.Timeout(20.0, connect=7.0)
-        async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
-            upstream = await client.get(src_url, headers=req_headers)
+        async with request.app['media_client'].stream('GET', src_url, headers=req_headers) as upstream:
+            if upstream.status_code not in (200, 206):
+                logger.warning(f"game_media upstream bad status: track={track_id}, status={upstream.status_code}")
+                return aiohttp_web.Response(text='Audio source error', status=502, headers=headers)
+
+            out_headers = dict(headers)
+            for name, out_name in (
+                ('content-type', 'Content-Type'),
+                ('content-range', 'Content-Range'),
+                ('accept-ranges', 'Accept-Ranges'),
+                ('etag', 'ETag'),
+                ('last-modified', 'Last-Modified'),
+            ):
+                value = upstream.headers.get(name)
+                if value:
+                    out_headers[out_name] = value
+            # aiter_bytes распаковывает Content-Encoding: длина источника тогда не подходит.
+            content_length = upstream.headers.get('content-length')
+            if content_length and not upstream.headers.get('content-encoding'):
+                out_headers['Content-Length'] = content_length
+            out_headers['Cache-Control'] = 'public, max-age=86400'
+
+            resp = aiohttp_web.StreamResponse(status=upstream.status_code, headers=out_headers)
+            await resp.prepare(request)
+            async for chunk in upstream.aiter_bytes(media_cache.FETCH_CHUNK_BYTES):
+                await resp.write(chunk)
     except Exception as e:
-        logger.warning(f"game_media upstream fetch failed: track={track_id}, err={e}")
-        return aiohttp_web.Response(text='Audio source unavailable', status=502, headers=headers)
-
-    if upstream.status_code not in (200, 206):
-        logger.warning(f"game_media upstream bad status: track={track_id}, status={upstream.status_code}")
-        return aiohttp_web.Response(text='Audio source error', status=502, headers=headers)
-
-    out_headers = dict(headers)
-    content_type = upstream.headers.get('content-type')
-    if content_type:
-        out_headers['Content-Type'] = content_type
-    content_length = upstream.headers.get('content-length')
-    if content_length:
-        out_headers['Content-Length'] = content_length
-    content_range = upstream.headers.get('content-range')
-    if content_range:
-        out_headers['Content-Range'] = content_range
-    accept_ranges = upstream.headers.get('accept-ranges')
-    if accept_ranges:
-        out_headers['Accept-Ranges'] = accept_ranges
-    etag = upstream.headers.get('etag')
-    if etag:
-        out_headers['ETag'] = etag
-    last_modified = upstream.headers.get('last-modified')
-    if last_modified:
-        out_headers['Last-Modified'] = last_modified
-    out_headers['Cache-Control'] = 'public, max-age=86400'
-
-    return aiohttp_web.Response(
-        body=upstream.content,
-        status=upstream.status_code,
-        headers=out_headers
-    )
+        if resp is None:
+            logger.warning(f"game_media upstream fetch failed: track={track_id}, err={e}")
+            return aiohttp_web.Response(text='Audio source unavailable', status=502, headers=headers)
+        # Заголовки уже ушли — остаётся оборвать ответ.
+        logger.warning(f"game_media stream aborted: track={track_id}, err={e}")
+        return resp
+    await resp.write_eof()
+    return resp
+
+
+async def handle_health(request):
+    """GET /health — healthcheck + метрики пула БД (ожидание checkout, таймауты)."""
+    return aiohttp_web.json_response({
+        'ok': True,
+        'db_pool': db.get_pool_stats(),
+        'db_async_pool': adb.get_pool_stats(),
+        'leaderboard': leaderboard.board.stats(),
+        'init_data_cache': init_data_cache_stats(),
+        'rate_limit': GAME_RATE_LIMITER.stats(),
+        'json_encoder': http_json.ENCODER_NAME,
+        'game_assets': request.app['game_assets'].stats() if 'game_assets' in request.app else None,
+        'media_cache': request.app['media_cache'].stats() if request.app.get('media_cache') else None,
+        'game_events': game_events.hub.stats(),
+        'sync_coalescer': request.app['sync_coalescer'].stats() if request.app.get('sync_coalescer') else None,
+        'referral_credits': db.get_referral_credit_stats(),
+        'referral_cache': db.get_referral_cache_stats(),
+    })
 
 
-def start_http_server_thread():
-    """Запускает aiohttp в отдельном потоке чтобы не конфликтовать с event loop бота."""
-    import threading
+_GAME_EVENT_TASKS: set = set()
+
+
+def _game_events_backend() -> str:
+    if GAME_EVENTS_BACKEND in ('memory', 'postgres'):
+        return GAME_EVENTS_BACKEND
+    return 'postgres' if GAME_API_WORKERS > 0 else 'memory'
+
+
+def _forward_game_event(topic: str, event: dict) -> None:
+    """publish при backend=postgres: NOTIFY из текущего event loop-а, из фонового
+    потока — синхронным NOTIFY. При ошибке событие раздаётся локально: из потока
+    это делает hub (исключение), из loop-а — _deliver_if_notify_failed."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        if not db.notify_game_event(game_events.NOTIFY_CHANNEL, game_events.encode_notify(topic, event)):
+            raise
+        return
+    task = loop.create_task(adb.notify_game_event(
+        game_events.NOTIFY_CHANNEL, game_events.encode_notify(topic, event)))
+    _GAME_EVENT_TASKS.add(task)
+    task.add_done_callback(_GAME_EVENT_TASKS.discard)
+    task.add_done_callback(functools.partial(_deliver_if_notify_failed, topic, event))
+
+
+def _deliver_if_notify_failed(topic: str, event: dict, task) -> None:
+    """NOTIFY из event loop-а не прошёл (False или исключение) — раздаём событие хотя бы в этом процессе."""
+    if task.cancelled():
+        return
+    if task.exception() is None and task.result():
+        return
+    game_events.hub.forward_errors += 1
+    game_events.hub.deliver(topic, event)
+
+
+def _publish_referral_credits(referrer_ids: list) -> None:
+    """Очередь начислений отдала доли пригласившим: их клиенты перечитают состояние."""
+    for referrer_id in referrer_ids:
+        game_events.publish_user(referrer_id, 'referral_bonus')
+
+
+def _on_remote_user_event(event: dict) -> None:
+    """Событие user:<id> через NOTIFY: запись могла смениться в другом процессе
+    (очередь бонусов, админка бота) — реферальная сводка и версия раздела ref
+    этого процесса устарели."""
+    if event.get('user_id'):
+        db.invalidate_referral_cache([event['user_id']])
+
+
+def _on_remote_settings_event(event: dict) -> None:
+    """Массовый сброс игры или переподключение LISTEN (события могли потеряться) — весь кэш рефералов."""
+    if event.get('reason') in ('reset_all', 'resync'):
+        db.invalidate_referral_cache()
+
+
+def _configure_game_events() -> None:
+    if _game_events_backend() == 'postgres':
+        game_events.hub.set_forwarder(_forward_game_event)
+        # При memory свои записи кэш сбрасывает после commit сам.
+        game_events.hub.add_listener(game_events.USER_TOPICS, _on_remote_user_event)
+        game_events.hub.add_listener(game_events.SETTINGS_TOPIC, _on_remote_settings_event)
+
+
+def _on_game_event_notify(payload: str) -> None:
+    """NOTIFY от другого процесса: техрежим перечитываем сразу, остальное — клиентам."""
+    if '"maintenance"' in payload:
+        _maintenance_cache['last_check'] = datetime.min
+    game_events.hub.deliver_notify(payload)
+
+
+async def _listen_game_events() -> None:
+    """LISTEN канала событий; после переподключения клиентам уходит resync (события могли потеряться)."""
+    reconnect = False
+    while True:
+        conn = None
+        try:
+            conn = await adb.open_listener(game_events.NOTIFY_CHANNEL, _on_game_event_notify)
+            if reconnect:
+                game_events.hub.deliver(game_events.SETTINGS_TOPIC, {'type': 'settings', 'reason': 'resync'})
+            reconnect = True
+            while True:
+                await asyncio.sleep(30)
+                await conn.execute('SELECT 1')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"game_events listener reconnect: {e}")
+            await asyncio.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+
+
+def _pending_chapter_openings(schedule: list) -> list:
+    """Время (unix) запланированных, но ещё закрытых глав."""
+    pending = []
+    for row in schedule or []:
+        if row.get('open') or not row.get('open_at'):
+            continue
+        try:
+            pending.append(datetime.fromisoformat(row['open_at']).timestamp())
+        except (TypeError, ValueError):
+            continue
+    return sorted(pending)
+
+
+async def _game_events_ticker() -> None:
+    """Фон процесса API: рассылает топ рейтинга при изменении и событие открытия глав по расписанию.
+
+    Источник топа — рейтинг в памяти этого процесса, поэтому события leaderboard
+    раздаются локально (у каждого воркера свой тикер), а не через NOTIFY.
+    """
+    hub = game_events.hub
+    board_sig = None
+    top_version = None
+    openings: list = []
+    schedule_checked = 0.0
+    while True:
+        await asyncio.sleep(GAME_EVENTS_TICK_SEC)
+        try:
+            if hub.has_subscribers(game_events.LEADERBOARD_TOPIC) and leaderboard.board.ready:
+                sig = (leaderboard.board.updates, leaderboard.board.loaded_at)
+                if sig != board_sig:
+                    board_sig = sig
+                    payload = await _game_leaderboard_payload()
+                    version = http_json.section_version(payload)
+                    if version != top_version:
+                        top_version = version
+                        hub.deliver(game_events.LEADERBOARD_TOPIC,
+                                    dict(payload, type='leaderboard', reason='top'))
+            if hub.has_subscribers(game_events.SETTINGS_TOPIC):
+                now = time.time()
+                due = bool(openings) and openings[0] <= now
+                if due:
+                    hub.deliver(game_events.SETTINGS_TOPIC, {'type': 'settings', 'reason': 'chapters'})
+                if due or now - schedule_checked >= 60:
+                    schedule_checked = now
+                    openings = [ts for ts in _pending_chapter_openings(
+                        await adb.get_chapter_schedule_for_game()) if ts > now - 1]
+        except Exception as e:
+            logger.warning(f"game_events ticker error: {e}")
+
+
+async def handle_game_events(request):
+    """GET /game_events?user_id=...&session=... — поток Server-Sent Events для Mini App.
+
+    Темы: состояние игрока, топ рейтинга, настройки игры (техрежим, главы).
+    Клиент перечитывает /game_state только по событию, а не по таймеру.
+    """
+    headers = _game_cors_headers(request, 'GET, OPTIONS')
+    if request.method == 'OPTIONS':
+        return aiohttp_web.Response(headers=headers)
+
+    query = request.rel_url.query
+    user_id = _to_int(query.get('user_id'), 0)
+    if user_id <= 0:
+        return aiohttp_web.json_response({'ok': False, 'error': 'invalid user_id'}, status=400, headers=headers)
+    auth_ok, auth_reason, _ = _authorize_game_request(user_id, query.get('init_data', ''), query.get('session', ''))
+    if not auth_ok:
+        logger.warning(f"game_events auth failed: user={user_id}, reason={auth_reason}")
+        return _unauthorized_game_response(headers, auth_reason)
+    hub = game_events.hub
+    if hub.stats()['clients'] >= GAME_EVENTS_MAX_CLIENTS:
+        # Клиент останется на опросе /game_state.
+        return aiohttp_web.json_response({'ok': False, 'error': 'busy'}, status=503, headers=headers)
+
+    topics = {game_events.user_topic(user_id), game_events.SETTINGS_TOPIC}
+    if 'leaderboard' in str(query.get('topics', '')).split(','):
+        topics.add(game_events.LEADERBOARD_TOPIC)
+
+    response = aiohttp_web.StreamResponse(headers=dict(
+        headers,
+        **{
+            'Content-Type': 'text/event-stream; charset=utf-8',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    ))
+    await response.prepare(request)
+    sub = hub.subscribe(topics)
+    try:
+        await response.write(b'retry: 5000\nevent: hello\ndata: {"ok":true}\n\n')
+        while True:
+            events = await sub.next(GAME_EVENTS_HEARTBEAT_SEC)
+            if not events:
+                await response.write(b': ping\n\n')
+                continue
+            await response.write(b''.join(game_events.format_sse(topic, event) for topic, event in events))
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.unsubscribe(sub)
+    return response
+
+
+def _build_game_media_cache(client):
+    """MediaCache для /game_media или None (GAME_MEDIA_CACHE_MB=0, каталог недоступен)."""
+    if GAME_MEDIA_CACHE_MB <= 0:
+        return None
+    try:
+        return media_cache.MediaCache(
+            GAME_MEDIA_CACHE_DIR,
+            GAME_MEDIA_CACHE_MB * 1024 * 1024,
+            functools.partial(media_cache.httpx_fetch, client=client),
+        )
+    except OSError as e:
+        logger.warning(f"game_media cache disabled: dir={GAME_MEDIA_CACHE_DIR}, err={e}")
+        return None
+
+
+def _build_game_http_app() -> aiohttp_web.Application:
+    """aiohttp-приложение Mini App: API и файлы игры."""
     import pathlib
-    import sys
 
     GAME_DIR = pathlib.Path(__file__).parent / 'game'
+    assets = game_assets.AssetStore(GAME_DIR).load()
+
+    def _asset_response(request, name: str):
+        result = assets.respond(
+            name,
+            request.headers.get('Accept-Encoding'),
+            request.headers.get('If-None-Match'),
+        )
+        if result is None:
+            return None
+        status, body, headers = result
+        return aiohttp_web.Response(body=body if status == 200 else None, status=status, headers=headers)
 
     async def serve_game_index(request):
-        """Отдаёт index.html игры."""
-        fpath = GAME_DIR / 'index.html'
-        if fpath.exists():
-            return aiohttp_web.FileResponse(fpath, headers={
-                'Content-Type': 'text/html; charset=utf-8',
-                'Cache-Control': 'no-cache, no-store, must-revalidate',
-            })
+        """Отдаёт index.html игры (с картой хэшированных имён, revalidate по ETag)."""
+        response = _asset_response(request, game_assets.INDEX_NAME)
+        if response is not None:
+            return response
         return aiohttp_web.Response(text='Game not found', status=404)
 
     async def serve_game_file(request):
-        """Отдаёт файлы игры (game.js и пр.)."""
+        """Отдаёт файлы игры: game.<hash>.js — immutable, game.js — с revalidate."""
         filename = request.match_info.get('filename', '')
         safe_filename = pathlib.Path(filename).name
         # Защита от path traversal и скрытых файлов
         if safe_filename != filename or safe_filename.startswith('.'):
             logger.warning(f"serve_game_file forbidden: filename='{filename}', path='{request.path_qs}'")
             return aiohttp_web.Response(text='Forbidden', status=403)
-        fpath = GAME_DIR / safe_filename
-        if fpath.exists() and fpath.is_file():
-            content_types = {
-                '.js': 'application/javascript; charset=utf-8',
-                '.css': 'text/css; charset=utf-8',
-                '.html': 'text/html; charset=utf-8',
-                '.png': 'image/png',
-                '.jpg': 'image/jpeg',
-                '.svg': 'image/svg+xml',
-            }
-            ct = content_types.get(fpath.suffix, 'application/octet-stream')
-            return aiohttp_web.FileResponse(fpath, headers={
-                'Content-Type': ct,
-                'Cache-Control': 'no-cache, no-store, must-revalidate',
-            })
+        response = _asset_response(request, safe_filename)
+        if response is not None:
+            return response
         logger.warning(f"serve_game_file not found: filename='{filename}', path='{request.path_qs}'")
         return aiohttp_web.Response(text='Not found', status=404)
 
+    app_http = aiohttp_web.Application()
+    app_http['game_assets'] = assets
+    media_client = httpx.AsyncClient(timeout=httpx.Timeout(20.0, connect=7.0), follow_redirects=True)
+    app_http['media_client'] = media_client
+    app_http['media_cache'] = _build_game_media_cache(media_client)
+
+    async def _close_media_client(_app):
+        await media_client.aclose()
+
+    app_http.on_cleanup.append(_close_media_client)
+
+    async def _start_game_events(app):
+        app['game_events_tasks'] = [asyncio.create_task(_game_events_ticker())]
+        if game_events.hub.backend == 'postgres':
+            app['game_events_tasks'].append(asyncio.create_task(_listen_game_events()))
+
+    async def _stop_game_events(app):
+        for task in app.get('game_events_tasks', []):
+            task.cancel()
+
+    app_http.on_startup.append(_start_game_events)
+    app_http.on_cleanup.append(_stop_game_events)
+
+    if GAME_SYNC_COALESCE_MS > 0:
+        coalescer = sync_coalesce.SyncCoalescer(GAME_SYNC_COALESCE_MS / 1000, _apply_coalesced_sync)
+        app_http['sync_coalescer'] = coalescer
+
+        async def _flush_sync_coalescer(_app):
+            await coalescer.flush_all()
+
+        app_http.on_shutdown.append(_flush_sync_coalescer)
+    # API
+    app_http.router.add_post('/game_reset', handle_game_reset)
+    app_http.router.add_options('/game_reset', handle_game_reset)
+    app_http.router.add_get('/game_state', handle_game_state)
+    app_http.router.add_options('/game_state', handle_game_state)
+    app_http.router.add_get('/game_leaderboard', handle_game_leaderboard)
+    app_http.router.add_options('/game_leaderboard', handle_game_leaderboard)
+    app_http.router.add_post('/game_sync', handle_game_sync)
+    app_http.router.add_options('/game_sync', handle_game_sync)
+    app_http.router.add_post('/game_sync_batch', handle_game_sync_batch)
+    app_http.router.add_options('/game_sync_batch', handle_game_sync_batch)
+    app_http.router.add_get('/game_events', handle_game_events)
+    app_http.router.add_options('/game_events', handle_game_events)
+    app_http.router.add_get('/game_media/{track_id}', handle_game_media)
+    app_http.router.add_options('/game_media/{track_id}', handle_game_media)
+    app_http.router.add_get('/health', handle_health)
+    # Файлы игры
+    app_http.router.add_get('/', serve_game_index)
+    app_http.router.add_get('/index.html', serve_game_index)
+    app_http.router.add_get('/game', serve_game_index)
+    app_http.router.add_get('/game/', serve_game_index)
+    app_http.router.add_get('/game/{filename}', serve_game_file)
+    app_http.router.add_get('/{filename}', serve_game_file)
+    logger.info(f"📁 Game dir: {GAME_DIR} (exists: {GAME_DIR.exists()}), assets: {assets.manifest(assets.assets)}")
+    return app_http
+
+
+async def _serve_game_http(reuse_port: bool = False, label: str = 'HTTP server') -> None:
+    """Поднимает приложение Mini App на PORT и держит его запущенным.
+    reuse_port=True — SO_REUSEPORT: несколько процессов слушают один порт,
+    ядро распределяет между ними соединения."""
+    runner = aiohttp_web.AppRunner(_build_game_http_app())
+    await runner.setup()
+    site = aiohttp_web.TCPSite(runner, '0.0.0.0', PORT, reuse_port=reuse_port or None)
+    await site.start()
+    logger.info(f"✅ {label} started on port {PORT}")
+    # Держим сервер запущенным
+    await asyncio.Event().wait()
+
 
-    async def _run():
-        app_http = aiohttp_web.Application()
-        # API
-        app_http.router.add_post('/game_reset', handle_game_reset)
-        app_http.router.add_options('/game_reset', handle_game_reset)
-        app_http.router.add_get('/game_state', handle_game_state)
-        app_http.router.add_options('/game_state', handle_game_state)
-        app_http.router.add_get('/game_leaderboard', handle_game_leaderboard)
-        app_http.router.add_options('/game_leaderboard', handle_game_leaderboard)
-        app_http.router.add_post('/game_sync', handle_game_sync)
-        app_http.router.add_options('/game_sync', handle_game_sync)
-        app_http.router.add_get('/game_media/{track_id}', handle_game_media)
-        app_http.router.add_options('/game_media/{track_id}', handle_game_media)
-        app_http.router.add_get('/health', lambda r: aiohttp_web.json_response({'ok': True}))
-        # Файлы игры
-        app_http.router.add_get('/', serve_game_index)
-        app_http.router.add_get('/index.html', serve_game_index)
-        app_http.router.add_get('/game', serve_game_index)
-        app_http.router.add_get('/game/', serve_game_index)
-        app_http.router.add_get('/game/{filename}', serve_game_file)
-        app_http.router.add_get('/{filename}', serve_game_file)
-        runner = aiohttp_web.AppRunner(app_http)
-        await runner.setup()
-        site = aiohttp_web.TCPSite(runner, '0.0.0.0', PORT)
-        await site.start()
-        logger.info(f"✅ HTTP server started on port {PORT}")
-        logger.info(f"📁 Game dir: {GAME_DIR} (exists: {GAME_DIR.exists()})")
-        # Держим сервер запущенным
-        await asyncio.Event().wait()
+def start_http_server_thread():
+    """Запускает aiohttp в отдельном потоке чтобы не конфликтовать с event loop бота."""
+    import threading
 
     def _thread():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(_run())
+            loop.run_until_complete(_serve_game_http())
         except Exception as e:
             logger.error(f"HTTP server error: {e}")
 
@@ -8030,6 +8719,63 @@ def start_http_server_thread():
     logger.info(f"HTTP server thread started (port {PORT})")
 
 
+def run_game_api_worker(worker_idx: int = 0, reuse_port: bool = True) -> None:
+    """Процесс API Mini App без Telegram polling (GAME_API_WORKERS или `python bot.py api`).
+
+    Свой пул БД, свой рейтинг в памяти (сверка с БД — LEADERBOARD_RECONCILE_SEC)
+    и свой event loop: тяжёлые обработчики бота больше не делят с /game_sync GIL.
+    Фоновые задачи на всю БД (очистка ответов sync, сверка реферальных
+    счётчиков, очередь бонусов пригласивших) запускает только main(): иначе
+    при GAME_API_WORKERS=N их работало бы N+1 копий.
+    """
+    db.init_pool(maxconn=_db_pool_maxconn())
+    db.leaderboard_reload()
+    db.start_leaderboard_reconciler()
+    if GAME_RATE_LIMITER.backend.name == 'memory':
+        # Общие счётчики (postgres) чистит процесс бота.
+        GAME_RATE_LIMITER.start_sweeper()
+    _configure_game_events()
+    try:
+        asyncio.run(_serve_game_http(reuse_port=reuse_port, label=f"API worker {worker_idx}"))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_game_api_workers(count: int) -> None:
+    """Запускает count процессов run_game_api_worker на общем порту (SO_REUSEPORT)
+    и перезапускает упавшие. Процессы — daemon: завершаются вместе с ботом."""
+    import multiprocessing
+    import threading
+
+    if GAME_RATE_LIMITER.backend.name == 'memory':
+        logger.warning(
+            "GAME_API_WORKERS=%s с GAME_RATE_LIMIT_BACKEND=memory: лимиты считаются в каждом воркере отдельно",
+            count,
+        )
+    # spawn, а не fork: пул psycopg2 и потоки родителя не должны попасть в дочерние процессы.
+    ctx = multiprocessing.get_context('spawn')
+    workers: list = [None] * count
+
+    def _start(idx: int):
+        proc = ctx.Process(target=run_game_api_worker, args=(idx,), name=f'game-api-{idx}', daemon=True)
+        proc.start()
+        workers[idx] = proc
+        logger.info(f"API worker {idx} started (pid {proc.pid})")
+
+    for idx in range(count):
+        _start(idx)
+
+    def _watch():
+        while True:
+            time.sleep(5)
+            for idx, proc in enumerate(workers):
+                if proc is not None and not proc.is_alive():
+                    logger.error(f"API worker {idx} exited with code {proc.exitcode}, restarting")
+                    _start(idx)
+
+    threading.Thread(target=_watch, name='game-api-watch', daemon=True).start()
+
+
 def main():
     # Ждём БД при старте (Railway PostgreSQL стартует чуть позже бота)
     max_wait = _env_int('DB_STARTUP_MAX_WAIT_SEC', 180)
@@ -8038,9 +8784,9 @@ def main():
     for attempt in range(attempts):
         try:
             db.init_db()
-            db.init_pool()
+            db.init_pool(maxconn=_db_pool_maxconn())
             db.seed_teachers(ALL_TEACHERS)
-            db.migrate_bot_admins_table()
+            db.leaderboard_reload()
             logger.info("✅ БД инициализирована успешно")
             break
         except Exception as e:
@@ -8051,9 +8797,19 @@ def main():
                 logger.critical(f"❌ БД недоступна после {max_wait}с: {e}")
                 raise SystemExit(1)
 
+    db.start_leaderboard_reconciler()
+    db.start_game_sync_responses_purger()
+    db.start_referral_counters_repair()
+    db.start_referral_credit_worker(on_credited=_publish_referral_credits)
+    GAME_RATE_LIMITER.start_sweeper()
+    _configure_game_events()
+
     # Запускаем HTTP-сервер ДО ожидания polling lock —
     # чтобы файлы игры отдавались сразу, даже пока старый инстанс ещё жив.
-    start_http_server_thread()
+    if GAME_API_WORKERS > 0:
+        start_game_api_workers(GAME_API_WORKERS)
+    else:
+        start_http_server_thread()
 
     # Один активный poller на весь бот (исключаем Conflict при параллельных инстансах)
     if not db.wait_for_polling_lock(max_wait_sec=60, interval_sec=3):
@@ -8067,10 +8823,14 @@ def main():
             ("cancel",  "❌ Отменить последнее действие"),
         ])
 
+    async def post_shutdown(application):
+        await adb.close_pool()
+
     app = (
         Application.builder()
         .token(TOKEN)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         # Не блокируем все кнопки одним долгим обработчиком (ИИ/админка и т.п.)
         .concurrent_updates(64)
         .read_timeout(REQUEST_TIMEOUT)
@@ -8186,4 +8946,10 @@ def get_main_menu_kb(profile: dict | None, is_admin: bool = False,
 
 
 if __name__ == '__main__':
-    main()
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'api':
+        # Отдельный сервис только с API Mini App (без polling).
+        run_game_api_worker(reuse_port=True)
+    else:
+        main()
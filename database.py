@@ -1,12 +1,20 @@
 ﻿import psycopg2
+import psycopg2.extensions
 from psycopg2 import pool
 import os
 import time
 import json
+import asyncio
+import threading
+import contextvars
+from collections import deque
 from datetime import datetime, timedelta
 import pytz
 import logging
 
+import leaderboard
+import referral_cache
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -14,8 +22,17 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("❌ DATABASE_URL не установлен!")
 
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int((os.environ.get(name) or "").strip() or default)
+    except Exception:
+        return default
+
+
 db_pool = None
 _TEMP_CONNECTION_IDS: set[int] = set()
+_TEMP_CONNECTIONS_OPENED = 0
 _POLLING_LOCK_CONN = None
 _POLLING_LOCK_KEY = 82445031
 
@@ -23,6 +40,27 @@ _POLLING_LOCK_KEY = 82445031
 _DB_RETRY_ATTEMPTS = 5        # попыток переподключения
 _DB_RETRY_DELAYS   = [1, 2, 4, 8, 15]  # секунды между попытками
 
+# Параметры пула соединений.
+# DB_POOL_MAX — верхняя граница; фактический размер задаёт init_pool(maxconn=...)
+# по числу потоков, которые реально ходят в БД (см. bot._db_pool_maxconn).
+DB_POOL_MIN = max(1, _env_int('DB_POOL_MIN', 2))
+DB_POOL_MAX = max(DB_POOL_MIN, _env_int('DB_POOL_MAX', 20))
+DB_POOL_WAIT_MS = max(0, _env_int('DB_POOL_WAIT_MS', 5000))        # сколько ждать свободное соединение
+DB_POOL_MAX_WAITERS = max(0, _env_int('DB_POOL_MAX_WAITERS', 64))  # длина очереди ожидания
+DB_POOL_MAX_AGE_SEC = max(0, _env_int('DB_POOL_MAX_AGE_SEC', 1800))  # 0 — без ограничения
+DB_POOL_MAX_IDLE_SEC = max(0, _env_int('DB_POOL_MAX_IDLE_SEC', 300))
+DB_POOL_SLOW_WAIT_MS = max(0, _env_int('DB_POOL_SLOW_WAIT_MS', 200))
+# Фоновая проверка живости: раз в DB_POOL_HEALTH_INTERVAL_SEC пингуем только
+# соединения, простоявшие дольше DB_POOL_PROBE_IDLE_SEC. На checkout SELECT 1
+# делается только для таких же давно не проверенных соединений, тёплые выдаются сразу.
+DB_POOL_HEALTH_INTERVAL_SEC = max(1, _env_int('DB_POOL_HEALTH_INTERVAL_SEC', 15))
+DB_POOL_PROBE_IDLE_SEC = max(1, _env_int('DB_POOL_PROBE_IDLE_SEC', 30))
+# Рейтинг в памяти (leaderboard.py): период полной сверки с БД, 0 — без сверки.
+LEADERBOARD_RECONCILE_SEC = max(0, _env_int('LEADERBOARD_RECONCILE_SEC', 300))
+# Кэш реферальной сводки и агентов (referral_cache.py): срок жизни записи, 0 — без кэша.
+REFERRAL_CACHE_TTL_SEC = max(0, _env_int('REFERRAL_CACHE_TTL_SEC', 60))
+_referral_cache = referral_cache.ReferralCache(ttl_sec=REFERRAL_CACHE_TTL_SEC)
+
 _SECRET_MODES = {
     'none':    {'title': 'Обычный режим', 'bonus_pct': 0},
     'silent':  {'title': 'Тихий шифр', 'bonus_pct': 20},
@@ -217,9 +255,378 @@ _SECRET_MISSIONS = [
 _SECRET_MISSIONS_BY_ID = {m['id']: m for m in _SECRET_MISSIONS}
 
 
-def init_pool():
-    '''Инициализирует пул соединений с retry.'''
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение пула.
+
+    session — DbSession, которой сейчас принадлежит соединение: в атомарной
+    сессии commit() откладывается до её завершения, а rollback() откатывает
+    всю сессию.
+    leaderboard_rows — строки рейтинга, прочитанные после записи очков/ролей
+    (см. _leaderboard_stage): попадают в leaderboard.board только после
+    настоящего commit, rollback их отбрасывает. Так же referral_stale
+    (пользователи, чью реферальную запись в кэше сбросить; None — всех) и
+    referral_fresh (аргументы _referral_cache.put, см. _referral_cache_defer).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.leaderboard_rows = []
+        self.leaderboard_full = False
+        self.referral_stale = set()
+        self.referral_fresh = []
+
+    def commit(self):
+        session = self.session
+        if session is not None and session.atomic:
+            return
+        super().commit()
+        rows, full = self.leaderboard_rows, self.leaderboard_full
+        if rows or full:
+            self.leaderboard_rows, self.leaderboard_full = [], False
+            if full:
+                leaderboard.board.load(rows)
+            else:
+                leaderboard.board.apply(rows)
+        stale, fresh = self.referral_stale, self.referral_fresh
+        if stale or fresh:
+            self.referral_stale, self.referral_fresh = set(), []
+            _referral_cache_apply(stale, fresh)
+
+    def rollback(self):
+        session = self.session
+        if session is not None and session.atomic:
+            session.failed = True
+        self.leaderboard_rows, self.leaderboard_full = [], False
+        self.referral_stale, self.referral_fresh = set(), []
+        super().rollback()
+
+
+class BoundedConnectionPool:
+    '''Потокобезопасный пул psycopg2 с ограниченной очередью ожидания.
+
+    В отличие от SimpleConnectionPool: при исчерпании пула поток ждёт
+    освобождения соединения (не дольше wait_ms, в очереди не больше
+    max_waiters потоков), соединения пересоздаются по возрасту и простою,
+    а время ожидания checkout попадает в stats(). Живость простаивающих
+    соединений проверяет фоновый поток (start_reaper); getconn пингует только
+    соединение, не проверявшееся дольше probe_idle_sec (reaper до него ещё
+    не дошёл), и вместо мёртвого выдаёт следующее. Соединение, вернувшееся
+    закрытым (сервер рвал соединения), делает такими же все простаивающие.
+    '''
+
+    def __init__(self, minconn: int, maxconn: int, *args,
+                 wait_ms: int = DB_POOL_WAIT_MS,
+                 max_waiters: int = DB_POOL_MAX_WAITERS,
+                 max_age_sec: int = DB_POOL_MAX_AGE_SEC,
+                 max_idle_sec: int = DB_POOL_MAX_IDLE_SEC,
+                 probe_idle_sec: int = DB_POOL_PROBE_IDLE_SEC,
+                 **kwargs):
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, self.minconn, int(maxconn))
+        self.wait_ms = max(0, int(wait_ms))
+        self.max_waiters = max(0, int(max_waiters))
+        self.max_age_sec = max(0, int(max_age_sec))
+        self.max_idle_sec = max(0, int(max_idle_sec))
+        self.probe_idle_sec = max(0, int(probe_idle_sec))
+        self.closed = False
+        self._args = args
+        self._kwargs = kwargs
+        self._cond = threading.Condition()
+        self._idle: deque = deque()          # (conn, created_at, released_at, checked_at)
+        self._used: dict[int, tuple] = {}    # id(conn) -> (conn, created_at)
+        self._size = 0                       # открытые + открываемые соединения
+        self._waiters = 0
+        self._recent_waits_ms: deque = deque(maxlen=512)
+        self._reaper: threading.Thread | None = None
+        self._reaper_stop = threading.Event()
+        self._stats = {
+            'checkouts': 0,
+            'waited': 0,
+            'wait_ms_total': 0.0,
+            'wait_ms_max': 0.0,
+            'timeouts': 0,
+            'rejected': 0,
+            'opened': 0,
+            'recycled': 0,
+            'probed': 0,
+            'probe_failed': 0,
+        }
+        for _ in range(self.minconn):
+            conn = self._connect()
+            now = time.monotonic()
+            self._idle.append((conn, now, now, now))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(*self._args, **self._kwargs)
+        self._stats['opened'] += 1
+        return conn
+
+    def _is_expired(self, created_at: float, released_at: float, now: float) -> bool:
+        if self.max_age_sec and now - created_at > self.max_age_sec:
+            return True
+        if self.max_idle_sec and now - released_at > self.max_idle_sec:
+            return True
+        return False
+
+    @staticmethod
+    def _close_quietly(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _record_wait(self, started: float) -> None:
+        waited_ms = (time.monotonic() - started) * 1000
+        st = self._stats
+        st['checkouts'] += 1
+        if waited_ms >= 1.0:
+            st['waited'] += 1
+        st['wait_ms_total'] += waited_ms
+        if waited_ms > st['wait_ms_max']:
+            st['wait_ms_max'] = waited_ms
+        self._recent_waits_ms.append(waited_ms)
+        if DB_POOL_SLOW_WAIT_MS and waited_ms >= DB_POOL_SLOW_WAIT_MS:
+            logger.warning(
+                f"slow-db-pool checkout: {waited_ms:.1f} ms "
+                f"(in_use={len(self._used)}, size={self._size}/{self.maxconn}, waiters={self._waiters})"
+            )
+
+    @staticmethod
+    def _probe(conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        while True:
+            conn, checked_at = self._take()
+            if checked_at is None or time.monotonic() - checked_at < self.probe_idle_sec:
+                return conn
+            alive = self._probe(conn)
+            with self._cond:
+                self._stats['probed'] += 1
+                if not alive:
+                    self._stats['probe_failed'] += 1
+            if alive:
+                return conn
+            # Мёртвое соединение закрываем и берём следующее (в конце — новое).
+            self.putconn(conn, close=True)
+
+    def _take(self):
+        '''(соединение, когда его последний раз видели живым | None для нового).'''
+        started = time.monotonic()
+        deadline = started + self.wait_ms / 1000.0
+        expired = []
+        try:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise pool.PoolError("connection pool is closed")
+                    now = time.monotonic()
+                    while self._idle:
+                        # LIFO: берём самое «тёплое» соединение, холодные уходят по max_idle.
+                        conn, created_at, released_at, checked_at = self._idle.pop()
+                        if conn.closed or self._is_expired(created_at, released_at, now):
+                            self._size -= 1
+                            self._stats['recycled'] += 1
+                            expired.append(conn)
+                            continue
+                        self._used[id(conn)] = (conn, created_at)
+                        self._record_wait(started)
+                        return conn, checked_at
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    if self._waiters >= self.max_waiters:
+                        self._stats['rejected'] += 1
+                        raise pool.PoolError("connection pool exhausted (wait queue full)")
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise pool.PoolError("connection pool exhausted (wait timeout)")
+                    self._waiters += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+        finally:
+            for conn in expired:
+                self._close_quietly(conn)
+
+        # Новое соединение открываем вне блокировки: TLS-handshake не держит остальных.
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._used[id(conn)] = (conn, time.monotonic())
+            self._record_wait(started)
+        return conn, None
+
+    def putconn(self, conn, close: bool = False) -> None:
+        with self._cond:
+            entry = self._used.pop(id(conn), None)
+        if entry is None:
+            raise pool.PoolError("trying to put unkeyed connection")
+        _conn, created_at = entry
+        broken = conn.closed
+
+        if not close and not conn.closed:
+            # Как в psycopg2.pool: незавершённую транзакцию откатываем,
+            # соединение в неизвестном состоянии — закрываем.
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    close = True
+
+        now = time.monotonic()
+        with self._cond:
+            if broken and self._idle:
+                # Сервер рвёт соединения: простаивающие проверяются на следующем checkout.
+                self._idle = deque((c, created, released, float('-inf'))
+                                   for c, created, released, _checked in self._idle)
+            if close or conn.closed or self.closed or self._is_expired(created_at, now, now):
+                self._size -= 1
+                if not close and not conn.closed and not self.closed:
+                    self._stats['recycled'] += 1
+                reuse = False
+            else:
+                self._idle.append((conn, created_at, now, now))
+                reuse = True
+            self._cond.notify()
+        if not reuse:
+            self._close_quietly(conn)
+
+    def start_reaper(self, interval_sec: int = DB_POOL_HEALTH_INTERVAL_SEC,
+                     probe_idle_sec: int = DB_POOL_PROBE_IDLE_SEC) -> None:
+        '''Запускает фоновый поток: пинг давно простаивающих, ротация и добор до minconn.'''
+        if self._reaper is not None:
+            return
+
+        def _loop():
+            while not self._reaper_stop.wait(interval_sec):
+                try:
+                    self.reap(probe_idle_sec)
+                except Exception as e:
+                    logger.warning(f"db-pool reaper error: {e}")
+
+        self._reaper = threading.Thread(target=_loop, name='db-pool-reaper', daemon=True)
+        self._reaper.start()
+
+    def reap(self, probe_idle_sec: int = DB_POOL_PROBE_IDLE_SEC) -> None:
+        '''Один проход фоновой проверки (вызывается из reaper-потока).'''
+        now = time.monotonic()
+        to_close = []
+        to_probe = []
+        with self._cond:
+            keep: deque = deque()
+            for entry in self._idle:
+                conn, created_at, released_at, checked_at = entry
+                if conn.closed or self._is_expired(created_at, released_at, now):
+                    to_close.append(conn)
+                    self._size -= 1
+                    self._stats['recycled'] += 1
+                elif now - checked_at >= probe_idle_sec:
+                    to_probe.append(entry)
+                else:
+                    keep.append(entry)
+            # Проверяемые соединения временно не выдаются, но остаются в _size.
+            self._idle = keep
+            missing = max(0, self.minconn - self._size)
+            self._size += missing
+            if to_close:
+                self._cond.notify(len(to_close))
+        for conn in to_close:
+            self._close_quietly(conn)
+
+        for conn, created_at, released_at, _checked_at in to_probe:
+            alive = self._probe(conn)
+            with self._cond:
+                self._stats['probed'] += 1
+                if alive and not self.closed:
+                    # В начало очереди: getconn берёт с конца самые свежие.
+                    self._idle.appendleft((conn, created_at, released_at, time.monotonic()))
+                else:
+                    self._size -= 1
+                    if not alive:
+                        self._stats['probe_failed'] += 1
+                self._cond.notify()
+            if not alive or self.closed:
+                self._close_quietly(conn)
+
+        for _ in range(missing):
+            try:
+                conn = self._connect()
+            except Exception as e:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                logger.warning(f"db-pool reaper: не удалось открыть соединение: {e}")
+                continue
+            fresh = time.monotonic()
+            with self._cond:
+                if self.closed:
+                    self._size -= 1
+                    self._close_quietly(conn)
+                else:
+                    self._idle.appendleft((conn, fresh, fresh, fresh))
+                self._cond.notify()
+
+    def closeall(self) -> None:
+        self._reaper_stop.set()
+        with self._cond:
+            self.closed = True
+            idle = [entry[0] for entry in self._idle]
+            used = [entry[0] for entry in self._used.values()]
+            self._idle.clear()
+            self._used.clear()
+            self._size = 0
+            self._cond.notify_all()
+        for conn in idle + used:
+            self._close_quietly(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            st = dict(self._stats)
+            waits = sorted(self._recent_waits_ms)
+            st.update({
+                'size': self._size,
+                'in_use': len(self._used),
+                'idle': len(self._idle),
+                'waiters': self._waiters,
+                'minconn': self.minconn,
+                'maxconn': self.maxconn,
+            })
+        checkouts = st['checkouts'] or 1
+        st['wait_ms_avg'] = round(st['wait_ms_total'] / checkouts, 2)
+        st['wait_ms_p95'] = round(waits[int(len(waits) * 0.95) - 1], 2) if waits else 0.0
+        st['wait_ms_total'] = round(st['wait_ms_total'], 1)
+        st['wait_ms_max'] = round(st['wait_ms_max'], 2)
+        return st
+
+
+def init_pool(minconn: int | None = None, maxconn: int | None = None):
+    '''Инициализирует пул соединений с retry.
+
+    maxconn — число потоков, одновременно работающих с БД; ограничивается DB_POOL_MAX.
+    '''
     global db_pool
+    minconn = DB_POOL_MIN if minconn is None else max(1, int(minconn))
+    maxconn = DB_POOL_MAX if maxconn is None else max(1, min(DB_POOL_MAX, int(maxconn)))
+    minconn = min(minconn, maxconn)
     last_err = None
     for attempt, delay in enumerate(_DB_RETRY_DELAYS, 1):
         try:
@@ -228,12 +635,17 @@ def init_pool():
                     db_pool.closeall()
                 except Exception:
                     pass
-            db_pool = pool.SimpleConnectionPool(
-                minconn=1, maxconn=10,
+            db_pool = BoundedConnectionPool(
+                minconn, maxconn,
                 dsn=DATABASE_URL, sslmode='require',
                 connect_timeout=10,
+                connection_factory=PooledConnection,
+            )
+            db_pool.start_reaper()
+            logger.info(
+                f"✅ Пул PostgreSQL инициализирован (попытка {attempt}, "
+                f"min={minconn}, max={maxconn}, wait={DB_POOL_WAIT_MS}ms)"
             )
-            logger.info(f"✅ Пул PostgreSQL инициализирован (попытка {attempt})")
             return
         except Exception as e:
             last_err = e
@@ -244,13 +656,26 @@ def init_pool():
     raise last_err
 
 
+def get_pool_stats() -> dict:
+    '''Метрики пула: размер, занятость, ожидание checkout (avg/p95/max), таймауты.'''
+    if db_pool is None:
+        return {'initialized': False, 'temp_connections': len(_TEMP_CONNECTION_IDS),
+                'temp_opened': _TEMP_CONNECTIONS_OPENED}
+    stats = db_pool.stats()
+    stats['initialized'] = True
+    stats['temp_connections'] = len(_TEMP_CONNECTION_IDS)
+    stats['temp_opened'] = _TEMP_CONNECTIONS_OPENED
+    return stats
+
+
 def _try_new_connection():
     '''Создаёт новое прямое соединение с retry.'''
     last_err = None
     for attempt, delay in enumerate(_DB_RETRY_DELAYS[:3], 1):  # макс 3 попытки для одного запроса
         try:
             conn = psycopg2.connect(
-                DATABASE_URL, sslmode='require', connect_timeout=10
+                DATABASE_URL, sslmode='require', connect_timeout=10,
+                connection_factory=PooledConnection,
             )
             return conn
         except Exception as e:
@@ -266,61 +691,55 @@ def _pool_is_dead():
     global db_pool
     if db_pool is None:
         return True
-    try:
-        # SimpleConnectionPool не имеет .closed, проверяем через getconn/putconn
-        conn = db_pool.getconn()
-        db_pool.putconn(conn)
-        return False
-    except Exception:
-        return True
+    return bool(db_pool.closed)
 
 
 def get_connection():
-    '''Возвращает живое соединение из пула. При обрыве — пересоздаёт с retry.'''
-    global db_pool
+    '''Возвращает соединение из пула. Живость проверяет фоновый reaper пула,
+    давно не проверенные соединения пингуются при выдаче (BoundedConnectionPool.getconn).
+    Внутри DbSession возвращает общее соединение сессии.'''
+    session = _CURRENT_SESSION.get()
+    if session is not None:
+        return session._acquire()
+    return _checkout_connection()
+
+
+def _checkout_connection():
+    global db_pool, _TEMP_CONNECTIONS_OPENED
     if db_pool is None:
         init_pool()
     try:
         conn = db_pool.getconn()
-    except pool.PoolError:
-        logger.warning("⚠️ Пул БД исчерпан, открываю временное подключение")
-        conn = _try_new_connection()
-        _TEMP_CONNECTION_IDS.add(id(conn))
+    except pool.PoolError as e:
+        if not db_pool.closed:
+            logger.warning(f"⚠️ Пул БД исчерпан ({e}), открываю временное подключение")
+            conn = _try_new_connection()
+            _TEMP_CONNECTION_IDS.add(id(conn))
+            _TEMP_CONNECTIONS_OPENED += 1
+            return conn
+        logger.warning("⚠️  Пул соединений закрыт, пересоздаём...")
+        db_pool = None
+        init_pool()
+        conn = db_pool.getconn()
     except Exception:
         # Пул сломан — пересоздаём
         logger.warning("⚠️  Пул соединений сломан, пересоздаём...")
         db_pool = None  # сбрасываем чтобы init_pool не пытался закрыть сломанный пул
         init_pool()
         conn = db_pool.getconn()
-    try:
-        # Проверяем что соединение живое
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1")
-        return conn
-    except Exception:
-        # Соединение мёртвое — закрываем и создаём новое напрямую
-        release_connection(conn)
-        try:
-            new_conn = _try_new_connection()
-            # Кладём новое соединение обратно в пул и берём его
-            try:
-                db_pool.putconn(new_conn)
-            except Exception:
-                try:
-                    new_conn.close()
-                except Exception:
-                    pass
-                raise
-            return db_pool.getconn()
-        except Exception as e:
-            logger.error(f"Не удалось переподключиться к БД: {e}")
-            raise
+    conn.leaderboard_rows, conn.leaderboard_full = [], False
+    return conn
 
 
 def release_connection(conn):
     global db_pool
     if conn is None:
         return
+    session = getattr(conn, 'session', None)
+    if session is not None:
+        # Соединение сессии вернётся в пул при её завершении.
+        session._release(conn)
+        return
     if id(conn) in _TEMP_CONNECTION_IDS:
         _TEMP_CONNECTION_IDS.discard(id(conn))
         try:
@@ -341,7 +760,11 @@ def release_connection(conn):
         else:
             db_pool.putconn(conn)
     except Exception:
-        pass
+        # Соединение от старого (пересозданного) пула — просто закрываем.
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 
 def _safe_rollback(conn):
@@ -355,6 +778,120 @@ def _safe_rollback(conn):
         pass
 
 
+_CURRENT_SESSION: contextvars.ContextVar = contextvars.ContextVar('db_session', default=None)
+
+
+class SessionAborted(Exception):
+    '''Атомарная сессия уже откатилась или завершена — запрос не выполняется.'''
+
+
+class DbSession:
+    '''Единица работы: все вызовы функций модуля внутри блока идут через
+    одно соединение, а при atomic=True — и через одну транзакцию.
+
+        async with db.session() as unit:
+            row = await asyncio.to_thread(db.get_game_result, user_id)
+            await asyncio.to_thread(db.save_game_sync_result, ...)
+        if unit.failed:
+            ...
+
+    Сессия лежит в ContextVar, а asyncio.to_thread копирует контекст, поэтому
+    функции БД подхватывают её без изменения сигнатур. Соединение берётся
+    из пула при первом get_connection() и возвращается при выходе из блока.
+    При atomic=True commit() внутри функций откладывается до выхода, а любой
+    rollback() откатывает всю сессию: последующие вызовы получают
+    SessionAborted (и возвращают своё значение по умолчанию), failed == True.
+    Вызовы из разных потоков одной сессии выполняются по очереди.
+    '''
+
+    def __init__(self, atomic: bool = True):
+        self.atomic = atomic
+        self.failed = False
+        self.calls = 0
+        self._conn = None
+        self._closed = False
+        self._lock = threading.RLock()
+        self._token = None
+
+    def _acquire(self):
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise SessionAborted('сессия БД уже завершена')
+            if self.failed:
+                raise SessionAborted('сессия БД откатилась')
+            if self._conn is None:
+                conn = _checkout_connection()
+                conn.session = self
+                self._conn = conn
+            self.calls += 1
+            return self._conn
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def _release(self, conn):
+        try:
+            if conn is self._conn and conn.closed:
+                # Соединение оборвалось посреди сессии.
+                self._conn = None
+                conn.session = None
+                if self.atomic:
+                    self.failed = True
+                release_connection(conn)
+        finally:
+            self._lock.release()
+
+    def close(self, commit: bool = True) -> bool:
+        '''Фиксирует (или откатывает) транзакцию сессии и возвращает
+        соединение в пул. True — если работа сессии сохранена.'''
+        with self._lock:
+            if self._closed:
+                return not self.failed
+            self._closed = True
+            conn, self._conn = self._conn, None
+            if not commit:
+                self.failed = True
+            if conn is None:
+                return not self.failed
+            conn.session = None
+            try:
+                if self.atomic and not conn.closed:
+                    if self.failed:
+                        conn.rollback()
+                    else:
+                        conn.commit()
+            except Exception as e:
+                logger.error(f"DbSession commit error: {e}")
+                self.failed = True
+                _safe_rollback(conn)
+            finally:
+                release_connection(conn)
+            return not self.failed
+
+    def __enter__(self):
+        self._token = _CURRENT_SESSION.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _CURRENT_SESSION.reset(self._token)
+        self.close(commit=exc_type is None)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _CURRENT_SESSION.reset(self._token)
+        await asyncio.to_thread(self.close, exc_type is None)
+        return False
+
+
+def session(atomic: bool = True) -> DbSession:
+    '''Открывает единицу работы (см. DbSession).'''
+    return DbSession(atomic=atomic)
+
+
 def _secret_to_int(value, default: int = 0) -> int:
     try:
         return int(value)
@@ -637,337 +1174,611 @@ def release_polling_lock(lock_key: int = _POLLING_LOCK_KEY) -> None:
             pass
 
 
-
-#  ИНИЦИАЛИЗАЦИЯ БД
 # ──────────────────────────────────────────────
-def init_db():
-    conn = None
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cur = conn.cursor()
+#  МИГРАЦИИ СХЕМЫ
+# ──────────────────────────────────────────────
+# Упорядоченные идемпотентные шаги; применённые версии записываются в schema_version.
+# init_db при старте делает один SELECT и применяет только недостающие шаги,
+# `python migration.py up` делает то же до деплоя.
+# Уже выпущенные шаги не редактируются: любое изменение схемы — новый шаг в конце
+# _MIGRATIONS (в т.ч. новая версия _GAME_SYNC_SQL — шаг, который выполняет её заново).
+
+def _migration_base_schema(cur):
+    '''v1: схема, которую раньше init_db создавал на каждом старте.'''
+    # Пользователи
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id    BIGINT PRIMARY KEY,
+            username   TEXT,
+            first_name TEXT,
+            last_name  TEXT,
+            language_code TEXT,
+            role       TEXT DEFAULT 'user',
+            joined_at  TIMESTAMPTZ DEFAULT NOW(),
+            last_active TIMESTAMPTZ DEFAULT NOW(),
+            last_news_check TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'user'")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_news_check TIMESTAMPTZ DEFAULT NOW()")
 
-        # Пользователи
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id    BIGINT PRIMARY KEY,
-                username   TEXT,
-                first_name TEXT,
-                last_name  TEXT,
-                language_code TEXT,
-                role       TEXT DEFAULT 'user',
-                joined_at  TIMESTAMPTZ DEFAULT NOW(),
-                last_active TIMESTAMPTZ DEFAULT NOW(),
-                last_news_check TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'user'")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_news_check TIMESTAMPTZ DEFAULT NOW()")
+    # Учителя (авторегистрация)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS teachers (
+            id          SERIAL PRIMARY KEY,
+            full_name   TEXT UNIQUE NOT NULL,
+            telegram_id BIGINT DEFAULT 0,
+            registered  BOOLEAN DEFAULT FALSE,
+            registered_at TIMESTAMPTZ
+        )
+    ''')
 
-        # Учителя (авторегистрация)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS teachers (
-                id          SERIAL PRIMARY KEY,
-                full_name   TEXT UNIQUE NOT NULL,
-                telegram_id BIGINT DEFAULT 0,
-                registered  BOOLEAN DEFAULT FALSE,
-                registered_at TIMESTAMPTZ
-            )
-        ''')
+    # Замены
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS substitutions (
+            id           SERIAL PRIMARY KEY,
+            date         TEXT NOT NULL,
+            day          TEXT NOT NULL,
+            lesson_number INTEGER NOT NULL,
+            old_subject  TEXT NOT NULL,
+            new_subject  TEXT NOT NULL,
+            old_teacher  TEXT NOT NULL,
+            new_teacher  TEXT NOT NULL,
+            class_name   TEXT NOT NULL,
+            created_at   TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
 
-        # Замены
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS substitutions (
-                id           SERIAL PRIMARY KEY,
-                date         TEXT NOT NULL,
-                day          TEXT NOT NULL,
-                lesson_number INTEGER NOT NULL,
-                old_subject  TEXT NOT NULL,
-                new_subject  TEXT NOT NULL,
-                old_teacher  TEXT NOT NULL,
-                new_teacher  TEXT NOT NULL,
-                class_name   TEXT NOT NULL,
-                created_at   TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
+    # Активность пользователей
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            id        SERIAL PRIMARY KEY,
+            user_id   BIGINT NOT NULL,
+            action    TEXT NOT NULL,
+            class_name TEXT,
+            timestamp TIMESTAMPTZ DEFAULT NOW(),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    ''')
 
-        # Активность пользователей
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS user_activity (
-                id        SERIAL PRIMARY KEY,
-                user_id   BIGINT NOT NULL,
-                action    TEXT NOT NULL,
-                class_name TEXT,
-                timestamp TIMESTAMPTZ DEFAULT NOW(),
-                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )
-        ''')
+    # Техрежим
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_status (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            maintenance_mode INTEGER DEFAULT 0,
+            maintenance_until TEXT,
+            maintenance_message TEXT
+        )
+    ''')
+    cur.execute("INSERT INTO bot_status (id, maintenance_mode) VALUES (1, 0) ON CONFLICT DO NOTHING")
+    cur.execute("ALTER TABLE bot_status ADD COLUMN IF NOT EXISTS season_mode TEXT DEFAULT 'auto'")
+    cur.execute("UPDATE bot_status SET season_mode = LOWER(COALESCE(season_mode, 'auto'))")
+    cur.execute("UPDATE bot_status SET season_mode = 'auto' WHERE season_mode NOT IN ('auto', 'summer', 'school')")
 
-        # Техрежим
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS bot_status (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                maintenance_mode INTEGER DEFAULT 0,
-                maintenance_until TEXT,
-                maintenance_message TEXT
-            )
-        ''')
-        cur.execute("INSERT INTO bot_status (id, maintenance_mode) VALUES (1, 0) ON CONFLICT DO NOTHING")
-        cur.execute("ALTER TABLE bot_status ADD COLUMN IF NOT EXISTS season_mode TEXT DEFAULT 'auto'")
-        cur.execute("UPDATE bot_status SET season_mode = LOWER(COALESCE(season_mode, 'auto'))")
-        cur.execute("UPDATE bot_status SET season_mode = 'auto' WHERE season_mode NOT IN ('auto', 'summer', 'school')")
+    # Избранное
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_favorites (
+            id         SERIAL PRIMARY KEY,
+            user_id    BIGINT NOT NULL,
+            fav_type   TEXT NOT NULL,
+            value      TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            UNIQUE(user_id, fav_type, value)
+        )
+    ''')
 
-        # Избранное
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS user_favorites (
-                id         SERIAL PRIMARY KEY,
-                user_id    BIGINT NOT NULL,
-                fav_type   TEXT NOT NULL,
-                value      TEXT NOT NULL,
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                UNIQUE(user_id, fav_type, value)
-            )
-        ''')
+    # Новости
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS news (
+            id           SERIAL PRIMARY KEY,
+            title        TEXT NOT NULL,
+            content      TEXT NOT NULL,
+            published_at TIMESTAMPTZ DEFAULT NOW(),
+            views_count  INTEGER DEFAULT 0
+        )
+    ''')
+    cur.execute("ALTER TABLE news ADD COLUMN IF NOT EXISTS views_count INTEGER DEFAULT 0")
+    cur.execute("ALTER TABLE news ADD COLUMN IF NOT EXISTS category TEXT DEFAULT 'bot'")
+    cur.execute("UPDATE news SET category='bot' WHERE category IS NULL OR category = ''")
+    cur.execute("UPDATE news SET category='school' WHERE LOWER(category)='school'")
+    cur.execute("UPDATE news SET category='bot' WHERE LOWER(category)<>'school'")
+    cur.execute("ALTER TABLE news ALTER COLUMN category SET DEFAULT 'bot'")
+    cur.execute("ALTER TABLE news ALTER COLUMN category SET NOT NULL")
+
+    # Журнал изменений проекта для автогенерации новостей без git-коммитов.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS project_change_log (
+            id           SERIAL PRIMARY KEY,
+            scope        TEXT NOT NULL DEFAULT 'bot',
+            change_type  TEXT NOT NULL DEFAULT 'feature',
+            title        TEXT NOT NULL,
+            details      TEXT,
+            source       TEXT NOT NULL DEFAULT 'bot',
+            actor_id     BIGINT,
+            dedupe_key   TEXT,
+            used_in_news BOOLEAN DEFAULT FALSE,
+            created_at   TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute("ALTER TABLE project_change_log ADD COLUMN IF NOT EXISTS dedupe_key TEXT")
+    cur.execute("ALTER TABLE project_change_log ADD COLUMN IF NOT EXISTS used_in_news BOOLEAN DEFAULT FALSE")
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_project_change_log_dedupe
+        ON project_change_log (dedupe_key)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_project_change_log_news
+        ON project_change_log (used_in_news, created_at DESC)
+    ''')
 
-        # Новости
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS news (
-                id           SERIAL PRIMARY KEY,
-                title        TEXT NOT NULL,
-                content      TEXT NOT NULL,
-                published_at TIMESTAMPTZ DEFAULT NOW(),
-                views_count  INTEGER DEFAULT 0
-            )
-        ''')
-        cur.execute("ALTER TABLE news ADD COLUMN IF NOT EXISTS views_count INTEGER DEFAULT 0")
-        cur.execute("ALTER TABLE news ADD COLUMN IF NOT EXISTS category TEXT DEFAULT 'bot'")
-        cur.execute("UPDATE news SET category='bot' WHERE category IS NULL OR category = ''")
-        cur.execute("UPDATE news SET category='school' WHERE LOWER(category)='school'")
-        cur.execute("UPDATE news SET category='bot' WHERE LOWER(category)<>'school'")
-        cur.execute("ALTER TABLE news ALTER COLUMN category SET DEFAULT 'bot'")
-        cur.execute("ALTER TABLE news ALTER COLUMN category SET NOT NULL")
-
-        # Журнал изменений проекта для автогенерации новостей без git-коммитов.
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS project_change_log (
-                id           SERIAL PRIMARY KEY,
-                scope        TEXT NOT NULL DEFAULT 'bot',
-                change_type  TEXT NOT NULL DEFAULT 'feature',
-                title        TEXT NOT NULL,
-                details      TEXT,
-                source       TEXT NOT NULL DEFAULT 'bot',
-                actor_id     BIGINT,
-                dedupe_key   TEXT,
-                used_in_news BOOLEAN DEFAULT FALSE,
-                created_at   TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute("ALTER TABLE project_change_log ADD COLUMN IF NOT EXISTS dedupe_key TEXT")
-        cur.execute("ALTER TABLE project_change_log ADD COLUMN IF NOT EXISTS used_in_news BOOLEAN DEFAULT FALSE")
-        cur.execute('''
-            CREATE UNIQUE INDEX IF NOT EXISTS idx_project_change_log_dedupe
-            ON project_change_log (dedupe_key)
-        ''')
-        cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_project_change_log_news
-            ON project_change_log (used_in_news, created_at DESC)
-        ''')
+    # Просмотры новостей
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS news_views (
+            id        SERIAL PRIMARY KEY,
+            news_id   INTEGER NOT NULL REFERENCES news(id) ON DELETE CASCADE,
+            user_id   BIGINT  NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            viewed_at TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE(news_id, user_id)
+        )
+    ''')
 
-        # Просмотры новостей
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS news_views (
-                id        SERIAL PRIMARY KEY,
-                news_id   INTEGER NOT NULL REFERENCES news(id) ON DELETE CASCADE,
-                user_id   BIGINT  NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                viewed_at TIMESTAMPTZ DEFAULT NOW(),
-                UNIQUE(news_id, user_id)
-            )
-        ''')
+    # Профили пользователей (роль + данные регистрации)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id      BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            role         TEXT NOT NULL DEFAULT 'guest',
+            display_name TEXT,
+            class_name   TEXT,
+            registered_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+
+    # Подписки на замены классов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS class_subscriptions (
+            id         SERIAL PRIMARY KEY,
+            user_id    BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            class_name TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE(user_id, class_name)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_class_sub_class ON class_subscriptions(class_name)')
+
+    # Результаты игры "Шивровальщик"
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_results (
+            id           SERIAL PRIMARY KEY,
+            user_id      BIGINT NOT NULL,
+            user_name    TEXT,
+            chapter      INTEGER DEFAULT 0,
+            score        INTEGER DEFAULT 0,
+            total_score  INTEGER DEFAULT 0,
+            completed    INTEGER DEFAULT 0,
+            game_over    BOOLEAN DEFAULT FALSE,
+            failed       BOOLEAN DEFAULT FALSE,
+            updated_at   TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE(user_id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_game_score ON game_results(total_score DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_game_user  ON game_results(user_id)')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS banned BOOLEAN DEFAULT FALSE')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS achievement_count INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS achievement_pts INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS restart_mode VARCHAR(20) DEFAULT NULL')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS reset_token BIGINT DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS failed BOOLEAN DEFAULT FALSE')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS retreat_count INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS pending_retreat_penalty INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS pending_retreat_chapter INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_chapter INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_max_chapter_score INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_max_cipher_idx INTEGER DEFAULT -1')
+    # Таблица управления главами игры
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_chapters (
+            chapter_id   INTEGER PRIMARY KEY,
+            is_open      BOOLEAN DEFAULT FALSE,
+            open_at      TIMESTAMPTZ,
+            updated_at   TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    # Глобальный режим доступа к игре:
+    # beta (только белый список), open (для всех), closed (закрыта)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_access_settings (
+            id          INTEGER PRIMARY KEY CHECK (id = 1),
+            access_mode TEXT NOT NULL DEFAULT 'beta',
+            updated_at  TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('''
+        INSERT INTO game_access_settings (id, access_mode)
+        VALUES (1, 'beta')
+        ON CONFLICT (id) DO NOTHING
+    ''')
+    # ZERO_DAY удалён из проекта — чистим старые таблицы и схему (idempotent, безопасно при повторных запусках).
+    cur.execute('DROP TABLE IF EXISTS zdnet_beta')
+    cur.execute('DROP TABLE IF EXISTS zdnet_roles')
+    cur.execute('DROP TABLE IF EXISTS zdnet_access_settings')
+    cur.execute('DROP SCHEMA IF EXISTS zdnet CASCADE')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS beta_access_requests (
+            id           SERIAL PRIMARY KEY,
+            game_key     TEXT NOT NULL,
+            user_id      BIGINT NOT NULL,
+            user_name    TEXT,
+            status       TEXT NOT NULL DEFAULT 'pending',
+            requested_at TIMESTAMPTZ DEFAULT NOW(),
+            resolved_at  TIMESTAMPTZ,
+            resolved_by  BIGINT
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_beta_access_requests_pending
+        ON beta_access_requests (game_key, status, requested_at DESC)
+    ''')
+    # Инициализируем таблицу ролей
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_roles (
+            user_id    BIGINT PRIMARY KEY,
+            role       TEXT DEFAULT 'player',
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_referrals (
+            referred_id          BIGINT PRIMARY KEY,
+            referrer_id          BIGINT NOT NULL,
+            start_bonus_awarded  BOOLEAN DEFAULT FALSE,
+            rewarded_chapters    INTEGER DEFAULT 0,
+            total_referrer_bonus INTEGER DEFAULT 0,
+            pct_referrer_bonus_paid INTEGER DEFAULT 0,
+            total_referred_bonus INTEGER DEFAULT 0,
+            invitee_bonus_percent INTEGER DEFAULT 1,
+            max_referred_base_score INTEGER DEFAULT 0,
+            created_at           TIMESTAMPTZ DEFAULT NOW(),
+            updated_at           TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS pct_referrer_bonus_paid INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS total_referred_bonus INTEGER DEFAULT 0')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS invitee_bonus_percent INTEGER DEFAULT 1')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS max_referred_base_score INTEGER DEFAULT 0')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_game_referrals_referrer ON game_referrals(referrer_id)')
+    # Таблица доступа к главам для конкретных игроков
+    # (для обычных игроков главы открываются индивидуально через админа)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS player_chapter_access (
+            user_id    BIGINT NOT NULL,
+            chapter_id INTEGER NOT NULL,
+            granted_at TIMESTAMPTZ DEFAULT NOW(),
+            granted_by BIGINT,
+            PRIMARY KEY (user_id, chapter_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_secret_state (
+            user_id BIGINT PRIMARY KEY,
+            selected_mode TEXT NOT NULL DEFAULT 'none',
+            missions_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+            runtime_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+            completed_count INTEGER DEFAULT 0,
+            bonus_points INTEGER DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS selected_mode TEXT NOT NULL DEFAULT 'none'")
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS missions_json JSONB NOT NULL DEFAULT '{}'::jsonb")
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS runtime_json JSONB NOT NULL DEFAULT '{}'::jsonb")
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS completed_count INTEGER DEFAULT 0")
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS bonus_points INTEGER DEFAULT 0")
+    cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW()")
+    cur.execute('''
+        INSERT INTO game_chapters (chapter_id, is_open)
+        VALUES (1,TRUE),(2,FALSE),(3,FALSE),(4,FALSE),(5,FALSE),(6,FALSE)
+        ON CONFLICT (chapter_id) DO NOTHING
+    ''')
+
+    # Миграция: если глава 1 ещё закрыта — открываем её (фикс для существующих деплоев)
+    cur.execute('''
+        UPDATE game_chapters SET is_open = TRUE
+        WHERE chapter_id = 1 AND is_open = FALSE AND open_at IS NULL
+    ''')
+
+    # Индексы
+    for idx_sql in [
+        'CREATE INDEX IF NOT EXISTS idx_sub_date ON substitutions(date)',
+        'CREATE INDEX IF NOT EXISTS idx_sub_class_date ON substitutions(class_name, date)',
+        'CREATE INDEX IF NOT EXISTS idx_sub_teacher ON substitutions(new_teacher, date)',
+        'CREATE INDEX IF NOT EXISTS idx_activity_ts ON user_activity(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_activity_user ON user_activity(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_active)',
+        'CREATE INDEX IF NOT EXISTS idx_fav_user ON user_favorites(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_news_pub ON news(published_at)',
+        'CREATE INDEX IF NOT EXISTS idx_news_category_pub ON news(category, published_at)',
+        'CREATE INDEX IF NOT EXISTS idx_teachers_tgid ON teachers(telegram_id)',
+    ]:
+        cur.execute(idx_sql)
+
+    # Админы бота и бета-доступ (раньше создавались отдельными вызовами при старте)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_admins (
+            user_id    BIGINT PRIMARY KEY,
+            granted_by BIGINT,
+            granted_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_beta (
+            user_id    BIGINT PRIMARY KEY,
+            user_name  TEXT,
+            added_at   TIMESTAMPTZ DEFAULT NOW(),
+            note       TEXT
+        )
+    ''')
+
+
+def _migration_game_sync_apply(cur):
+    '''v2: серверная функция /game_sync (см. _GAME_SYNC_SQL).'''
+    cur.execute(_GAME_SYNC_SQL)
+
+
+def _migration_rank_index(cur):
+    '''v4: покрывающий частичный индекс под get_game_player_rank (порядок рейтинга).'''
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_results_rank
+        ON game_results (total_score DESC, updated_at ASC)
+        INCLUDE (user_id)
+        WHERE total_score > 0 AND NOT COALESCE(banned, FALSE)
+    ''')
+
+
+def _migration_rate_limits(cur):
+    '''v5: общие счётчики rate_limit.py (бэкенд postgres). UNLOGGED — счётчики
+    эфемерны, WAL на каждый запрос к API не нужен.'''
+    cur.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_counters (
+            key          TEXT NOT NULL,
+            window_start BIGINT NOT NULL,
+            window_sec   INTEGER NOT NULL,
+            hits         INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (key, window_start)
+        )
+    ''')
+
+
+def _migration_sync_responses(cur):
+    '''v6: ответы /game_sync по ключу идемпотентности клиента (event_id):
+    повтор события после таймаута получает сохранённый ответ, а не применяется
+    второй раз. Записываются в транзакции применения события; живут
+    GAME_SYNC_IDEMPOTENCY_TTL_SEC (purge_game_sync_responses).'''
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_sync_responses (
+            user_id    BIGINT NOT NULL,
+            event_id   TEXT NOT NULL,
+            response   JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, event_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_sync_responses_created
+        ON game_sync_responses (created_at)
+    ''')
+
+
+def _migration_referral_counters(cur):
+    '''v7: счётчики агентов пригласившего (game_referral_counters) вместо
+    COUNT(*) по game_referrals на каждом /game_sync и /game_state.
+    counted_active / counted_completed в game_referrals — учтён ли агент в
+    active_count / completed_count; меняются вместе со счётчиками в одной
+    транзакции (game_sync_apply, сбросы, удаление связей), расхождения чинит
+    repair_referral_counters.'''
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_referral_counters (
+            referrer_id     BIGINT PRIMARY KEY,
+            invited_count   INTEGER NOT NULL DEFAULT 0,
+            active_count    INTEGER NOT NULL DEFAULT 0,
+            completed_count INTEGER NOT NULL DEFAULT 0,
+            updated_at      TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS counted_active BOOLEAN NOT NULL DEFAULT FALSE')
+    cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS counted_completed BOOLEAN NOT NULL DEFAULT FALSE')
+    cur.execute('''
+        UPDATE game_referrals a
+        SET counted_active = (COALESCE(gr.total_score, 0) > 0 OR COALESCE(gr.completed, 0) > 0),
+            counted_completed = COALESCE(gr.completed, 0) > 0
+        FROM game_results gr
+        WHERE gr.user_id = a.referred_id
+    ''')
+    cur.execute('''
+        INSERT INTO game_referral_counters (referrer_id, invited_count, active_count, completed_count)
+        SELECT referrer_id,
+               COUNT(*)::INTEGER,
+               COUNT(*) FILTER (WHERE counted_active)::INTEGER,
+               COUNT(*) FILTER (WHERE counted_completed)::INTEGER
+        FROM game_referrals
+        GROUP BY referrer_id
+        ON CONFLICT (referrer_id) DO UPDATE
+        SET invited_count = EXCLUDED.invited_count,
+            active_count = EXCLUDED.active_count,
+            completed_count = EXCLUDED.completed_count,
+            updated_at = NOW()
+    ''')
+
+
+def _migration_referral_credit_queue(cur):
+    '''v10: очередь начислений пригласившим. /game_sync только ставит в неё
+    referrer_id, когда база агента выросла; доли пригласивших начисляет
+    process_referral_credits в фоне — sync не блокирует чужие строки.'''
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS game_referral_credit_queue (
+            id          BIGSERIAL PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            queued_at   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_referral_credit_queue_referrer
+        ON game_referral_credit_queue (referrer_id)
+    ''')
+    # Всех пригласивших — в очередь: долги по ставке, накопленные до перехода.
+    cur.execute('''
+        INSERT INTO game_referral_credit_queue (referrer_id)
+        SELECT referrer_id FROM game_referral_counters WHERE invited_count > 0
+    ''')
+
+
+def _migration_referral_credit_queue_unique(cur):
+    '''v13: уникальный referrer_id в очереди начислений. NOT EXISTS при
+    READ COMMITTED не видит чужую незафиксированную вставку/удаление;
+    ON CONFLICT по уникальному индексу дожидается её исхода.'''
+    cur.execute('''
+        DELETE FROM game_referral_credit_queue q
+        USING game_referral_credit_queue d
+        WHERE d.referrer_id = q.referrer_id AND d.id < q.id
+    ''')
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_game_referral_credit_queue_referrer
+        ON game_referral_credit_queue (referrer_id)
+    ''')
+    cur.execute('DROP INDEX IF EXISTS idx_game_referral_credit_queue_referrer')
+
+
+def _migration_referral_counters_totals(cur):
+    '''v15: оплаченные главы и бонус пригласившего в game_referral_counters —
+    сводка и /game_sync читают их по ключу, без SUM по game_referrals.
+    Сдвигаются там же, где меняются rewarded_chapters / total_referrer_bonus
+    связей (бонус агента, _REFERRER_REFRESH_SQL, удаление связей).'''
+    cur.execute('ALTER TABLE game_referral_counters ADD COLUMN IF NOT EXISTS rewarded_chapters INTEGER NOT NULL DEFAULT 0')
+    cur.execute('ALTER TABLE game_referral_counters ADD COLUMN IF NOT EXISTS bonus_points INTEGER NOT NULL DEFAULT 0')
+    cur.execute('''
+        UPDATE game_referral_counters c
+        SET rewarded_chapters = s.rewarded, bonus_points = s.bonus, updated_at = NOW()
+        FROM (
+            SELECT referrer_id,
+                   COALESCE(SUM(GREATEST(0, COALESCE(rewarded_chapters, 0))), 0)::INTEGER AS rewarded,
+                   COALESCE(SUM(GREATEST(0, COALESCE(total_referrer_bonus, 0))), 0)::INTEGER AS bonus
+            FROM game_referrals
+            GROUP BY referrer_id
+        ) s
+        WHERE c.referrer_id = s.referrer_id
+    ''')
+
+
+_MIGRATIONS = [
+    (1, 'base_schema', _migration_base_schema),
+    (2, 'game_sync_apply', _migration_game_sync_apply),
+    (3, 'game_sync_apply_lb_rows', _migration_game_sync_apply),
+    (4, 'game_results_rank_index', _migration_rank_index),
+    (5, 'rate_limit_counters', _migration_rate_limits),
+    (6, 'game_sync_responses', _migration_sync_responses),
+    (7, 'game_referral_counters', _migration_referral_counters),
+    (8, 'game_sync_apply_ref_counters', _migration_game_sync_apply),
+    (9, 'game_sync_apply_set_based_inviter', _migration_game_sync_apply),
+    (10, 'game_referral_credit_queue', _migration_referral_credit_queue),
+    (11, 'game_sync_apply_credit_queue', _migration_game_sync_apply),
+    (12, 'game_sync_apply_cached_agents', _migration_game_sync_apply),
+    (13, 'game_referral_credit_queue_unique', _migration_referral_credit_queue_unique),
+    (14, 'game_sync_apply_credit_queue_upsert', _migration_game_sync_apply),
+    (15, 'game_referral_counters_totals', _migration_referral_counters_totals),
+    (16, 'game_sync_apply_counter_totals', _migration_game_sync_apply),
+    (17, 'game_sync_apply_referral_savepoint', _migration_game_sync_apply),
+]
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+_MIGRATION_LOCK_KEY = 82445032
+
+
+def _read_schema_version(cur) -> int:
+    '''Текущая версия схемы; 0 — если schema_version ещё нет.'''
+    try:
+        cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        return int(cur.fetchone()[0] or 0)
+    except psycopg2.Error as e:
+        if e.pgcode != '42P01':  # undefined_table
+            raise
+        cur.connection.rollback()
+        return 0
 
-        # Профили пользователей (роль + данные регистрации)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS user_profiles (
-                user_id      BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
-                role         TEXT NOT NULL DEFAULT 'guest',
-                display_name TEXT,
-                class_name   TEXT,
-                registered_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
 
-        # Подписки на замены классов
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS class_subscriptions (
-                id         SERIAL PRIMARY KEY,
-                user_id    BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                class_name TEXT NOT NULL,
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                UNIQUE(user_id, class_name)
-            )
-        ''')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_class_sub_class ON class_subscriptions(class_name)')
+def _apply_migrations(conn, target: int) -> list:
+    '''Применяет шаги (current, target] одной транзакцией под advisory lock
+    (параллельный деплой дождётся и ничего не повторит). Возвращает версии.'''
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (_MIGRATION_LOCK_KEY,))
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    current = int(cur.fetchone()[0] or 0)
+    applied = []
+    for version, name, step in _MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        step(cur)
+        cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+        applied.append(version)
+    conn.commit()
+    return applied
 
-        # Результаты игры "Шивровальщик"
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_results (
-                id           SERIAL PRIMARY KEY,
-                user_id      BIGINT NOT NULL,
-                user_name    TEXT,
-                chapter      INTEGER DEFAULT 0,
-                score        INTEGER DEFAULT 0,
-                total_score  INTEGER DEFAULT 0,
-                completed    INTEGER DEFAULT 0,
-                game_over    BOOLEAN DEFAULT FALSE,
-                failed       BOOLEAN DEFAULT FALSE,
-                updated_at   TIMESTAMPTZ DEFAULT NOW(),
-                UNIQUE(user_id)
-            )
-        ''')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_game_score ON game_results(total_score DESC)')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_game_user  ON game_results(user_id)')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS banned BOOLEAN DEFAULT FALSE')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS achievement_count INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS achievement_pts INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS restart_mode VARCHAR(20) DEFAULT NULL')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS reset_token BIGINT DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS failed BOOLEAN DEFAULT FALSE')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS retreat_count INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS pending_retreat_penalty INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS pending_retreat_chapter INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_chapter INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_max_chapter_score INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_results ADD COLUMN IF NOT EXISTS sync_max_cipher_idx INTEGER DEFAULT -1')
-        # Таблица управления главами игры
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_chapters (
-                chapter_id   INTEGER PRIMARY KEY,
-                is_open      BOOLEAN DEFAULT FALSE,
-                open_at      TIMESTAMPTZ,
-                updated_at   TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        # Глобальный режим доступа к игре:
-        # beta (только белый список), open (для всех), closed (закрыта)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_access_settings (
-                id          INTEGER PRIMARY KEY CHECK (id = 1),
-                access_mode TEXT NOT NULL DEFAULT 'beta',
-                updated_at  TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute('''
-            INSERT INTO game_access_settings (id, access_mode)
-            VALUES (1, 'beta')
-            ON CONFLICT (id) DO NOTHING
-        ''')
-        # ZERO_DAY удалён из проекта — чистим старые таблицы и схему (idempotent, безопасно при повторных запусках).
-        cur.execute('DROP TABLE IF EXISTS zdnet_beta')
-        cur.execute('DROP TABLE IF EXISTS zdnet_roles')
-        cur.execute('DROP TABLE IF EXISTS zdnet_access_settings')
-        cur.execute('DROP SCHEMA IF EXISTS zdnet CASCADE')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS beta_access_requests (
-                id           SERIAL PRIMARY KEY,
-                game_key     TEXT NOT NULL,
-                user_id      BIGINT NOT NULL,
-                user_name    TEXT,
-                status       TEXT NOT NULL DEFAULT 'pending',
-                requested_at TIMESTAMPTZ DEFAULT NOW(),
-                resolved_at  TIMESTAMPTZ,
-                resolved_by  BIGINT
-            )
-        ''')
-        cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_beta_access_requests_pending
-            ON beta_access_requests (game_key, status, requested_at DESC)
-        ''')
-        # Инициализируем таблицу ролей
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_roles (
-                user_id    BIGINT PRIMARY KEY,
-                role       TEXT DEFAULT 'player',
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_referrals (
-                referred_id          BIGINT PRIMARY KEY,
-                referrer_id          BIGINT NOT NULL,
-                start_bonus_awarded  BOOLEAN DEFAULT FALSE,
-                rewarded_chapters    INTEGER DEFAULT 0,
-                total_referrer_bonus INTEGER DEFAULT 0,
-                pct_referrer_bonus_paid INTEGER DEFAULT 0,
-                total_referred_bonus INTEGER DEFAULT 0,
-                invitee_bonus_percent INTEGER DEFAULT 1,
-                max_referred_base_score INTEGER DEFAULT 0,
-                created_at           TIMESTAMPTZ DEFAULT NOW(),
-                updated_at           TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS pct_referrer_bonus_paid INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS total_referred_bonus INTEGER DEFAULT 0')
-        cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS invitee_bonus_percent INTEGER DEFAULT 1')
-        cur.execute('ALTER TABLE game_referrals ADD COLUMN IF NOT EXISTS max_referred_base_score INTEGER DEFAULT 0')
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_game_referrals_referrer ON game_referrals(referrer_id)')
-        # Таблица доступа к главам для конкретных игроков
-        # (для обычных игроков главы открываются индивидуально через админа)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS player_chapter_access (
-                user_id    BIGINT NOT NULL,
-                chapter_id INTEGER NOT NULL,
-                granted_at TIMESTAMPTZ DEFAULT NOW(),
-                granted_by BIGINT,
-                PRIMARY KEY (user_id, chapter_id)
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_secret_state (
-                user_id BIGINT PRIMARY KEY,
-                selected_mode TEXT NOT NULL DEFAULT 'none',
-                missions_json JSONB NOT NULL DEFAULT '{}'::jsonb,
-                runtime_json JSONB NOT NULL DEFAULT '{}'::jsonb,
-                completed_count INTEGER DEFAULT 0,
-                bonus_points INTEGER DEFAULT 0,
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        ''')
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS selected_mode TEXT NOT NULL DEFAULT 'none'")
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS missions_json JSONB NOT NULL DEFAULT '{}'::jsonb")
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS runtime_json JSONB NOT NULL DEFAULT '{}'::jsonb")
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS completed_count INTEGER DEFAULT 0")
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS bonus_points INTEGER DEFAULT 0")
-        cur.execute("ALTER TABLE game_secret_state ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW()")
 
-        cur.execute('''
-            INSERT INTO game_chapters (chapter_id, is_open)
-            VALUES (1,TRUE),(2,FALSE),(3,FALSE),(4,FALSE),(5,FALSE),(6,FALSE)
-            ON CONFLICT (chapter_id) DO NOTHING
-        ''')
+def get_schema_status() -> dict:
+    '''{'current': int, 'latest': int, 'pending': [(version, name), ...]}'''
+    conn = None
+    try:
+        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+        current = _read_schema_version(conn.cursor())
+        return {
+            'current': current,
+            'latest': SCHEMA_VERSION,
+            'pending': [(v, name) for v, name, _ in _MIGRATIONS if v > current],
+        }
+    finally:
+        if conn:
+            conn.close()
 
-        # Миграция: если глава 1 ещё закрыта — открываем её (фикс для существующих деплоев)
-        cur.execute('''
-            UPDATE game_chapters SET is_open = TRUE
-            WHERE chapter_id = 1 AND is_open = FALSE AND open_at IS NULL
-        ''')
 
-        # Индексы
-        for idx_sql in [
-            'CREATE INDEX IF NOT EXISTS idx_sub_date ON substitutions(date)',
-            'CREATE INDEX IF NOT EXISTS idx_sub_class_date ON substitutions(class_name, date)',
-            'CREATE INDEX IF NOT EXISTS idx_sub_teacher ON substitutions(new_teacher, date)',
-            'CREATE INDEX IF NOT EXISTS idx_activity_ts ON user_activity(timestamp)',
-            'CREATE INDEX IF NOT EXISTS idx_activity_user ON user_activity(user_id)',
-            'CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_active)',
-            'CREATE INDEX IF NOT EXISTS idx_fav_user ON user_favorites(user_id)',
-            'CREATE INDEX IF NOT EXISTS idx_news_pub ON news(published_at)',
-            'CREATE INDEX IF NOT EXISTS idx_news_category_pub ON news(category, published_at)',
-            'CREATE INDEX IF NOT EXISTS idx_teachers_tgid ON teachers(telegram_id)',
-        ]:
-            cur.execute(idx_sql)
+def migrate(target: int | None = None) -> list:
+    '''Доводит схему до версии target (по умолчанию — последней).
+    Возвращает список применённых версий.'''
+    conn = None
+    try:
+        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+        return _apply_migrations(conn, SCHEMA_VERSION if target is None else int(target))
+    except Exception:
+        _safe_rollback(conn)
+        raise
+    finally:
+        if conn:
+            conn.close()
+
 
-        conn.commit()
-        logger.info("✅ БД инициализирована")
+# ──────────────────────────────────────────────
+#  ИНИЦИАЛИЗАЦИЯ БД
+# ──────────────────────────────────────────────
+def init_db():
+    '''Проверяет версию схемы одним запросом и применяет только недостающие миграции.'''
+    conn = None
+    try:
+        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+        cur = conn.cursor()
+        current = _read_schema_version(cur)
+        conn.rollback()
+        if current >= SCHEMA_VERSION:
+            logger.info(f"✅ БД инициализирована (схема v{current})")
+            return
+        applied = _apply_migrations(conn, SCHEMA_VERSION)
+        logger.info(f"✅ БД инициализирована: схема v{current} → v{SCHEMA_VERSION}, применены шаги {applied}")
     except Exception as e:
+        _safe_rollback(conn)
         err_text = str(e)
         if 'Connection refused' in err_text or 'could not connect to server' in err_text:
             logger.warning(f"⚠️ init_db: БД ещё не готова: {e}")
@@ -2246,23 +3057,237 @@ def get_peak_hours():
 REFERRAL_INVITER_PCT_PER_AGENT = 1
 REFERRAL_INVITER_PCT_MAX = 100
 REFERRAL_INVITEE_PCT = 1
+# Ставка пригласившего и бонус от базы считаются только SQL-функциями
+# game_inviter_percent / game_referral_bonus (_GAME_SYNC_SQL) — и в
+# game_sync_apply, и в запросах Python-путей, чтобы правила не расходились.
+
+
+# Счётчики агентов пригласившего (game_referral_counters, см. _migration_referral_counters).
+# Активный агент — есть очки или пройденные главы; completed — есть пройденные главы.
+_REFERRAL_ACTIVITY_SQL = '''
+    WITH target AS (
+        SELECT a.referred_id, a.referrer_id,
+               a.counted_active AS was_active,
+               a.counted_completed AS was_completed,
+               (COALESCE(gr.total_score, 0) > 0 OR COALESCE(gr.completed, 0) > 0) AS is_active,
+               COALESCE(gr.completed, 0) > 0 AS is_completed
+        FROM game_referrals a
+        LEFT JOIN game_results gr ON gr.user_id = a.referred_id
+        WHERE {where}
+        FOR UPDATE OF a
+    ), changed AS (
+        UPDATE game_referrals a
+        SET counted_active = t.is_active,
+            counted_completed = t.is_completed
+        FROM target t
+        WHERE a.referred_id = t.referred_id
+          AND (t.was_active <> t.is_active OR t.was_completed <> t.is_completed)
+        RETURNING t.referrer_id,
+                  t.is_active::INTEGER - t.was_active::INTEGER AS active_delta,
+                  t.is_completed::INTEGER - t.was_completed::INTEGER AS completed_delta
+    )
+    UPDATE game_referral_counters c
+    SET active_count = GREATEST(0, c.active_count + d.active_delta),
+        completed_count = GREATEST(0, c.completed_count + d.completed_delta),
+        updated_at = NOW()
+    FROM (
+        SELECT referrer_id, SUM(active_delta)::INTEGER AS active_delta,
+               SUM(completed_delta)::INTEGER AS completed_delta
+        FROM changed
+        GROUP BY referrer_id
+    ) d
+    WHERE c.referrer_id = d.referrer_id
+'''
+
+
+def _referral_refresh_activity(cur, referred_ids: list) -> None:
+    '''Пересчитывает активность агентов referred_ids по game_results и сдвигает
+    счётчики их пригласивших (в текущей транзакции, после изменения очков).'''
+    ids = [int(uid) for uid in referred_ids or [] if int(uid or 0) > 0]
+    if ids:
+        cur.execute(_REFERRAL_ACTIVITY_SQL.format(where='a.referred_id = ANY(%s)'), (ids,))
+        # Очки агентов видны в списке пригласивших.
+        cur.execute('SELECT DISTINCT referrer_id FROM game_referrals WHERE referred_id = ANY(%s)', (ids,))
+        _referral_cache_defer(cur.connection, [r[0] for r in cur.fetchall() or []])
+
+
+def _referral_counters_add(cur, referrer_id: int, invited: int = 0, active: int = 0, completed: int = 0,
+                           rewarded: int = 0, bonus: int = 0) -> tuple:
+    '''Сдвигает счётчики пригласившего; возвращает (invited_count, ставка пригласившего).'''
+    deltas = (invited, active, completed, rewarded, bonus)
+    cur.execute(
+        '''
+        INSERT INTO game_referral_counters AS c
+            (referrer_id, invited_count, active_count, completed_count,
+             rewarded_chapters, bonus_points, updated_at)
+        VALUES (%s, GREATEST(0, %s), GREATEST(0, %s), GREATEST(0, %s),
+                GREATEST(0, %s), GREATEST(0, %s), NOW())
+        ON CONFLICT (referrer_id) DO UPDATE
+        SET invited_count = GREATEST(0, c.invited_count + %s),
+            active_count = GREATEST(0, c.active_count + %s),
+            completed_count = GREATEST(0, c.completed_count + %s),
+            rewarded_chapters = GREATEST(0, c.rewarded_chapters + %s),
+            bonus_points = GREATEST(0, c.bonus_points + %s),
+            updated_at = NOW()
+        RETURNING invited_count, game_inviter_percent(invited_count, %s, %s)
+        ''',
+        (referrer_id,) + deltas + deltas + (REFERRAL_INVITER_PCT_PER_AGENT, REFERRAL_INVITER_PCT_MAX),
+    )
+    row = cur.fetchone() or (0, 0)
+    return int(row[0] or 0), int(row[1] or 0)
 
 
-def _referral_inviter_percent(invited_count: int) -> int:
-    count = max(0, int(invited_count or 0))
-    if count <= 0:
-        return 0
-    pct = count * int(REFERRAL_INVITER_PCT_PER_AGENT)
-    return max(1, min(int(REFERRAL_INVITER_PCT_MAX), pct))
+def _referral_counters(cur, referrer_id: int) -> tuple:
+    '''(invited_count, active_count, completed_count, rewarded_chapters, bonus_points,
+    ставка пригласившего) — поиск по ключу.'''
+    cur.execute(
+        '''
+        SELECT invited_count, active_count, completed_count, rewarded_chapters, bonus_points,
+               game_inviter_percent(invited_count, %s, %s)
+        FROM game_referral_counters
+        WHERE referrer_id = %s
+        ''',
+        (REFERRAL_INVITER_PCT_PER_AGENT, REFERRAL_INVITER_PCT_MAX, referrer_id),
+    )
+    row = cur.fetchone() or (0, 0, 0, 0, 0, 0)
+    return tuple(int(v or 0) for v in row)
 
 
-def _referral_total_bonus_for_base(base_score: int, percent: int) -> int:
-    base = max(0, int(base_score or 0))
-    pct = max(0, int(percent or 0))
-    if base <= 0 or pct <= 0:
-        return 0
-    # Round up so rewards appear immediately once progress starts.
-    return max(1, (base * pct + 99) // 100)
+def _referral_credit_enqueue(cur, referrer_id: int) -> None:
+    '''Ставит пригласившего в очередь начислений (process_referral_credits).
+    Запись уже есть — ничего не делаем; если обработчик как раз удаляет её,
+    вставка дождётся его commit и поставит пригласившего заново.'''
+    cur.execute(
+        '''
+        INSERT INTO game_referral_credit_queue (referrer_id)
+        VALUES (%s)
+        ON CONFLICT (referrer_id) DO NOTHING
+        ''',
+        (referrer_id,),
+    )
+
+# Строки для leaderboard.board: (user_id, user_name, total_score, completed, game_over,
+# banned, role, achievement_count, achievement_pts, updated_at).
+_LEADERBOARD_SELECT = '''
+    SELECT gr.user_id, gr.user_name, COALESCE(gr.total_score, 0), COALESCE(gr.completed, 0),
+           COALESCE(gr.game_over, FALSE), COALESCE(gr.banned, FALSE),
+           COALESCE(rol.role, 'player'),
+           COALESCE(gr.achievement_count, 0), COALESCE(gr.achievement_pts, 0),
+           gr.updated_at
+    FROM game_results gr
+    LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
+'''
+# Все, кто может попасть в какой-либо рейтинг (см. leaderboard._group).
+_LEADERBOARD_ELIGIBLE = '''
+    WHERE NOT COALESCE(gr.banned, FALSE)
+      AND (COALESCE(rol.role, 'player') IN ('admin', 'tester') OR gr.total_score > 0)
+'''
+
+
+def _leaderboard_stage(cur, user_ids=None) -> None:
+    '''Читает (в текущей транзакции) строки рейтинга затронутых игроков;
+    leaderboard.board обновится после commit. user_ids=None — перечитать всех.'''
+    conn = cur.connection
+    if user_ids is None:
+        cur.execute(_LEADERBOARD_SELECT + _LEADERBOARD_ELIGIBLE)
+        rows, full = cur.fetchall(), True
+    else:
+        ids = sorted({int(u) for u in user_ids if u})
+        if not ids:
+            return
+        cur.execute(_LEADERBOARD_SELECT + 'WHERE gr.user_id = ANY(%s)', (ids,))
+        rows, full = cur.fetchall(), False
+    _leaderboard_defer(conn, rows, full)
+
+
+def _leaderboard_defer(conn, rows, full: bool = False) -> None:
+    '''Откладывает обновление рейтинга до commit соединения (см. PooledConnection).'''
+    if not isinstance(conn, PooledConnection):
+        if full:
+            leaderboard.board.load(rows)
+        else:
+            leaderboard.board.apply(rows)
+        return
+    if full:
+        conn.leaderboard_rows, conn.leaderboard_full = list(rows), True
+    else:
+        conn.leaderboard_rows.extend(rows)
+
+
+def _referral_cache_apply(stale, fresh) -> None:
+    '''Сбрасывает записи stale (None среди них — весь кэш), затем put(*args) для fresh.'''
+    if None in stale:
+        _referral_cache.clear()
+    else:
+        _referral_cache.invalidate(stale)
+    for args in fresh:
+        _referral_cache.put(*args)
+
+
+def _referral_cache_defer(conn, user_ids=(), fresh=None) -> None:
+    '''Откладывает до commit соединения сброс реферального кэша user_ids
+    (None — всех) и запись fresh = (user_id, token, сводка, агенты, limit).'''
+    stale = {None} if user_ids is None else {int(u) for u in user_ids if u}
+    fresh = [fresh] if fresh else []
+    if not isinstance(conn, PooledConnection):
+        _referral_cache_apply(stale, fresh)
+        return
+    conn.referral_stale |= stale
+    conn.referral_fresh.extend(fresh)
+
+
+def _referral_cache_take_sync(result: dict, user_id: int, token: int, cached_agents, agents_limit: int) -> tuple:
+    '''Разбирает ответ game_sync_apply() для кэша: подставляет агентов из кэша
+    (функцию вызвали с p_agents_limit = 0) и возвращает (user_ids, fresh)
+    для _referral_cache_defer. Пригласившего сбрасываем, если у его агента
+    сдвинулись бонус или засчитанные главы.'''
+    summary = result.get('ref_summary')
+    if not isinstance(summary, dict):
+        return (), None
+    agents = result.get('ref_agents')
+    if agents is None:
+        result['ref_agents'] = cached_agents or []
+    stale = ()
+    referrer_id = int(summary.get('referrer_id') or 0)
+    if referrer_id > 0 and (int(result.get('ref_award_invitee') or 0) > 0
+                            or int(result.get('ref_award_chapters') or 0) > 0):
+        stale = (referrer_id,)
+    return stale, (int(user_id), token, summary, agents, agents_limit)
+
+
+def leaderboard_reload() -> bool:
+    '''Полная загрузка рейтинга в память (старт и периодическая сверка).'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute(_LEADERBOARD_SELECT + _LEADERBOARD_ELIGIBLE)
+        leaderboard.board.load(cur.fetchall())
+        return True
+    except Exception as e:
+        logger.error(f"leaderboard_reload error: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+
+_LEADERBOARD_RECONCILER = None
+
+
+def start_leaderboard_reconciler(interval_sec: int = LEADERBOARD_RECONCILE_SEC) -> None:
+    '''Фоновый поток сверки рейтинга в памяти с БД (раз в interval_sec).'''
+    global _LEADERBOARD_RECONCILER
+    if _LEADERBOARD_RECONCILER is not None or interval_sec <= 0:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(interval_sec)
+            leaderboard_reload()
+
+    _LEADERBOARD_RECONCILER = threading.Thread(target=_loop, name='leaderboard-reconcile', daemon=True)
+    _LEADERBOARD_RECONCILER.start()
+
 
 def save_game_result(user_id, user_name, chapter, score, total_score,
                      completed, game_over=False, failed=False):
@@ -2293,6 +3318,7 @@ def save_game_result(user_id, user_name, chapter, score, total_score,
                 updated_at  = NOW()
         ''', (user_id, user_name, chapter, score, total_score,
               completed, game_over, failed))
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return True
     except Exception as e:
@@ -2317,6 +3343,7 @@ def register_game_player(user_id, user_name=None):
             ON CONFLICT (user_id) DO UPDATE
                 SET user_name = EXCLUDED.user_name
         ''', (user_id, user_name))
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
     except Exception as e:
         logger.error(f"register_game_player error {user_id}: {e}")
@@ -2418,12 +3445,11 @@ def attach_game_referral(referrer_id: int, referred_id: int, referred_name: str
             (referred_id, referrer_id, REFERRAL_INVITEE_PCT),
         )
 
-        cur.execute(
-            "SELECT COUNT(*) FROM game_referrals WHERE referrer_id = %s",
-            (referrer_id,),
-        )
-        invited_count = int((cur.fetchone() or [0])[0] or 0)
-        inviter_percent = _referral_inviter_percent(invited_count)
+        # Новый агент ещё без прогресса (проверено выше) — активным не считается.
+        invited_count, inviter_percent = _referral_counters_add(cur, referrer_id, invited=1)
+        # Ставка выросла для всех агентов пригласившего.
+        _referral_credit_enqueue(cur, referrer_id)
+        _referral_cache_defer(conn, [referrer_id, referred_id])
         conn.commit()
         return {
             'ok': True,
@@ -2487,7 +3513,6 @@ def apply_referral_bonus_for_completed(
 
         referrer_id = int(row[0] or 0)
         rewarded_chapters = max(0, int(row[1] or 0))
-        total_referrer_bonus_before = max(0, int(row[2] or 0))
         pct_referrer_bonus_paid_before = max(0, int(row[3] or 0))
         total_referred_bonus_before = max(0, int(row[4] or 0))
         invitee_pct = max(0, int(row[5] or REFERRAL_INVITEE_PCT))
@@ -2506,43 +3531,24 @@ def apply_referral_bonus_for_completed(
                 'awarded_points_invitee': 0,
             }
 
-        cur.execute(
-            "SELECT COUNT(*) FROM game_referrals WHERE referrer_id = %s",
-            (referrer_id,),
-        )
-        invited_count = int((cur.fetchone() or [0])[0] or 0)
-        inviter_pct = _referral_inviter_percent(invited_count)
+        invited_count, _, _, _, _, inviter_pct = _referral_counters(cur, referrer_id)
 
         # Anti-abuse: reward only for new personal best (base score),
         # excluding previously paid invitee-referral bonuses.
         current_base_score_raw = max(0, total_score_after - total_referred_bonus_before)
         current_base_score = max(max_base_score_before, current_base_score_raw)
 
-        invitee_total_target = _referral_total_bonus_for_base(current_base_score, invitee_pct)
-        inviter_total_target = _referral_total_bonus_for_base(current_base_score, inviter_pct)
+        cur.execute(
+            'SELECT game_referral_bonus(%s, %s), game_referral_bonus(%s, %s)',
+            (current_base_score, invitee_pct, current_base_score, inviter_pct),
+        )
+        invitee_total_target, inviter_total_target = (int(v or 0) for v in cur.fetchone())
 
         invitee_bonus_points = max(0, invitee_total_target - total_referred_bonus_before)
-        inviter_bonus_points = max(0, inviter_total_target - pct_referrer_bonus_paid_before)
+        # Доля пригласившего начисляется в фоне (process_referral_credits).
+        inviter_owed_points = max(0, inviter_total_target - pct_referrer_bonus_paid_before)
         new_chapters = max(0, completed_after - rewarded_chapters)
 
-        cur.execute(
-            '''
-            INSERT INTO game_results (user_id, user_name, chapter, score, total_score, completed, game_over, failed, updated_at)
-            VALUES (%s, %s, 0, 0, 0, 0, FALSE, FALSE, NOW())
-            ON CONFLICT (user_id) DO NOTHING
-            ''',
-            (referrer_id, 'Игрок'),
-        )
-        if inviter_bonus_points > 0:
-            cur.execute(
-                '''
-                UPDATE game_results
-                SET total_score = COALESCE(total_score, 0) + %s,
-                    updated_at = NOW()
-                WHERE user_id = %s
-                ''',
-                (inviter_bonus_points, referrer_id),
-            )
         if invitee_bonus_points > 0:
             cur.execute(
                 '''
@@ -2557,8 +3563,6 @@ def apply_referral_bonus_for_completed(
             '''
             UPDATE game_referrals
             SET rewarded_chapters = %s,
-                total_referrer_bonus = %s,
-                pct_referrer_bonus_paid = %s,
                 total_referred_bonus = %s,
                 max_referred_base_score = %s,
                 updated_at = NOW()
@@ -2566,23 +3570,30 @@ def apply_referral_bonus_for_completed(
             ''',
             (
                 max(rewarded_chapters, completed_after),
-                total_referrer_bonus_before + inviter_bonus_points,
-                pct_referrer_bonus_paid_before + inviter_bonus_points,
                 total_referred_bonus_before + invitee_bonus_points,
                 current_base_score,
                 referred_id,
             ),
         )
+        if new_chapters > 0:
+            _referral_counters_add(cur, referrer_id, rewarded=new_chapters)
+        if inviter_owed_points > 0:
+            _referral_credit_enqueue(cur, referrer_id)
+        if invitee_bonus_points > 0:
+            _leaderboard_stage(cur, [referred_id])
+        if invitee_bonus_points > 0 or completed_after > rewarded_chapters:
+            _referral_cache_defer(conn, [referred_id, referrer_id])
 
         conn.commit()
         return {
             'ok': True,
-            'status': 'awarded' if (inviter_bonus_points > 0 or invitee_bonus_points > 0) else 'nothing_to_award',
+            'status': 'awarded' if invitee_bonus_points > 0 else 'nothing_to_award',
             'referrer_id': referrer_id,
-            'awarded_points': int(inviter_bonus_points),
-            'awarded_points_to_referrer': int(inviter_bonus_points),
-            'awarded_points_inviter': int(inviter_bonus_points),
+            'awarded_points': 0,
+            'awarded_points_to_referrer': 0,
+            'awarded_points_inviter': 0,
             'awarded_points_invitee': int(invitee_bonus_points),
+            'queued_points_inviter': int(inviter_owed_points),
             'awarded_chapters': int(new_chapters),
             'inviter_percent': int(inviter_pct),
             'invitee_percent': int(invitee_pct),
@@ -2603,6 +3614,115 @@ def apply_referral_bonus_for_completed(
         release_connection(conn)
 
 
+# Доли пригласивших по всем их агентам одним запросом: ставка — по
+# game_referral_counters, дельты (game_referral_bonus) пишутся одним UPDATE, суммы начисляются
+# пригласившим и прибавляются к их bonus_points в game_referral_counters там же. Агенты, чьи строки заблокированы их собственным sync,
+# пропускаются (SKIP LOCKED): их sync снова поставит пригласившего в очередь.
+_REFERRER_REFRESH_SQL = '''
+    WITH params AS (
+        SELECT r.referrer_id,
+               COALESCE(c.invited_count, 0)::INTEGER AS invited,
+               game_inviter_percent(COALESCE(c.invited_count, 0)::INTEGER, %s, %s) AS pct
+        FROM unnest(%s::BIGINT[]) AS r(referrer_id)
+        LEFT JOIN game_referral_counters c ON c.referrer_id = r.referrer_id
+    ), agents AS (
+        SELECT a.referred_id,
+               a.referrer_id,
+               GREATEST(0, COALESCE(a.total_referrer_bonus, 0)) AS total_referrer_bonus,
+               GREATEST(0, COALESCE(a.pct_referrer_bonus_paid, 0)) AS pct_paid,
+               GREATEST(0, COALESCE(a.max_referred_base_score, 0)) AS max_base,
+               GREATEST(
+                   GREATEST(0, COALESCE(a.max_referred_base_score, 0)),
+                   GREATEST(0, COALESCE(gr.total_score, 0) - GREATEST(0, COALESCE(a.total_referred_bonus, 0)))
+               ) AS base,
+               p.pct
+        FROM game_referrals a
+        JOIN params p ON p.referrer_id = a.referrer_id
+        LEFT JOIN game_results gr ON gr.user_id = a.referred_id
+        WHERE p.pct > 0
+        FOR UPDATE OF a SKIP LOCKED
+    ), skipped AS (
+        -- Агенты, чью строку держит /game_sync: их доля — при следующей обработке.
+        SELECT a.referrer_id, COUNT(*)::INTEGER AS n
+        FROM game_referrals a
+        JOIN params p ON p.referrer_id = a.referrer_id
+        WHERE p.pct > 0
+          AND NOT EXISTS (SELECT 1 FROM agents x WHERE x.referred_id = a.referred_id)
+        GROUP BY a.referrer_id
+    ), changed AS (
+        UPDATE game_referrals a
+        SET total_referrer_bonus = x.total_referrer_bonus + d.delta,
+            pct_referrer_bonus_paid = x.pct_paid + d.delta,
+            max_referred_base_score = x.base,
+            updated_at = NOW()
+        FROM agents x
+        CROSS JOIN LATERAL (
+            SELECT GREATEST(0, game_referral_bonus(x.base, x.pct) - x.pct_paid) AS delta
+        ) d
+        WHERE a.referred_id = x.referred_id
+          AND (d.delta > 0 OR x.base <> x.max_base)
+        RETURNING x.referrer_id, d.delta
+    ), totals AS (
+        SELECT referrer_id, SUM(delta)::INTEGER AS total
+        FROM changed
+        GROUP BY referrer_id
+    ), counted AS (
+        UPDATE game_referral_counters c
+        SET bonus_points = c.bonus_points + t.total,
+            updated_at = NOW()
+        FROM totals t
+        WHERE c.referrer_id = t.referrer_id AND t.total > 0
+        RETURNING 1
+    ), credited AS (
+        INSERT INTO game_results AS g
+            (user_id, user_name, chapter, score, total_score, completed, game_over, failed, updated_at)
+        SELECT referrer_id, 'Игрок', 0, 0, total, 0, FALSE, FALSE, NOW()
+        FROM totals
+        WHERE total > 0
+        ON CONFLICT (user_id) DO UPDATE
+        SET total_score = COALESCE(g.total_score, 0) + EXCLUDED.total_score,
+            updated_at = NOW()
+        RETURNING 1
+    )
+    SELECT p.referrer_id, p.invited, p.pct, COALESCE(t.total, 0), COALESCE(s.n, 0)
+    FROM params p
+    LEFT JOIN totals t ON t.referrer_id = p.referrer_id
+    LEFT JOIN skipped s ON s.referrer_id = p.referrer_id
+'''
+
+
+def _refresh_referrers(cur, referrer_ids: list) -> list:
+    '''[(referrer_id, invited_count, inviter_percent, начислено, пропущено агентов)]
+    в текущей транзакции.
+
+    Строки game_results пригласивших блокируются заранее по возрастанию id —
+    в том же порядке, что и у /game_sync (сначала своя строка, потом связи).
+    Строки агентов, занятые /game_sync, пропускаются (SKIP LOCKED): таких
+    пригласивших вызывающий возвращает в очередь (_referral_credit_requeue).'''
+    ids = sorted({int(uid) for uid in referrer_ids if int(uid or 0) > 0})
+    if not ids:
+        return []
+    cur.execute('SELECT user_id FROM game_results WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE', (ids,))
+    cur.execute(_REFERRER_REFRESH_SQL, (REFERRAL_INVITER_PCT_PER_AGENT, REFERRAL_INVITER_PCT_MAX, ids))
+    rows = [
+        (int(r[0]), int(r[1] or 0), int(r[2] or 0), int(r[3] or 0), int(r[4] or 0))
+        for r in cur.fetchall() or []
+    ]
+    credited = [r[0] for r in rows if r[3] > 0]
+    if credited:
+        _leaderboard_stage(cur, credited)
+        _referral_cache_defer(cur.connection, credited)
+    return rows
+
+
+def _referral_credit_requeue(cur, rows: list) -> list:
+    '''Возвращает в очередь пригласивших, у которых _refresh_referrers пропустил агентов.'''
+    requeued = sorted(r[0] for r in rows if r[4] > 0)
+    for referrer_id in requeued:
+        _referral_credit_enqueue(cur, referrer_id)
+    return requeued
+
+
 def refresh_referrer_bonus(referrer_id: int) -> dict:
     '''Recalculate inviter % bonuses across all agents for current inviter rate.'''
     conn = None
@@ -2613,28 +3733,11 @@ def refresh_referrer_bonus(referrer_id: int) -> dict:
 
         conn = get_connection()
         cur = conn.cursor()
-
-        cur.execute(
-            '''
-            SELECT
-                rf.referred_id,
-                COALESCE(rf.total_referrer_bonus, 0),
-                COALESCE(rf.pct_referrer_bonus_paid, 0),
-                COALESCE(rf.total_referred_bonus, 0),
-                COALESCE(rf.max_referred_base_score, 0),
-                COALESCE(gr.total_score, 0)
-            FROM game_referrals rf
-            LEFT JOIN game_results gr ON gr.user_id = rf.referred_id
-            WHERE rf.referrer_id = %s
-            FOR UPDATE SKIP LOCKED
-            ''',
-            (referrer_id,),
-        )
-        rows = cur.fetchall() or []
-        invited_count = len(rows)
-        inviter_pct = _referral_inviter_percent(invited_count)
+        rows = _refresh_referrers(cur, [referrer_id])
+        _referral_credit_requeue(cur, rows)
+        _, invited_count, inviter_pct, awarded_total, _ = rows[0] if rows else (referrer_id, 0, 0, 0, 0)
+        conn.commit()
         if invited_count <= 0 or inviter_pct <= 0:
-            conn.commit()
             return {
                 'ok': True,
                 'status': 'no_agents',
@@ -2642,61 +3745,6 @@ def refresh_referrer_bonus(referrer_id: int) -> dict:
                 'inviter_percent': int(inviter_pct),
                 'invited_count': int(invited_count),
             }
-
-        awarded_total = 0
-        for row in rows:
-            referred_id = int(row[0] or 0)
-            total_referrer_bonus_before = max(0, int(row[1] or 0))
-            pct_paid_before = max(0, int(row[2] or 0))
-            total_referred_bonus = max(0, int(row[3] or 0))
-            max_base_before = max(0, int(row[4] or 0))
-            referred_total_score = max(0, int(row[5] or 0))
-
-            current_base_raw = max(0, referred_total_score - total_referred_bonus)
-            current_base_score = max(max_base_before, current_base_raw)
-            target_pct_bonus = _referral_total_bonus_for_base(current_base_score, inviter_pct)
-            delta = max(0, target_pct_bonus - pct_paid_before)
-            if delta <= 0 and current_base_score == max_base_before:
-                continue
-
-            cur.execute(
-                '''
-                UPDATE game_referrals
-                SET total_referrer_bonus = %s,
-                    pct_referrer_bonus_paid = %s,
-                    max_referred_base_score = %s,
-                    updated_at = NOW()
-                WHERE referred_id = %s
-                ''',
-                (
-                    total_referrer_bonus_before + delta,
-                    pct_paid_before + delta,
-                    current_base_score,
-                    referred_id,
-                ),
-            )
-            awarded_total += delta
-
-        if awarded_total > 0:
-            cur.execute(
-                '''
-                INSERT INTO game_results (user_id, user_name, chapter, score, total_score, completed, game_over, failed, updated_at)
-                VALUES (%s, %s, 0, 0, 0, 0, FALSE, FALSE, NOW())
-                ON CONFLICT (user_id) DO NOTHING
-                ''',
-                (referrer_id, 'Игрок'),
-            )
-            cur.execute(
-                '''
-                UPDATE game_results
-                SET total_score = COALESCE(total_score, 0) + %s,
-                    updated_at = NOW()
-                WHERE user_id = %s
-                ''',
-                (awarded_total, referrer_id),
-            )
-
-        conn.commit()
         return {
             'ok': True,
             'status': 'awarded' if awarded_total > 0 else 'nothing_to_award',
@@ -2735,33 +3783,15 @@ def get_referral_summary(referrer_id: int) -> dict:
         }
         if referrer_id <= 0:
             return empty
+        cached = _referral_cache.summary(referrer_id)
+        if cached is not None:
+            return cached
 
+        token = _referral_cache.token()
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute(
-            '''
-            SELECT
-                COUNT(*) AS invited_count,
-                COALESCE(
-                    SUM(
-                        CASE
-                            WHEN COALESCE(gr.total_score, 0) > 0 OR COALESCE(gr.completed, 0) > 0
-                            THEN 1 ELSE 0
-                        END
-                    ),
-                    0
-                ) AS active_count,
-                COALESCE(SUM(COALESCE(rf.rewarded_chapters, 0)), 0) AS rewarded_chapters,
-                COALESCE(SUM(COALESCE(rf.total_referrer_bonus, 0)), 0) AS bonus_points
-            FROM game_referrals rf
-            LEFT JOIN game_results gr ON gr.user_id = rf.referred_id
-            WHERE rf.referrer_id = %s
-            ''',
-            (referrer_id,),
-        )
-        row = cur.fetchone() or (0, 0, 0, 0)
-        invited_count = int(row[0] or 0)
-        inviter_percent = _referral_inviter_percent(invited_count)
+        (invited_count, active_count, _, rewarded_chapters, bonus_points,
+         inviter_percent) = _referral_counters(cur, referrer_id)
 
         cur.execute(
             '''
@@ -2776,16 +3806,19 @@ def get_referral_summary(referrer_id: int) -> dict:
         )
         invitee_row = cur.fetchone() or (0, REFERRAL_INVITEE_PCT, 0)
 
-        return {
+        summary = {
             'invited_count': invited_count,
-            'active_count': int(row[1] or 0),
-            'rewarded_chapters': int(row[2] or 0),
-            'bonus_points': int(row[3] or 0),
+            'active_count': active_count,
+            'rewarded_chapters': rewarded_chapters,
+            'bonus_points': bonus_points,
             'inviter_percent': int(inviter_percent),
             'invitee_percent': int(invitee_row[1] or REFERRAL_INVITEE_PCT),
             'invitee_bonus_points': int(invitee_row[0] or 0),
             'referrer_id': int(invitee_row[2] or 0),
         }
+        if _CURRENT_SESSION.get() is None:
+            _referral_cache.put(referrer_id, token, summary=summary)
+        return summary
     except Exception as e:
         logger.error(f"get_referral_summary error {referrer_id}: {e}")
         return {
@@ -2810,6 +3843,10 @@ def get_referral_agents(referrer_id: int, limit: int = 15) -> list:
         limit = max(1, min(50, int(limit or 15)))
         if referrer_id <= 0:
             return []
+        cached = _referral_cache.agents(referrer_id, limit)
+        if cached is not None:
+            return cached
+        token = _referral_cache.token()
         conn = get_connection()
         cur = conn.cursor()
         cur.execute(
@@ -2834,9 +3871,7 @@ def get_referral_agents(referrer_id: int, limit: int = 15) -> list:
             (REFERRAL_INVITEE_PCT, referrer_id, limit),
         )
         rows = cur.fetchall() or []
-        cur.execute("SELECT COUNT(*) FROM game_referrals WHERE referrer_id = %s", (referrer_id,))
-        invited_count_total = int((cur.fetchone() or [0])[0] or 0)
-        inviter_percent = _referral_inviter_percent(invited_count_total)
+        inviter_percent = _referral_counters(cur, referrer_id)[5]
         result = []
         for r in rows:
             result.append({
@@ -2851,6 +3886,8 @@ def get_referral_agents(referrer_id: int, limit: int = 15) -> list:
                 'inviter_percent': int(inviter_percent),
                 'created_at': r[8],
             })
+        if _CURRENT_SESSION.get() is None:
+            _referral_cache.put(referrer_id, token, agents=result, limit=limit)
         return result
     except Exception as e:
         logger.error(f"get_referral_agents error {referrer_id}: {e}")
@@ -2858,6 +3895,35 @@ def get_referral_agents(referrer_id: int, limit: int = 15) -> list:
     finally:
         release_connection(conn)
 
+
+def get_referral_cache_stats() -> dict:
+    '''Метрики кэша реферальной сводки и агентов (для /health).'''
+    return _referral_cache.stats()
+
+
+def invalidate_referral_cache(user_ids=None) -> None:
+    '''Сбрасывает записи кэша рефералов user_ids (None — весь кэш).
+
+    Для записей другого процесса (событие user:<id> через NOTIFY): свои
+    записи сбрасываются после commit сами (_referral_cache_defer).'''
+    _referral_cache_apply({None} if user_ids is None else {int(u) for u in user_ids if u}, ())
+
+
+def referral_section_token() -> int:
+    '''Номер кэша рефералов: берётся до чтения раздела ref, см. put_referral_section_version.'''
+    return _referral_cache.token()
+
+
+def get_referral_section_version(user_id: int) -> str | None:
+    '''Версия раздела ref ответа /game_state из кэша рефералов или None.'''
+    return _referral_cache.version(int(user_id or 0))
+
+
+def put_referral_section_version(user_id: int, token: int, version: str) -> bool:
+    '''Запоминает версию раздела ref, прочитанного после token; сбрасывается
+    вместе с записями кэша пользователя.'''
+    return _referral_cache.put(int(user_id or 0), token, version=version)
+
 def get_secret_missions_state(user_id: int) -> dict:
     conn = None
     try:
@@ -2873,7 +3939,7 @@ def get_secret_missions_state(user_id: int) -> dict:
         cur = conn.cursor()
         cur.execute(
             '''
-            SELECT selected_mode, missions_json
+            SELECT selected_mode, missions_json, updated_at
             FROM game_secret_state
             WHERE user_id = %s
             ''',
@@ -2888,6 +3954,7 @@ def get_secret_missions_state(user_id: int) -> dict:
                 'mode': exported['mode'],
                 'summary': exported['summary'],
                 'missions': exported['missions'],
+                'stamp': None,
             }
         mode = _sanitize_secret_mode(row[0])
         missions_map = _secret_normalize_missions(row[1])
@@ -2897,6 +3964,8 @@ def get_secret_missions_state(user_id: int) -> dict:
             'mode': exported['mode'],
             'summary': exported['summary'],
             'missions': exported['missions'],
+            # updated_at строки: по нему /game_state сверяет версию раздела без чтения миссий.
+            'stamp': row[2],
         }
     except Exception as e:
         logger.error(f"get_secret_missions_state error {user_id}: {e}")
@@ -2910,6 +3979,280 @@ def get_secret_missions_state(user_id: int) -> dict:
         release_connection(conn)
 
 
+def _secret_fast(ev: dict) -> bool:
+    return 0 < ev['answer_elapsed'] <= 14
+
+
+# Правила миссий: mission_id -> (типы событий, поля, кандидат прогресса).
+# Тип '*' — любое событие; поля — входы, от которых зависит результат:
+#   answer       — новый ответ (mission_answer_token вырос);
+#   event        — само событие (для правил конкретного типа);
+#   mode         — сменился secret_mode;
+#   invited_count, active_count — есть агенты (счётчики приходят из БД).
+# Кандидат — прогресс по контексту события и runtime либо None (условие
+# не выполнено). Порядок записей — порядок проверки и наград.
+_SECRET_RULES = {
+    'sm_silent_no_hint': ('*', ('answer',),
+                          lambda ev, rt: 1 if ev['mode'] == 'silent' and ev['answer_no_hint'] else None),
+    'sm_speed_three': ('*', ('answer',),
+                       lambda ev, rt: rt['speed_streak'] if ev['mode'] == 'speed' and _secret_fast(ev)
+                       and ev['answer_streak'] >= 1 else None),
+    'sm_iron_one_life': ('*', ('answer',),
+                         lambda ev, rt: 1 if ev['mode'] == 'iron' and ev['answer_one_life'] else None),
+    'sm_recruit_one': ('*', ('mode', 'invited_count'),
+                       lambda ev, rt: min(1, ev['invited_count']) if ev['mode'] == 'recruit' else None),
+    'sm_night_watch': ('*', ('answer',),
+                       lambda ev, rt: 1 if ev['mode'] == 'night' and (ev['hour'] >= 23 or ev['hour'] <= 5) else None),
+    'sm_flawless_chapter': (('chapter_complete',), ('event',),
+                            lambda ev, rt: 1 if ev['chapter_hints'] <= 0 and ev['chapter_errors'] <= 0 else None),
+    'sm_morse_five_fast': ('*', ('answer',), lambda ev, rt: rt['morse_fast_count']),
+    'sm_week_discipline': ('*', ('answer',), lambda ev, rt: len(rt['active_days'])),
+    'sm_network_three': ('*', ('active_count',), lambda ev, rt: ev['active_count']),
+    'sm_map_runner': ('*', ('answer',), lambda ev, rt: rt['map_answer_count']),
+    'sm_type_mix': ('*', ('answer',), lambda ev, rt: len(rt['unique_types'])),
+    'sm_evening_watch': ('*', ('answer',), lambda ev, rt: len(rt['evening_days'])),
+    'sm_last_life_chapter': (('chapter_complete',), ('event',),
+                             lambda ev, rt: 1 if ev['lives'] == 1 else None),
+    'sm_clean_two_chapters': (('chapter_complete',), ('event',),
+                              lambda ev, rt: rt['clean_chapter_count'] if ev['clean_chapter'] else None),
+    'sm_chapter_score_700': (('chapter_complete',), ('event',),
+                             lambda ev, rt: 1 if ev['chapter_score'] >= 700 else None),
+}
+
+
+def _secret_build_dispatch(rules: dict) -> dict:
+    '''(тип события, поле) -> mission_id правил в порядке rules.
+
+    Правила '*' попадают и под каждый явно названный тип: поиск делает
+    один get, а неизвестный тип берёт ключ ('*', поле).'''
+    typed = sorted({t for events, _, _ in rules.values() if events != '*' for t in events})
+    dispatch: dict = {}
+    for mission_id, (events, fields, _) in rules.items():
+        for event_type in (['*'] + typed if events == '*' else events):
+            for field in fields:
+                dispatch.setdefault((event_type, field), []).append(mission_id)
+    order = {mission_id: i for i, mission_id in enumerate(rules)}
+    return {key: tuple(sorted(ids, key=order.__getitem__)) for key, ids in dispatch.items()}
+
+
+_SECRET_DISPATCH = _secret_build_dispatch(_SECRET_RULES)
+_SECRET_RULE_ORDER = {mission_id: i for i, mission_id in enumerate(_SECRET_RULES)}
+
+
+def _secret_evaluate(mode: str, missions_map: dict, runtime: dict, payload: dict,
+                     invited_count: int, active_count: int) -> tuple[str, list, int, bool]:
+    '''Применяет событие игры к состоянию секретных миссий (без БД).
+
+    Проверяются только правила, чьи поля затронуты событием (_SECRET_DISPATCH),
+    и только у незавершённых миссий. missions_map и runtime меняются на месте;
+    возвращает (mode, awards, awarded_points, changed): changed == False —
+    состояние не изменилось и его можно не записывать.
+    '''
+    stored_mode = mode
+    if 'secret_mode' in payload:
+        mode = _sanitize_secret_mode(payload.get('secret_mode'))
+    changed = mode != stored_mode
+
+    event_type = str(payload.get('event_type') or payload.get('type') or 'sync').strip().lower()
+    chapter_errors = max(0, _secret_to_int(payload.get('chapter_errors', 0), 0))
+    chapter_hints = max(0, _secret_to_int(payload.get('chapter_hints', 0), 0))
+    ev = {
+        'mode': mode,
+        'chapter_score': max(0, _secret_to_int(payload.get('chapter_score', payload.get('score', 0)), 0)),
+        'chapter_errors': chapter_errors,
+        'chapter_hints': chapter_hints,
+        'clean_chapter': event_type == 'chapter_complete' and chapter_errors <= 1 and chapter_hints <= 1,
+        'lives': max(-1, _secret_to_int(payload.get('lives', 0), 0)),
+        'answer_elapsed': max(0, min(9999, _secret_to_int(payload.get('mission_last_answer_elapsed', payload.get('answer_elapsed', 0)), 0))),
+        'answer_no_hint': _secret_to_bool(payload.get('mission_last_answer_no_hint', payload.get('answer_no_hint', False))),
+        'answer_one_life': _secret_to_bool(payload.get('mission_last_answer_one_life', payload.get('answer_one_life', False))),
+        'answer_streak': max(0, min(200, _secret_to_int(payload.get('mission_last_answer_streak', payload.get('answer_streak', 0)), 0))),
+        'invited_count': invited_count,
+        'active_count': active_count,
+        'hour': 0,
+    }
+    answer_type = str(payload.get('mission_last_answer_type', payload.get('answer_type', '')) or '').strip().lower()
+    answer_token = max(0, _secret_to_int(payload.get('mission_answer_token', payload.get('answer_token', 0)), 0))
+    break_token = max(0, _secret_to_int(payload.get('mission_break_token', payload.get('break_token', 0)), 0))
+
+    if break_token > runtime.get('last_break_token', 0):
+        runtime['last_break_token'] = break_token
+        runtime['speed_streak'] = 0
+        changed = True
+
+    answer_event = answer_token > runtime.get('last_answer_token', 0)
+    now_dt = None
+    if answer_event:
+        now_dt = _secret_now_minsk()
+        ev['hour'] = int(now_dt.hour)
+        fast = _secret_fast(ev)
+        runtime['last_answer_token'] = answer_token
+        if fast:
+            runtime['speed_streak'] = max(0, _secret_to_int(runtime.get('speed_streak', 0), 0)) + 1
+        else:
+            runtime['speed_streak'] = 0
+        if mode == 'speed' and not (fast and ev['answer_streak'] >= 1):
+            runtime['speed_streak'] = 0
+        if answer_type == 'morse' and fast:
+            runtime['morse_fast_count'] = max(0, _secret_to_int(runtime.get('morse_fast_count', 0), 0)) + 1
+        if answer_type == 'map':
+            runtime['map_answer_count'] = max(0, _secret_to_int(runtime.get('map_answer_count', 0), 0)) + 1
+        if answer_type:
+            unique_types = runtime.get('unique_types', [])
+            if not isinstance(unique_types, list):
+                unique_types = []
+            if answer_type not in unique_types:
+                unique_types.append(answer_type)
+            runtime['unique_types'] = unique_types[:16]
+        active_days = runtime.get('active_days', [])
+        if not isinstance(active_days, list):
+            active_days = []
+        day_key = now_dt.strftime('%Y-%m-%d')
+        if day_key not in active_days:
+            active_days.append(day_key)
+        runtime['active_days'] = active_days[-14:]
+        if 18 <= ev['hour'] <= 22:
+            evening_days = runtime.get('evening_days', [])
+            if not isinstance(evening_days, list):
+                evening_days = []
+            if day_key not in evening_days:
+                evening_days.append(day_key)
+            runtime['evening_days'] = evening_days[-14:]
+        changed = True
+    if ev['clean_chapter']:
+        runtime['clean_chapter_count'] = max(0, _secret_to_int(runtime.get('clean_chapter_count', 0), 0)) + 1
+        changed = True
+
+    fields = ['event']
+    if answer_event:
+        fields.append('answer')
+    if mode != stored_mode:
+        fields.append('mode')
+    if invited_count > 0:
+        fields.append('invited_count')
+    if active_count > 0:
+        fields.append('active_count')
+    affected = set()
+    for field in fields:
+        affected.update(_SECRET_DISPATCH.get((event_type, field), _SECRET_DISPATCH.get(('*', field), ())))
+
+    awards = []
+    awarded_points = 0
+    for mission_id in sorted(affected, key=_SECRET_RULE_ORDER.__getitem__):
+        mission = _SECRET_MISSIONS_BY_ID.get(mission_id)
+        row_state = missions_map.get(mission_id)
+        if not mission or not isinstance(row_state, dict) or _secret_to_bool(row_state.get('completed', False)):
+            continue
+        candidate = _SECRET_RULES[mission_id][2](ev, runtime)
+        if candidate is None:
+            continue
+        target = max(1, _secret_to_int(mission.get('target', 1), 1))
+        progress_was = max(0, _secret_to_int(row_state.get('progress', 0), 0))
+        progress_now = max(progress_was, max(0, min(target, _secret_to_int(candidate, 0))))
+        if progress_now == progress_was:
+            continue
+        changed = True
+        row_state['progress'] = progress_now
+        if progress_now >= target:
+            if now_dt is None:
+                now_dt = _secret_now_minsk()
+            bonus_points = _secret_bonus_points(mission, ev['chapter_score'])
+            row_state['completed'] = True
+            row_state['completed_at'] = now_dt.isoformat()
+            row_state['reward_points'] = bonus_points
+            awarded_points += bonus_points
+            awards.append({
+                'id': mission_id,
+                'name': mission['name'],
+                'icon': mission['icon'],
+                'bonus_pct': max(0, _secret_to_int(mission.get('bonus_pct', 0), 0)),
+                'points': bonus_points,
+            })
+
+    return mode, awards, awarded_points, changed
+
+
+def _secret_store_params(uid: int, mode: str, missions_map: dict, runtime: dict) -> tuple:
+    '''Параметры upsert-а game_secret_state: (user_id, mode, missions_json, runtime_json, completed, bonus).'''
+    summary = _secret_summary_from_missions(missions_map)
+    return (
+        uid,
+        mode,
+        json.dumps(missions_map, ensure_ascii=False),
+        json.dumps(runtime, ensure_ascii=False),
+        summary['completed'],
+        summary['bonus_points'],
+    )
+
+
+def _secret_store(cur, uid: int, mode: str, missions_map: dict, runtime: dict, awarded_points: int) -> dict:
+    '''Записывает состояние секретных миссий и начисляет бонус; возвращает _secret_export.'''
+    if awarded_points > 0:
+        cur.execute(
+            '''
+            UPDATE game_results
+            SET total_score = GREATEST(0, COALESCE(total_score, 0) + %s),
+                updated_at = NOW()
+            WHERE user_id = %s
+            ''',
+            (awarded_points, uid),
+        )
+        _leaderboard_stage(cur, [uid])
+
+    cur.execute(
+        '''
+        INSERT INTO game_secret_state (
+            user_id, selected_mode, missions_json, runtime_json,
+            completed_count, bonus_points, updated_at
+        )
+        VALUES (%s, %s, %s::jsonb, %s::jsonb, %s, %s, NOW())
+        ON CONFLICT (user_id) DO UPDATE SET
+            selected_mode = EXCLUDED.selected_mode,
+            missions_json = EXCLUDED.missions_json,
+            runtime_json = EXCLUDED.runtime_json,
+            completed_count = EXCLUDED.completed_count,
+            bonus_points = EXCLUDED.bonus_points,
+            updated_at = NOW()
+        ''',
+        _secret_store_params(uid, mode, missions_map, runtime),
+    )
+    return _secret_export(mode, missions_map)
+
+
+def _secret_prepare(state: dict | None, payload: dict, ref_counts: dict) -> tuple[dict, tuple | None]:
+    '''Считает секретные миссии для уже заблокированного (FOR UPDATE) состояния из game_sync_apply().
+
+    Возвращает (secret, store): store — аргументы для _secret_store
+    (mode, missions_map, runtime, awarded_points), либо None, если состояние не изменилось.
+    '''
+    state = state if isinstance(state, dict) else None
+    stored_mode = _sanitize_secret_mode(state.get('mode')) if state else 'none'
+    missions_map = _secret_normalize_missions(state.get('missions')) if state else _secret_empty_missions_state()
+    runtime = _secret_normalize_runtime(state.get('runtime')) if state else _secret_default_runtime()
+
+    invited_count = max(0, _secret_to_int(ref_counts.get('invited_count', 0), 0))
+    active_count = max(0, _secret_to_int(ref_counts.get('active_count', 0), 0))
+    rewarded_chapters = max(0, _secret_to_int(ref_counts.get('rewarded_chapters', 0), 0))
+
+    mode, awards, awarded_points, changed = _secret_evaluate(
+        stored_mode, missions_map, runtime, payload, invited_count, active_count
+    )
+    store = (mode, missions_map, runtime, awarded_points) if changed else None
+    exported = _secret_export(mode, missions_map)
+    secret = {
+        'ok': True,
+        'mode': exported['mode'],
+        'summary': exported['summary'],
+        'missions': exported['missions'],
+        'awards': awards,
+        'awarded_points': awarded_points,
+        'invited_count': invited_count,
+        'active_count': active_count,
+        'rewarded_chapters': rewarded_chapters,
+    }
+    return secret, store
+
+
 def apply_secret_missions_sync(user_id: int, payload: dict | None = None) -> dict:
     conn = None
     payload = payload or {}
@@ -2965,189 +4308,16 @@ def apply_secret_missions_sync(user_id: int, payload: dict | None = None) -> dic
             missions_map = _secret_normalize_missions(row[1])
             runtime = _secret_normalize_runtime(row[2])
 
-        if 'secret_mode' in payload:
-            mode = _sanitize_secret_mode(payload.get('secret_mode'))
-
-        event_type = str(payload.get('event_type') or payload.get('type') or 'sync').strip().lower()
-        chapter_score = max(0, _secret_to_int(payload.get('chapter_score', payload.get('score', 0)), 0))
-        chapter_errors = max(0, _secret_to_int(payload.get('chapter_errors', 0), 0))
-        chapter_hints = max(0, _secret_to_int(payload.get('chapter_hints', 0), 0))
-        lives = max(-1, _secret_to_int(payload.get('lives', 0), 0))
-
-        answer_token = max(0, _secret_to_int(payload.get('mission_answer_token', payload.get('answer_token', 0)), 0))
-        break_token = max(0, _secret_to_int(payload.get('mission_break_token', payload.get('break_token', 0)), 0))
-        answer_elapsed = max(0, min(9999, _secret_to_int(payload.get('mission_last_answer_elapsed', payload.get('answer_elapsed', 0)), 0)))
-        answer_no_hint = _secret_to_bool(payload.get('mission_last_answer_no_hint', payload.get('answer_no_hint', False)))
-        answer_one_life = _secret_to_bool(payload.get('mission_last_answer_one_life', payload.get('answer_one_life', False)))
-        answer_type = str(payload.get('mission_last_answer_type', payload.get('answer_type', '')) or '').strip().lower()
-        answer_streak = max(0, min(200, _secret_to_int(payload.get('mission_last_answer_streak', payload.get('answer_streak', 0)), 0)))
-
-        if break_token > runtime.get('last_break_token', 0):
-            runtime['last_break_token'] = break_token
-            runtime['speed_streak'] = 0
-
-        answer_event = answer_token > runtime.get('last_answer_token', 0)
-        now_dt = _secret_now_minsk()
-        now_iso = now_dt.isoformat()
-        now_hour = int(now_dt.hour)
-        if answer_event:
-            runtime['last_answer_token'] = answer_token
-            if answer_elapsed > 0 and answer_elapsed <= 14:
-                runtime['speed_streak'] = max(0, _secret_to_int(runtime.get('speed_streak', 0), 0)) + 1
-            else:
-                runtime['speed_streak'] = 0
-            if answer_type == 'morse' and answer_elapsed > 0 and answer_elapsed <= 14:
-                runtime['morse_fast_count'] = max(0, _secret_to_int(runtime.get('morse_fast_count', 0), 0)) + 1
-            if answer_type == 'map':
-                runtime['map_answer_count'] = max(0, _secret_to_int(runtime.get('map_answer_count', 0), 0)) + 1
-            if answer_type:
-                unique_types = runtime.get('unique_types', [])
-                if not isinstance(unique_types, list):
-                    unique_types = []
-                if answer_type not in unique_types:
-                    unique_types.append(answer_type)
-                runtime['unique_types'] = unique_types[:16]
-            active_days = runtime.get('active_days', [])
-            if not isinstance(active_days, list):
-                active_days = []
-            day_key = now_dt.strftime('%Y-%m-%d')
-            if day_key not in active_days:
-                active_days.append(day_key)
-            runtime['active_days'] = active_days[-14:]
-            if 18 <= now_hour <= 22:
-                evening_days = runtime.get('evening_days', [])
-                if not isinstance(evening_days, list):
-                    evening_days = []
-                if day_key not in evening_days:
-                    evening_days.append(day_key)
-                runtime['evening_days'] = evening_days[-14:]
-
-        cur.execute(
-            '''
-            SELECT
-                COUNT(*)::INT AS invited_count,
-                COUNT(*) FILTER (WHERE COALESCE(gr.completed, 0) > 0)::INT AS active_count,
-                COALESCE(SUM(rf.rewarded_chapters), 0)::INT AS rewarded_chapters
-            FROM game_referrals rf
-            LEFT JOIN game_results gr ON gr.user_id = rf.referred_id
-            WHERE rf.referrer_id = %s
-            ''',
-            (uid,),
-        )
-        ref_row = cur.fetchone() or (0, 0, 0)
-        invited_count = max(0, _secret_to_int(ref_row[0], 0))
-        active_count = max(0, _secret_to_int(ref_row[1], 0))
-        rewarded_chapters = max(0, _secret_to_int(ref_row[2], 0))
-
-        awards = []
-        awarded_points = 0
-
-        def _apply_progress(mission_id: str, candidate_progress: int, base_score: int):
-            nonlocal awarded_points
-            mission = _SECRET_MISSIONS_BY_ID.get(mission_id)
-            if not mission:
-                return
-            target = max(1, _secret_to_int(mission.get('target', 1), 1))
-            row_state = missions_map.get(mission_id, {})
-            if not isinstance(row_state, dict):
-                row_state = {'progress': 0, 'completed': False, 'completed_at': None, 'reward_points': 0}
-            progress_now = max(0, _secret_to_int(row_state.get('progress', 0), 0))
-            completed_now = _secret_to_bool(row_state.get('completed', False))
-            if completed_now:
-                row_state['progress'] = target
-                missions_map[mission_id] = row_state
-                return
-            progress_now = max(progress_now, max(0, min(target, _secret_to_int(candidate_progress, 0))))
-            row_state['progress'] = progress_now
-            if progress_now >= target:
-                bonus_points = _secret_bonus_points(mission, base_score)
-                row_state['progress'] = target
-                row_state['completed'] = True
-                row_state['completed_at'] = now_iso
-                row_state['reward_points'] = bonus_points
-                awarded_points += bonus_points
-                awards.append({
-                    'id': mission_id,
-                    'name': mission['name'],
-                    'icon': mission['icon'],
-                    'bonus_pct': max(0, _secret_to_int(mission.get('bonus_pct', 0), 0)),
-                    'points': bonus_points,
-                })
-            missions_map[mission_id] = row_state
-
-        if mode == 'silent' and answer_event and answer_no_hint:
-            _apply_progress('sm_silent_no_hint', 1, chapter_score)
-
-        if mode == 'speed' and answer_event:
-            if answer_elapsed > 0 and answer_elapsed <= 14 and answer_streak >= 1:
-                _apply_progress('sm_speed_three', runtime.get('speed_streak', 0), chapter_score)
-            else:
-                runtime['speed_streak'] = 0
-
-        if mode == 'iron' and answer_event and answer_one_life:
-            _apply_progress('sm_iron_one_life', 1, chapter_score)
-
-        if mode == 'recruit':
-            _apply_progress('sm_recruit_one', min(1, invited_count), chapter_score)
-
-        if mode == 'night' and answer_event and (now_hour >= 23 or now_hour <= 5):
-            _apply_progress('sm_night_watch', 1, chapter_score)
-
-        if event_type == 'chapter_complete' and chapter_hints <= 0 and chapter_errors <= 0:
-            _apply_progress('sm_flawless_chapter', 1, chapter_score)
-
-        _apply_progress('sm_morse_five_fast', runtime.get('morse_fast_count', 0), chapter_score)
-        _apply_progress('sm_week_discipline', len(runtime.get('active_days', [])), chapter_score)
-        _apply_progress('sm_network_three', active_count, chapter_score)
-        _apply_progress('sm_map_runner', runtime.get('map_answer_count', 0), chapter_score)
-        _apply_progress('sm_type_mix', len(runtime.get('unique_types', [])), chapter_score)
-        _apply_progress('sm_evening_watch', len(runtime.get('evening_days', [])), chapter_score)
-
-        if event_type == 'chapter_complete' and lives == 1:
-            _apply_progress('sm_last_life_chapter', 1, chapter_score)
-        if event_type == 'chapter_complete' and chapter_errors <= 1 and chapter_hints <= 1:
-            runtime['clean_chapter_count'] = max(0, _secret_to_int(runtime.get('clean_chapter_count', 0), 0)) + 1
-            _apply_progress('sm_clean_two_chapters', runtime.get('clean_chapter_count', 0), chapter_score)
-        if event_type == 'chapter_complete' and chapter_score >= 700:
-            _apply_progress('sm_chapter_score_700', 1, chapter_score)
-
-        if awarded_points > 0:
-            cur.execute(
-                '''
-                UPDATE game_results
-                SET total_score = GREATEST(0, COALESCE(total_score, 0) + %s),
-                    updated_at = NOW()
-                WHERE user_id = %s
-                ''',
-                (awarded_points, uid),
-            )
+        # Для миссий активный агент — прошедший хотя бы одну главу (completed_count).
+        invited_count, _, active_count, rewarded_chapters, _, _ = _referral_counters(cur, uid)
 
-        exported = _secret_export(mode, missions_map)
-        summary = exported['summary']
-        cur.execute(
-            '''
-            INSERT INTO game_secret_state (
-                user_id, selected_mode, missions_json, runtime_json,
-                completed_count, bonus_points, updated_at
-            )
-            VALUES (%s, %s, %s::jsonb, %s::jsonb, %s, %s, NOW())
-            ON CONFLICT (user_id) DO UPDATE SET
-                selected_mode = EXCLUDED.selected_mode,
-                missions_json = EXCLUDED.missions_json,
-                runtime_json = EXCLUDED.runtime_json,
-                completed_count = EXCLUDED.completed_count,
-                bonus_points = EXCLUDED.bonus_points,
-                updated_at = NOW()
-            ''',
-            (
-                uid,
-                mode,
-                json.dumps(missions_map, ensure_ascii=False),
-                json.dumps(runtime, ensure_ascii=False),
-                summary['completed'],
-                summary['bonus_points'],
-            ),
+        mode, awards, awarded_points, changed = _secret_evaluate(
+            mode, missions_map, runtime, payload, invited_count, active_count
         )
+        if changed:
+            exported = _secret_store(cur, uid, mode, missions_map, runtime, awarded_points)
+        else:
+            exported = _secret_export(mode, missions_map)
         conn.commit()
 
         return {
@@ -3178,6 +4348,8 @@ def apply_secret_missions_sync(user_id: int, payload: dict | None = None) -> dic
 
 def get_game_players_count():
     '''Возвращает количество участников рейтинга (только role=player).'''
+    if leaderboard.board.ready:
+        return leaderboard.board.players_count()
     conn = None
     try:
         conn = get_connection()
@@ -3198,270 +4370,576 @@ def get_game_players_count():
         release_connection(conn)
 
 
-def _calc_retreat_penalty_points(score_value: int) -> int:
-    base = max(0, int(score_value or 0))
-    if base <= 0:
-        return 0
-    return max(1, int(round(base * 0.10)))
+# Серверная часть /game_sync: весь путь sync (проверка reset_token, слияние
+# прогресса и штрафы отхода, достижения, сброс restart_mode, роль, реферальные
+# бонусы, сводка агентов) выполняется одним вызовом game_sync_apply() —
+# один сетевой round trip вместо десятка. Реферальная часть повторяет
+# apply_referral_bonus_for_completed / get_referral_summary / get_referral_agents
+# (формулы — общие SQL-функции ниже, Python-пути вызывают их же); доли пригласивших sync только ставит
+# в очередь (process_referral_credits), а список агентов пропускает, если он
+# уже в кэше вызывающего (p_agents_limit = 0). Создаётся миграцией (см. _MIGRATIONS).
+_GAME_SYNC_SQL = '''
+CREATE OR REPLACE FUNCTION game_retreat_penalty(p_base INTEGER) RETURNS INTEGER
+LANGUAGE sql IMMUTABLE AS $fn$
+    -- 10% от очков главы; round(float8) округляет половины к чётному, как round() в Python
+    SELECT CASE WHEN COALESCE(p_base, 0) <= 0 THEN 0
+                ELSE GREATEST(1, round(p_base * 0.10::float8)::INTEGER) END
+$fn$;
+
+CREATE OR REPLACE FUNCTION game_referral_bonus(p_base INTEGER, p_pct INTEGER) RETURNS INTEGER
+LANGUAGE sql IMMUTABLE AS $fn$
+    SELECT CASE WHEN COALESCE(p_base, 0) <= 0 OR COALESCE(p_pct, 0) <= 0 THEN 0
+                ELSE GREATEST(1, ((p_base::BIGINT * p_pct + 99) / 100)::INTEGER) END
+$fn$;
+
+CREATE OR REPLACE FUNCTION game_inviter_percent(p_count INTEGER, p_per_agent INTEGER, p_max INTEGER) RETURNS INTEGER
+LANGUAGE sql IMMUTABLE AS $fn$
+    SELECT CASE WHEN COALESCE(p_count, 0) <= 0 THEN 0
+                ELSE GREATEST(1, LEAST(p_max, p_count * p_per_agent)) END
+$fn$;
+
+CREATE OR REPLACE FUNCTION game_sync_apply(
+    p_user_id BIGINT,
+    p_user_name TEXT,
+    p_chapter INTEGER,
+    p_score INTEGER,
+    p_total_score INTEGER,
+    p_completed INTEGER,
+    p_game_over BOOLEAN,
+    p_failed BOOLEAN,
+    p_event_type TEXT,
+    p_cipher_idx INTEGER,
+    p_in_progress BOOLEAN,
+    p_restart_penalty INTEGER,
+    p_client_reset_token BIGINT,
+    p_achievement_count INTEGER,
+    p_achievement_pts INTEGER,
+    p_invitee_pct INTEGER,
+    p_inviter_pct_per_agent INTEGER,
+    p_inviter_pct_max INTEGER,
+    p_agents_limit INTEGER
+) RETURNS JSONB
+LANGUAGE plpgsql AS $fn$
+DECLARE
+    g game_results%ROWTYPE;
+    rf RECORD;
+    link RECORD;
+    v_found BOOLEAN;
+    v_event TEXT := COALESCE(NULLIF(p_event_type, ''), 'sync');
+    v_chapter INTEGER := GREATEST(0, COALESCE(p_chapter, 0));
+    v_score INTEGER := GREATEST(0, COALESCE(p_score, 0));
+    v_total INTEGER := GREATEST(0, COALESCE(p_total_score, 0));
+    v_completed INTEGER := GREATEST(0, COALESCE(p_completed, 0));
+    v_cipher INTEGER := COALESCE(p_cipher_idx, -1);
+    v_penalty INTEGER := GREATEST(0, COALESCE(p_restart_penalty, 0));
+    v_total_before INTEGER := 0;
+    v_token BIGINT;
+    v_role TEXT;
+    v_restart_mode TEXT;
+    v_retreat INTEGER;
+    v_pending INTEGER;
+    v_pending_chapter INTEGER;
+    v_sync_chapter INTEGER;
+    v_sync_max_score INTEGER;
+    v_sync_max_cipher INTEGER;
+    v_manual BOOLEAN := FALSE;
+    v_auto BOOLEAN := FALSE;
+    v_penalty_applied INTEGER := 0;
+    v_new_chapter INTEGER;
+    v_new_score INTEGER;
+    v_new_total INTEGER;
+    v_new_completed INTEGER;
+    v_new_game_over BOOLEAN;
+    v_new_failed BOOLEAN;
+    v_achievements BOOLEAN;
+    v_is_active BOOLEAN;
+    v_is_completed BOOLEAN;
+    v_count INTEGER;
+    v_pct INTEGER;
+    v_invitee_pct INTEGER;
+    v_base INTEGER;
+    v_award_invitee INTEGER := 0;
+    v_award_chapters INTEGER := 0;
+    v_ref_found BOOLEAN := FALSE;
+    v_invitee_total INTEGER := 0;
+    v_invitee_pct_out INTEGER;
+    v_referrer_id BIGINT := 0;
+    v_invited INTEGER := 0;
+    v_active INTEGER := 0;
+    v_active_completed INTEGER := 0;
+    v_rewarded INTEGER := 0;
+    v_bonus INTEGER := 0;
+    v_inviter_pct INTEGER := 0;
+    v_summary JSONB;
+    v_agents JSONB;
+    v_secret JSONB;
+    v_secret_found BOOLEAN := FALSE;
+    v_ref_failed BOOLEAN := FALSE;
+    v_lb_rows JSONB;
+BEGIN
+    SELECT * INTO g FROM game_results WHERE user_id = p_user_id FOR UPDATE;
+    v_found := FOUND;
+    IF v_found THEN
+        v_total_before := COALESCE(g.total_score, 0);
+        v_token := COALESCE(g.reset_token, 0);
+        -- Защита от перезаписи после админ-сброса (= game_security.is_stale_sync_token).
+        IF v_token > 0 AND COALESCE(p_client_reset_token, 0) > 0 AND p_client_reset_token <> v_token THEN
+            SELECT role INTO v_role FROM game_roles WHERE user_id = p_user_id;
+            RETURN jsonb_build_object(
+                'stale', TRUE,
+                'db_score', v_total_before,
+                'db_completed', COALESCE(g.completed, 0),
+                'db_reset_token', v_token,
+                'banned', COALESCE(g.banned, FALSE),
+                'role', COALESCE(v_role, 'player')
+            );
+        END IF;
+    ELSE
+        INSERT INTO game_results (user_id, user_name, chapter, score, total_score, completed, game_over, failed, updated_at)
+        VALUES (p_user_id, COALESCE(NULLIF(p_user_name, ''), 'Игрок'), 0, 0, 0, 0, FALSE, FALSE, NOW())
+        ON CONFLICT (user_id) DO NOTHING;
+        SELECT * INTO g FROM game_results WHERE user_id = p_user_id FOR UPDATE;
+    END IF;
+
+    v_restart_mode := g.restart_mode;
+    v_retreat := COALESCE(g.retreat_count, 0);
+    v_pending := GREATEST(0, COALESCE(g.pending_retreat_penalty, 0));
+    v_pending_chapter := GREATEST(0, COALESCE(g.pending_retreat_chapter, 0));
+    v_sync_chapter := GREATEST(0, COALESCE(g.sync_chapter, 0));
+    v_sync_max_score := GREATEST(0, COALESCE(g.sync_max_chapter_score, 0));
+    v_sync_max_cipher := COALESCE(g.sync_max_cipher_idx, -1);
+
+    IF v_event = 'chapter_replay_start' THEN
+        -- Явный старт повтора завершённой главы: total_score/completed можно понизить.
+        IF v_penalty > 0 THEN
+            v_pending := GREATEST(v_pending, v_penalty);
+            v_pending_chapter := v_chapter;
+        END IF;
+        v_retreat := v_retreat + 1;
+        v_sync_chapter := v_chapter;
+        v_sync_max_score := 0;
+        v_sync_max_cipher := -1;
+        v_new_chapter := GREATEST(COALESCE(g.chapter, 0), v_chapter);
+        v_new_score := 0;
+        v_new_total := v_total;
+        v_new_completed := v_completed;
+        v_new_game_over := FALSE;
+        v_new_failed := FALSE;
+    ELSE
+        -- Явный ручной "отход" с клиента.
+        v_manual := v_event = 'manual_restart';
+        IF v_manual THEN
+            IF v_penalty <= 0 THEN
+                v_penalty := game_retreat_penalty(v_score);
+            END IF;
+            v_pending := GREATEST(v_pending, v_penalty);
+            v_pending_chapter := v_chapter;
+            v_retreat := v_retreat + 1;
+            v_sync_chapter := v_chapter;
+            v_sync_max_score := v_score;
+            v_sync_max_cipher := GREATEST(-1, v_cipher);
+        END IF;
+
+        -- Резервное авто-детектирование перезапуска.
+        IF NOT v_manual AND COALESCE(p_in_progress, FALSE) AND v_chapter > 0
+           AND v_sync_chapter = v_chapter AND v_pending_chapter <> v_chapter THEN
+            IF v_score + 5 < v_sync_max_score
+               OR (v_cipher >= 0 AND v_sync_max_cipher >= 0 AND v_cipher + 1 < v_sync_max_cipher) THEN
+                v_auto := TRUE;
+                v_pending := GREATEST(v_pending, game_retreat_penalty(GREATEST(v_sync_max_score, v_score)));
+                v_pending_chapter := v_chapter;
+                v_retreat := v_retreat + 1;
+                v_sync_max_score := v_score;
+                v_sync_max_cipher := GREATEST(-1, v_cipher);
+            END IF;
+        END IF;
+
+        -- Максимум прогресса внутри текущей главы.
+        IF COALESCE(p_in_progress, FALSE) AND v_chapter > 0 AND NOT v_manual AND NOT v_auto THEN
+            IF v_sync_chapter <> v_chapter THEN
+                v_sync_chapter := v_chapter;
+                v_sync_max_score := v_score;
+                v_sync_max_cipher := GREATEST(-1, v_cipher);
+            ELSE
+                v_sync_max_score := GREATEST(v_sync_max_score, v_score);
+                IF v_cipher >= 0 THEN
+                    v_sync_max_cipher := GREATEST(v_sync_max_cipher, v_cipher);
+                END IF;
+            END IF;
+        END IF;
+
+        -- Серверное применение штрафа при завершении главы.
+        IF v_event = 'chapter_complete' AND v_pending > 0 AND v_pending_chapter = v_chapter THEN
+            v_penalty_applied := LEAST(GREATEST(0, v_pending - v_penalty), v_score);
+            v_score := GREATEST(0, v_score - v_penalty_applied);
+            v_total := GREATEST(0, v_total - v_penalty_applied);
+            v_pending := 0;
+            v_pending_chapter := 0;
+            v_sync_max_score := 0;
+            v_sync_max_cipher := -1;
+            v_sync_chapter := 0;
+        ELSIF v_event = 'chapter_complete' THEN
+            v_sync_max_score := 0;
+            v_sync_max_cipher := -1;
+            v_sync_chapter := 0;
+        END IF;
+
+        v_new_chapter := GREATEST(COALESCE(g.chapter, 0), v_chapter);
+        IF v_total >= COALESCE(g.total_score, 0) OR v_completed >= COALESCE(g.completed, 0) THEN
+            v_new_score := v_score;
+        ELSE
+            v_new_score := COALESCE(g.score, 0);
+        END IF;
+        v_new_total := GREATEST(COALESCE(g.total_score, 0), v_total);
+        v_new_completed := GREATEST(COALESCE(g.completed, 0), v_completed);
+        v_new_game_over := COALESCE(g.game_over, FALSE) OR COALESCE(p_game_over, FALSE);
+        v_new_failed := COALESCE(p_failed, FALSE);
+    END IF;
+
+    -- Достижения сохраняем только при реальном прогрессе (до или после этого sync).
+    v_achievements := (COALESCE(p_achievement_count, 0) > 0 OR COALESCE(p_achievement_pts, 0) > 0)
+        AND (v_total_before > 0 OR v_new_total > 0 OR GREATEST(0, COALESCE(p_completed, 0)) > 0 OR v_new_completed > 0);
+
+    UPDATE game_results
+    SET user_name = COALESCE(NULLIF(p_user_name, ''), NULLIF(g.user_name, ''), 'Игрок'),
+        chapter = v_new_chapter,
+        score = v_new_score,
+        total_score = v_new_total,
+        completed = v_new_completed,
+        game_over = v_new_game_over,
+        failed = v_new_failed,
+        retreat_count = v_retreat,
+        pending_retreat_penalty = v_pending,
+        pending_retreat_chapter = v_pending_chapter,
+        sync_chapter = v_sync_chapter,
+        sync_max_chapter_score = v_sync_max_score,
+        sync_max_cipher_idx = v_sync_max_cipher,
+        achievement_count = CASE WHEN v_achievements THEN p_achievement_count ELSE achievement_count END,
+        achievement_pts = CASE WHEN v_achievements THEN p_achievement_pts ELSE achievement_pts END,
+        -- restart_mode одноразовый: снимаем после первого успешного sync.
+        restart_mode = CASE WHEN restart_mode IN ('penalty', 'nopts') THEN NULL ELSE restart_mode END,
+        updated_at = NOW()
+    WHERE user_id = p_user_id;
+
+    SELECT role INTO v_role FROM game_roles WHERE user_id = p_user_id;
+    IF FOUND AND v_role IS NULL THEN
+        UPDATE game_roles SET role = 'player', updated_at = NOW() WHERE user_id = p_user_id;
+    END IF;
+    v_role := COALESCE(v_role, 'player');
+
+    -- Реферальный шаг — во вложенном блоке (неявный SAVEPOINT): его ошибка
+    -- откатывает только реферальные записи, очки и прогресс игрока сохраняются.
+    BEGIN
+        -- Активность агента для счётчиков пригласившего (= _referral_refresh_activity).
+        v_is_active := v_new_total > 0 OR v_new_completed > 0;
+        v_is_completed := v_new_completed > 0;
+        SELECT referrer_id, counted_active, counted_completed
+        INTO link
+        FROM game_referrals
+        WHERE referred_id = p_user_id
+        FOR UPDATE;
+        IF FOUND AND (link.counted_active <> v_is_active OR link.counted_completed <> v_is_completed) THEN
+            UPDATE game_referrals
+            SET counted_active = v_is_active, counted_completed = v_is_completed
+            WHERE referred_id = p_user_id;
+            UPDATE game_referral_counters
+            SET active_count = GREATEST(0, active_count + v_is_active::INTEGER - link.counted_active::INTEGER),
+                completed_count = GREATEST(0, completed_count + v_is_completed::INTEGER - link.counted_completed::INTEGER),
+                updated_at = NOW()
+            WHERE referrer_id = link.referrer_id;
+        END IF;
+
+        SELECT invited_count, active_count, completed_count, rewarded_chapters, bonus_points
+        INTO v_invited, v_active, v_active_completed, v_rewarded, v_bonus
+        FROM game_referral_counters
+        WHERE referrer_id = p_user_id;
+        v_invited := COALESCE(v_invited, 0);
+        v_active := COALESCE(v_active, 0);
+        v_active_completed := COALESCE(v_active_completed, 0);
+        v_rewarded := COALESCE(v_rewarded, 0);
+        v_bonus := COALESCE(v_bonus, 0);
+
+        IF v_role = 'player' THEN
+            -- Бонус по % от личного рекорда приглашённого (и его пригласившему).
+            SELECT referrer_id,
+                   GREATEST(0, COALESCE(rewarded_chapters, 0)) AS rewarded_chapters,
+                   GREATEST(0, COALESCE(total_referrer_bonus, 0)) AS total_referrer_bonus,
+                   GREATEST(0, COALESCE(pct_referrer_bonus_paid, 0)) AS pct_paid,
+                   GREATEST(0, COALESCE(total_referred_bonus, 0)) AS total_referred_bonus,
+                   GREATEST(0, COALESCE(NULLIF(invitee_bonus_percent, 0), p_invitee_pct)) AS invitee_pct,
+                   GREATEST(0, COALESCE(max_referred_base_score, 0)) AS max_base
+            INTO rf
+            FROM game_referrals
+            WHERE referred_id = p_user_id
+            FOR UPDATE;
+            v_ref_found := FOUND;
+            IF v_ref_found THEN
+                SELECT invited_count INTO v_count FROM game_referral_counters WHERE referrer_id = rf.referrer_id;
+                v_count := COALESCE(v_count, 0);
+                v_pct := game_inviter_percent(v_count, p_inviter_pct_per_agent, p_inviter_pct_max);
+                v_invitee_pct := rf.invitee_pct;
+                v_base := GREATEST(rf.max_base, GREATEST(0, v_new_total - rf.total_referred_bonus));
+                v_award_invitee := GREATEST(0, game_referral_bonus(v_base, v_invitee_pct) - rf.total_referred_bonus);
+                v_award_chapters := GREATEST(0, LEAST(6, v_new_completed) - rf.rewarded_chapters);
+
+                -- Долю пригласившего начисляет process_referral_credits: sync только
+                -- ставит его в очередь и не блокирует чужую строку game_results.
+                IF game_referral_bonus(v_base, v_pct) > rf.pct_paid THEN
+                    INSERT INTO game_referral_credit_queue (referrer_id)
+                    VALUES (rf.referrer_id)
+                    ON CONFLICT (referrer_id) DO NOTHING;
+                END IF;
+                IF v_award_invitee > 0 THEN
+                    UPDATE game_results
+                    SET total_score = COALESCE(total_score, 0) + v_award_invitee, updated_at = NOW()
+                    WHERE user_id = p_user_id;
+                END IF;
+                UPDATE game_referrals
+                SET rewarded_chapters = GREATEST(rf.rewarded_chapters, LEAST(6, v_new_completed)),
+                    total_referred_bonus = rf.total_referred_bonus + v_award_invitee,
+                    max_referred_base_score = v_base,
+                    updated_at = NOW()
+                WHERE referred_id = p_user_id;
+                IF v_award_chapters > 0 THEN
+                    UPDATE game_referral_counters
+                    SET rewarded_chapters = rewarded_chapters + v_award_chapters, updated_at = NOW()
+                    WHERE referrer_id = rf.referrer_id;
+                END IF;
+                v_invitee_total := rf.total_referred_bonus + v_award_invitee;
+                v_invitee_pct_out := v_invitee_pct;
+                v_referrer_id := rf.referrer_id;
+            END IF;
+
+            -- Доли от агентов начисляются в фоне (очередь game_referral_credit_queue).
+            v_inviter_pct := game_inviter_percent(v_invited, p_inviter_pct_per_agent, p_inviter_pct_max);
+
+            v_summary := jsonb_build_object(
+                'invited_count', v_invited,
+                'active_count', v_active,
+                'rewarded_chapters', v_rewarded,
+                'bonus_points', v_bonus,
+                'inviter_percent', v_inviter_pct,
+                'invitee_percent', COALESCE(v_invitee_pct_out, p_invitee_pct),
+                'invitee_bonus_points', v_invitee_total,
+                'referrer_id', v_referrer_id
+            );
+            -- p_agents_limit = 0: список агентов у вызывающего в кэше (referral_cache.py).
+            IF COALESCE(p_agents_limit, 15) > 0 THEN
+            SELECT COALESCE(jsonb_agg(x.agent ORDER BY x.created_at DESC), '[]'::jsonb)
+            INTO v_agents
+            FROM (
+                SELECT a.created_at,
+                       jsonb_build_object(
+                           'user_id', a.referred_id,
+                           'name', COALESCE(NULLIF(u.first_name, ''), NULLIF(gr.user_name, ''), 'Игрок'),
+                           'completed', COALESCE(gr.completed, 0),
+                           'total_score', COALESCE(gr.total_score, 0),
+                           'rewarded_chapters', COALESCE(a.rewarded_chapters, 0),
+                           'bonus_points', COALESCE(a.total_referrer_bonus, 0),
+                           'invitee_bonus_points', COALESCE(a.total_referred_bonus, 0),
+                           'invitee_percent', COALESCE(NULLIF(a.invitee_bonus_percent, 0), p_invitee_pct),
+                           'inviter_percent', v_inviter_pct
+                       ) AS agent
+                FROM game_referrals a
+                LEFT JOIN users u ON u.user_id = a.referred_id
+                LEFT JOIN game_results gr ON gr.user_id = a.referred_id
+                WHERE a.referrer_id = p_user_id
+                ORDER BY a.created_at DESC
+                LIMIT GREATEST(1, LEAST(50, COALESCE(p_agents_limit, 15)))
+            ) x;
+            END IF;
+        END IF;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE WARNING 'game_sync_apply referral step failed for %: %', p_user_id, SQLERRM;
+        v_ref_failed := TRUE;
+        v_award_invitee := 0;
+        v_award_chapters := 0;
+        v_invited := 0;
+        v_active_completed := 0;
+        v_rewarded := 0;
+        v_inviter_pct := 0;
+        v_invitee_pct_out := NULL;
+        v_summary := NULL;
+        v_agents := NULL;
+    END;
+
+    -- Состояние секретных миссий блокируем здесь же; сами миссии считает Python.
+    IF v_role IN ('player', 'tester', 'admin') THEN
+        SELECT jsonb_build_object('mode', selected_mode, 'missions', missions_json, 'runtime', runtime_json)
+        INTO v_secret
+        FROM game_secret_state
+        WHERE user_id = p_user_id
+        FOR UPDATE;
+        v_secret_found := FOUND;
+    END IF;
+
+    SELECT * INTO g FROM game_results WHERE user_id = p_user_id;
+    -- Строка рейтинга в памяти (см. _LEADERBOARD_SELECT) для игрока.
+    SELECT COALESCE(jsonb_agg(jsonb_build_array(
+               gr.user_id, gr.user_name, COALESCE(gr.total_score, 0), COALESCE(gr.completed, 0),
+               COALESCE(gr.game_over, FALSE), COALESCE(gr.banned, FALSE), COALESCE(rol.role, 'player'),
+               COALESCE(gr.achievement_count, 0), COALESCE(gr.achievement_pts, 0),
+               EXTRACT(EPOCH FROM gr.updated_at)
+           )), '[]'::jsonb)
+    INTO v_lb_rows
+    FROM game_results gr
+    LEFT JOIN game_roles rol ON rol.user_id = gr.user_id
+    WHERE gr.user_id = p_user_id;
+    RETURN jsonb_build_object(
+        'stale', FALSE,
+        'db_score', COALESCE(g.total_score, 0),
+        'db_completed', COALESCE(g.completed, 0),
+        'db_reset_token', COALESCE(g.reset_token, 0),
+        'retreat_count', COALESCE(g.retreat_count, 0),
+        'banned', COALESCE(g.banned, FALSE),
+        'role', v_role,
+        'server_penalty_applied', v_penalty_applied,
+        'restart_mode_cleared', CASE WHEN v_restart_mode IN ('penalty', 'nopts') THEN v_restart_mode END,
+        -- Доли пригласивших — в фоне (process_referral_credits); ключи для совместимости.
+        'ref_award_inviter', 0,
+        'ref_award_invitee', v_award_invitee,
+        'ref_award_upstream', 0,
+        'ref_award_chapters', v_award_chapters,
+        'ref_inviter_percent', v_inviter_pct,
+        'ref_invitee_percent', COALESCE(v_invitee_pct_out, 1),
+        'ref_invited_count', CASE WHEN v_role = 'player' THEN v_invited ELSE 0 END,
+        'ref_summary', v_summary,
+        'ref_agents', v_agents,
+        'ref_failed', v_ref_failed,
+        'secret_eligible', v_role IN ('player', 'tester', 'admin'),
+        'secret_state', CASE WHEN v_secret_found THEN v_secret END,
+        'secret_ref_counts', jsonb_build_object(
+            'invited_count', v_invited,
+            'active_count', v_active_completed,
+            'rewarded_chapters', v_rewarded
+        ),
+        'lb_rows', v_lb_rows
+    );
+END
+$fn$;
+'''
+
+
+def _game_sync_apply_params(user_id, user_name, chapter, score, total_score, completed,
+                            game_over, failed, event_type, cipher_idx, chapter_in_progress,
+                            restart_penalty_points, client_reset_token, achievement_count,
+                            achievement_pts, agents_limit) -> tuple:
+    '''Нормализованные аргументы game_sync_apply() в порядке объявления функции.'''
+    return (
+        int(user_id),
+        user_name or None,
+        max(0, int(chapter or 0)),
+        max(0, int(score or 0)),
+        max(0, int(total_score or 0)),
+        max(0, int(completed or 0)),
+        bool(game_over),
+        bool(failed),
+        str(event_type or 'sync'),
+        int(cipher_idx if cipher_idx is not None else -1),
+        bool(chapter_in_progress),
+        max(0, int(restart_penalty_points or 0)),
+        max(0, int(client_reset_token or 0)),
+        max(0, int(achievement_count or 0)),
+        max(0, int(achievement_pts or 0)),
+        int(REFERRAL_INVITEE_PCT),
+        int(REFERRAL_INVITER_PCT_PER_AGENT),
+        int(REFERRAL_INVITER_PCT_MAX),
+        max(0, int(agents_limit if agents_limit is not None else 12)),
+    )
+
+
+def _game_sync_take_secret(result: dict, secret_payload) -> tuple | None:
+    '''Дополняет ответ game_sync_apply() полями ok/secret (на месте).
+
+    Возвращает аргументы для _secret_store, если состояние миссий нужно записать.
+    '''
+    result['ok'] = True
+    result['secret'] = None
+    secret_state = result.pop('secret_state', None)
+    ref_counts = result.pop('secret_ref_counts', None) or {}
+    if result.get('stale') or secret_payload is None or not result.get('secret_eligible'):
+        return None
+    secret, store = _secret_prepare(secret_state, secret_payload, ref_counts)
+    if secret['awarded_points'] > 0:
+        result['db_score'] = int(result.get('db_score') or 0) + secret['awarded_points']
+    result['secret'] = secret
+    return store
+
+
+def _game_sync_drop_secret(result: dict, db_score) -> None:
+    '''Убирает из ответа итог секретного шага, откаченного до SAVEPOINT:
+    очки и прогресс sync остаются, миссии посчитаются при следующем sync.'''
+    result['secret'] = None
+    result['db_score'] = db_score
 
 
 def save_game_sync_result(user_id, user_name, chapter, score, total_score,
                           completed, game_over=False, failed=False,
                           event_type='sync', chapter_idx=-1, cipher_idx=-1,
-                          chapter_in_progress=False, restart_penalty_points=0):
-    '''Сохраняет sync из игры с серверной фиксацией штрафа "отхода/перегруппировки".
+                          chapter_in_progress=False, restart_penalty_points=0,
+                          client_reset_token=0, achievement_count=0, achievement_pts=0,
+                          secret_payload=None, agents_limit=12):
+    '''Применяет sync из игры одним вызовом game_sync_apply() (см. _GAME_SYNC_SQL):
+    проверка reset_token, серверная фиксация штрафа "отхода/перегруппировки",
+    достижения, restart_mode, роль, реферальные бонусы и сводка агентов.
+    Секретные миссии (secret_payload) считаются здесь же, в той же транзакции;
+    в БД они пишутся, только если состояние изменилось.
+
+    Реферальный шаг (блок EXCEPTION в game_sync_apply) и секретные миссии
+    (SAVEPOINT game_sync_secret) откатываются отдельно: их ошибка не отменяет
+    очки и прогресс игрока — в ответе ref_failed = true или secret = None.
 
     Возвращает dict:
       {
-        ok: bool,
-        db_score: int,
-        db_completed: int,
-        server_penalty_applied: int,
-        retreat_count: int
+        ok: bool, stale: bool,
+        db_score, db_completed, db_reset_token, retreat_count: int,
+        banned: bool, role: str,
+        server_penalty_applied: int, restart_mode_cleared: str | None,
+        ref_award_inviter, ref_award_invitee, ref_award_upstream, ref_award_chapters: int,
+        ref_inviter_percent, ref_invitee_percent, ref_invited_count: int,
+        ref_summary: dict | None, ref_agents: list | None, ref_failed: bool,
+        secret: dict | None
       }
     '''
     conn = None
     try:
+        token = _referral_cache.token()
+        cached_agents = _referral_cache.agents(user_id, agents_limit)
         conn = get_connection()
         cur = conn.cursor()
-
-        chapter = max(0, int(chapter or 0))
-        score = max(0, int(score or 0))
-        total_score = max(0, int(total_score or 0))
-        completed = max(0, int(completed or 0))
-        game_over = bool(game_over)
-        failed = bool(failed)
-        chapter_idx = int(chapter_idx or 0)
-        cipher_idx = int(cipher_idx if cipher_idx is not None else -1)
-        chapter_in_progress = bool(chapter_in_progress)
-        event_type = str(event_type or 'sync')
-        restart_penalty_points = max(0, int(restart_penalty_points or 0))
-
-        cur.execute('''
-            SELECT user_id, user_name, chapter, score, total_score, completed, game_over, failed,
-                   COALESCE(retreat_count, 0),
-                   COALESCE(pending_retreat_penalty, 0),
-                   COALESCE(pending_retreat_chapter, 0),
-                   COALESCE(sync_chapter, 0),
-                   COALESCE(sync_max_chapter_score, 0),
-                   COALESCE(sync_max_cipher_idx, -1)
-            FROM game_results
-            WHERE user_id = %s
-            FOR UPDATE
-        ''', (user_id,))
-        row = cur.fetchone()
-
-        if not row:
-            cur.execute('''
-                INSERT INTO game_results
-                    (user_id, user_name, chapter, score, total_score, completed, game_over, failed, updated_at)
-                VALUES (%s, %s, 0, 0, 0, 0, FALSE, FALSE, NOW())
-                ON CONFLICT (user_id) DO NOTHING
-            ''', (user_id, user_name or 'Игрок'))
-            cur.execute('''
-                SELECT user_id, user_name, chapter, score, total_score, completed, game_over, failed,
-                       COALESCE(retreat_count, 0),
-                       COALESCE(pending_retreat_penalty, 0),
-                       COALESCE(pending_retreat_chapter, 0),
-                       COALESCE(sync_chapter, 0),
-                       COALESCE(sync_max_chapter_score, 0),
-                       COALESCE(sync_max_cipher_idx, -1)
-                FROM game_results
-                WHERE user_id = %s
-                FOR UPDATE
-            ''', (user_id,))
-            row = cur.fetchone()
-
-        (
-            _uid, db_user_name, db_chapter, db_score, db_total, db_completed, db_game_over, _db_failed,
-            retreat_count, pending_penalty, pending_chapter, sync_chapter, sync_max_score, sync_max_cipher
-        ) = row
-
-        retreat_count = int(retreat_count or 0)
-        pending_penalty = max(0, int(pending_penalty or 0))
-        pending_chapter = max(0, int(pending_chapter or 0))
-        sync_chapter = max(0, int(sync_chapter or 0))
-        sync_max_score = max(0, int(sync_max_score or 0))
-        sync_max_cipher = int(sync_max_cipher if sync_max_cipher is not None else -1)
-
-        # Явный старт повтора завершённой главы:
-        # разрешаем понизить total_score/completed, чтобы обнуление главы
-        # корректно отражалось в игре и в рейтинге.
-        explicit_replay_start = event_type == 'chapter_replay_start'
-        if explicit_replay_start:
-            if restart_penalty_points > 0:
-                pending_penalty = max(pending_penalty, restart_penalty_points)
-                pending_chapter = chapter
-            retreat_count += 1
-            sync_chapter = chapter
-            sync_max_score = 0
-            sync_max_cipher = -1
-
-            new_user_name = user_name or db_user_name or 'Игрок'
-            new_chapter = max(int(db_chapter or 0), chapter)
-            new_score = 0
-            new_total_score = max(0, int(total_score or 0))
-            new_completed = max(0, int(completed or 0))
-            new_game_over = False
-
-            cur.execute('''
-                UPDATE game_results
-                SET user_name = %s,
-                    chapter = %s,
-                    score = %s,
-                    total_score = %s,
-                    completed = %s,
-                    game_over = %s,
-                    failed = %s,
-                    retreat_count = %s,
-                    pending_retreat_penalty = %s,
-                    pending_retreat_chapter = %s,
-                    sync_chapter = %s,
-                    sync_max_chapter_score = %s,
-                    sync_max_cipher_idx = %s,
-                    updated_at = NOW()
-                WHERE user_id = %s
-            ''', (
-                new_user_name,
-                new_chapter,
-                new_score,
-                new_total_score,
-                new_completed,
-                new_game_over,
-                False,
-                retreat_count,
-                pending_penalty,
-                pending_chapter,
-                sync_chapter,
-                sync_max_score,
-                sync_max_cipher,
-                user_id
-            ))
-
-            conn.commit()
-            return {
-                'ok': True,
-                'db_score': int(new_total_score),
-                'db_completed': int(new_completed),
-                'server_penalty_applied': 0,
-                'retreat_count': int(retreat_count),
-            }
-
-        # Явный ручной "отход" с клиента.
-        explicit_manual_retreat = event_type == 'manual_restart'
-        if explicit_manual_retreat:
-            if restart_penalty_points <= 0:
-                restart_penalty_points = _calc_retreat_penalty_points(score)
-            pending_penalty = max(pending_penalty, restart_penalty_points)
-            pending_chapter = chapter
-            retreat_count += 1
-            sync_chapter = chapter
-            sync_max_score = max(0, score)
-            sync_max_cipher = max(-1, cipher_idx)
-
-        # Резервное авто-детектирование перезапуска (если клиентский event не пришёл).
-        auto_retreat_detected = False
-        if (
-            not explicit_manual_retreat and
-            chapter_in_progress and
-            chapter > 0 and
-            sync_chapter == chapter and
-            pending_chapter != chapter
-        ):
-            score_drop = score + 5 < sync_max_score
-            cipher_drop = (cipher_idx >= 0 and sync_max_cipher >= 0 and (cipher_idx + 1) < sync_max_cipher)
-            if score_drop or cipher_drop:
-                auto_retreat_detected = True
-                penalty_base = max(sync_max_score, score)
-                detected_penalty = _calc_retreat_penalty_points(penalty_base)
-                pending_penalty = max(pending_penalty, detected_penalty)
-                pending_chapter = chapter
-                retreat_count += 1
-                sync_max_score = max(0, score)
-                sync_max_cipher = max(-1, cipher_idx)
-
-        # Поддерживаем максимум прогресса внутри текущей главы.
-        if chapter_in_progress and chapter > 0 and not explicit_manual_retreat and not auto_retreat_detected:
-            if sync_chapter != chapter:
-                sync_chapter = chapter
-                sync_max_score = max(0, score)
-                sync_max_cipher = max(-1, cipher_idx)
-            else:
-                sync_max_score = max(sync_max_score, max(0, score))
-                if cipher_idx >= 0:
-                    sync_max_cipher = max(sync_max_cipher, cipher_idx)
-
-        # Серверное применение штрафа при завершении главы.
-        server_penalty_applied = 0
-        if event_type == 'chapter_complete' and pending_penalty > 0 and pending_chapter == chapter:
-            client_penalty_applied = max(0, int(restart_penalty_points or 0))
-            penalty_to_apply_server = max(0, pending_penalty - client_penalty_applied)
-            server_penalty_applied = min(penalty_to_apply_server, score)
-            score = max(0, score - server_penalty_applied)
-            total_score = max(0, total_score - server_penalty_applied)
-            pending_penalty = 0
-            pending_chapter = 0
-            sync_max_score = 0
-            sync_max_cipher = -1
-            sync_chapter = 0
-        elif event_type == 'chapter_complete':
-            # Глава завершена без ожидающего штрафа — закрываем runtime-трекер.
-            sync_max_score = 0
-            sync_max_cipher = -1
-            sync_chapter = 0
-
-        new_chapter = max(int(db_chapter or 0), chapter)
-        if total_score >= int(db_total or 0) or completed >= int(db_completed or 0):
-            new_score = score
-        else:
-            new_score = int(db_score or 0)
-        new_total_score = max(int(db_total or 0), total_score)
-        new_completed = max(int(db_completed or 0), completed)
-        new_game_over = bool(db_game_over) or bool(game_over)
-        new_user_name = user_name or db_user_name or 'Игрок'
-
-        cur.execute('''
-            UPDATE game_results
-            SET user_name = %s,
-                chapter = %s,
-                score = %s,
-                total_score = %s,
-                completed = %s,
-                game_over = %s,
-                failed = %s,
-                retreat_count = %s,
-                pending_retreat_penalty = %s,
-                pending_retreat_chapter = %s,
-                sync_chapter = %s,
-                sync_max_chapter_score = %s,
-                sync_max_cipher_idx = %s,
-                updated_at = NOW()
-            WHERE user_id = %s
-        ''', (
-            new_user_name,
-            new_chapter,
-            new_score,
-            new_total_score,
-            new_completed,
-            new_game_over,
-            failed,
-            retreat_count,
-            pending_penalty,
-            pending_chapter,
-            sync_chapter,
-            sync_max_score,
-            sync_max_cipher,
-            user_id
-        ))
-
+        cur.execute(
+            '''
+            SELECT game_sync_apply(
+                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                %s, %s, %s, %s, %s, %s, %s, %s, %s
+            )
+            ''',
+            _game_sync_apply_params(
+                user_id, user_name, chapter, score, total_score, completed,
+                game_over, failed, event_type, cipher_idx, chapter_in_progress,
+                restart_penalty_points, client_reset_token, achievement_count,
+                achievement_pts, 0 if cached_agents is not None else agents_limit,
+            ),
+        )
+        result = dict(cur.fetchone()[0] or {})
+        _leaderboard_defer(conn, result.pop('lb_rows', None) or [])
+        _referral_cache_defer(conn, *_referral_cache_take_sync(
+            result, user_id, token, cached_agents, agents_limit))
+        # Секретные миссии — под SAVEPOINT: их ошибка не отменяет сохранение очков.
+        db_score, staged = result.get('db_score'), len(conn.leaderboard_rows)
+        cur.execute('SAVEPOINT game_sync_secret')
+        try:
+            store = _game_sync_take_secret(result, secret_payload)
+            if store:
+                _secret_store(cur, int(user_id), *store)
+            cur.execute('RELEASE SAVEPOINT game_sync_secret')
+        except Exception as e:
+            logger.error(f"save_game_sync_result secret step error {user_id}: {e}")
+            cur.execute('ROLLBACK TO SAVEPOINT game_sync_secret')
+            del conn.leaderboard_rows[staged:]
+            _game_sync_drop_secret(result, db_score)
         conn.commit()
-        return {
-            'ok': True,
-            'db_score': int(new_total_score),
-            'db_completed': int(new_completed),
-            'server_penalty_applied': int(server_penalty_applied),
-            'retreat_count': int(retreat_count),
-        }
+        return result
     except Exception as e:
         logger.error(f"save_game_sync_result error {user_id}: {e}")
         _safe_rollback(conn)
@@ -3476,42 +4954,40 @@ def save_game_sync_result(user_id, user_name, chapter, score, total_score,
         release_connection(conn)
 
 
+# Место = 1 + число игроков строго впереди (очки больше, либо равны и раньше
+# updated_at) — один проход по idx_game_results_rank вместо сортировки
+# всей таблицы оконной функцией. found = игрок сам входит в рейтинг.
+_PLAYER_RANK_SQL = '''
+    SELECT
+        COUNT(*) FILTER (
+            WHERE gr.total_score > me.total_score
+               OR (gr.total_score = me.total_score AND gr.updated_at < me.updated_at)
+        ) + 1 AS pos,
+        COUNT(*) AS total_players,
+        COALESCE(BOOL_OR(gr.user_id = $1), FALSE) AS found
+    FROM game_results gr
+    LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
+    LEFT JOIN game_results me ON me.user_id = $1
+    WHERE NOT COALESCE(gr.banned, FALSE)
+      AND COALESCE(rol.role, 'player') = 'player'
+      AND gr.total_score > 0
+'''
+
+
 def get_game_player_rank(user_id):
     '''Возвращает позицию игрока в публичном рейтинге (role=player), либо (None, total_players).'''
+    if leaderboard.board.ready:
+        return leaderboard.board.rank(user_id)
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute('''
-            WITH ranked AS (
-                SELECT
-                    gr.user_id,
-                    ROW_NUMBER() OVER (ORDER BY gr.total_score DESC, gr.updated_at ASC) AS pos,
-                    COUNT(*) OVER () AS total_players
-                FROM game_results gr
-                LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
-                WHERE NOT COALESCE(gr.banned, FALSE)
-                  AND COALESCE(rol.role, 'player') = 'player'
-                  AND gr.total_score > 0
-            )
-            SELECT pos, total_players
-            FROM ranked
-            WHERE user_id = %s
-        ''', (user_id,))
+        cur.execute(_PLAYER_RANK_SQL.replace('$1', '%s'), (user_id, user_id))
         row = cur.fetchone()
-        if row:
-            return int(row[0]), int(row[1])
-
-        cur.execute('''
-            SELECT COUNT(*)
-            FROM game_results gr
-            LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
-            WHERE NOT COALESCE(gr.banned, FALSE)
-              AND COALESCE(rol.role, 'player') = 'player'
-              AND gr.total_score > 0
-        ''')
-        total = cur.fetchone()[0] or 0
-        return None, int(total)
+        total = int(row[1] or 0) if row else 0
+        if row and row[2]:
+            return int(row[0]), total
+        return None, total
     except Exception as e:
         logger.error(f"get_game_player_rank error {user_id}: {e}")
         return None, 0
@@ -3521,6 +4997,8 @@ def get_game_player_rank(user_id):
 def get_game_leaderboard(limit=20):
     '''Возвращает публичный топ игроков.
     Админы, тестировщики и игроки с 0 очков НЕ включаются.'''
+    if leaderboard.board.ready:
+        return leaderboard.board.top(limit)
     conn = None
     try:
         conn = get_connection()
@@ -3596,6 +5074,8 @@ def reset_game_result(user_id):
         ''', (user_id,))
         updated = cur.rowcount
         cur.execute("DELETE FROM game_secret_state WHERE user_id=%s", (user_id,))
+        _referral_refresh_activity(cur, [user_id])
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return updated > 0
     except Exception as e:
@@ -3619,6 +5099,7 @@ def update_achievement_stats(user_id, achievement_count, achievement_pts):
                 updated_at        = NOW()
             WHERE user_id = %s
         ''', (achievement_count, achievement_pts, user_id))
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
     except Exception as e:
         logger.error(f"update_achievement_stats error {user_id}: {e}")
@@ -3651,6 +5132,7 @@ def reset_game_result_soft(user_id, mode='penalty'):
             WHERE user_id=%s
         ''', (mode, user_id))
         updated = cur.rowcount
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return updated > 0
     except Exception as e:
@@ -3718,6 +5200,19 @@ def reset_all_game_results(drop_referrals: bool = False):
         cur.execute("DELETE FROM game_secret_state")
         if drop_referrals:
             cur.execute("DELETE FROM game_referrals")
+            cur.execute("DELETE FROM game_referral_counters")
+        else:
+            # Прогресс обнулён у всех: активных агентов не осталось.
+            cur.execute('''
+                UPDATE game_referrals SET counted_active = FALSE, counted_completed = FALSE
+                WHERE counted_active OR counted_completed
+            ''')
+            cur.execute('''
+                UPDATE game_referral_counters SET active_count = 0, completed_count = 0, updated_at = NOW()
+                WHERE active_count <> 0 OR completed_count <> 0
+            ''')
+        _leaderboard_stage(cur)
+        _referral_cache_defer(conn, None)
         conn.commit()
         return updated
     except Exception as e:
@@ -3748,6 +5243,8 @@ def ban_game_user(user_id):
             WHERE user_id = %s
         ''', (user_id,))
         updated = cur.rowcount
+        _referral_refresh_activity(cur, [user_id])
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return updated > 0
     except Exception as e:
@@ -3768,8 +5265,10 @@ def unban_game_user(user_id):
             UPDATE game_results SET banned = FALSE, updated_at = NOW()
             WHERE user_id = %s
         ''', (user_id,))
+        updated = cur.rowcount
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
-        return cur.rowcount > 0
+        return updated > 0
     except Exception as e:
         logger.error(f"unban_game_user error {user_id}: {e}")
         _safe_rollback(conn)
@@ -3985,6 +5484,7 @@ def set_game_role(user_id, role):
             VALUES (%s, %s)
             ON CONFLICT (user_id) DO UPDATE SET role = EXCLUDED.role, updated_at = NOW()
         ''', (user_id, role))
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return True
     except Exception as e:
@@ -4013,6 +5513,8 @@ def get_game_role(user_id):
 
 def get_game_leaderboard_with_roles(limit=20):
     '''Таблица лидеров с ролями — сортировка: admin → tester → player, внутри по очкам.'''
+    if leaderboard.board.ready:
+        return leaderboard.board.top_with_roles(limit)
     conn = None
     try:
         conn = get_connection()
@@ -4542,6 +6044,287 @@ def get_all_bot_admins() -> list:
     finally:
         release_connection(conn)
 
+
+# ══════════════════════════════════════════════════════════
+#  ОГРАНИЧЕНИЕ ЧАСТОТЫ (rate_limit.py, бэкенд postgres)
+#  Счёт хитов — database_async.rate_limit_hit
+# ══════════════════════════════════════════════════════════
+
+def purge_rate_limits() -> int:
+    '''Удаляет окна счётчиков, которые уже не участвуют в оценке (старше двух окон).'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM rate_limit_counters
+            WHERE window_start + 2 * window_sec < EXTRACT(EPOCH FROM NOW())::BIGINT
+        ''')
+        deleted = cur.rowcount or 0
+        conn.commit()
+        return deleted
+    except Exception as e:
+        logger.error(f"purge_rate_limits error: {e}")
+        _safe_rollback(conn)
+        return 0
+    finally:
+        release_connection(conn)
+
+
+# ══════════════════════════════════════════════════════════
+#  ИДЕМПОТЕНТНОСТЬ /game_sync (ключи event_id)
+#  Чтение и запись — database_async.get_sync_response / save_sync_response
+# ══════════════════════════════════════════════════════════
+
+GAME_SYNC_IDEMPOTENCY_TTL_SEC = max(60, _env_int('GAME_SYNC_IDEMPOTENCY_TTL_SEC', 600))
+_SYNC_RESPONSES_PURGER = None
+
+
+def purge_game_sync_responses(ttl_sec: int = GAME_SYNC_IDEMPOTENCY_TTL_SEC) -> int:
+    '''Удаляет сохранённые ответы старше ttl_sec.'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM game_sync_responses
+            WHERE created_at < NOW() - make_interval(secs => %s)
+        ''', (int(ttl_sec),))
+        deleted = cur.rowcount or 0
+        conn.commit()
+        return deleted
+    except Exception as e:
+        logger.error(f"purge_game_sync_responses error: {e}")
+        _safe_rollback(conn)
+        return 0
+    finally:
+        release_connection(conn)
+
+
+def start_game_sync_responses_purger(interval_sec: int = 300) -> None:
+    '''Фоновая очистка game_sync_responses раз в interval_sec.'''
+    global _SYNC_RESPONSES_PURGER
+    if _SYNC_RESPONSES_PURGER is not None or interval_sec <= 0:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(interval_sec)
+            purge_game_sync_responses()
+
+    _SYNC_RESPONSES_PURGER = threading.Thread(target=_loop, name='game-sync-responses-purge', daemon=True)
+    _SYNC_RESPONSES_PURGER.start()
+
+# ══════════════════════════════════════════════════════════
+#  СЧЁТЧИКИ АГЕНТОВ (game_referral_counters)
+#  Обновляются транзакционно там же, где меняются связи и прогресс агентов;
+#  repair_referral_counters догоняет пути, которые их не трогают.
+# ══════════════════════════════════════════════════════════
+
+REFERRAL_COUNTERS_REPAIR_SEC = max(0, _env_int('REFERRAL_COUNTERS_REPAIR_SEC', 3600))
+_REFERRAL_COUNTERS_REPAIRER = None
+
+
+def repair_referral_counters() -> int:
+    '''Сверяет счётчики с game_referrals/game_results; возвращает число исправленных строк.
+
+    Флаги активности чинятся тем же сдвигом, что и при сбросах. Счётчики
+    переписываются оптимистично: только если строка не изменилась после
+    снимка, по которому они посчитаны (параллельный attach не теряется —
+    расхождение исправит следующий проход).'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute(_REFERRAL_ACTIVITY_SQL.format(where='''
+            a.counted_active <> (COALESCE(gr.total_score, 0) > 0 OR COALESCE(gr.completed, 0) > 0)
+            OR a.counted_completed <> (COALESCE(gr.completed, 0) > 0)
+        '''))
+        fixed = cur.rowcount or 0
+        conn.commit()
+        cur.execute('''
+            WITH actual AS (
+                SELECT referrer_id,
+                       COUNT(*)::INTEGER AS invited,
+                       COUNT(*) FILTER (WHERE counted_active)::INTEGER AS active,
+                       COUNT(*) FILTER (WHERE counted_completed)::INTEGER AS completed,
+                       COALESCE(SUM(GREATEST(0, COALESCE(rewarded_chapters, 0))), 0)::INTEGER AS rewarded,
+                       COALESCE(SUM(GREATEST(0, COALESCE(total_referrer_bonus, 0))), 0)::INTEGER AS bonus
+                FROM game_referrals
+                GROUP BY referrer_id
+            ), diff AS (
+                SELECT COALESCE(a.referrer_id, c.referrer_id) AS referrer_id,
+                       COALESCE(a.invited, 0) AS invited,
+                       COALESCE(a.active, 0) AS active,
+                       COALESCE(a.completed, 0) AS completed,
+                       COALESCE(a.rewarded, 0) AS rewarded,
+                       COALESCE(a.bonus, 0) AS bonus,
+                       c.referrer_id IS NULL AS missing,
+                       c.invited_count AS seen_invited,
+                       c.active_count AS seen_active,
+                       c.completed_count AS seen_completed,
+                       c.rewarded_chapters AS seen_rewarded,
+                       c.bonus_points AS seen_bonus
+                FROM actual a
+                FULL JOIN game_referral_counters c ON c.referrer_id = a.referrer_id
+                WHERE c.referrer_id IS NULL
+                   OR (c.invited_count, c.active_count, c.completed_count, c.rewarded_chapters, c.bonus_points)
+                      IS DISTINCT FROM (COALESCE(a.invited, 0), COALESCE(a.active, 0), COALESCE(a.completed, 0),
+                                        COALESCE(a.rewarded, 0), COALESCE(a.bonus, 0))
+            ), inserted AS (
+                INSERT INTO game_referral_counters
+                    (referrer_id, invited_count, active_count, completed_count, rewarded_chapters, bonus_points)
+                SELECT referrer_id, invited, active, completed, rewarded, bonus FROM diff WHERE missing
+                ON CONFLICT (referrer_id) DO NOTHING
+                RETURNING 1
+            ), updated AS (
+                UPDATE game_referral_counters c
+                SET invited_count = d.invited,
+                    active_count = d.active,
+                    completed_count = d.completed,
+                    rewarded_chapters = d.rewarded,
+                    bonus_points = d.bonus,
+                    updated_at = NOW()
+                FROM diff d
+                WHERE NOT d.missing
+                  AND c.referrer_id = d.referrer_id
+                  AND c.invited_count = d.seen_invited
+                  AND c.active_count = d.seen_active
+                  AND c.completed_count = d.seen_completed
+                  AND c.rewarded_chapters = d.seen_rewarded
+                  AND c.bonus_points = d.seen_bonus
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM inserted) + (SELECT COUNT(*) FROM updated)
+        ''')
+        fixed += int((cur.fetchone() or [0])[0] or 0)
+        if fixed:
+            _referral_cache_defer(conn, None)
+        conn.commit()
+        if fixed:
+            logger.warning(f"repair_referral_counters: исправлено строк: {fixed}")
+        return fixed
+    except Exception as e:
+        logger.error(f"repair_referral_counters error: {e}")
+        _safe_rollback(conn)
+        return 0
+    finally:
+        release_connection(conn)
+
+
+def start_referral_counters_repair(interval_sec: int = REFERRAL_COUNTERS_REPAIR_SEC) -> None:
+    '''Фоновая сверка счётчиков агентов раз в interval_sec (0 — выключена).'''
+    global _REFERRAL_COUNTERS_REPAIRER
+    if _REFERRAL_COUNTERS_REPAIRER is not None or interval_sec <= 0:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(interval_sec)
+            repair_referral_counters()
+
+    _REFERRAL_COUNTERS_REPAIRER = threading.Thread(target=_loop, name='referral-counters-repair', daemon=True)
+    _REFERRAL_COUNTERS_REPAIRER.start()
+
+# ══════════════════════════════════════════════════════════
+#  ОЧЕРЕДЬ НАЧИСЛЕНИЙ ПРИГЛАСИВШИМ (game_referral_credit_queue)
+#  /game_sync ставит referrer_id, фоновый поток начисляет доли пачками.
+# ══════════════════════════════════════════════════════════
+
+REFERRAL_CREDIT_INTERVAL_SEC = max(0, _env_int('REFERRAL_CREDIT_INTERVAL_SEC', 2))
+REFERRAL_CREDIT_BATCH = 100
+_REFERRAL_CREDIT_WORKER = None
+_referral_credit_stats = {'batches': 0, 'referrers': 0, 'points': 0, 'requeued': 0, 'errors': 0}
+
+
+def process_referral_credits(limit: int = REFERRAL_CREDIT_BATCH) -> tuple:
+    '''Одна пачка очереди: забирает записи (SKIP LOCKED — параллельные
+    обработчики не мешают друг другу) и начисляет доли их пригласившим
+    в той же транзакции. При ошибке записи остаются в очереди.
+    Возвращает (забрано записей, id пригласивших, получивших очки).
+
+    Записи удаляются последним шагом, после блокировок game_results: /game_sync,
+    ставящий того же пригласившего, ждёт удаления (уникальный ключ) уже
+    у транзакции, которая сама больше ничего не ждёт. Пригласившие с
+    пропущенными (занятыми sync) агентами возвращаются в очередь.'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT id, referrer_id FROM game_referral_credit_queue
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', (int(limit),))
+        claimed = cur.fetchall() or []
+        if not claimed:
+            conn.commit()
+            return 0, []
+        taken = [int(r[1]) for r in claimed]
+        rows = _refresh_referrers(cur, taken)
+        cur.execute('DELETE FROM game_referral_credit_queue WHERE id = ANY(%s)', ([int(r[0]) for r in claimed],))
+        requeued = _referral_credit_requeue(cur, rows)
+        conn.commit()
+        _referral_credit_stats['batches'] += 1
+        _referral_credit_stats['referrers'] += len(rows)
+        _referral_credit_stats['points'] += sum(r[3] for r in rows)
+        _referral_credit_stats['requeued'] += len(requeued)
+        return len(taken), [r[0] for r in rows if r[3] > 0]
+    except Exception as e:
+        logger.error(f"process_referral_credits error: {e}")
+        _referral_credit_stats['errors'] += 1
+        _safe_rollback(conn)
+        return 0, []
+    finally:
+        release_connection(conn)
+
+
+def get_referral_credit_stats() -> dict:
+    '''Для /health: пачки, пригласившие и очки, обработанные этим процессом.'''
+    return dict(_referral_credit_stats, running=_REFERRAL_CREDIT_WORKER is not None)
+
+
+def notify_game_event(channel: str, payload: str) -> bool:
+    '''pg_notify из синхронного кода (фоновые потоки); False — ошибка.'''
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute('SELECT pg_notify(%s, %s)', (channel, payload))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.warning(f"notify_game_event error: {e}")
+        _safe_rollback(conn)
+        return False
+    finally:
+        release_connection(conn)
+
+
+def start_referral_credit_worker(interval_sec: float = REFERRAL_CREDIT_INTERVAL_SEC, on_credited=None) -> None:
+    '''Фоновая обработка очереди начислений; on_credited(referrer_ids) —
+    уведомление о начислении (из потока обработчика).'''
+    global _REFERRAL_CREDIT_WORKER
+    if _REFERRAL_CREDIT_WORKER is not None or interval_sec <= 0:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(interval_sec)
+            # Полная пачка — очередь, скорее всего, не пуста: разбираем без паузы.
+            taken = REFERRAL_CREDIT_BATCH
+            while taken >= REFERRAL_CREDIT_BATCH:
+                taken, credited = process_referral_credits()
+                if credited and on_credited is not None:
+                    try:
+                        on_credited(credited)
+                    except Exception as e:
+                        logger.warning(f"referral credit callback error: {e}")
+
+    _REFERRAL_CREDIT_WORKER = threading.Thread(target=_loop, name='referral-credits', daemon=True)
+    _REFERRAL_CREDIT_WORKER.start()
+
 # ══════════════════════════════════════════════════════════
 #  ИНДИВИДУАЛЬНЫЙ ДОСТУП К ГЛАВАМ ДЛЯ ИГРОКОВ
 # ══════════════════════════════════════════════════════════
@@ -4668,15 +6451,27 @@ def get_player_chapter_access_map(user_id: int) -> set:
 
 
 def _delete_game_referrals_for_user(cur, user_id: int) -> int:
-    '''Delete referral links where user is inviter or invited.'''
+    '''Delete referral links where user is inviter or invited (and adjust counters).'''
     cur.execute(
         '''
         DELETE FROM game_referrals
         WHERE referrer_id = %s OR referred_id = %s
+        RETURNING referrer_id, counted_active, counted_completed, referred_id,
+                  rewarded_chapters, total_referrer_bonus
         ''',
         (user_id, user_id),
     )
-    return int(cur.rowcount or 0)
+    rows = cur.fetchall() or []
+    cur.execute('DELETE FROM game_referral_counters WHERE referrer_id = %s', (user_id,))
+    for referrer_id, counted_active, counted_completed, _, rewarded, bonus in rows:
+        if int(referrer_id) != int(user_id):
+            _referral_counters_add(
+                cur, int(referrer_id), invited=-1,
+                active=-int(bool(counted_active)), completed=-int(bool(counted_completed)),
+                rewarded=-max(0, int(rewarded or 0)), bonus=-max(0, int(bonus or 0)),
+            )
+    _referral_cache_defer(cur.connection, [user_id] + [uid for r in rows for uid in (r[0], r[3])])
+    return len(rows)
 
 
 def reset_game_result_full(user_id: int, drop_referrals: bool = False) -> bool:
@@ -4723,6 +6518,9 @@ def reset_game_result_full(user_id: int, drop_referrals: bool = False) -> bool:
         cur.execute('DELETE FROM player_chapter_access WHERE user_id = %s', (user_id,))
         if drop_referrals:
             _delete_game_referrals_for_user(cur, user_id)
+        else:
+            _referral_refresh_activity(cur, [user_id])
+        _leaderboard_stage(cur, [user_id])
         conn.commit()
         return updated > 0
     except Exception as e:
@@ -0,0 +1,975 @@
+'''Асинхронный слой БД для обработчиков бота и HTTP API игры.
+
+Повторяет API database.py, но без пула потоков: горячие функции
+(состояние игры, sync, рейтинг, профили, права) ходят в PostgreSQL через
+asyncpg прямо из event loop. Остальные функции database.py доступны под
+тем же именем и выполняются в asyncio.to_thread, поэтому в bot.py можно
+писать единообразно:
+
+    row = await adb.get_game_result(user_id)
+    await adb.add_feedback(user_id, text)     # -> to_thread(db.add_feedback, ...)
+
+Синхронный database.py остаётся для скриптов, init_db и фоновых задач.
+
+В боте два event loop-а (polling и HTTP-поток), а соединения asyncpg
+привязаны к loop-у, поэтому пул у каждого loop-а свой.
+'''
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import weakref
+from contextlib import asynccontextmanager
+
+import asyncpg
+import pytz
+
+import database as db
+import leaderboard
+
+logger = logging.getLogger(__name__)
+
+DB_ASYNC_POOL_MIN = max(1, db._env_int('DB_ASYNC_POOL_MIN', 1))
+DB_ASYNC_POOL_MAX = max(DB_ASYNC_POOL_MIN, db._env_int('DB_ASYNC_POOL_MAX', 10))
+# 0 — для pgbouncer в режиме transaction (без кэша prepared statements)
+DB_ASYNC_STATEMENT_CACHE = max(0, db._env_int('DB_ASYNC_STATEMENT_CACHE', 100))
+
+_POOLS: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_POOL_LOCKS: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+async def get_pool() -> asyncpg.Pool:
+    '''Пул asyncpg текущего event loop-а (создаётся при первом обращении).'''
+    loop = asyncio.get_running_loop()
+    pool = _POOLS.get(loop)
+    if pool is not None:
+        return pool
+    lock = _POOL_LOCKS.setdefault(loop, asyncio.Lock())
+    async with lock:
+        pool = _POOLS.get(loop)
+        if pool is None:
+            pool = await asyncpg.create_pool(
+                db.DATABASE_URL,
+                ssl='require',
+                min_size=DB_ASYNC_POOL_MIN,
+                max_size=DB_ASYNC_POOL_MAX,
+                max_inactive_connection_lifetime=db.DB_POOL_MAX_IDLE_SEC or 300,
+                statement_cache_size=DB_ASYNC_STATEMENT_CACHE,
+                timeout=10,
+            )
+            _POOLS[loop] = pool
+            logger.info(
+                f"✅ Async-пул PostgreSQL инициализирован "
+                f"(min={DB_ASYNC_POOL_MIN}, max={DB_ASYNC_POOL_MAX})"
+            )
+    return pool
+
+
+async def close_pool() -> None:
+    '''Закрывает пул текущего event loop-а.'''
+    pool = _POOLS.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+def get_pool_stats() -> dict:
+    '''Метрики async-пулов: сколько соединений открыто и сколько свободно.'''
+    pools = list(_POOLS.values())
+    return {
+        'pools': len(pools),
+        'size': sum(p.get_size() for p in pools),
+        'idle': sum(p.get_idle_size() for p in pools),
+        'min': DB_ASYNC_POOL_MIN,
+        'max': DB_ASYNC_POOL_MAX,
+    }
+
+
+_CURRENT_SESSION: contextvars.ContextVar = contextvars.ContextVar('adb_session', default=None)
+
+
+class AsyncSession:
+    '''Единица работы для нативных функций модуля — аналог db.DbSession:
+
+        unit = adb.session()
+        async with unit:
+            await adb.save_game_sync_result(...)
+        if unit.failed:
+            ...
+
+    Соединение берётся из пула при первом запросе, при atomic=True открывается
+    одна транзакция; commit — при выходе из блока без исключения. Ошибка любого
+    запроса откатывает всю сессию: последующие вызовы получают
+    db.SessionAborted (и возвращают своё значение по умолчанию).
+    Функции, выполняемые через to_thread, в сессию не входят.
+    '''
+
+    def __init__(self, atomic: bool = True):
+        self.atomic = atomic
+        self.failed = False
+        self.calls = 0
+        self._pool = None
+        self._conn = None
+        self._tx = None
+        self._closed = False
+        self._lock = asyncio.Lock()
+        self._token = None
+        self.leaderboard_rows = []
+        self.referral_stale = set()
+        self.referral_fresh = []
+
+    async def _acquire(self):
+        if self._closed:
+            raise db.SessionAborted('сессия БД уже завершена')
+        if self.failed:
+            raise db.SessionAborted('сессия БД откатилась')
+        if self._conn is None:
+            self._pool = await get_pool()
+            conn = await self._pool.acquire()
+            try:
+                if self.atomic:
+                    self._tx = conn.transaction()
+                    await self._tx.start()
+            except BaseException:
+                await self._pool.release(conn)
+                raise
+            self._conn = conn
+        self.calls += 1
+        return self._conn
+
+    async def close(self, commit: bool = True) -> bool:
+        '''Фиксирует (или откатывает) транзакцию и возвращает соединение в пул.
+        True — если работа сессии сохранена.'''
+        async with self._lock:
+            if self._closed:
+                return not self.failed
+            self._closed = True
+            if not commit:
+                self.failed = True
+            conn, tx = self._conn, self._tx
+            self._conn = self._tx = None
+            if conn is None:
+                return not self.failed
+            try:
+                if tx is not None:
+                    if self.failed:
+                        await tx.rollback()
+                    else:
+                        await tx.commit()
+            except Exception as e:
+                logger.error(f"AsyncSession commit error: {e}")
+                self.failed = True
+            finally:
+                await self._pool.release(conn)
+            rows, self.leaderboard_rows = self.leaderboard_rows, []
+            if rows and not self.failed:
+                leaderboard.board.apply(rows)
+            stale, fresh = self.referral_stale, self.referral_fresh
+            self.referral_stale, self.referral_fresh = set(), []
+            if (stale or fresh) and not self.failed:
+                db._referral_cache_apply(stale, fresh)
+            return not self.failed
+
+    async def __aenter__(self):
+        self._token = _CURRENT_SESSION.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _CURRENT_SESSION.reset(self._token)
+        await self.close(commit=exc_type is None)
+        return False
+
+
+def session(atomic: bool = True) -> AsyncSession:
+    '''Открывает единицу работы (см. AsyncSession).'''
+    return AsyncSession(atomic=atomic)
+
+
+@asynccontextmanager
+async def _connection():
+    '''Соединение для одного вызова: общее соединение сессии либо своё из пула.'''
+    unit = _CURRENT_SESSION.get()
+    if unit is None:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            yield conn
+        return
+    async with unit._lock:
+        conn = await unit._acquire()
+        try:
+            yield conn
+        except BaseException:
+            if unit.atomic:
+                unit.failed = True
+            raise
+
+
+def _leaderboard_defer(rows) -> None:
+    '''Обновляет рейтинг в памяти после commit (в атомарной сессии — при её закрытии).'''
+    if not rows:
+        return
+    unit = _CURRENT_SESSION.get()
+    if unit is not None and unit.atomic:
+        unit.leaderboard_rows.extend(rows)
+    else:
+        leaderboard.board.apply(rows)
+
+
+def _referral_cache_defer(user_ids=(), fresh=None) -> None:
+    '''Реферальный кэш после commit (см. db._referral_cache_defer).'''
+    stale = {int(u) for u in user_ids if u}
+    fresh = [fresh] if fresh else []
+    if not stale and not fresh:
+        return
+    unit = _CURRENT_SESSION.get()
+    if unit is not None and unit.atomic:
+        unit.referral_stale |= stale
+        unit.referral_fresh.extend(fresh)
+    else:
+        db._referral_cache_apply(stale, fresh)
+
+
+def _json(value, fallback=None):
+    '''jsonb/json из asyncpg приходит строкой (кодек по умолчанию).'''
+    if value is None:
+        return fallback
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+# ══════════════════════════════════════════════════════════
+#  ПОЛЬЗОВАТЕЛИ, УЧИТЕЛЯ, ИЗБРАННОЕ
+# ══════════════════════════════════════════════════════════
+
+async def get_user_info(user_id):
+    '''Возвращает информацию о пользователе: dict или None.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow(
+                'SELECT user_id, username, first_name, last_name FROM users WHERE user_id=$1',
+                user_id,
+            )
+        if row:
+            return {'user_id': row[0], 'username': row[1],
+                    'first_name': row[2], 'last_name': row[3]}
+        return None
+    except Exception as e:
+        logger.error(f"get_user_info: {e}")
+        return None
+
+
+async def get_user_profile(user_id):
+    '''Возвращает профиль пользователя или None.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('''
+                SELECT role, display_name, class_name, registered_at
+                FROM user_profiles WHERE user_id=$1
+            ''', user_id)
+        if row:
+            return {'role': row[0], 'display_name': row[1],
+                    'class_name': row[2], 'registered_at': row[3]}
+        return None
+    except Exception as e:
+        logger.error(f"get_user_profile: {e}")
+        return None
+
+
+async def find_teacher_by_telegram_id(telegram_id):
+    '''Возвращает {'full_name': ..., 'registered_at': ...} или None.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow(
+                'SELECT full_name, registered_at FROM teachers WHERE telegram_id=$1',
+                telegram_id,
+            )
+        if row:
+            return {'full_name': row[0], 'registered_at': row[1]}
+        return None
+    except Exception as e:
+        logger.error(f"find_teacher_by_telegram_id: {e}")
+        return None
+
+
+async def get_registered_teacher_names():
+    '''Возвращает set имён учителей которые уже зарегистрировались в боте.'''
+    try:
+        async with _connection() as conn:
+            rows = await conn.fetch(
+                'SELECT full_name FROM teachers WHERE registered=TRUE AND telegram_id != 0'
+            )
+        return {row[0] for row in rows}
+    except Exception as e:
+        logger.error(f"get_registered_teacher_names: {e}")
+        return set()
+
+
+async def is_favorite(user_id, fav_type, value):
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow(
+                'SELECT 1 FROM user_favorites WHERE user_id=$1 AND fav_type=$2 AND value=$3',
+                user_id, fav_type, value,
+            )
+        return row is not None
+    except Exception as e:
+        logger.error(f"is_favorite: {e}")
+        return False
+
+
+# ══════════════════════════════════════════════════════════
+#  СТАТУС БОТА И ПРАВА
+# ══════════════════════════════════════════════════════════
+
+async def get_maintenance_status():
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow(
+                'SELECT maintenance_mode, maintenance_until, maintenance_message FROM bot_status WHERE id=1'
+            )
+        if row:
+            return {'enabled': bool(row[0]), 'until': row[1], 'message': row[2]}
+        return {'enabled': False, 'until': None, 'message': None}
+    except Exception as e:
+        logger.error(f"get_maintenance_status: {e}")
+        return {'enabled': False, 'until': None, 'message': None}
+
+
+async def get_game_access_mode() -> str:
+    '''Возвращает глобальный режим доступа: beta/open/closed.
+    Таблицу game_access_settings создаёт init_db.'''
+    try:
+        async with _connection() as conn:
+            mode = await conn.fetchval('SELECT access_mode FROM game_access_settings WHERE id = 1')
+        mode = (mode or 'beta').strip().lower()
+        return mode if mode in ('beta', 'open', 'closed') else 'beta'
+    except Exception as e:
+        logger.error(f"get_game_access_mode error: {e}")
+        return 'beta'
+
+
+async def is_beta_allowed(user_id):
+    '''True если пользователь в белом списке бета-теста.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('SELECT 1 FROM game_beta WHERE user_id = $1', user_id)
+        return row is not None
+    except Exception as e:
+        logger.error(f"is_beta_allowed error {user_id}: {e}")
+        return False
+
+
+async def is_bot_admin_db(user_id: int) -> bool:
+    '''Проверяет есть ли пользователь в таблице bot_admins.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('SELECT 1 FROM bot_admins WHERE user_id = $1', user_id)
+        return row is not None
+    except Exception as e:
+        logger.error(f"is_bot_admin_db error: {e}")
+        return False
+
+
+async def get_all_bot_admins() -> list:
+    '''Возвращает список всех бот-администраторов: [(user_id, granted_at), ...].'''
+    try:
+        async with _connection() as conn:
+            rows = await conn.fetch('SELECT user_id, granted_at FROM bot_admins ORDER BY granted_at')
+        return [tuple(r) for r in rows]
+    except Exception as e:
+        logger.error(f"get_all_bot_admins error: {e}")
+        return []
+
+
+# ══════════════════════════════════════════════════════════
+#  ИГРА «ШИФРОВАЛЬЩИК»
+# ══════════════════════════════════════════════════════════
+
+async def get_game_result(user_id):
+    '''Возвращает результат конкретного игрока или None.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('''
+                SELECT user_id, user_name, total_score, completed, game_over, updated_at,
+                       COALESCE(banned, FALSE) as banned,
+                       COALESCE(achievement_count, 0) as achievement_count,
+                       COALESCE(achievement_pts, 0) as achievement_pts,
+                       COALESCE(chapter, 0) as chapter,
+                       COALESCE(score, 0) as score,
+                       COALESCE(reset_token, 0) as reset_token,
+                       COALESCE(retreat_count, 0) as retreat_count,
+                       COALESCE(pending_retreat_penalty, 0) as pending_retreat_penalty,
+                       COALESCE(pending_retreat_chapter, 0) as pending_retreat_chapter
+                FROM game_results
+                WHERE user_id = $1
+            ''', user_id)
+        return tuple(row) if row else None
+    except Exception as e:
+        logger.error(f"get_game_result error {user_id}: {e}")
+        return None
+
+
+async def get_game_result_detail(user_id):
+    '''Детальный результат игрока для админа.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('''
+                SELECT user_id, user_name, total_score, completed, game_over,
+                       chapter, score, COALESCE(failed, FALSE),
+                       COALESCE(banned, FALSE), updated_at,
+                       COALESCE(retreat_count, 0) as retreat_count,
+                       COALESCE(pending_retreat_penalty, 0) as pending_retreat_penalty,
+                       COALESCE(pending_retreat_chapter, 0) as pending_retreat_chapter
+                FROM game_results
+                WHERE user_id = $1
+            ''', user_id)
+        return tuple(row) if row else None
+    except Exception as e:
+        logger.error(f"get_game_result_detail error {user_id}: {e}")
+        return None
+
+
+async def get_game_role(user_id):
+    '''Возвращает роль игрока или 'player' по умолчанию.'''
+    try:
+        async with _connection() as conn:
+            role = await conn.fetchval('SELECT role FROM game_roles WHERE user_id = $1', user_id)
+        return role or 'player'
+    except Exception as e:
+        logger.error(f"get_game_role error: {e}")
+        return 'player'
+
+
+async def get_restart_mode(user_id):
+    '''Возвращает режим перезапуска для игрока или None.'''
+    try:
+        async with _connection() as conn:
+            return await conn.fetchval('SELECT restart_mode FROM game_results WHERE user_id=$1', user_id)
+    except Exception as e:
+        logger.error(f"get_restart_mode error {user_id}: {e}")
+        return None
+
+
+async def get_chapter_schedule_for_game() -> list:
+    '''Возвращает расписание глав для передачи в игру (таймеры).
+    [{'id', 'open', 'open_at' (ISO UTC или None)}, ...]
+    '''
+    try:
+        async with _connection() as conn:
+            rows = await conn.fetch('''
+                SELECT chapter_id,
+                       (is_open OR (open_at IS NOT NULL AND open_at <= NOW())) AS is_effectively_open,
+                       open_at
+                FROM game_chapters
+                ORDER BY chapter_id
+            ''')
+        result = []
+        for ch_id, is_open, open_at in rows:
+            oa = None
+            if open_at and not is_open:
+                oa = open_at.astimezone(pytz.utc).isoformat()
+            result.append({'id': ch_id, 'open': bool(is_open), 'open_at': oa})
+        return result
+    except Exception as e:
+        logger.error(f"get_chapter_schedule_for_game error: {e}")
+        return []
+
+
+async def get_player_accessible_chapters(user_id: int) -> set:
+    '''Главы, доступные игроку: индивидуально открытые + глобально открытые.'''
+    try:
+        async with _connection() as conn:
+            rows = await conn.fetch('''
+                SELECT chapter_id FROM player_chapter_access WHERE user_id = $1
+                UNION
+                SELECT chapter_id FROM game_chapters
+                WHERE is_open = TRUE OR (open_at IS NOT NULL AND open_at <= NOW())
+            ''', user_id)
+        return {r[0] for r in rows}
+    except Exception as e:
+        logger.error(f"get_player_accessible_chapters error {user_id}: {e}")
+        return set()
+
+
+async def open_chapter(chapter_id):
+    '''Немедленно открывает главу.'''
+    try:
+        async with _connection() as conn:
+            await conn.execute('''
+                UPDATE game_chapters
+                SET is_open = TRUE, open_at = NULL, updated_at = NOW()
+                WHERE chapter_id = $1
+            ''', chapter_id)
+        return True
+    except Exception as e:
+        logger.error(f"open_chapter error {chapter_id}: {e}")
+        return False
+
+
+async def get_game_leaderboard(limit=20):
+    '''Возвращает публичный топ игроков.
+    Админы, тестировщики и игроки с 0 очков НЕ включаются.'''
+    if leaderboard.board.ready:
+        return leaderboard.board.top(limit)
+    try:
+        async with _connection() as conn:
+            rows = await conn.fetch('''
+                SELECT
+                    gr.user_id, gr.user_name, gr.total_score, gr.completed,
+                    gr.game_over,
+                    COALESCE(rol.role, 'player') AS role,
+                    COALESCE(gr.achievement_count, 0) AS achievement_count,
+                    COALESCE(gr.achievement_pts,   0) AS achievement_pts
+                FROM game_results gr
+                LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
+                WHERE NOT COALESCE(gr.banned, FALSE)
+                  AND COALESCE(rol.role, 'player') NOT IN ('admin', 'tester')
+                  AND gr.total_score > 0
+                ORDER BY gr.total_score DESC, gr.updated_at ASC
+                LIMIT $1
+            ''', limit)
+        return [tuple(r) for r in rows]
+    except Exception as e:
+        logger.error(f"get_game_leaderboard error: {e}")
+        return []
+
+
+_PLAYERS_COUNT_SQL = '''
+    SELECT COUNT(*)
+    FROM game_results gr
+    LEFT JOIN game_roles rol ON gr.user_id = rol.user_id
+    WHERE NOT COALESCE(gr.banned, FALSE)
+      AND COALESCE(rol.role, 'player') = 'player'
+      AND gr.total_score > 0
+'''
+
+
+async def get_game_leaderboard_with_roles(limit=20):
+    '''Таблица лидеров с ролями (admin → tester → player); пока рейтинг
+    не загружен в память — через db в пуле потоков.'''
+    if leaderboard.board.ready:
+        return leaderboard.board.top_with_roles(limit)
+    return await asyncio.to_thread(db.get_game_leaderboard_with_roles, limit)
+
+
+async def get_game_players_count():
+    '''Возвращает количество участников рейтинга (только role=player).'''
+    if leaderboard.board.ready:
+        return leaderboard.board.players_count()
+    try:
+        async with _connection() as conn:
+            return await conn.fetchval(_PLAYERS_COUNT_SQL)
+    except Exception as e:
+        logger.error(f"get_game_players_count error: {e}")
+        return 0
+
+
+async def get_game_player_rank(user_id):
+    '''Возвращает позицию игрока в публичном рейтинге (role=player), либо (None, total_players).'''
+    if leaderboard.board.ready:
+        return leaderboard.board.rank(user_id)
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow(db._PLAYER_RANK_SQL, int(user_id))
+        total = int(row[1] or 0) if row else 0
+        if row and row[2]:
+            return int(row[0]), total
+        return None, total
+    except Exception as e:
+        logger.error(f"get_game_player_rank error {user_id}: {e}")
+        return None, 0
+
+
+# ── Рефералы ──
+
+def _empty_referral_summary() -> dict:
+    return {
+        'invited_count': 0,
+        'active_count': 0,
+        'rewarded_chapters': 0,
+        'bonus_points': 0,
+        'inviter_percent': 0,
+        'invitee_percent': int(db.REFERRAL_INVITEE_PCT),
+        'invitee_bonus_points': 0,
+        'referrer_id': 0,
+    }
+
+
+async def get_referral_summary(referrer_id: int) -> dict:
+    '''Aggregate referral stats for inviter and invited-player bonuses.'''
+    try:
+        referrer_id = int(referrer_id or 0)
+        if referrer_id <= 0:
+            return _empty_referral_summary()
+        cached = db._referral_cache.summary(referrer_id)
+        if cached is not None:
+            return cached
+        token = db._referral_cache.token()
+        async with _connection() as conn:
+            counters = await conn.fetchrow(
+                '''
+                SELECT invited_count, active_count, rewarded_chapters, bonus_points,
+                       game_inviter_percent(invited_count, $2, $3)
+                FROM game_referral_counters
+                WHERE referrer_id = $1
+                ''',
+                referrer_id, int(db.REFERRAL_INVITER_PCT_PER_AGENT), int(db.REFERRAL_INVITER_PCT_MAX),
+            )
+            invitee_row = await conn.fetchrow(
+                '''
+                SELECT
+                    COALESCE(total_referred_bonus, 0),
+                    COALESCE(invitee_bonus_percent, $1),
+                    COALESCE(referrer_id, 0)
+                FROM game_referrals
+                WHERE referred_id = $2
+                ''',
+                int(db.REFERRAL_INVITEE_PCT), referrer_id,
+            )
+        counters = counters or (0, 0, 0, 0, 0)
+        invitee_row = invitee_row or (0, db.REFERRAL_INVITEE_PCT, 0)
+        summary = {
+            'invited_count': int(counters[0] or 0),
+            'active_count': int(counters[1] or 0),
+            'rewarded_chapters': int(counters[2] or 0),
+            'bonus_points': int(counters[3] or 0),
+            'inviter_percent': int(counters[4] or 0),
+            'invitee_percent': int(invitee_row[1] or db.REFERRAL_INVITEE_PCT),
+            'invitee_bonus_points': int(invitee_row[0] or 0),
+            'referrer_id': int(invitee_row[2] or 0),
+        }
+        if _CURRENT_SESSION.get() is None:
+            db._referral_cache.put(referrer_id, token, summary=summary)
+        return summary
+    except Exception as e:
+        logger.error(f"get_referral_summary error {referrer_id}: {e}")
+        return _empty_referral_summary()
+
+
+async def get_referral_agents(referrer_id: int, limit: int = 15) -> list:
+    '''Return referred players list for inviter.'''
+    try:
+        referrer_id = int(referrer_id or 0)
+        limit = max(1, min(50, int(limit or 15)))
+        if referrer_id <= 0:
+            return []
+        cached = db._referral_cache.agents(referrer_id, limit)
+        if cached is not None:
+            return cached
+        token = db._referral_cache.token()
+        async with _connection() as conn:
+            rows = await conn.fetch(
+                '''
+                SELECT
+                    rf.referred_id,
+                    COALESCE(NULLIF(u.first_name, ''), NULLIF(gr.user_name, ''), 'Игрок') AS display_name,
+                    COALESCE(gr.completed, 0) AS completed,
+                    COALESCE(gr.total_score, 0) AS total_score,
+                    COALESCE(rf.rewarded_chapters, 0) AS rewarded_chapters,
+                    COALESCE(rf.total_referrer_bonus, 0) AS total_referrer_bonus,
+                    COALESCE(rf.total_referred_bonus, 0) AS total_referred_bonus,
+                    COALESCE(rf.invitee_bonus_percent, $1) AS invitee_bonus_percent,
+                    rf.created_at
+                FROM game_referrals rf
+                LEFT JOIN users u ON u.user_id = rf.referred_id
+                LEFT JOIN game_results gr ON gr.user_id = rf.referred_id
+                WHERE rf.referrer_id = $2
+                ORDER BY rf.created_at DESC
+                LIMIT $3
+                ''',
+                int(db.REFERRAL_INVITEE_PCT), referrer_id, limit,
+            )
+            inviter_percent = await conn.fetchval(
+                '''
+                SELECT game_inviter_percent(invited_count, $2, $3)
+                FROM game_referral_counters
+                WHERE referrer_id = $1
+                ''',
+                referrer_id, int(db.REFERRAL_INVITER_PCT_PER_AGENT), int(db.REFERRAL_INVITER_PCT_MAX),
+            )
+        inviter_percent = int(inviter_percent or 0)
+        agents = [
+            {
+                'user_id': int(r[0]),
+                'name': r[1] or 'Игрок',
+                'completed': int(r[2] or 0),
+                'total_score': int(r[3] or 0),
+                'rewarded_chapters': int(r[4] or 0),
+                'bonus_points': int(r[5] or 0),
+                'invitee_bonus_points': int(r[6] or 0),
+                'invitee_percent': int(r[7] or db.REFERRAL_INVITEE_PCT),
+                'inviter_percent': int(inviter_percent),
+                'created_at': r[8],
+            }
+            for r in rows
+        ]
+        if _CURRENT_SESSION.get() is None:
+            db._referral_cache.put(referrer_id, token, agents=agents, limit=limit)
+        return agents
+    except Exception as e:
+        logger.error(f"get_referral_agents error {referrer_id}: {e}")
+        return []
+
+
+# ── Секретные миссии ──
+
+def _secret_state_error() -> dict:
+    return {
+        'ok': False,
+        'mode': 'none',
+        'summary': {'completed': 0, 'total': len(db._SECRET_MISSIONS), 'bonus_points': 0},
+        'missions': [],
+    }
+
+
+async def get_secret_missions_state(user_id: int) -> dict:
+    try:
+        uid = db._secret_to_int(user_id, 0)
+        if uid <= 0:
+            return _secret_state_error()
+        async with _connection() as conn:
+            row = await conn.fetchrow(
+                'SELECT selected_mode, missions_json, updated_at FROM game_secret_state WHERE user_id = $1',
+                uid,
+            )
+        if row:
+            mode = db._sanitize_secret_mode(row[0])
+            missions_map = db._secret_normalize_missions(_json(row[1]))
+        else:
+            mode = 'none'
+            missions_map = db._secret_empty_missions_state()
+        exported = db._secret_export(mode, missions_map)
+        return {
+            'ok': True,
+            'mode': exported['mode'],
+            'summary': exported['summary'],
+            'missions': exported['missions'],
+            'stamp': row[2] if row else None,
+        }
+    except Exception as e:
+        logger.error(f"get_secret_missions_state error {user_id}: {e}")
+        return _secret_state_error()
+
+
+async def get_secret_missions_stamp(user_id: int):
+    '''updated_at строки game_secret_state (None — строки нет или ошибка).
+    Все записи состояния миссий обновляют updated_at, поэтому совпавший
+    stamp значит, что миссии не менялись.'''
+    try:
+        uid = db._secret_to_int(user_id, 0)
+        if uid <= 0:
+            return None
+        async with _connection() as conn:
+            return await conn.fetchval('SELECT updated_at FROM game_secret_state WHERE user_id = $1', uid)
+    except Exception as e:
+        logger.error(f"get_secret_missions_stamp error {user_id}: {e}")
+        return None
+
+
+async def _secret_store(conn, uid: int, mode: str, missions_map: dict, runtime: dict,
+                        awarded_points: int) -> list:
+    '''Async-версия db._secret_store: состояние миссий + бонус к total_score.
+    Возвращает обновлённые строки рейтинга (если очки начислены).'''
+    lb_rows = []
+    if awarded_points > 0:
+        await conn.execute(
+            '''
+            UPDATE game_results
+            SET total_score = GREATEST(0, COALESCE(total_score, 0) + $1),
+                updated_at = NOW()
+            WHERE user_id = $2
+            ''',
+            awarded_points, uid,
+        )
+        lb_rows = await conn.fetch(db._LEADERBOARD_SELECT + 'WHERE gr.user_id = $1', uid)
+    await conn.execute(
+        '''
+        INSERT INTO game_secret_state (
+            user_id, selected_mode, missions_json, runtime_json,
+            completed_count, bonus_points, updated_at
+        )
+        VALUES ($1, $2, $3::jsonb, $4::jsonb, $5, $6, NOW())
+        ON CONFLICT (user_id) DO UPDATE SET
+            selected_mode = EXCLUDED.selected_mode,
+            missions_json = EXCLUDED.missions_json,
+            runtime_json = EXCLUDED.runtime_json,
+            completed_count = EXCLUDED.completed_count,
+            bonus_points = EXCLUDED.bonus_points,
+            updated_at = NOW()
+        ''',
+        *db._secret_store_params(uid, mode, missions_map, runtime),
+    )
+    return [tuple(r) for r in lb_rows]
+
+
+async def save_game_sync_result(user_id, user_name, chapter, score, total_score,
+                                completed, game_over=False, failed=False,
+                                event_type='sync', chapter_idx=-1, cipher_idx=-1,
+                                chapter_in_progress=False, restart_penalty_points=0,
+                                client_reset_token=0, achievement_count=0, achievement_pts=0,
+                                secret_payload=None, agents_limit=12):
+    '''Async-версия db.save_game_sync_result: один вызов game_sync_apply()
+    и (при изменениях) запись секретных миссий в одной транзакции;
+    секретный шаг — под SAVEPOINT, как в sync-версии.
+    Список агентов из реферального кэша в функции не пересчитывается.'''
+    try:
+        token = db._referral_cache.token()
+        cached_agents = db._referral_cache.agents(user_id, agents_limit)
+        async with _connection() as conn:
+            async with conn.transaction():
+                raw = await conn.fetchval(
+                    '''
+                    SELECT game_sync_apply(
+                        $1, $2, $3, $4, $5, $6, $7, $8, $9, $10,
+                        $11, $12, $13, $14, $15, $16, $17, $18, $19
+                    )
+                    ''',
+                    *db._game_sync_apply_params(
+                        user_id, user_name, chapter, score, total_score, completed,
+                        game_over, failed, event_type, cipher_idx, chapter_in_progress,
+                        restart_penalty_points, client_reset_token, achievement_count,
+                        achievement_pts, 0 if cached_agents is not None else agents_limit,
+                    ),
+                )
+                result = dict(_json(raw, {}))
+                lb_rows = result.pop('lb_rows', None) or []
+                # Секретные миссии — под SAVEPOINT (вложенная транзакция):
+                # их ошибка не отменяет сохранение очков.
+                db_score = result.get('db_score')
+                try:
+                    async with conn.transaction():
+                        store = db._game_sync_take_secret(result, secret_payload)
+                        if store:
+                            lb_rows += await _secret_store(conn, int(user_id), *store)
+                except Exception as e:
+                    logger.error(f"save_game_sync_result secret step error {user_id}: {e}")
+                    db._game_sync_drop_secret(result, db_score)
+        _leaderboard_defer(lb_rows)
+        _referral_cache_defer(*db._referral_cache_take_sync(
+            result, user_id, token, cached_agents, agents_limit))
+        return result
+    except Exception as e:
+        logger.error(f"save_game_sync_result error {user_id}: {e}")
+        return {
+            'ok': False,
+            'db_score': 0,
+            'db_completed': 0,
+            'server_penalty_applied': 0,
+            'retreat_count': 0,
+        }
+
+
+# ══════════════════════════════════════════════════════════
+#  ОГРАНИЧЕНИЕ ЧАСТОТЫ (rate_limit.SharedBackend)
+# ══════════════════════════════════════════════════════════
+
+async def rate_limit_hit(key: str, window_start: int, window_sec: int):
+    '''Засчитывает хит в окне window_start и возвращает (хиты окна, хиты предыдущего окна);
+    None — если БД недоступна.'''
+    try:
+        async with _connection() as conn:
+            row = await conn.fetchrow('''
+                WITH cur AS (
+                    INSERT INTO rate_limit_counters (key, window_start, window_sec, hits)
+                    VALUES ($1, $2, $3, 1)
+                    ON CONFLICT (key, window_start)
+                    DO UPDATE SET hits = rate_limit_counters.hits + 1
+                    RETURNING hits
+                )
+                SELECT cur.hits,
+                       COALESCE((
+                           SELECT p.hits FROM rate_limit_counters p
+                           WHERE p.key = $1 AND p.window_start = $2 - $3
+                       ), 0)
+                FROM cur
+            ''', str(key), int(window_start), int(window_sec))
+        return (int(row[0]), int(row[1])) if row else None
+    except Exception as e:
+        logger.error(f"rate_limit_hit error {key}: {e}")
+        return None
+
+
+# ══════════════════════════════════════════════════════════
+#  ИДЕМПОТЕНТНОСТЬ /game_sync (таблица game_sync_responses, миграция v6)
+# ══════════════════════════════════════════════════════════
+
+async def get_sync_response(user_id: int, event_id: str):
+    '''Сохранённый ответ на событие event_id (не старше TTL) или None.'''
+    try:
+        async with _connection() as conn:
+            raw = await conn.fetchval('''
+                SELECT response FROM game_sync_responses
+                WHERE user_id = $1 AND event_id = $2
+                  AND created_at >= NOW() - make_interval(secs => $3)
+            ''', int(user_id), str(event_id), float(db.GAME_SYNC_IDEMPOTENCY_TTL_SEC))
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        logger.error(f"get_sync_response error {user_id}: {e}")
+        return None
+
+
+async def save_sync_response(user_id: int, event_id: str, response: dict):
+    '''Запоминает ответ в текущей транзакции. True — записан; False — ключ уже
+    занят параллельным запросом (его транзакцию надо откатить); None — ошибка.'''
+    try:
+        async with _connection() as conn:
+            inserted = await conn.fetchval('''
+                INSERT INTO game_sync_responses (user_id, event_id, response)
+                VALUES ($1, $2, $3::jsonb)
+                ON CONFLICT (user_id, event_id) DO UPDATE
+                    SET response = EXCLUDED.response, created_at = NOW()
+                    WHERE game_sync_responses.created_at < NOW() - make_interval(secs => $4)
+                RETURNING TRUE
+            ''', int(user_id), str(event_id), json.dumps(response, ensure_ascii=False, default=str),
+                float(db.GAME_SYNC_IDEMPOTENCY_TTL_SEC))
+        return bool(inserted)
+    except Exception as e:
+        logger.error(f"save_sync_response error {user_id}: {e}")
+        return None
+
+
+# ══════════════════════════════════════════════════════════
+#  PUSH-СОБЫТИЯ ИГРЫ (LISTEN/NOTIFY, см. game_events.py)
+# ══════════════════════════════════════════════════════════
+
+async def notify_game_event(channel: str, payload: str) -> bool:
+    '''pg_notify: в сессии — при её commit, иначе сразу.'''
+    try:
+        async with _connection() as conn:
+            await conn.execute('SELECT pg_notify($1, $2)', channel, payload)
+        return True
+    except Exception as e:
+        logger.error(f"notify_game_event error: {e}")
+        return False
+
+
+async def open_listener(channel: str, callback) -> asyncpg.Connection:
+    '''Отдельное соединение (не из пула) с LISTEN channel; callback(payload: str).
+    Закрывает вызывающий.'''
+    conn = await asyncpg.connect(db.DATABASE_URL, ssl='require', timeout=10)
+    await conn.add_listener(channel, lambda _conn, _pid, _channel, payload: callback(payload))
+    return conn
+
+
+# ══════════════════════════════════════════════════════════
+#  ОСТАЛЬНОЕ — через пул потоков
+# ══════════════════════════════════════════════════════════
+
+def __getattr__(name: str):
+    '''Функции database.py без нативной версии: await adb.X(...) ==
+    await asyncio.to_thread(db.X, ...). Функция ищется в db в момент вызова,
+    поэтому обёртки bot._instrument_db_calls тоже срабатывают.'''
+    if name.startswith('_'):
+        raise AttributeError(name)
+    fn = getattr(db, name, None)
+    if not inspect.isfunction(fn):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    async def call(*args, **kwargs):
+        return await asyncio.to_thread(getattr(db, name), *args, **kwargs)
+
+    call.__name__ = call.__qualname__ = name
+    call.__doc__ = fn.__doc__
+    globals()[name] = call
+    return call
@@ -436,6 +436,7 @@ function _applySyncResponse(result, forceServerState = false) {
   if (hasRefSummary) state.referralSummary = normalizeReferralSummary(result.ref_summary);
   if (hasRefAgents) state.referralAgents = normalizeReferralAgents(result.ref_agents);
   const referralChanged = hasRefSummary || hasRefAgents;
+  _rememberSectionVersions(result.versions);
 
   const hasDbSnapshot = (typeof result.db_score === 'number') || (typeof result.db_completed === 'number');
   if (!hasDbSnapshot) {
@@ -479,7 +480,63 @@ function _applySyncResponse(result, forceServerState = false) {
   }
 }
 
-async function sendResultToBot(data) {
+// Очередь событий для /game_sync_batch: ответы, конец главы и рестарты,
+// случившиеся подряд, уходят одним запросом (одна авторизация и одна
+// транзакция на сервере) вместо POST на каждое событие.
+const SYNC_BATCH_DELAY_MS = 800;
+const SYNC_BATCH_MAX = 25;
+let _syncQueue = [];
+let _syncSeq = 0;
+// Ключ идемпотентности события (event_id = <вкладка>.<seq>): повтор после таймаута
+// (в т.ч. из pending_results после перезапуска) сервер не применяет второй раз.
+const _syncClientId = (() => {
+  try {
+    const buf = new Uint32Array(2);
+    crypto.getRandomValues(buf);
+    return buf[0].toString(36) + buf[1].toString(36);
+  } catch (_) {
+    return Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+  }
+})();
+let _syncBatchTimer = null;
+let _syncBatchChain = Promise.resolve();
+
+// Версии крупных разделов ответа (ref, secret, schedule): сервер не присылает
+// раздел, если версия у клиента та же. Версия действительна, пока локальные
+// данные раздела не менялись после получения (сверяем снимок).
+let _sectionVersions = {};
+
+// Поток /game_events (см. «PUSH-СОБЫТИЯ» ниже).
+let _gameEvents = null;
+let _gameEventsLive = false;
+let _gameEventsWasLive = false;
+let _gameEventsRetryMs = 0;
+let _gameEventsTimer = null;
+
+function _sectionSnapshot(name) {
+  if (name === 'ref') return JSON.stringify([state.referralSummary, state.referralAgents]);
+  if (name === 'secret') return JSON.stringify([state.secretMode, state.secretSummary, state.secretMissions]);
+  if (name === 'schedule') return JSON.stringify(tgChapterSchedule);
+  return '';
+}
+
+function _sectionHave() {
+  const have = {};
+  Object.keys(_sectionVersions).forEach(name => {
+    const entry = _sectionVersions[name];
+    if (entry && entry.snap === _sectionSnapshot(name)) have[name] = entry.v;
+  });
+  return have;
+}
+
+function _rememberSectionVersions(versions) {
+  if (!versions || typeof versions !== 'object') return;
+  Object.keys(versions).forEach(name => {
+    _sectionVersions[name] = { v: String(versions[name]), snap: _sectionSnapshot(name) };
+  });
+}
+
+function sendResultToBot(data) {
   ensureSecretState();
   data.completed = _stateCompletedCount();
   data.total_score = state.totalScore;
@@ -496,50 +553,103 @@ async function sendResultToBot(data) {
     const initDataRaw = getTgInitDataRaw();
     if (initDataRaw) data.init_data = initDataRaw;
   }
+  return _enqueueSync(data, true);
+}
+
+// Ставит событие в очередь; промис резолвится true, когда сервер его принял.
+// fallback — при ошибке отправить через tg.sendData / pending_results
+// (для событий глав; обычный autoSync просто повторится позже).
+function _enqueueSync(data, fallback) {
+  data.seq = ++_syncSeq;
+  if (!data.event_id) data.event_id = _syncClientId + '.' + data.seq;
+  return new Promise(resolve => {
+    _syncQueue.push({ data, resolve, fallback: !!fallback });
+    // Автосинк ответов ждёт попутчиков, события глав и уход со страницы — нет.
+    const urgent = data.type !== 'sync' || document.hidden;
+    _scheduleSyncBatch(urgent ? 0 : SYNC_BATCH_DELAY_MS);
+  });
+}
+
+function _scheduleSyncBatch(delayMs) {
+  if (_syncBatchTimer) {
+    if (delayMs > 0) return;
+    clearTimeout(_syncBatchTimer);
+  }
+  _syncBatchTimer = setTimeout(() => {
+    _syncBatchTimer = null;
+    _syncBatchChain = _syncBatchChain.then(_flushSyncBatch).catch(() => {});
+  }, delayMs);
+}
+
+async function _flushSyncBatch() {
+  if (!_syncQueue.length) return;
+  const batch = _syncQueue.splice(0, SYNC_BATCH_MAX);
+  if (_syncQueue.length) _scheduleSyncBatch(0);
+  const events = batch.map(item => item.data);
+  const last = events[events.length - 1];
 
   const syncUrl = window._syncUrl;
-  if (syncUrl && data.user_id) {
+  let handled = false;
+  if (syncUrl && last.user_id) {
     try {
-      const resp = await fetch(syncUrl, {
+      const resp = await fetch(syncUrl.replace('/game_sync', '/game_sync_batch'), {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify(data)
+        body: JSON.stringify({
+          user_id: last.user_id,
+          init_data: last.init_data || '',
+          have: _sectionHave(),
+          events: events.map(({ user_id, init_data, ...event }) => event)
+        })
       });
       if (resp.ok) {
         const result = await resp.json().catch(() => ({}));
-        if (result.banned) {
-          document.body.innerHTML = '<div style="display:flex;flex-direction:column;align-items:center;justify-content:center;height:100vh;background:#0d0b08;color:#fff;text-align:center;padding:32px;font-family:sans-serif"><div style="font-size:64px;margin-bottom:16px">🚫</div><div style="font-size:22px;font-weight:700;color:#ffe033;margin-bottom:12px">Access blocked</div><div style="font-size:15px;color:rgba(255,255,255,.6);max-width:280px">Your account was blocked by administrator.</div></div>';
-          try { localStorage.removeItem(storageKey()); } catch(e2) {}
-          return;
-        }
-        _applySyncResponse(result, !!result.stale || !!result.force_state);
-        _lastSyncedScore = Number(state.totalScore || data.total_score || 0);
-        _lastSyncedCompleted = _stateCompletedCount();
-        _lastSyncedSignature = [
-          Number(state.totalScore || 0),
-          _lastSyncedCompleted,
-          _stateCurrentChapterId(),
-          Number(state.chapterScore || 0),
-          Number(state.cipherIdx || 0),
-          Number(state.lives || 0),
-          state.gameOver ? 1 : 0,
-          Object.keys(state.achievements || {}).length,
-          Number(state.achievementPts || 0),
-          state.secretMode,
-          normalizeSecretSummary(state.secretSummary).completed,
-          normalizeSecretSummary(state.secretSummary).bonus_points
-        ].join('|');
-        return;
+        _handleSyncResult(result, last);
+        handled = true;
+      } else {
+        console.warn('game_sync_batch HTTP error:', resp.status);
       }
-      console.warn('game_sync HTTP error:', resp.status);
     } catch(e) {
-      console.warn('game_sync fetch error:', e);
+      console.warn('game_sync_batch fetch error:', e);
     }
   }
+  if (!handled) {
+    const fallbackEvents = batch.filter(item => item.fallback).map(item => item.data);
+    if (fallbackEvents.length) _fallbackSyncResults(fallbackEvents);
+  }
+  batch.forEach(item => item.resolve(handled));
+}
+
+function _handleSyncResult(result, data) {
+  if (result.banned) {
+    document.body.innerHTML = '<div style="display:flex;flex-direction:column;align-items:center;justify-content:center;height:100vh;background:#0d0b08;color:#fff;text-align:center;padding:32px;font-family:sans-serif"><div style="font-size:64px;margin-bottom:16px">🚫</div><div style="font-size:22px;font-weight:700;color:#ffe033;margin-bottom:12px">Access blocked</div><div style="font-size:15px;color:rgba(255,255,255,.6);max-width:280px">Your account was blocked by administrator.</div></div>';
+    try { localStorage.removeItem(storageKey()); } catch(e2) {}
+    return;
+  }
+  _applySyncResponse(result, !!result.stale || !!result.force_state);
+  _lastSyncedScore = Number(state.totalScore || data.total_score || 0);
+  _lastSyncedCompleted = _stateCompletedCount();
+  _lastSyncedSignature = [
+    Number(state.totalScore || 0),
+    _lastSyncedCompleted,
+    _stateCurrentChapterId(),
+    Number(state.chapterScore || 0),
+    Number(state.cipherIdx || 0),
+    Number(state.lives || 0),
+    state.gameOver ? 1 : 0,
+    Object.keys(state.achievements || {}).length,
+    Number(state.achievementPts || 0),
+    state.secretMode,
+    normalizeSecretSummary(state.secretSummary).completed,
+    normalizeSecretSummary(state.secretSummary).bonus_points
+  ].join('|');
+}
 
+function _fallbackSyncResults(events) {
+  const last = events[events.length - 1];
   if (tg && tg.sendData && tg.initData) {
     try {
-      tg.sendData(JSON.stringify(data));
+      tg.sendData(JSON.stringify(last));
       return;
     } catch(e) {
       console.warn('tg.sendData failed:', e);
@@ -548,7 +658,8 @@ async function sendResultToBot(data) {
 
   try {
     const pending = JSON.parse(localStorage.getItem('pending_results') || '[]');
-    pending.push({ ...data, ts: Date.now() });
+    const now = Date.now();
+    events.forEach(data => pending.push({ ...data, ts: now }));
     localStorage.setItem('pending_results', JSON.stringify(pending.slice(-10)));
   } catch(e) {}
 }
@@ -679,7 +790,7 @@ function showPenaltyNotice(text, duration = 5600) {
 // ═══════════════════════════════════════════════════════
 //  АВТОСИНХРОНИЗАЦИЯ (фоновая, без UI)
 // ═══════════════════════════════════════════════════════
-let _syncInFlight = false;
+let _queuedSyncSignature = '';
 
 async function autoSync(showNotification = false, force = false) {
   const syncUrl = window._syncUrl;
@@ -707,8 +818,8 @@ async function autoSync(showNotification = false, force = false) {
     secretSummary.bonus_points
   ].join('|');
   if (!force && syncSignature === _lastSyncedSignature) return;
-  if (_syncInFlight) return;
-  _syncInFlight = true;
+  if (!force && syncSignature === _queuedSyncSignature) return;
+  _queuedSyncSignature = syncSignature;
 
   const data = {
     type: 'sync',
@@ -730,41 +841,15 @@ async function autoSync(showNotification = false, force = false) {
   if (_serverResetToken > 0) data.reset_token = _serverResetToken;
 
   try {
-    const resp = await fetch(syncUrl, {
-      method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify(data)
-    });
-    if (resp.ok) {
-      const result = await resp.json().catch(() => ({}));
-      if (result.stale) {
-        _applySyncResponse(result, true);
-      } else {
-        _applySyncResponse(result, !!result.force_state);
-      }
-      _lastSyncedScore = Number(state.totalScore || 0);
-      _lastSyncedCompleted = _stateCompletedCount();
-      _lastSyncedSignature = [
-        Number(state.totalScore || 0),
-        _lastSyncedCompleted,
-        _stateCurrentChapterId(),
-        Number(state.chapterScore || 0),
-        Number(state.cipherIdx || 0),
-        Number(state.lives || 0),
-        state.gameOver ? 1 : 0,
-        Object.keys(state.achievements || {}).length,
-        Number(state.achievementPts || 0),
-        state.secretMode,
-        normalizeSecretSummary(state.secretSummary).completed,
-        normalizeSecretSummary(state.secretSummary).bonus_points
-      ].join('|');
+    const ok = await _enqueueSync(data, false);
+    if (ok) {
       console.log('autoSync OK:', state.totalScore, 'pts,', _lastSyncedCompleted, 'chapters');
       if (showNotification) showToast('Progress saved');
     }
   } catch(e) {
     console.warn('autoSync error:', e);
   } finally {
-    _syncInFlight = false;
+    if (_queuedSyncSignature === syncSignature) _queuedSyncSignature = '';
   }
 }
 
@@ -4637,9 +4722,14 @@ function switchTab(tab) {
   if (screenEl) screenEl.classList.add('active');
   if (tabEl)    tabEl.classList.add('active');
 
-  if (tab === 'chapters')    { renderChapters(); fetchAndApplyState(); }
-  if (tab === 'leaderboard') { renderLeaderboardTab(); fetchAndApplyState(); fetchAndApplyLeaderboard(); }
-  if (tab === 'profile')     { renderProfileTab();     fetchAndApplyState(); }
+  // С подключённым /game_events изменения приходят событиями — повторный запрос не нужен.
+  const needRefresh = !_gameEventsLive;
+  if (tab === 'chapters')    { renderChapters(); if (needRefresh) fetchAndApplyState(); }
+  if (tab === 'leaderboard') {
+    renderLeaderboardTab();
+    if (needRefresh) { fetchAndApplyState(); fetchAndApplyLeaderboard(); }
+  }
+  if (tab === 'profile')     { renderProfileTab();     if (needRefresh) fetchAndApplyState(); }
   if (tab === 'about') {
     renderAboutTab();
     applyAboutBuildVersion();
@@ -4650,7 +4740,7 @@ function switchTab(tab) {
   }
   if (tab === 'secret') {
     renderSecretMissionsTab();
-    fetchAndApplyState();
+    if (needRefresh) fetchAndApplyState();
   }
   if (tab === 'settings')     renderSettingsTab();
 }
@@ -6957,6 +7047,9 @@ async function fetchAndApplyState() {
     const initDataRaw = getTgInitDataRaw();
     let stateUrl = base + '/game_state?user_id=' + encodeURIComponent(uid);
     if (initDataRaw) stateUrl += '&init_data=' + encodeURIComponent(initDataRaw);
+    const have = _sectionHave();
+    const haveParam = Object.keys(have).map(name => name + ':' + have[name]).join(',');
+    if (haveParam) stateUrl += '&have=' + encodeURIComponent(haveParam);
 
     const resp = await fetch(stateUrl);
     const data = await resp.json().catch(() => null);
@@ -6989,8 +7082,10 @@ async function fetchAndApplyState() {
       state.testerMode = false;
     }
     if (data.role) state.gameRole = data.role;
-    const refSummary = normalizeReferralSummary(data.ref_summary || (tgInitMe && tgInitMe.ref_summary) || state.referralSummary);
-    const refAgents = normalizeReferralAgents(data.ref_agents || (tgInitMe && tgInitMe.ref_agents) || state.referralAgents);
+    // Раздел не пришёл, потому что не менялся (versions) — оставляем свой.
+    const refKept = !!data.versions && !('ref_summary' in data);
+    const refSummary = normalizeReferralSummary(refKept ? state.referralSummary : (data.ref_summary || (tgInitMe && tgInitMe.ref_summary) || state.referralSummary));
+    const refAgents = normalizeReferralAgents(refKept ? state.referralAgents : (data.ref_agents || (tgInitMe && tgInitMe.ref_agents) || state.referralAgents));
     state.referralSummary = refSummary;
     state.referralAgents = refAgents;
     const secretChanged = _applySecretStateFromServer(
@@ -7009,6 +7104,7 @@ async function fetchAndApplyState() {
     if (Array.isArray(data.chapter_schedule)) {
       tgChapterSchedule = data.chapter_schedule;
     }
+    _rememberSectionVersions(data.versions);
 
     const prevResetToken = _getStoredResetToken();
     if (typeof data.reset_token === 'number' && data.reset_token > 0) {
@@ -7115,6 +7211,20 @@ async function fetchAndApplyState() {
   }
 }
 
+function _applyLeaderboardRows(rows) {
+  state.leaderboard = rows.map(r => ({
+    uid: String(r.uid),
+    name: r.name || 'Игрок',
+    score: Number(r.score || 0),
+    completed: Number(r.completed || 0),
+    role: r.role || 'player',
+    achievementCount: Number(r.achievementCount || 0),
+    achievementPts: Number(r.achievementPts || 0),
+  }));
+  tgInitLB = state.leaderboard.slice();
+  if (currentTab === 'leaderboard') renderLeaderboardTab();
+}
+
 let _lbSyncInFlight = false;
 async function fetchAndApplyLeaderboard() {
   const uid = getTgUserId();
@@ -7130,17 +7240,7 @@ async function fetchAndApplyLeaderboard() {
     const data = await resp.json().catch(() => null);
     if (!resp.ok || !data || !data.ok || !Array.isArray(data.leaderboard)) return;
 
-    state.leaderboard = data.leaderboard.map(r => ({
-      uid: String(r.uid),
-      name: r.name || 'Игрок',
-      score: Number(r.score || 0),
-      completed: Number(r.completed || 0),
-      role: r.role || 'player',
-      achievementCount: Number(r.achievementCount || 0),
-      achievementPts: Number(r.achievementPts || 0),
-    }));
-    tgInitLB = state.leaderboard.slice();
-    if (currentTab === 'leaderboard') renderLeaderboardTab();
+    _applyLeaderboardRows(data.leaderboard);
   } catch (e) {
     console.warn('fetchAndApplyLeaderboard:', e);
   } finally {
@@ -7148,9 +7248,83 @@ async function fetchAndApplyLeaderboard() {
   }
 }
 
+// ═══════════════════════════════════════════════════════
+//  PUSH-СОБЫТИЯ (/game_events, Server-Sent Events)
+// ═══════════════════════════════════════════════════════
+// Пока поток подключён, состояние и рейтинг перечитываются по событию сервера,
+// а не при каждом переключении вкладки. Без EventSource или при отказе сервера
+// остаётся прежнее поведение. Состояние потока объявлено рядом с очередью sync.
+
+function _gameEventsUrl() {
+  const uid = getTgUserId();
+  const syncUrl = window._syncUrl;
+  if (!uid || !syncUrl) return '';
+  const base = syncUrl.replace('/game_sync', '');
+  let url = base + '/game_events?user_id=' + encodeURIComponent(uid) + '&topics=leaderboard';
+  const initDataRaw = getTgInitDataRaw();
+  if (initDataRaw) url += '&init_data=' + encodeURIComponent(initDataRaw);
+  return typeof window.__patchGameUrl === 'function' ? window.__patchGameUrl(url) : url;
+}
+
+function _stopGameEvents() {
+  clearTimeout(_gameEventsTimer);
+  _gameEventsTimer = null;
+  if (_gameEvents) {
+    try { _gameEvents.close(); } catch (_) {}
+  }
+  _gameEvents = null;
+  _gameEventsLive = false;
+}
+
+function _startGameEvents() {
+  if (_gameEvents || typeof EventSource !== 'function' || document.hidden) return;
+  const url = _gameEventsUrl();
+  if (!url) return;
+  let es;
+  try {
+    es = new EventSource(url);
+  } catch (_) {
+    return;
+  }
+  _gameEvents = es;
+  es.addEventListener('hello', () => {
+    // После обрыва события могли потеряться — перечитываем один раз.
+    if (_gameEventsWasLive) {
+      fetchAndApplyState();
+      fetchAndApplyLeaderboard();
+    }
+    _gameEventsLive = true;
+    _gameEventsWasLive = true;
+    _gameEventsRetryMs = 0;
+  });
+  es.addEventListener('state', () => fetchAndApplyState());
+  es.addEventListener('settings', () => fetchAndApplyState());
+  es.addEventListener('leaderboard', (ev) => {
+    try {
+      const data = JSON.parse(ev.data);
+      if (data && Array.isArray(data.leaderboard)) _applyLeaderboardRows(data.leaderboard);
+    } catch (_) {}
+  });
+  es.onerror = () => {
+    _gameEventsLive = false;
+    // CONNECTING — браузер переподключится сам; CLOSED — отказ (403/503), URL нужен новый.
+    if (es.readyState !== EventSource.CLOSED || _gameEvents !== es) return;
+    _gameEvents = null;
+    _gameEventsRetryMs = Math.min(60000, (_gameEventsRetryMs || 2500) * 2);
+    clearTimeout(_gameEventsTimer);
+    _gameEventsTimer = setTimeout(_startGameEvents, _gameEventsRetryMs);
+  };
+}
+
+document.addEventListener('visibilitychange', () => {
+  if (document.hidden) _stopGameEvents();
+  else _startGameEvents();
+});
+
 renderChapters();
 fetchAndApplyState();
 fetchAndApplyLeaderboard();
+_startGameEvents();
 flushPendingResults();
 try {
 } catch(e) {}
@@ -7,6 +7,9 @@
   const RESET_TOKEN_MAX = 2147483647;
   let serverResetToken = 0;
   let accessOverlayShown = false;
+  // Подписанный токен сессии из /game_state: запросы отправляют его вместо init_data.
+  let gameSessionToken = "";
+  let gameSessionExpiresAt = 0;
 
   function escapeHtml(value) {
     return String(value)
@@ -46,6 +49,25 @@
     }
   }
 
+  function setSessionToken(token, expiresAtSec) {
+    const expiresAt = Number(expiresAtSec);
+    if (typeof token !== "string" || !token || !Number.isFinite(expiresAt) || expiresAt <= 0) return;
+    gameSessionToken = token;
+    // Запас 30 секунд, чтобы не отправить токен, истекающий в пути;
+    // при расхождении часов сервер ответит 403, и запрос повторится с init_data.
+    gameSessionExpiresAt = expiresAt * 1000 - 30000;
+  }
+
+  function getSessionToken() {
+    if (!gameSessionToken || Date.now() >= gameSessionExpiresAt) return "";
+    return gameSessionToken;
+  }
+
+  function clearSessionToken() {
+    gameSessionToken = "";
+    gameSessionExpiresAt = 0;
+  }
+
   function getInitDataRaw() {
     if (!tg || typeof tg.initData !== "string") return "";
     return tg.initData;
@@ -204,13 +226,20 @@
     }
   }
 
-  function patchGetUrl(rawUrl) {
+  function patchGetUrl(rawUrl, sessionToken) {
     const url = normalizeUrl(rawUrl);
     if (!url) return rawUrl;
     const pathname = url.pathname || "";
-    if (!pathname.endsWith("/game_state") && !pathname.endsWith("/game_leaderboard")) {
+    const isEvents = pathname.endsWith("/game_events");
+    if (!pathname.endsWith("/game_state") && !pathname.endsWith("/game_leaderboard") && !isEvents) {
       return rawUrl;
     }
+    // /game_state всегда с init_data: он же выдаёт свежий токен сессии.
+    if (sessionToken && (pathname.endsWith("/game_leaderboard") || isEvents)) {
+      url.searchParams.delete("init_data");
+      url.searchParams.set("session", sessionToken);
+      return url.toString();
+    }
     if (!url.searchParams.get("init_data")) {
       const initDataRaw = getInitDataRaw();
       if (initDataRaw) url.searchParams.set("init_data", initDataRaw);
@@ -229,22 +258,26 @@
     return null;
   }
 
-  function patchPostBody(rawUrl, init) {
+  function patchPostBody(rawUrl, init, sessionToken) {
     const url = normalizeUrl(rawUrl);
     if (!url) return init;
     const method = String(init.method || "GET").toUpperCase();
     if (method !== "POST") return init;
     const pathname = url.pathname || "";
     const isSync = pathname.endsWith("/game_sync");
+    const isBatch = pathname.endsWith("/game_sync_batch");
     const isReset = pathname.endsWith("/game_reset");
-    if (!isSync && !isReset) return init;
+    if (!isSync && !isBatch && !isReset) return init;
 
     const bodyObj = parseBodyToObject(init.body);
     if (!bodyObj) return init;
 
     const nextBody = { ...bodyObj };
     const initDataRaw = getInitDataRaw();
-    if (initDataRaw && !nextBody.init_data) {
+    if (sessionToken) {
+      delete nextBody.init_data;
+      nextBody.session = sessionToken;
+    } else if (initDataRaw && !nextBody.init_data) {
       nextBody.init_data = initDataRaw;
     }
     if (isSync) {
@@ -255,6 +288,13 @@
         nextBody.reset_token = serverResetToken;
       }
     }
+    if (isBatch && Array.isArray(nextBody.events) && serverResetToken > 0) {
+      nextBody.events = nextBody.events.map((event) => (
+        event && typeof event === "object" && toSafeResetToken(event.reset_token) <= 0
+          ? { ...event, reset_token: serverResetToken }
+          : event
+      ));
+    }
 
     const headers = new Headers(init.headers || {});
     if (!headers.has("Content-Type")) {
@@ -305,6 +345,7 @@
 
       if (payload.db_reset_token !== undefined) setResetToken(payload.db_reset_token);
       if (payload.reset_token !== undefined) setResetToken(payload.reset_token);
+      if (payload.session_token !== undefined) setSessionToken(payload.session_token, payload.session_expires_at);
 
       if (payload.allowed === false) {
         showAccessOverlay(
@@ -334,14 +375,28 @@
         return response;
       }
 
-      const patchedUrl = patchGetUrl(input);
-      const nextInit = patchPostBody(patchedUrl, init ? { ...init } : {});
+      const sessionToken = getSessionToken();
+      const patchedUrl = patchGetUrl(input, sessionToken);
+      const nextInit = patchPostBody(patchedUrl, init ? { ...init } : {}, sessionToken);
       const response = await nativeFetch(patchedUrl, nextInit);
+      if (response.status === 403 && sessionToken && (patchedUrl !== input || nextInit.body !== (init || {}).body)) {
+        // Токен отклонён (истёк, сменился бот-токен) — повторяем с init_data.
+        clearSessionToken();
+        const retryUrl = patchGetUrl(input, "");
+        const retryResponse = await nativeFetch(retryUrl, patchPostBody(retryUrl, init ? { ...init } : {}, ""));
+        inspectGameResponse(retryResponse);
+        return retryResponse;
+      }
       inspectGameResponse(response);
       return response;
     };
   }
 
+  // EventSource не идёт через fetch: game.js берёт URL /game_events отсюда.
+  window.__patchGameUrl = function (rawUrl) {
+    return patchGetUrl(rawUrl, getSessionToken());
+  };
+
   sanitizeTgUserObject();
   sanitizeStartParams();
   sanitizeLocalLeaderboardCache();
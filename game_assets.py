@@ -0,0 +1,152 @@
+'''Статика Mini App: хэшированные имена, предсжатие и кэширование.
+
+При старте каждый файл game/* читается один раз: считается хэш содержимого,
+готовятся сжатые варианты (gzip; br — если установлен brotli) и имя с
+отпечатком — game.js -> game.<hash>.js. По такому имени файл отдаётся с
+Cache-Control: immutable: новое содержимое — новое имя, старое кэшируется
+навсегда.
+
+index.html остаётся с revalidate (no-cache + ETag): в него перед </head>
+подставляется window.__GAME_ASSETS — карта «имя -> имя с отпечатком», по
+которой загрузчик берёт скрипты. Обычные имена (game.js) тоже работают,
+но с revalidate, — для старых закэшированных index.html.
+'''
+import gzip
+import hashlib
+import json
+import pathlib
+
+from http_json import accepted_encodings, etag_matches
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - зависит от окружения
+    brotli = None
+
+INDEX_NAME = 'index.html'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Меньше этого сжатие не окупает заголовки.
+PRECOMPRESS_MIN_BYTES = 512
+
+CONTENT_TYPES = {
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.svg': 'image/svg+xml',
+}
+# Уже сжатые форматы повторно не жмём.
+_COMPRESSIBLE = ('.js', '.css', '.html', '.svg')
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=5).hexdigest()
+
+
+def hashed_name(name: str, digest: str) -> str:
+    '''game.js + ab12 -> game.ab12.js'''
+    path = pathlib.PurePath(name)
+    return f'{path.stem}.{digest}{path.suffix}'
+
+
+class Asset:
+    __slots__ = ('name', 'url_name', 'content_type', 'etag', 'variants')
+
+    def __init__(self, name: str, body: bytes, url_name: str | None = None):
+        digest = content_hash(body)
+        suffix = pathlib.PurePath(name).suffix
+        self.name = name
+        self.url_name = url_name or hashed_name(name, digest)
+        self.content_type = CONTENT_TYPES.get(suffix, 'application/octet-stream')
+        self.etag = f'"{digest}"'
+        # Content-Encoding (None — без сжатия) -> тело.
+        self.variants = {None: body}
+        if suffix in _COMPRESSIBLE and len(body) >= PRECOMPRESS_MIN_BYTES:
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body, quality=11)
+
+    def select(self, accept_encoding: str | None) -> tuple[bytes, str | None]:
+        '''(тело, Content-Encoding | None): br, затем gzip, иначе как есть.'''
+        if len(self.variants) > 1:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding in ('br', 'gzip'):
+                if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                    return self.variants[encoding], encoding
+        return self.variants[None], None
+
+
+class AssetStore:
+    def __init__(self, game_dir):
+        self.game_dir = pathlib.Path(game_dir)
+        self.assets: dict[str, Asset] = {}
+        self._routes: dict[str, tuple] = {}   # имя в URL -> (asset, immutable)
+        self.index = None
+
+    def load(self) -> 'AssetStore':
+        '''Читает game/*; index.html собирается последним — с картой имён.'''
+        assets, routes = {}, {}
+        if self.game_dir.is_dir():
+            for path in sorted(self.game_dir.iterdir()):
+                if not path.is_file() or path.name.startswith('.') or path.name == INDEX_NAME:
+                    continue
+                asset = Asset(path.name, path.read_bytes())
+                assets[path.name] = asset
+                routes[path.name] = (asset, False)
+                routes[asset.url_name] = (asset, True)
+        index = None
+        index_path = self.game_dir / INDEX_NAME
+        if index_path.is_file():
+            html = inject_manifest(index_path.read_text(encoding='utf-8'), self.manifest(assets))
+            index = Asset(INDEX_NAME, html.encode('utf-8'), url_name=INDEX_NAME)
+            routes[INDEX_NAME] = (index, False)
+        self.assets, self._routes, self.index = assets, routes, index
+        return self
+
+    @staticmethod
+    def manifest(assets: dict) -> dict:
+        return {name: asset.url_name for name, asset in sorted(assets.items())}
+
+    def lookup(self, url_name: str):
+        '''(asset, immutable) или None.'''
+        return self._routes.get(url_name)
+
+    def respond(self, url_name: str, accept_encoding: str | None = None,
+                if_none_match: str | None = None):
+        '''(status, тело, заголовки) для файла или None, если такого нет.'''
+        found = self.lookup(url_name)
+        if found is None:
+            return None
+        asset, immutable = found
+        headers = {
+            'Cache-Control': IMMUTABLE if immutable else REVALIDATE,
+            'ETag': asset.etag,
+        }
+        if len(asset.variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if etag_matches(if_none_match, asset.etag):
+            return 304, b'', headers
+        body, encoding = asset.select(accept_encoding)
+        headers['Content-Type'] = asset.content_type
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return 200, body, headers
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self.assets),
+            'brotli': brotli is not None,
+            'manifest': self.manifest(self.assets),
+        }
+
+
+def inject_manifest(html: str, manifest: dict) -> str:
+    '''Вставляет window.__GAME_ASSETS перед </head> (или в начало, если его нет).'''
+    payload = json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+    script = f'<script>window.__GAME_ASSETS={payload};</script>\n'
+    marker = html.find('</head>')
+    if marker < 0:
+        return script + html
+    return html[:marker] + script + html[marker:]
@@ -0,0 +1,201 @@
+'''Push-события Mini App (Server-Sent Events, /game_events).
+
+Клиент держит одно соединение и подписан на темы:
+  user:<id>    — его состояние изменилось (бан, сброс, роль, доступ к главам);
+  leaderboard  — изменился топ рейтинга (payload — тот же, что /game_leaderboard);
+  settings     — техрежим, открытие/расписание глав.
+
+События user/settings — подсказки «перечитай»: клиент делает один
+/game_state (дёшево благодаря ETag/304), а не опрашивает его по таймеру.
+
+EventHub живёт в процессе; publish потокобезопасен (обработчики бота и
+HTTP API работают в разных event loop-ах). При нескольких процессах API
+(GAME_API_WORKERS) события из процесса бота идут через PostgreSQL
+NOTIFY (канал NOTIFY_CHANNEL): hub.set_forwarder направляет publish в NOTIFY,
+а каждый процесс API слушает канал и раздаёт события своим клиентам
+(deliver).
+
+Слушатели (hub.add_listener) получают каждое раздаваемое событие темы в
+своём процессе — так процессы API сбрасывают локальные кэши (расписание
+глав, реферальная сводка) по событиям из процесса бота. Слушатель темы
+USER_TOPICS получает события всех user:<id>; id — в поле user_id события
+(клиенту в кадре SSE не уходит).
+
+Очередь подписчика ограничена и схлопывает события одной темы и причины:
+медленный клиент получает последнее состояние, а не хвост истории.
+'''
+import asyncio
+import json
+import threading
+from collections import OrderedDict
+
+NOTIFY_CHANNEL = 'game_events'
+LEADERBOARD_TOPIC = 'leaderboard'
+SETTINGS_TOPIC = 'settings'
+USER_TOPICS = 'user:*'
+MAX_PENDING = 16
+
+
+def user_topic(user_id) -> str:
+    return f'user:{int(user_id)}'
+
+
+class Subscription:
+    '''Очередь событий одного соединения; методы вызываются в его loop-е.'''
+
+    def __init__(self, loop, topics):
+        self.loop = loop
+        self.topics = frozenset(topics)
+        self._pending: OrderedDict = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self.dropped = 0
+
+    def push(self, topic: str, event: dict) -> None:
+        key = (topic, event.get('reason'))
+        if key in self._pending:
+            del self._pending[key]
+        elif len(self._pending) >= MAX_PENDING:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[key] = (topic, event)
+        self._wakeup.set()
+
+    async def next(self, timeout: float) -> list:
+        '''События, накопленные к моменту пробуждения; [] — по таймауту (heartbeat).'''
+        if not self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        self._wakeup.clear()
+        events = list(self._pending.values())
+        self._pending.clear()
+        return events
+
+
+class EventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: dict[str, set] = {}
+        self._forward = None
+        self._listeners: dict[str, list] = {}
+        self.published = 0
+        self.delivered = 0
+        self.forward_errors = 0
+
+    def set_forwarder(self, forward) -> None:
+        '''forward(topic, event) — отправка во внешний канал вместо локальной раздачи.'''
+        self._forward = forward
+
+    def add_listener(self, topic: str, callback) -> None:
+        '''callback(event) на каждое событие темы (USER_TOPICS — любой user:<id>),
+        раздаваемое в этом процессе.'''
+        with self._lock:
+            self._listeners.setdefault(topic, []).append(callback)
+
+    @property
+    def backend(self) -> str:
+        return 'postgres' if self._forward else 'memory'
+
+    def subscribe(self, topics) -> Subscription:
+        sub = Subscription(asyncio.get_running_loop(), topics)
+        with self._lock:
+            for topic in sub.topics:
+                self._subs.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._subs.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subs[topic]
+
+    def has_subscribers(self, topic: str) -> bool:
+        return bool(self._subs.get(topic))
+
+    def publish(self, topic: str, event: dict) -> None:
+        '''Событие для всех процессов API: через forwarder, если он задан.'''
+        self.published += 1
+        if self._forward is not None:
+            try:
+                self._forward(topic, event)
+                return
+            except Exception:
+                self.forward_errors += 1
+        self.deliver(topic, event)
+
+    def deliver(self, topic: str, event: dict) -> int:
+        '''Раздаёт событие подписчикам этого процесса (из любого потока).'''
+        with self._lock:
+            subs = list(self._subs.get(topic, ()))
+            listeners = list(self._listeners.get(topic, ()))
+            if topic.startswith('user:'):
+                listeners += self._listeners.get(USER_TOPICS, ())
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception:
+                continue
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub.push, topic, event)
+            except RuntimeError:
+                # loop соединения уже закрыт — отпишется в своём finally.
+                continue
+        self.delivered += len(subs)
+        return len(subs)
+
+    def deliver_notify(self, payload: str) -> None:
+        '''Обработчик NOTIFY: payload — JSON {"topic", "event"} из encode_notify.'''
+        try:
+            data = json.loads(payload)
+            self.deliver(str(data['topic']), dict(data['event']))
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            clients = len({sub for subs in self._subs.values() for sub in subs})
+            topics = len(self._subs)
+        return {
+            'backend': self.backend,
+            'clients': clients,
+            'topics': topics,
+            'published': self.published,
+            'delivered': self.delivered,
+            'forward_errors': self.forward_errors,
+        }
+
+
+hub = EventHub()
+
+
+def encode_notify(topic: str, event: dict) -> str:
+    return json.dumps({'topic': topic, 'event': event}, ensure_ascii=False, separators=(',', ':'))
+
+
+def publish_user(user_id, reason: str, **data) -> None:
+    '''Подсказка клиенту игрока перечитать состояние.'''
+    try:
+        topic = user_topic(user_id)
+    except (TypeError, ValueError):
+        return
+    hub.publish(topic, dict(data, type='state', reason=reason, user_id=int(user_id)))
+
+
+def publish_settings(reason: str, **data) -> None:
+    '''Глобальные настройки игры (техрежим, главы) изменились.'''
+    hub.publish(SETTINGS_TOPIC, dict(data, type='settings', reason=reason))
+
+
+def format_sse(topic: str, event: dict) -> bytes:
+    '''Кадр SSE: event: <тема без id пользователя>, data: JSON.'''
+    name = topic
+    if topic.startswith('user:'):
+        name = 'state'
+        event = {k: v for k, v in event.items() if k != 'user_id'}
+    data = json.dumps(event, ensure_ascii=False, separators=(',', ':'), default=str)
+    return f'event: {name}\ndata: {data}\n\n'.encode('utf-8')
@@ -1,13 +1,25 @@
+import functools
 import hashlib
 import hmac
 import json
 import re
+import threading
 import time
 import urllib.parse
+from collections import OrderedDict
 
 MAX_INIT_DATA_LEN = 8192
 MAX_USER_JSON_LEN = 4096
 MAX_ALLOWED_FUTURE_SKEW_SEC = 30
+INIT_DATA_CACHE_SIZE = 4096
+
+_HASH_PARAM_RE = re.compile(r"(?:^|&)hash=([0-9a-f]{64})(?:&|$)")
+
+# hash -> (init_data_raw, bot_token, auth_date, user_id): успешные проверки.
+# Запись живёт до auth_date + max_age_sec (проверяется при каждом попадании).
+_init_data_cache: "OrderedDict[str, tuple[str, str, int, int]]" = OrderedDict()
+_init_data_cache_lock = threading.Lock()
+_init_data_cache_stats = {"hits": 0, "misses": 0}
 
 
 def is_stale_sync_token(client_token: int, server_token: int) -> bool:
@@ -21,98 +33,251 @@ def is_stale_sync_token(client_token: int, server_token: int) -> bool:
     return s > 0 and c > 0 and c != s
 
 
+@functools.lru_cache(maxsize=8)
+def _webapp_secret_key(bot_token: str) -> bytes:
+    """secret_key = HMAC("WebAppData", bot_token) — один раз на токен."""
+    return hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _check_auth_window(auth_date: int, max_age_sec, now_ts) -> str:
+    try:
+        ttl = int(max_age_sec)
+    except Exception:
+        ttl = 86400
+    if ttl <= 0:
+        ttl = 86400
+
+    now = int(now_ts if now_ts is not None else time.time())
+    if auth_date > now + MAX_ALLOWED_FUTURE_SKEW_SEC:
+        return "future_auth_date"
+    if now - auth_date > ttl:
+        return "expired"
+    return "ok"
+
+
+def _check_expected_user(
+    auth_user_id: int, expected_user_id, auth_date: int
+) -> tuple[bool, str, int | None, int | None]:
+    if expected_user_id is not None:
+        try:
+            expected_uid = int(expected_user_id)
+        except Exception:
+            return False, "bad_expected_user_id", auth_user_id, auth_date
+        if expected_uid <= 0:
+            return False, "bad_expected_user_id", auth_user_id, auth_date
+        if expected_uid != auth_user_id:
+            return False, "user_mismatch", auth_user_id, auth_date
+    return True, "ok", auth_user_id, auth_date
+
+
+def _cached_init_data(init_data_raw: str, bot_token: str) -> tuple[int, int] | None:
+    match = _HASH_PARAM_RE.search(init_data_raw)
+    if not match:
+        return None
+    with _init_data_cache_lock:
+        entry = _init_data_cache.get(match.group(1))
+        # Сравнение всей строки: подпись не должна «переноситься» на другие поля.
+        if entry is None or entry[0] != init_data_raw or entry[1] != bot_token:
+            return None
+        _init_data_cache.move_to_end(match.group(1))
+        return entry[2], entry[3]
+
+
+def _remember_init_data(recv_hash: str, init_data_raw: str, bot_token: str, auth_date: int, user_id: int) -> None:
+    with _init_data_cache_lock:
+        _init_data_cache[recv_hash] = (init_data_raw, bot_token, auth_date, user_id)
+        _init_data_cache.move_to_end(recv_hash)
+        while len(_init_data_cache) > INIT_DATA_CACHE_SIZE:
+            _init_data_cache.popitem(last=False)
+
+
+def _forget_init_data(init_data_raw: str) -> None:
+    match = _HASH_PARAM_RE.search(init_data_raw)
+    if match:
+        with _init_data_cache_lock:
+            _init_data_cache.pop(match.group(1), None)
+
+
+def init_data_cache_stats() -> dict:
+    with _init_data_cache_lock:
+        return {"size": len(_init_data_cache), **_init_data_cache_stats}
+
+
+def clear_init_data_cache() -> None:
+    with _init_data_cache_lock:
+        _init_data_cache.clear()
+        _init_data_cache_stats["hits"] = _init_data_cache_stats["misses"] = 0
+
+
 def validate_webapp_init_data(
     init_data_raw: str,
     bot_token: str,
     expected_user_id: int | None = None,
     max_age_sec: int = 86400,
     now_ts: int | None = None,
-) -> tuple[bool, str, int | None]:
+    use_cache: bool = True,
+) -> tuple[bool, str, int | None, int | None]:
     """
     Validate Telegram WebApp initData signature and age.
-    Returns: (ok, reason, user_id_from_init_data)
+    Returns: (ok, reason, user_id_from_init_data, auth_date)
+
+    Successful signature checks are cached by hash (LRU, INIT_DATA_CACHE_SIZE);
+    a cache hit re-checks only the age window and expected_user_id.
     """
     if not bot_token:
-        return False, "missing_bot_token", None
+        return False, "missing_bot_token", None, None
     if not init_data_raw:
-        return False, "missing_init_data", None
+        return False, "missing_init_data", None, None
     if len(init_data_raw) > MAX_INIT_DATA_LEN:
-        return False, "init_data_too_large", None
+        return False, "init_data_too_large", None, None
+
+    if use_cache:
+        cached = _cached_init_data(init_data_raw, bot_token)
+        if cached is not None:
+            auth_date, auth_user_id = cached
+            window = _check_auth_window(auth_date, max_age_sec, now_ts)
+            if window != "ok":
+                if window == "expired":
+                    _forget_init_data(init_data_raw)
+                return False, window, None, None
+            with _init_data_cache_lock:
+                _init_data_cache_stats["hits"] += 1
+            return _check_expected_user(auth_user_id, expected_user_id, auth_date)
+        with _init_data_cache_lock:
+            _init_data_cache_stats["misses"] += 1
 
     try:
         pairs: list[tuple[str, str]] = urllib.parse.parse_qsl(
             init_data_raw, keep_blank_values=True, strict_parsing=False
         )
     except Exception:
-        return False, "bad_init_data_format", None
+        return False, "bad_init_data_format", None, None
     if not pairs:
-        return False, "empty_init_data", None
+        return False, "empty_init_data", None, None
 
     data: dict[str, str] = {}
     for key, value in pairs:
         # Защита от неоднозначной интерпретации query-string.
         if key in data:
-            return False, "duplicate_key", None
+            return False, "duplicate_key", None, None
         data[key] = value
 
     recv_hash = data.pop("hash", None)
     if not recv_hash:
-        return False, "missing_hash", None
+        return False, "missing_hash", None, None
     if not re.fullmatch(r"[0-9a-f]{64}", recv_hash):
-        return False, "bad_hash_format", None
+        return False, "bad_hash_format", None, None
 
     data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data.items()))
-    secret_key = hmac.new(
-        b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256
-    ).digest()
     calc_hash = hmac.new(
-        secret_key, data_check_string.encode("utf-8"), hashlib.sha256
+        _webapp_secret_key(bot_token), data_check_string.encode("utf-8"), hashlib.sha256
     ).hexdigest()
     if not hmac.compare_digest(calc_hash, recv_hash):
-        return False, "bad_hash", None
+        return False, "bad_hash", None, None
 
     auth_date_raw = data.get("auth_date")
     try:
         auth_date = int(auth_date_raw or 0)
     except Exception:
-        return False, "bad_auth_date", None
+        return False, "bad_auth_date", None, None
     if auth_date <= 0:
-        return False, "missing_auth_date", None
+        return False, "missing_auth_date", None, None
 
-    try:
-        ttl = int(max_age_sec)
-    except Exception:
-        ttl = 86400
-    if ttl <= 0:
-        ttl = 86400
-
-    now = int(now_ts if now_ts is not None else time.time())
-    if auth_date > now + MAX_ALLOWED_FUTURE_SKEW_SEC:
-        return False, "future_auth_date", None
-    if now - auth_date > ttl:
-        return False, "expired", None
+    window = _check_auth_window(auth_date, max_age_sec, now_ts)
+    if window != "ok":
+        return False, window, None, None
 
     user_raw = data.get("user")
     if not user_raw:
-        return False, "missing_user", None
+        return False, "missing_user", None, None
     if len(user_raw) > MAX_USER_JSON_LEN:
-        return False, "user_json_too_large", None
+        return False, "user_json_too_large", None, None
     try:
         user_obj = json.loads(user_raw)
         auth_user_id = int(user_obj.get("id"))
     except Exception:
-        return False, "bad_user_json", None
+        return False, "bad_user_json", None, None
     if auth_user_id <= 0:
-        return False, "bad_user_id", None
+        return False, "bad_user_id", None, None
 
-    if expected_user_id is not None:
-        try:
-            expected_uid = int(expected_user_id)
-        except Exception:
-            return False, "bad_expected_user_id", auth_user_id
-        if expected_uid <= 0:
-            return False, "bad_expected_user_id", auth_user_id
-        if expected_uid != auth_user_id:
-            return False, "user_mismatch", auth_user_id
+    if use_cache:
+        _remember_init_data(recv_hash, init_data_raw, bot_token, auth_date, auth_user_id)
+    return _check_expected_user(auth_user_id, expected_user_id, auth_date)
+
+
+@functools.lru_cache(maxsize=8)
+def _game_session_key(bot_token: str) -> bytes:
+    return hmac.new(b"GameSession", bot_token.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _game_session_sig(bot_token: str, body: str) -> str:
+    return hmac.new(_game_session_key(bot_token), body.encode("ascii"), hashlib.sha256).hexdigest()[:32]
+
+
+def issue_game_session_token(
+    user_id: int,
+    bot_token: str,
+    ttl_sec: int = 3600,
+    now_ts: int | None = None,
+    expires_at: int | None = None,
+) -> str:
+    """
+    Short-lived session token issued after a successful initData check.
+    Format: "<user_id>.<expires_at>.<hmac>" (~50 bytes instead of up to 8 KB of initData).
+    expires_at, if given, overrides now + ttl_sec.
+    """
+    if expires_at is None:
+        now = int(now_ts if now_ts is not None else time.time())
+        expires_at = now + max(1, int(ttl_sec))
+    body = f"{int(user_id)}.{int(expires_at)}"
+    return f"{body}.{_game_session_sig(bot_token, body)}"
+
+
+def game_session_expires_at(
+    auth_date: int,
+    auth_ttl_sec: int,
+    session_ttl_sec: int,
+    now_ts: int | None = None,
+    step_sec: int = 300,
+) -> int:
+    """
+    Expiry for a session token minted from initData signed at auth_date:
+    now + session_ttl_sec, but never past the initData's own expiry
+    (auth_date + auth_ttl_sec). Rounded down to step_sec so the token (and the
+    /game_state ETag) does not change every second. A result <= now means the
+    initData is about to expire and no token should be issued.
+    """
+    now = int(now_ts if now_ts is not None else time.time())
+    expires_at = min(now + max(1, int(session_ttl_sec)), int(auth_date) + max(1, int(auth_ttl_sec)))
+    step = max(1, int(step_sec))
+    return expires_at // step * step
 
-    return True, "ok", auth_user_id
+
+def verify_game_session_token(
+    token: str,
+    bot_token: str,
+    expected_user_id: int,
+    now_ts: int | None = None,
+) -> tuple[bool, str]:
+    """
+    Constant-time check of a token from issue_game_session_token.
+    Returns: (ok, reason)
+    """
+    if not bot_token:
+        return False, "missing_bot_token"
+    if not token or len(token) > 64 or not token.isascii():
+        return False, "bad_session"
+    body, _, sig = token.rpartition(".")
+    if not hmac.compare_digest(_game_session_sig(bot_token, body), sig):
+        return False, "bad_session"
+    uid_raw, _, exp_raw = body.partition(".")
+    try:
+        if int(uid_raw) != int(expected_user_id):
+            return False, "user_mismatch"
+        expires_at = int(exp_raw)
+    except Exception:
+        return False, "bad_session"
+    now = int(now_ts if now_ts is not None else time.time())
+    if now >= expires_at:
+        return False, "session_expired"
+    return True, "ok"
@@ -0,0 +1,157 @@
+'''JSON-ответы API игры: быстрый энкодер и сжатие по Accept-Encoding.
+
+Энкодер выбирается GAME_JSON_ENCODER: auto (orjson, если установлен,
+иначе json), orjson или json. Версия на stdlib пишет компактно и без
+\\u-экранирования кириллицы — это уже заметно меньше json_response.
+
+Сжатие: gzip или deflate — то, что клиент указал в Accept-Encoding (gzip
+в приоритете); тела короче min_size отдаются как есть, на них заголовки
+дороже выигрыша.
+
+Версии разделов: крупные разделы ответа (рефералы, секретные миссии,
+расписание) получают короткий хэш в payload['versions']; клиент присылает
+версии, которые у него уже есть (have), и совпавшие разделы не передаются.
+Если сервер знает версию раздела без чтения данных (кэш), раздел не
+читается вовсе: он передаётся в apply_section_versions как current.
+'''
+import hashlib
+import json
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
+
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 5
+
+
+def _dumps_json(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _dumps_orjson(payload) -> bytes:
+    return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS = {'json': _dumps_json}
+if orjson is not None:
+    ENCODERS['orjson'] = _dumps_orjson
+
+
+def pick_encoder(name: str | None = None):
+    '''(имя, функция) энкодера; неизвестное или недоступное имя — auto.'''
+    name = (name or os.environ.get('GAME_JSON_ENCODER', 'auto')).strip().lower()
+    if name not in ENCODERS:
+        name = 'orjson' if 'orjson' in ENCODERS else 'json'
+    return name, ENCODERS[name]
+
+
+ENCODER_NAME, dumps = pick_encoder()
+
+
+def accepted_encodings(accept_encoding: str | None) -> set:
+    '''Кодировки из Accept-Encoding, кроме явно запрещённых (q=0).'''
+    accepted = set()
+    for part in (accept_encoding or '').lower().split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip()
+        if not token:
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(token)
+    return accepted
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    '''gzip / deflate / None по заголовку Accept-Encoding (q=0 — отказ).'''
+    accepted = accepted_encodings(accept_encoding)
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    if 'deflate' in accepted:
+        return 'deflate'
+    return None
+
+
+def compress(body: bytes, encoding: str, level: int = COMPRESS_LEVEL) -> bytes:
+    if encoding == 'gzip':
+        co = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        co = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    return co.compress(body) + co.flush()
+
+
+def compress_body(body: bytes, accept_encoding: str | None = None,
+                  min_size: int = COMPRESS_MIN_BYTES) -> tuple[bytes, str | None]:
+    '''(тело, Content-Encoding | None): сжатие уже закодированного JSON.'''
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= min_size else None
+    if encoding is None:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+def encode_body(payload, accept_encoding: str | None = None,
+                min_size: int = COMPRESS_MIN_BYTES) -> tuple[bytes, str | None]:
+    '''(тело, Content-Encoding | None) для ответа с payload.'''
+    return compress_body(dumps(payload), accept_encoding, min_size)
+
+
+def etag_for(body: bytes) -> str:
+    '''Слабый ETag по несжатому телу: одинаков для gzip/deflate/identity.'''
+    return 'W/"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith('W/') else tag) == opaque:
+            return True
+    return False
+
+
+def section_version(value) -> str:
+    '''Короткий хэш раздела ответа.'''
+    return hashlib.blake2b(_dumps_json(value), digest_size=6).hexdigest()
+
+
+def parse_have(value) -> dict:
+    '''Версии разделов клиента: dict из тела запроса или "ref:ab12,secret:cd34" из query.'''
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, str):
+        items = (part.partition(':')[::2] for part in value.split(','))
+    else:
+        return {}
+    return {str(k).strip(): str(v).strip() for k, v in items if str(k).strip() and str(v).strip()}
+
+
+def apply_section_versions(payload: dict, sections: dict, have: dict | None = None,
+                           current: dict | None = None) -> dict:
+    '''Добавляет payload['versions'] и убирает разделы, версия которых уже есть у клиента.
+
+    sections: {имя: (ключи payload, ...)}; раздел учитывается, только если
+    в payload есть все его ключи (ответы с ошибкой/stale разделов не содержат).
+    current: {имя: версия} разделов, которые не читались — версия у клиента
+    актуальна; их ключей в payload нет, версия передаётся как есть.'''
+    have = have or {}
+    versions = {name: version for name, version in (current or {}).items() if name in sections}
+    for name, keys in sections.items():
+        if not all(key in payload for key in keys):
+            continue
+        version = section_version([payload[key] for key in keys])
+        versions[name] = version
+        if have.get(name) == version:
+            for key in keys:
+                payload.pop(key, None)
+    if versions:
+        payload['versions'] = versions
+    return payload
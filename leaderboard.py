@@ -0,0 +1,158 @@
+'''Рейтинг «Шифровальщика» в памяти процесса.
+
+Строки загружаются из БД при старте (database.leaderboard_reload) и
+обновляются точечно после commit-а функций, меняющих очки, роли и баны;
+периодическая сверка с БД подчищает расхождения (запись из другого процесса,
+гонка двух commit-ов). Чтение топа и числа игроков — без похода в БД.
+
+Строка: (user_id, user_name, total_score, completed, game_over, banned, role,
+achievement_count, achievement_pts, updated_at). Порядок внутри группы —
+(total_score DESC, updated_at ASC), как ORDER BY в SQL-версиях.
+
+Ключи групп — отсортированные списки (bisect): место игрока ищется за
+O(log n), вставка/удаление — сдвиг массива указателей (memmove), что
+на размерах школьного рейтинга быстрее любой древовидной структуры на Python.
+'''
+import bisect
+import threading
+import time
+from datetime import datetime
+
+# Группы в порядке вывода get_game_leaderboard_with_roles.
+_GROUPS = ('admin', 'tester', 'public')
+
+
+def _ts(value) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _group(row) -> str | None:
+    '''admin/tester видны в админском рейтинге всегда, остальные — только с очками.'''
+    if row[5]:
+        return None
+    role = row[6] or 'player'
+    if role in ('admin', 'tester'):
+        return role
+    return 'public' if int(row[2] or 0) > 0 else None
+
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: dict[int, tuple] = {}
+        self._sorted: dict[str, list] = {g: [] for g in _GROUPS}
+        self._placed: dict[int, tuple] = {}   # user_id -> (group, key)
+        self._players: list = []              # ключи public c role == 'player' (ранг)
+        self.loaded_at = 0.0
+        self.updates = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at > 0
+
+    def _normalize(self, row) -> tuple:
+        return (
+            int(row[0]), row[1], int(row[2] or 0), int(row[3] or 0), bool(row[4]),
+            bool(row[5]), row[6] or 'player', int(row[7] or 0), int(row[8] or 0), _ts(row[9]),
+        )
+
+    def _remove_locked(self, user_id: int) -> None:
+        placed = self._placed.pop(user_id, None)
+        row = self._rows.pop(user_id, None)
+        if placed is None:
+            return
+        group, key = placed
+        keys = self._sorted[group]
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+        if group == 'public' and row is not None and row[6] == 'player':
+            i = bisect.bisect_left(self._players, key)
+            if i < len(self._players) and self._players[i] == key:
+                del self._players[i]
+
+    def _put_locked(self, row: tuple) -> None:
+        user_id = row[0]
+        self._remove_locked(user_id)
+        group = _group(row)
+        if group is None:
+            return
+        key = (-row[2], row[9], user_id)
+        bisect.insort(self._sorted[group], key)
+        self._placed[user_id] = (group, key)
+        self._rows[user_id] = row
+        if group == 'public' and row[6] == 'player':
+            bisect.insort(self._players, key)
+
+    def load(self, rows) -> None:
+        '''Полная замена содержимого (старт и периодическая сверка).'''
+        fresh = Leaderboard()
+        for row in rows:
+            fresh._put_locked(self._normalize(row))
+        with self._lock:
+            self._rows, self._sorted = fresh._rows, fresh._sorted
+            self._placed, self._players = fresh._placed, fresh._players
+            self.loaded_at = time.time()
+
+    def apply(self, rows) -> None:
+        '''Точечное обновление строк, прочитанных после записи.'''
+        rows = [self._normalize(r) for r in rows]
+        with self._lock:
+            for row in rows:
+                self._put_locked(row)
+            self.updates += len(rows)
+
+    def top(self, limit: int = 20) -> list:
+        '''Публичный топ: как get_game_leaderboard (без admin/tester и нулевых очков).'''
+        with self._lock:
+            return [self._public_row(self._rows[k[2]]) for k in self._sorted['public'][:max(0, int(limit))]]
+
+    def top_with_roles(self, limit: int = 20) -> list:
+        '''admin → tester → остальные, как get_game_leaderboard_with_roles.'''
+        limit = max(0, int(limit))
+        result = []
+        with self._lock:
+            for group in _GROUPS:
+                for key in self._sorted[group]:
+                    if len(result) >= limit:
+                        return result
+                    row = self._rows[key[2]]
+                    result.append((row[0], row[1], row[2], row[3], row[4], row[6]))
+        return result
+
+    def players_count(self) -> int:
+        '''Участники рейтинга с role=player (как get_game_players_count).'''
+        with self._lock:
+            return len(self._players)
+
+    def rank(self, user_id) -> tuple:
+        '''(место, всего игроков) среди role=player, либо (None, всего) — как get_game_player_rank.'''
+        with self._lock:
+            total = len(self._players)
+            placed = self._placed.get(int(user_id))
+            row = self._rows.get(int(user_id))
+            if placed is None or placed[0] != 'public' or row[6] != 'player':
+                return None, total
+            return bisect.bisect_left(self._players, placed[1]) + 1, total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'rows': len(self._rows),
+                'players': len(self._players),
+                'updates': self.updates,
+                'loaded_at': int(self.loaded_at),
+            }
+
+    @staticmethod
+    def _public_row(row: tuple) -> tuple:
+        return (row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[8])
+
+
+board = Leaderboard()
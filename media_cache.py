@@ -0,0 +1,187 @@
+'''Дисковый кэш аудио для /game_media.
+
+Треки из GAME_AUDIO_TRACKS один раз скачиваются потоком во временный файл
+и атомарно (os.replace) переносятся в каталог кэша; дальше ответы, включая
+Range, отдаются с диска (FileResponse/sendfile) без похода к источнику.
+
+Первое скачивание — single-flight: пока трек качается, остальные запросы
+того же трека ждут этот же future, а не открывают свои соединения.
+
+Объём ограничен max_bytes; при переполнении удаляются давно не читанные
+файлы (LRU по времени последнего доступа, порядок переживает рестарт через
+mtime). Трек крупнее max_file_bytes не кэшируется — его отдаёт прокси
+потоком; такие треки запоминаются (uncacheable) и больше не скачиваются.
+
+Рядом с файлом лежит <track>.meta (JSON: content_type, etag, size).
+'''
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+FETCH_CHUNK_BYTES = 64 * 1024
+
+
+class TooLarge(Exception):
+    '''Трек больше max_file_bytes: не кэшируем.'''
+
+
+async def httpx_fetch(url: str, dest: str, max_bytes: int, client) -> dict:
+    '''Скачивает url в dest потоком; метаданные ответа источника.'''
+    async with client.stream('GET', url) as upstream:
+        if upstream.status_code != 200:
+            raise RuntimeError(f'upstream status {upstream.status_code}')
+        declared = int(upstream.headers.get('content-length') or 0)
+        if declared > max_bytes:
+            raise TooLarge(declared)
+        size = 0
+        with open(dest, 'wb') as fh:
+            async for chunk in upstream.aiter_bytes(FETCH_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise TooLarge(size)
+                fh.write(chunk)
+        return {
+            'content_type': upstream.headers.get('content-type') or 'application/octet-stream',
+            'etag': upstream.headers.get('etag') or '',
+            'size': size,
+        }
+
+
+class MediaCache:
+    def __init__(self, cache_dir: str, max_bytes: int, fetch, max_file_bytes: int | None = None):
+        '''fetch(url, dest, max_bytes) -> meta — корутина скачивания (см. httpx_fetch).'''
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.max_file_bytes = int(max_file_bytes or max_bytes)
+        self._fetch = fetch
+        self._lru: OrderedDict = OrderedDict()   # track_id -> (size, meta)
+        self._inflight: dict = {}
+        self._uncacheable: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _path(self, track_id: str) -> str:
+        return os.path.join(self.cache_dir, track_id)
+
+    def _scan(self) -> None:
+        '''Восстанавливает LRU по файлам каталога (старые сначала); недокачанные удаляет.'''
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                _unlink(path)
+                continue
+            if name.endswith('.meta'):
+                continue
+            try:
+                with open(path + '.meta', encoding='utf-8') as fh:
+                    meta = json.load(fh)
+                st = os.stat(path)
+            except (OSError, ValueError):
+                _unlink(path)
+                continue
+            if st.st_size != meta.get('size'):
+                _unlink(path)
+                continue
+            found.append((st.st_mtime, name, st.st_size, meta))
+        for _, name, size, meta in sorted(found):
+            self._lru[name] = (size, meta)
+        self._evict()
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(size for size, _ in self._lru.values())
+
+    def _evict(self, keep: str | None = None) -> None:
+        used = self.used_bytes
+        for track_id in list(self._lru):
+            if used <= self.max_bytes:
+                break
+            if track_id == keep:
+                continue
+            size, _ = self._lru.pop(track_id)
+            _unlink(self._path(track_id))
+            _unlink(self._path(track_id) + '.meta')
+            used -= size
+            self.evictions += 1
+
+    def lookup(self, track_id: str):
+        '''(путь, meta) уже скачанного трека или None; отмечает доступ.'''
+        entry = self._lru.get(track_id)
+        if entry is None:
+            return None
+        path = self._path(track_id)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Удалён извне (другой воркер вытеснил) — перекачаем.
+            self._lru.pop(track_id, None)
+            return None
+        self._lru.move_to_end(track_id)
+        return path, entry[1]
+
+    async def get(self, track_id: str, url: str):
+        '''(путь, meta) трека; при промахе — одно скачивание на всех ждущих.
+        None — трек не кэшируется (TooLarge), отдавать через прокси.'''
+        if track_id in self._uncacheable:
+            return None
+        found = self.lookup(track_id)
+        if found is not None:
+            self.hits += 1
+            return found
+        pending = self._inflight.get(track_id)
+        if pending is None:
+            self.misses += 1
+            pending = asyncio.ensure_future(self._fill(track_id, url))
+            self._inflight[track_id] = pending
+            pending.add_done_callback(lambda _f: self._inflight.pop(track_id, None))
+        return await asyncio.shield(pending)
+
+    async def _fill(self, track_id: str, url: str):
+        path = self._path(track_id)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            meta = await self._fetch(url, tmp, self.max_file_bytes)
+        except TooLarge:
+            _unlink(tmp)
+            self._uncacheable.add(track_id)
+            return None
+        except BaseException:
+            _unlink(tmp)
+            self.errors += 1
+            raise
+        meta = dict(meta, size=os.path.getsize(tmp), fetched_at=int(time.time()))
+        with open(tmp + '.meta', 'w', encoding='utf-8') as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, path)
+        os.replace(tmp + '.meta', path + '.meta')
+        self._lru[track_id] = (meta['size'], meta)
+        self._lru.move_to_end(track_id)
+        self._evict(keep=track_id)
+        return path, meta
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self._lru),
+            'bytes': self.used_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'errors': self.errors,
+            'inflight': len(self._inflight),
+            'uncacheable': len(self._uncacheable),
+        }
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
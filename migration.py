@@ -1 +1,53 @@
+#!/usr/bin/env python3
+"""Миграции схемы БД (schema_version).
 
+    python migration.py status        # текущая версия и недостающие шаги
+    python migration.py up [--to N]   # применить недостающие шаги
+
+Запускается до деплоя (railway.toml → preDeployCommand), поэтому init_db
+при старте бота обычно ограничивается одним SELECT.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+
+import database as db
+
+
+def cmd_status() -> int:
+    status = db.get_schema_status()
+    print(f"schema: v{status['current']} (latest v{status['latest']})")
+    for version, name in status['pending']:
+        print(f"  pending v{version}: {name}")
+    return 0
+
+
+def cmd_up(target: int | None) -> int:
+    applied = db.migrate(target)
+    if applied:
+        print(f"applied: {', '.join(f'v{v}' for v in applied)}")
+    else:
+        print("schema already up to date")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="показать версию схемы")
+    up = sub.add_parser("up", help="применить недостающие миграции")
+    up.add_argument("--to", type=int, default=None, help="целевая версия (по умолчанию последняя)")
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "status":
+            return cmd_status()
+        return cmd_up(args.to)
+    except Exception as exc:  # pragma: no cover
+        print(f"ERROR: {exc}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
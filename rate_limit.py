@@ -0,0 +1,170 @@
+'''Ограничение частоты запросов к API игры.
+
+Счётчик «два окна» (sliding window counter): на ключ хранятся номер текущего
+окна и два числа — хиты текущего и предыдущего окна. Оценка числа запросов
+за последние window_sec секунд:
+
+    prev * (1 - доля прошедшего текущего окна) + cur
+
+Память на ключ и время проверки — O(1); устаревшие ключи удаляет фоновый
+поток (sweep по таймеру), а не сам запрос.
+
+Бэкенды:
+  memory   — счётчики в процессе (один воркер API);
+  postgres — общая UNLOGGED-таблица rate_limit_counters, чтобы несколько
+             воркеров соблюдали один лимит (см. database_async.rate_limit_hit).
+'''
+import threading
+import time
+
+# Лимиты по умолчанию: endpoint -> (запросов, окно в секундах).
+DEFAULT_LIMITS = {
+    'game_state': (60, 60),
+    'game_sync': (30, 60),
+    'game_sync_batch': (30, 60),
+}
+
+
+def parse_limits(spec: str, defaults: dict | None = None) -> dict:
+    '''"game_state=60/60,game_sync=30" -> {endpoint: (limit, window_sec)} поверх defaults.
+    Окно по умолчанию — 60 с; некорректные элементы пропускаются.'''
+    limits = dict(DEFAULT_LIMITS if defaults is None else defaults)
+    for item in (spec or '').split(','):
+        name, sep, value = item.strip().partition('=')
+        if not sep or not name.strip():
+            continue
+        limit_raw, _, window_raw = value.strip().partition('/')
+        try:
+            limit = int(limit_raw)
+            window = int(window_raw) if window_raw.strip() else 60
+        except ValueError:
+            continue
+        if limit > 0 and window > 0:
+            limits[name.strip()] = (limit, window)
+    return limits
+
+
+def window_estimate(prev_hits: int, cur_hits: int, elapsed: float, window_sec: int) -> float:
+    '''Оценка числа запросов за скользящее окно по двум фиксированным.'''
+    weight = max(0.0, 1.0 - elapsed / float(window_sec))
+    return prev_hits * weight + cur_hits
+
+
+class MemoryBackend:
+    '''Счётчики в памяти процесса: key -> [номер окна, prev, cur, window_sec].'''
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict = {}
+
+    async def hit(self, key, window_sec: int, now: float) -> tuple[int, int]:
+        return self.hit_sync(key, window_sec, now)
+
+    def hit_sync(self, key, window_sec: int, now: float) -> tuple[int, int]:
+        idx = int(now // window_sec)
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None:
+                self._counters[key] = [idx, 0, 1, window_sec]
+                return 1, 0
+            if entry[0] != idx:
+                entry[1] = entry[2] if entry[0] == idx - 1 else 0
+                entry[0], entry[2] = idx, 0
+            entry[2] += 1
+            return entry[2], entry[1]
+
+    def sweep(self, now: float | None = None) -> int:
+        '''Удаляет ключи, у которых оба окна в прошлом.'''
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = [k for k, e in self._counters.items() if e[0] < int(now // e[3]) - 1]
+            for key in stale:
+                del self._counters[key]
+        return len(stale)
+
+    def size(self) -> int:
+        return len(self._counters)
+
+
+class SharedBackend:
+    '''Общие счётчики во внешнем хранилище.
+
+    hit_fn(key, window_start, window_sec) -> (cur, prev) | None — корутина
+    (атомарный upsert текущего окна + чтение предыдущего);
+    purge_fn() — синхронная очистка старых окон, вызывается из sweep.
+    При ошибке хранилища (None) запрос пропускается: лимитер не должен
+    ронять API вместе с БД.
+    '''
+
+    name = 'postgres'
+
+    def __init__(self, hit_fn, purge_fn=None):
+        self._hit_fn = hit_fn
+        self._purge_fn = purge_fn
+        self.errors = 0
+
+    async def hit(self, key, window_sec: int, now: float) -> tuple[int, int]:
+        window_start = int(now // window_sec) * window_sec
+        result = await self._hit_fn(key, window_start, window_sec)
+        if result is None:
+            self.errors += 1
+            return 0, 0
+        return int(result[0] or 0), int(result[1] or 0)
+
+    def sweep(self, now: float | None = None) -> int:
+        return int(self._purge_fn() or 0) if self._purge_fn else 0
+
+    def size(self) -> int:
+        return -1
+
+
+class RateLimiter:
+    def __init__(self, backend=None, limits: dict | None = None):
+        self.backend = backend or MemoryBackend()
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.checks = 0
+        self.rejected = 0
+        self._sweeper = None
+
+    async def is_limited(self, endpoint: str, user_id: int, now: float | None = None) -> bool:
+        '''Засчитывает запрос и возвращает True, если лимит endpoint превышен.
+        Для endpoint без настроенного лимита — всегда False.'''
+        rule = self.limits.get(endpoint)
+        if rule is None:
+            return False
+        limit, window_sec = rule
+        now = time.time() if now is None else now
+        cur, prev = await self.backend.hit(f'{endpoint}:{int(user_id)}', window_sec, now)
+        self.checks += 1
+        limited = window_estimate(prev, cur, now % window_sec, window_sec) > limit
+        if limited:
+            self.rejected += 1
+        return limited
+
+    def start_sweeper(self, interval_sec: int = 60) -> None:
+        '''Фоновая очистка устаревших счётчиков раз в interval_sec.'''
+        if self._sweeper is not None or interval_sec <= 0:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(interval_sec)
+                try:
+                    self.backend.sweep()
+                except Exception:
+                    pass
+
+        self._sweeper = threading.Thread(target=_loop, name='rate-limit-sweep', daemon=True)
+        self._sweeper.start()
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.backend.name,
+            'keys': self.backend.size(),
+            'checks': self.checks,
+            'rejected': self.rejected,
+            'errors': getattr(self.backend, 'errors', 0),
+            'limits': {k: f'{v[0]}/{v[1]}s' for k, v in sorted(self.limits.items())},
+        }
@@ -0,0 +1,159 @@
+'''Кэш реферальной сводки и списка агентов в памяти процесса.
+
+get_referral_summary / get_referral_agents читаются на каждый /game_state
+игрока и в меню бота, а меняются редко: привязка или удаление реферальной
+связи, начисление бонуса (очередь пригласивших, бонус приглашённого),
+сброс/бан агента. Функции database.py, меняющие эти данные, помечают
+затронутых пользователей на соединении, и после настоящего commit их записи
+сбрасываются (как строки рейтинга, см. database._leaderboard_stage).
+
+Гонка «чтение из БД до commit, запись в кэш после сброса» закрыта
+номерами: token() берётся до запроса, put() с токеном старше последнего
+сброса пользователя отбрасывается. TTL ограничивает расхождение с тем,
+что меняется без сброса (имя и очки агента). Записи другого процесса
+(GAME_API_WORKERS > 0) сбрасываются по событиям user:<id> из NOTIFY
+(bot._on_remote_user_event).
+
+Там же хранится версия раздела ref ответа /game_state (http_json): пока
+запись не сброшена и не устарела, клиенту с этой версией раздел не читают.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReferralCache:
+    def __init__(self, ttl_sec: float = 60.0, max_users: int = 20000):
+        self.ttl_sec = float(ttl_sec)
+        self.max_users = int(max_users)
+        self._lock = threading.Lock()
+        # user_id -> [stamp, (сводка, ts) | None, (limit, агенты, ts) | None, (версия, ts) | None]
+        self._entries: OrderedDict = OrderedDict()
+        self._seq = 0
+        self._floor = 0   # максимальный stamp среди вытесненных записей
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.rejected = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_sec > 0
+
+    def token(self) -> int:
+        '''Номер, который нужно взять до чтения из БД и передать в put().'''
+        with self._lock:
+            return self._seq
+
+    def _fresh(self, ts: float) -> bool:
+        return time.monotonic() - ts <= self.ttl_sec
+
+    def summary(self, user_id: int) -> dict | None:
+        '''Копия сводки из кэша или None (промах).'''
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(int(user_id))
+            cached = entry[1] if entry is not None else None
+            if cached is None or not self._fresh(cached[1]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(int(user_id))
+            return dict(cached[0])
+
+    def agents(self, user_id: int, limit: int) -> list | None:
+        '''Первые limit агентов из кэша или None (промах).
+
+        Список, прочитанный с большим limit, подходит и для меньшего;
+        неполный (короче своего limit) — для любого.'''
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(int(user_id))
+            cached = entry[2] if entry is not None else None
+            if (cached is None or not self._fresh(cached[2])
+                    or (cached[0] < limit and len(cached[1]) >= cached[0])):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(int(user_id))
+            return [dict(agent) for agent in cached[1][:limit]]
+
+    def version(self, user_id: int) -> str | None:
+        '''Версия раздела ref, сохранённая put(version=...), или None.'''
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(int(user_id))
+            cached = entry[3] if entry is not None else None
+            if cached is None or not self._fresh(cached[1]):
+                return None
+            return cached[0]
+
+    def put(self, user_id: int, token: int, summary: dict | None = None,
+            agents: list | None = None, limit: int = 0, version: str | None = None) -> bool:
+        '''Кладёт прочитанное из БД; False — пользователя сбросили после token().'''
+        if not self.enabled:
+            return False
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if token < (entry[0] if entry is not None else self._floor):
+                self.rejected += 1
+                return False
+            if entry is None:
+                entry = [token, None, None, None]
+                self._entries[user_id] = entry
+            if summary is not None:
+                entry[1] = (dict(summary), now)
+            if agents is not None:
+                entry[2] = (int(limit), [dict(agent) for agent in agents], now)
+            if version is not None:
+                entry[3] = (str(version), now)
+            self._entries.move_to_end(user_id)
+            self.puts += 1
+            self._trim()
+            return True
+
+    def invalidate(self, user_ids) -> None:
+        '''Сбрасывает записи пользователей (вызывать после commit).'''
+        ids = {int(uid) for uid in user_ids or [] if int(uid or 0) > 0}
+        if not ids:
+            return
+        with self._lock:
+            self._seq += 1
+            for uid in ids:
+                self._entries[uid] = [self._seq, None, None, None]
+                self._entries.move_to_end(uid)
+            self.invalidations += len(ids)
+            self._trim()
+
+    def clear(self) -> None:
+        '''Сбрасывает весь кэш (массовый сброс игры).'''
+        with self._lock:
+            self._seq += 1
+            self._floor = self._seq
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def _trim(self) -> None:
+        while len(self._entries) > self.max_users:
+            _, entry = self._entries.popitem(last=False)
+            self._floor = max(self._floor, entry[0])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'ttl_sec': self.ttl_sec,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'puts': self.puts,
+                'rejected': self.rejected,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,206 @@
+'''Слияние прогресс-тиков /game_sync (write-behind).
+
+Большинство /game_sync — type='sync': очки и курсор шифра только растут.
+Такой тик, монотонный относительно предыдущего события игрока, не пишется
+в game_results сразу: сервер отвечает по последнему настоящему ответу
+(с очками тика) и держит тик в буфере window_sec; следующие тики заменяют
+его. Через окно — одна запись последнего тика: для game_sync_apply она
+равносильна всей цепочке (максимумы sync_max_* и total_score те же).
+
+Сразу, в порядке поступления, применяется всё, что слить нельзя:
+chapter_complete, chapter_replay_start, manual_restart, game_over, штраф,
+падение очков или курсора (это сигнал авто-детекта перезапуска), смена
+главы/reset_token и — в секретном режиме — новый ответ миссии. Перед таким
+событием и перед чтением /game_state буфер игрока сбрасывается в БД.
+
+Буфер — в памяти процесса: при падении процесса теряется не больше окна
+прогресса, который клиент и так пришлёт следующим тиком (поля монотонные).
+'''
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Начисления ответа: суммируются по событиям пачки, у отложенного тика — нули.
+AWARD_FIELDS = (
+    'server_penalty_applied', 'ref_bonus_awarded', 'ref_bonus_awarded_inviter',
+    'ref_bonus_awarded_invitee', 'ref_bonus_awarded_upstream', 'secret_awarded_points',
+)
+
+# Должны совпадать у сливаемых тиков.
+_SAME_FIELDS = ('chapter', 'chapter_idx', 'chapter_in_progress', 'client_reset_token', 'secret_mode')
+# Поля секретных миссий: в секретном режиме тик с другим ответом — отдельное событие.
+_SECRET_FIELDS = (
+    'mission_answer_token', 'mission_break_token', 'chapter_errors', 'chapter_hints', 'lives',
+)
+# Могут только расти.
+_MONOTONIC_FIELDS = (
+    'score', 'total_score', 'completed', 'cipher_idx', 'achievement_count', 'achievement_pts',
+)
+
+
+def mergeable(prev: dict, event: dict) -> bool:
+    '''Можно ли записать только event вместо prev, затем event.'''
+    if prev.get('event_type') != 'sync' or event.get('event_type') != 'sync':
+        return False
+    if event.get('game_over') or event.get('restart_penalty_points'):
+        return False
+    fields = _SAME_FIELDS
+    if event.get('secret_mode', 'none') != 'none':
+        fields = fields + _SECRET_FIELDS
+    if any(prev.get(f) != event.get(f) for f in fields):
+        return False
+    return all(event.get(f, 0) >= prev.get(f, 0) for f in _MONOTONIC_FIELDS)
+
+
+def collapse(events: list) -> list:
+    '''[(seq, event, ids)] -> то же, где подряд идущие сливаемые тики заменены
+    последним; ids слитых событий переходят к нему.'''
+    result = []
+    for seq, event, ids in events:
+        if result and mergeable(result[-1][1], event):
+            result[-1] = (seq, event, result[-1][2] + tuple(ids))
+        else:
+            result.append((seq, event, tuple(ids)))
+    return result
+
+
+def deferred_response(response: dict, event: dict) -> dict:
+    '''Ответ на отложенный тик: последний настоящий ответ с очками тика и без начислений.'''
+    out = dict(response)
+    db_score = max(int(response.get('db_score', 0) or 0), int(event.get('total_score', 0) or 0))
+    db_completed = max(int(response.get('db_completed', 0) or 0), int(event.get('completed', 0) or 0))
+    out.update({
+        'saved': {'score': db_score, 'completed': db_completed},
+        'db_score': db_score,
+        'db_completed': db_completed,
+        'secret_awards': [],
+        'force_state': False,
+        'deferred': True,
+    })
+    for key in AWARD_FIELDS:
+        out[key] = 0
+    return out
+
+
+class SyncCoalescer:
+    def __init__(self, window_sec: float, apply_fn, base_ttl_sec: float = 15.0, max_users: int = 20000):
+        '''apply_fn(user_id, init_data_raw, event, ids) -> (ответ, status) — корутина записи.'''
+        self.window_sec = float(window_sec)
+        self.base_ttl_sec = float(base_ttl_sec)
+        self.max_users = int(max_users)
+        self._apply = apply_fn
+        self._base: OrderedDict = OrderedDict()   # user_id -> (event, ответ, ts)
+        self._pending: dict = {}                  # user_id -> [event, init_data_raw, ids, timer]
+        self._locks: dict = {}                    # user_id -> [asyncio.Lock, держателей и ждущих]
+        self._tasks: set = set()                  # записи по таймеру (loop держит задачи слабо)
+        self.deferred = 0
+        self.writes = 0
+        self.errors = 0
+
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id: int):
+        '''Порядок событий игрока в процессе: берётся на время обработки запроса.
+        Замок без держателей и ждущих удаляется.'''
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def remember(self, user_id: int, event: dict, response: dict) -> None:
+        '''Последнее записанное событие и ответ на него — база для следующих тиков.'''
+        if not response.get('ok') or response.get('stale') or response.get('banned'):
+            self._base.pop(user_id, None)
+            return
+        self._base[user_id] = (event, dict(response), time.monotonic())
+        self._base.move_to_end(user_id)
+        while len(self._base) > self.max_users:
+            self._base.popitem(last=False)
+
+    def forget(self, user_id: int) -> None:
+        '''Сброс базы и буфера (reset игрока): отложенный тик не записывается.'''
+        self._base.pop(user_id, None)
+        pending = self._pending.pop(user_id, None)
+        if pending is not None:
+            pending[3].cancel()
+
+    def try_defer(self, user_id: int, init_data_raw: str, event: dict, event_id: str = ''):
+        '''Ответ на отложенный тик или None — событие нужно применить сразу
+        (предварительно вызвав flush_locked). Вызывать под lock(user_id).'''
+        if self.window_sec <= 0:
+            return None
+        base = self._base.get(user_id)
+        if base is None or time.monotonic() - base[2] > self.base_ttl_sec:
+            return None
+        pending = self._pending.get(user_id)
+        if pending is not None and event_id and event_id in pending[2]:
+            # Повтор уже отложенного тика.
+            return deferred_response(base[1], pending[0])
+        prev = pending[0] if pending is not None else base[0]
+        if not mergeable(prev, event):
+            return None
+        if pending is None:
+            timer = asyncio.get_running_loop().call_later(self.window_sec, self._on_timer, user_id)
+            self._pending[user_id] = [event, init_data_raw, (event_id,) if event_id else (), timer]
+        else:
+            pending[0], pending[1] = event, init_data_raw or pending[1]
+            if event_id:
+                pending[2] = pending[2] + (event_id,)
+        self.deferred += 1
+        return deferred_response(base[1], event)
+
+    def _on_timer(self, user_id: int) -> None:
+        task = asyncio.ensure_future(self.flush(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, user_id: int) -> None:
+        async with self.lock(user_id):
+            await self.flush_locked(user_id)
+
+    async def flush_locked(self, user_id: int) -> None:
+        '''Записывает отложенный тик игрока (если есть). Вызывать под lock(user_id).'''
+        pending = self._pending.pop(user_id, None)
+        if pending is None:
+            return
+        event, init_data_raw, ids, timer = pending
+        timer.cancel()
+        try:
+            response, status = await self._apply(user_id, init_data_raw, event, ids)
+        except Exception as e:
+            response, status = {'ok': False, 'error': str(e)}, 500
+        if status == 200:
+            self.writes += 1
+            self.remember(user_id, event, response)
+        else:
+            # Следующий тик клиента несёт те же (или большие) значения.
+            self.errors += 1
+            self._base.pop(user_id, None)
+            logger.warning(f"sync coalescer flush failed: user={user_id}, status={status}")
+
+    async def flush_all(self) -> None:
+        for user_id in list(self._pending):
+            await self.flush(user_id)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'window_ms': int(self.window_sec * 1000),
+            'pending': len(self._pending),
+            'locks': len(self._locks),
+            'users': len(self._base),
+            'deferred': self.deferred,
+            'writes': self.writes,
+            'errors': self.errors,
+        }
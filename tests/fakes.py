@@ -0,0 +1,72 @@
+'''Общие заглушки psycopg2-соединения для тестов database.py.
+
+FakeConnection пишет каждый запрос в statements как (SQL одной строкой,
+params) и отдаёт заранее заданные результаты: results — список
+(фрагмент SQL, ответ), первый фрагмент, входящий в запрос, выигрывает.
+Ответ — список строк, исключение (будет брошено) или callable(conn, params),
+который возвращает строки или бросает сам.
+'''
+from unittest import mock
+
+import psycopg2.extensions
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        text = " ".join(sql.split())
+        self.connection.statements.append((text, params))
+        self._rows = []
+        for fragment, answer in self.connection.results:
+            if fragment in text:
+                if isinstance(answer, BaseException) or (
+                        isinstance(answer, type) and issubclass(answer, BaseException)):
+                    raise answer
+                self._rows = list(answer(self.connection, params) if callable(answer) else answer)
+                break
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class FakeConnection:
+    def __init__(self, results=()):
+        self.results = list(results)
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = 0
+        self.leaderboard_rows = []
+        self.info = mock.Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+    def sql(self, prefix: str = "") -> list:
+        '''Тексты выполненных запросов, начинающиеся с prefix.'''
+        return [text for text, _ in self.statements if text.startswith(prefix)]
+
+    def params(self, prefix: str) -> list:
+        '''Параметры выполненных запросов, начинающихся с prefix.'''
+        return [params for text, params in self.statements if text.startswith(prefix)]
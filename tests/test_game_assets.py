@@ -0,0 +1,51 @@
+import gzip
+import pathlib
+import tempfile
+import unittest
+
+from game_assets import IMMUTABLE, REVALIDATE, AssetStore
+
+
+class GameAssetsTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self._tmp.name)
+        (self.dir / "game.js").write_text("window.__GAME_JS_LOADED = true;\n" * 100, encoding="utf-8")
+        (self.dir / "index.html").write_text("<html><head></head><body></body></html>", encoding="utf-8")
+        (self.dir / ".secret").write_text("x", encoding="utf-8")
+        self.store = AssetStore(self.dir).load()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_hashed_name_is_immutable_and_injected(self):
+        hashed = self.store.manifest(self.store.assets)["game.js"]
+        self.assertRegex(hashed, r"^game\.[0-9a-f]{10}\.js$")
+        status, body, headers = self.store.respond(hashed, "gzip, deflate")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Cache-Control"], IMMUTABLE)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body), (self.dir / "game.js").read_bytes())
+
+        _, html, headers = self.store.respond("index.html")
+        self.assertEqual(headers["Cache-Control"], REVALIDATE)
+        self.assertIn(f'"game.js":"{hashed}"'.encode(), html)
+        self.assertIsNone(self.store.respond(".secret"))
+
+    def test_plain_name_revalidates_with_etag(self):
+        status, body, headers = self.store.respond("game.js")
+        self.assertEqual((status, headers["Cache-Control"]), (200, REVALIDATE))
+        self.assertNotIn("Content-Encoding", headers)
+        status, body, _ = self.store.respond("game.js", "gzip", headers["ETag"])
+        self.assertEqual((status, body), (304, b""))
+
+    def test_hash_changes_with_content(self):
+        before = self.store.manifest(self.store.assets)["game.js"]
+        (self.dir / "game.js").write_text("changed", encoding="utf-8")
+        after = self.store.load().manifest(self.store.assets)["game.js"]
+        self.assertNotEqual(before, after)
+        self.assertIsNone(self.store.respond(before))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+import game_events
+from game_events import EventHub, encode_notify, format_sse, user_topic
+
+
+class GameEventsTests(unittest.TestCase):
+    def test_delivery_by_topic_and_coalescing(self):
+        hub = EventHub()
+
+        async def run():
+            mine = hub.subscribe({user_topic(1), game_events.SETTINGS_TOPIC})
+            other = hub.subscribe({user_topic(2)})
+            hub.publish(user_topic(1), {"type": "state", "reason": "ban"})
+            hub.publish(game_events.SETTINGS_TOPIC, {"type": "settings", "reason": "chapters"})
+            hub.publish(game_events.SETTINGS_TOPIC, {"type": "settings", "reason": "chapters", "n": 2})
+            await asyncio.sleep(0)
+            got = await mine.next(1)
+            self.assertEqual([t for t, _ in got], [user_topic(1), game_events.SETTINGS_TOPIC])
+            self.assertEqual(got[1][1]["n"], 2)
+            self.assertEqual(await other.next(0.01), [])
+            hub.unsubscribe(mine)
+            hub.unsubscribe(other)
+            self.assertEqual(hub.stats()["clients"], 0)
+
+        asyncio.run(run())
+
+    def test_publish_from_other_thread_and_notify(self):
+        hub = EventHub()
+        forwarded = []
+        hub.set_forwarder(lambda topic, event: forwarded.append(encode_notify(topic, event)))
+
+        async def run():
+            sub = hub.subscribe({game_events.SETTINGS_TOPIC})
+            worker = threading.Thread(
+                target=hub.publish, args=(game_events.SETTINGS_TOPIC, {"reason": "maintenance"}))
+            worker.start()
+            worker.join()
+            # Через forwarder событие уходит в NOTIFY и возвращается через deliver_notify.
+            self.assertEqual(await sub.next(0.01), [])
+            hub.deliver_notify(forwarded[0])
+            hub.deliver_notify("not json")
+            return await sub.next(1)
+
+        got = asyncio.run(run())
+        self.assertEqual(got, [(game_events.SETTINGS_TOPIC, {"reason": "maintenance"})])
+        self.assertEqual(hub.backend, "postgres")
+
+    def test_listeners_see_delivered_events(self):
+        hub = EventHub()
+        seen = []
+        hub.add_listener(game_events.SETTINGS_TOPIC, seen.append)
+        hub.add_listener(game_events.SETTINGS_TOPIC, lambda event: 1 / 0)
+        hub.publish(game_events.SETTINGS_TOPIC, {"reason": "chapters"})
+        hub.publish(user_topic(1), {"reason": "ban"})
+        # Через NOTIFY слушатели срабатывают в каждом процессе при deliver.
+        hub.set_forwarder(lambda topic, event: None)
+        hub.publish(game_events.SETTINGS_TOPIC, {"reason": "maintenance"})
+        hub.deliver_notify(encode_notify(game_events.SETTINGS_TOPIC, {"reason": "reset_all"}))
+        self.assertEqual([e["reason"] for e in seen], ["chapters", "reset_all"])
+
+    def test_user_topics_listener_gets_user_id(self):
+        hub = EventHub()
+        seen = []
+        hub.add_listener(game_events.USER_TOPICS, seen.append)
+        hub.set_forwarder(lambda topic, event: None)
+        with mock.patch.object(game_events, "hub", hub):
+            game_events.publish_user(7, "referral_bonus")
+        hub.deliver_notify(encode_notify(user_topic(7), {"reason": "referral_bonus", "user_id": 7}))
+        hub.deliver(game_events.SETTINGS_TOPIC, {"reason": "chapters"})
+        self.assertEqual(seen, [{"reason": "referral_bonus", "user_id": 7}])
+
+    def test_format_sse_hides_user_id(self):
+        frame = format_sse(user_topic(42), {"type": "state", "reason": "ban", "user_id": 42})
+        self.assertEqual(frame, b'event: state\ndata: {"type":"state","reason":"ban"}\n\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,21 @@
 import hashlib
 import hmac
 import json
+import logging
+import os
 import time
 import urllib.parse
 import unittest
 
-from game_security import is_stale_sync_token, validate_webapp_init_data
+from game_security import (
+    clear_init_data_cache,
+    game_session_expires_at,
+    init_data_cache_stats,
+    is_stale_sync_token,
+    issue_game_session_token,
+    validate_webapp_init_data,
+    verify_game_session_token,
+)
 
 
 def _sign_init_data(data: dict, bot_token: str) -> str:
@@ -20,6 +30,9 @@ def _sign_init_data(data: dict, bot_token: str) -> str:
 
 
 class GameSecurityTests(unittest.TestCase):
+    def setUp(self):
+        clear_init_data_cache()
+
     def test_validate_webapp_init_data_ok(self):
         bot_token = "123456:TEST_TOKEN"
         now = int(time.time())
@@ -27,12 +40,13 @@ class GameSecurityTests(unittest.TestCase):
         data = {"auth_date": str(now), "query_id": "AAE", "user": raw_user}
         init_data = _sign_init_data(data, bot_token)
 
-        ok, reason, uid = validate_webapp_init_data(
+        ok, reason, uid, auth_date = validate_webapp_init_data(
             init_data, bot_token, expected_user_id=111, max_age_sec=3600, now_ts=now
         )
         self.assertTrue(ok)
         self.assertEqual(reason, "ok")
         self.assertEqual(uid, 111)
+        self.assertEqual(auth_date, now)
 
     def test_validate_webapp_init_data_bad_hash(self):
         bot_token = "123456:TEST_TOKEN"
@@ -41,7 +55,7 @@ class GameSecurityTests(unittest.TestCase):
         data = {"auth_date": str(now), "query_id": "AAE", "user": raw_user}
         init_data = _sign_init_data(data, bot_token) + "ff"
 
-        ok, reason, _ = validate_webapp_init_data(
+        ok, reason, _, _ = validate_webapp_init_data(
             init_data, bot_token, expected_user_id=222, max_age_sec=3600, now_ts=now
         )
         self.assertFalse(ok)
@@ -54,7 +68,7 @@ class GameSecurityTests(unittest.TestCase):
         data = {"auth_date": str(now - 7200), "query_id": "AAE", "user": raw_user}
         init_data = _sign_init_data(data, bot_token)
 
-        ok, reason, _ = validate_webapp_init_data(
+        ok, reason, _, _ = validate_webapp_init_data(
             init_data, bot_token, expected_user_id=333, max_age_sec=60, now_ts=now
         )
         self.assertFalse(ok)
@@ -67,7 +81,7 @@ class GameSecurityTests(unittest.TestCase):
         data = {"auth_date": str(now), "query_id": "AAE", "user": raw_user}
         init_data = _sign_init_data(data, bot_token)
 
-        ok, reason, uid = validate_webapp_init_data(
+        ok, reason, uid, _ = validate_webapp_init_data(
             init_data, bot_token, expected_user_id=445, max_age_sec=3600, now_ts=now
         )
         self.assertFalse(ok)
@@ -81,7 +95,7 @@ class GameSecurityTests(unittest.TestCase):
         data = {"auth_date": str(now), "query_id": "AAE", "user": raw_user}
         signed = _sign_init_data(data, bot_token)
         duplicated = signed + "&auth_date=" + str(now)
-        ok, reason, _ = validate_webapp_init_data(
+        ok, reason, _, _ = validate_webapp_init_data(
             duplicated, bot_token, expected_user_id=555, max_age_sec=3600, now_ts=now
         )
         self.assertFalse(ok)
@@ -93,17 +107,111 @@ class GameSecurityTests(unittest.TestCase):
         raw_user = json.dumps({"id": 666}, separators=(",", ":"))
         data = {"auth_date": str(now + 120), "query_id": "AAE", "user": raw_user}
         init_data = _sign_init_data(data, bot_token)
-        ok, reason, _ = validate_webapp_init_data(
+        ok, reason, _, _ = validate_webapp_init_data(
             init_data, bot_token, expected_user_id=666, max_age_sec=3600, now_ts=now
         )
         self.assertFalse(ok)
         self.assertEqual(reason, "future_auth_date")
 
+    def test_validate_webapp_init_data_cache_hit(self):
+        bot_token = "123456:TEST_TOKEN"
+        now = int(time.time())
+        raw_user = json.dumps({"id": 777}, separators=(",", ":"))
+        data = {"auth_date": str(now), "query_id": "AAE", "user": raw_user}
+        init_data = _sign_init_data(data, bot_token)
+
+        for _ in range(3):
+            ok, _, uid, _ = validate_webapp_init_data(
+                init_data, bot_token, expected_user_id=777, max_age_sec=3600, now_ts=now
+            )
+            self.assertTrue(ok)
+            self.assertEqual(uid, 777)
+        stats = init_data_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+        # Попадание в кэш не отменяет проверок пользователя, срока и токена.
+        ok, reason, _, _ = validate_webapp_init_data(
+            init_data, bot_token, expected_user_id=778, max_age_sec=3600, now_ts=now
+        )
+        self.assertEqual((ok, reason), (False, "user_mismatch"))
+        ok, reason, _, _ = validate_webapp_init_data(
+            init_data, "654321:OTHER", expected_user_id=777, max_age_sec=3600, now_ts=now
+        )
+        self.assertEqual((ok, reason), (False, "bad_hash"))
+        ok, reason, _, _ = validate_webapp_init_data(
+            init_data, bot_token, expected_user_id=777, max_age_sec=60, now_ts=now + 120
+        )
+        self.assertEqual((ok, reason), (False, "expired"))
+
+    def test_cached_hash_does_not_cover_other_fields(self):
+        bot_token = "123456:TEST_TOKEN"
+        now = int(time.time())
+        raw_user = json.dumps({"id": 888}, separators=(",", ":"))
+        init_data = _sign_init_data({"auth_date": str(now), "user": raw_user}, bot_token)
+        self.assertTrue(validate_webapp_init_data(init_data, bot_token, now_ts=now)[0])
+
+        forged_user = urllib.parse.quote(json.dumps({"id": 999}, separators=(",", ":")))
+        forged = init_data.replace(urllib.parse.quote_plus(raw_user), forged_user)
+        self.assertNotEqual(forged, init_data)
+        ok, reason, _, _ = validate_webapp_init_data(forged, bot_token, expected_user_id=999, now_ts=now)
+        self.assertEqual((ok, reason), (False, "bad_hash"))
+
+    def test_game_session_token(self):
+        bot_token = "123456:TEST_TOKEN"
+        token = issue_game_session_token(111, bot_token, ttl_sec=600, now_ts=1000)
+        self.assertLess(len(token), 64)
+        self.assertEqual(verify_game_session_token(token, bot_token, 111, now_ts=1599), (True, "ok"))
+        self.assertEqual(verify_game_session_token(token, bot_token, 111, now_ts=1600), (False, "session_expired"))
+        self.assertEqual(verify_game_session_token(token, bot_token, 112, now_ts=1000), (False, "user_mismatch"))
+        self.assertEqual(verify_game_session_token(token, "654321:OTHER", 111, now_ts=1000), (False, "bad_session"))
+        forged = token.replace("111.", "112.", 1)
+        self.assertEqual(verify_game_session_token(forged, bot_token, 112, now_ts=1000), (False, "bad_session"))
+        self.assertEqual(verify_game_session_token("", bot_token, 111), (False, "bad_session"))
+
+    def test_game_session_expiry_is_capped_by_init_data(self):
+        # Свежий initData: час сессии, округлённый вниз до 5 минут.
+        self.assertEqual(game_session_expires_at(10_000, 86400, 3600, now_ts=10_100), 13_500)
+        # initData истекает через 10 минут — токен не живёт дольше него.
+        self.assertEqual(game_session_expires_at(10_000, 1200, 3600, now_ts=10_600), 11_100)
+        # До конца initData меньше шага округления — токен не выдаётся.
+        self.assertLessEqual(game_session_expires_at(10_000, 1000, 3600, now_ts=10_950), 10_950)
+        token = issue_game_session_token(111, "123456:TEST_TOKEN", expires_at=11_100)
+        self.assertEqual(token.split(".")[1], "11100")
+
     def test_stale_sync_token(self):
         self.assertTrue(is_stale_sync_token(101, 202))
         self.assertFalse(is_stale_sync_token(0, 202))
         self.assertFalse(is_stale_sync_token(202, 202))
 
 
+@unittest.skipUnless(os.environ.get("RUN_BENCHMARKS") == "1", "бенчмарк: RUN_BENCHMARKS=1")
+class InitDataBenchmark(unittest.TestCase):
+    """Микро-бенчмарк: проверок initData в секунду без кэша и с кэшем."""
+
+    ROUNDS = 2000
+
+    def _rate(self, init_data, bot_token, now, use_cache):
+        started = time.perf_counter()
+        for _ in range(self.ROUNDS):
+            validate_webapp_init_data(
+                init_data, bot_token, expected_user_id=101, max_age_sec=3600,
+                now_ts=now, use_cache=use_cache,
+            )
+        return self.ROUNDS / max(time.perf_counter() - started, 1e-9)
+
+    def test_validations_per_second(self):
+        clear_init_data_cache()
+        bot_token = "123456:TEST_TOKEN"
+        now = int(time.time())
+        raw_user = json.dumps({"id": 101, "first_name": "Bench", "language_code": "ru"}, separators=(",", ":"))
+        init_data = _sign_init_data({"auth_date": str(now), "query_id": "AAE", "user": raw_user}, bot_token)
+
+        cold = self._rate(init_data, bot_token, now, use_cache=False)
+        cached = self._rate(init_data, bot_token, now, use_cache=True)
+        logging.getLogger("benchmarks").info(
+            "initData validations/sec: uncached=%s cached=%s", f"{cold:,.0f}", f"{cached:,.0f}")
+        self.assertGreater(cached, cold)
+
+
 if __name__ == "__main__":
     unittest.main()
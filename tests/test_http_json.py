@@ -0,0 +1,140 @@
+import gzip
+import json
+import logging
+import os
+import time
+import unittest
+import zlib
+
+import http_json
+from http_json import (
+    apply_section_versions,
+    encode_body,
+    etag_for,
+    etag_matches,
+    negotiate_encoding,
+    parse_have,
+)
+
+
+def _mission(i):
+    return {
+        "id": f"m{i}", "title": f"Секретная миссия №{i}", "desc": "Расшифровать донесение без подсказок",
+        "progress": i % 3, "target": 3, "done": i % 4 == 0, "bonus_points": 50 + i,
+    }
+
+
+def _state_payload():
+    return {
+        "ok": True, "allowed": True, "access_reason": "ok", "score": 4210, "completed": 4,
+        "game_over": False, "banned": False, "role": "player", "admin_mode": False,
+        "tester_mode": False, "in_rating": True, "open_chapters": [1, 2, 3, 4, 5],
+        "chapter_schedule": [{"chapter": c, "open_at": "2026-05-0%dT09:00:00+03:00" % c} for c in range(1, 7)],
+        "chapters": [{"id": c, "open": c < 6, "scheduled_open_at": None, "open_label": ""} for c in range(1, 7)],
+        "reset_token": 123456, "retreat_count": 2,
+        "ref_summary": {"invited_count": 12, "active_count": 7, "rewarded_chapters": 9, "bonus_points": 380,
+                        "inviter_percent": 5, "invitee_percent": 1, "invitee_bonus_points": 40, "referrer_id": 0},
+        "ref_agents": [{"user_id": 1000 + i, "name": f"Агент {i}", "completed": i % 7, "bonus_points": 10 * i,
+                        "invitee_bonus_points": i, "invitee_percent": 1, "inviter_percent": 5} for i in range(12)],
+        "secret_mode": "on",
+        "secret_summary": {"completed": 5, "total": 15, "bonus_points": 320},
+        "secret_missions": [_mission(i) for i in range(15)],
+    }
+
+
+def _sync_payload():
+    payload = _state_payload()
+    for key in ("chapter_schedule", "chapters", "open_chapters"):
+        payload.pop(key)
+    payload.update({"saved": {"score": 4210, "completed": 4}, "stale": False, "secret_awards": []})
+    return payload
+
+
+class HttpJsonTests(unittest.TestCase):
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding("gzip, deflate, br"), "gzip")
+        self.assertEqual(negotiate_encoding("deflate"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0, deflate"), "deflate")
+        self.assertEqual(negotiate_encoding("br"), None)
+        self.assertEqual(negotiate_encoding(None), None)
+
+    def test_encode_body_roundtrip(self):
+        payload = _state_payload()
+        body, encoding = encode_body(payload, "gzip")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(json.loads(gzip.decompress(body)), payload)
+        body, encoding = encode_body(payload, "deflate")
+        self.assertEqual(json.loads(zlib.decompress(body)), payload)
+
+    def test_small_bodies_are_not_compressed(self):
+        body, encoding = encode_body({"ok": False, "error": "rate_limited"}, "gzip")
+        self.assertIsNone(encoding)
+        self.assertEqual(json.loads(body), {"ok": False, "error": "rate_limited"})
+
+    def test_etag_matches(self):
+        tag = etag_for(b'{"ok":true}')
+        self.assertTrue(tag.startswith('W/"'))
+        self.assertTrue(etag_matches(tag, tag))
+        self.assertTrue(etag_matches('"x", ' + tag[2:], tag))
+        self.assertTrue(etag_matches("*", tag))
+        self.assertFalse(etag_matches('W/"other"', tag))
+        self.assertFalse(etag_matches(None, tag))
+
+    def test_section_versions_omit_unchanged(self):
+        sections = {"ref": ("ref_summary", "ref_agents"), "secret": ("secret_mode", "secret_missions")}
+        full = apply_section_versions(_sync_payload(), sections)
+        self.assertEqual(set(full["versions"]), {"ref", "secret"})
+        self.assertIn("ref_agents", full)
+
+        have = parse_have("ref:%s,secret:stale" % full["versions"]["ref"])
+        delta = apply_section_versions(_sync_payload(), sections, have)
+        self.assertEqual(delta["versions"], full["versions"])
+        self.assertNotIn("ref_summary", delta)
+        self.assertNotIn("ref_agents", delta)
+        self.assertIn("secret_missions", delta)
+        self.assertEqual(parse_have({"ref": "ab", "": "x", "secret": ""}), {"ref": "ab"})
+        self.assertEqual(parse_have(None), {})
+
+        # Разделы, которых нет в ответе (ошибка, stale), версий не получают.
+        self.assertNotIn("versions", apply_section_versions({"ok": False}, sections, have))
+
+    def test_current_sections_keep_client_version(self):
+        sections = {"ref": ("ref_summary", "ref_agents"), "secret": ("secret_mode", "secret_missions")}
+        payload = _sync_payload()
+        payload.pop("ref_summary")
+        payload.pop("ref_agents")
+        out = apply_section_versions(payload, sections, {"ref": "ab12"}, {"ref": "ab12", "other": "x"})
+        self.assertEqual(out["versions"]["ref"], "ab12")
+        self.assertNotIn("other", out["versions"])
+        self.assertIn("secret", out["versions"])
+
+
+@unittest.skipUnless(os.environ.get("RUN_BENCHMARKS") == "1", "бенчмарк: RUN_BENCHMARKS=1")
+class PayloadBenchmark(unittest.TestCase):
+    """Байты ответа и время кодирования по endpoint: json_response (stdlib по умолчанию) против http_json."""
+
+    ROUNDS = 300
+
+    def _measure(self, fn):
+        started = time.perf_counter()
+        for _ in range(self.ROUNDS):
+            out = fn()
+        return out, (time.perf_counter() - started) * 1e6 / self.ROUNDS
+
+    def test_payload_bytes_and_encode_time(self):
+        lines = [f"encoder={http_json.ENCODER_NAME}"]
+        for endpoint, payload in (("game_state", _state_payload()), ("game_sync", _sync_payload())):
+            baseline, base_us = self._measure(lambda: json.dumps(payload).encode("utf-8"))
+            (body, _), fast_us = self._measure(lambda: encode_body(payload, None))
+            (gz_body, _), gz_us = self._measure(lambda: encode_body(payload, "gzip"))
+            lines.append(
+                f"{endpoint}: stdlib {len(baseline)} B {base_us:.0f} us | "
+                f"compact {len(body)} B {fast_us:.0f} us | gzip {len(gz_body)} B {gz_us:.0f} us"
+            )
+            self.assertLess(len(body), len(baseline))
+            self.assertLess(len(gz_body), len(body) // 2)
+        logging.getLogger("benchmarks").info("payload benchmark\n%s", "\n".join(lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
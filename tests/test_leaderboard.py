@@ -0,0 +1,59 @@
+import unittest
+from datetime import datetime, timezone
+
+from leaderboard import Leaderboard
+
+
+def _row(uid, score, ts, role="player", banned=False, name=None):
+    return (uid, name or f"p{uid}", score, 1, False, banned, role, 0, 0, ts)
+
+
+class LeaderboardTests(unittest.TestCase):
+    def setUp(self):
+        self.board = Leaderboard()
+        self.board.load([
+            _row(1, 100, 10.0),
+            _row(2, 300, 20.0),
+            _row(3, 100, 5.0),
+            _row(4, 500, 1.0, role="admin"),
+            _row(5, 0, 1.0, role="tester"),
+            _row(6, 0, 1.0),
+            _row(7, 900, 1.0, banned=True),
+        ])
+
+    def test_top_orders_by_score_then_updated_at(self):
+        self.assertTrue(self.board.ready)
+        self.assertEqual([r[0] for r in self.board.top(10)], [2, 3, 1])
+        self.assertEqual([r[0] for r in self.board.top(2)], [2, 3])
+        self.assertEqual(self.board.players_count(), 3)
+
+    def test_top_with_roles_puts_staff_first(self):
+        rows = self.board.top_with_roles(10)
+        self.assertEqual([r[0] for r in rows], [4, 5, 2, 3, 1])
+        self.assertEqual(rows[0][5], "admin")
+
+    def test_apply_moves_bans_and_promotes(self):
+        self.board.apply([
+            _row(1, 1000, 30.0),
+            _row(2, 300, 20.0, banned=True),
+            _row(6, 50, datetime(2024, 1, 1, tzinfo=timezone.utc)),
+            _row(3, 100, 5.0, role="tester"),
+        ])
+        self.assertEqual([r[0] for r in self.board.top(10)], [1, 6])
+        self.assertEqual(self.board.players_count(), 2)
+        self.assertEqual([r[0] for r in self.board.top_with_roles(10)], [4, 3, 5, 1, 6])
+
+    def test_rank_counts_players_only(self):
+        self.assertEqual(self.board.rank(2), (1, 3))
+        self.assertEqual(self.board.rank(3), (2, 3))
+        self.assertEqual(self.board.rank(1), (3, 3))
+        for uid in (4, 5, 6, 7, 99):
+            self.assertEqual(self.board.rank(uid), (None, 3))
+        self.board.apply([_row(1, 400, 30.0), _row(2, 300, 20.0, role="tester")])
+        self.assertEqual(self.board.rank(1), (1, 2))
+        self.assertEqual(self.board.rank(3), (2, 2))
+        self.assertEqual(self.board.rank(2), (None, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
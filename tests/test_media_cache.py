@@ -0,0 +1,67 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from media_cache import MediaCache, TooLarge
+
+
+class _FakeUpstream:
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.calls = []
+
+    async def fetch(self, url, dest, max_bytes):
+        self.calls.append(url)
+        await asyncio.sleep(0.01)
+        size = self.sizes[url]
+        if size > max_bytes:
+            raise TooLarge(size)
+        with open(dest, "wb") as fh:
+            fh.write(b"x" * size)
+        return {"content_type": "audio/mpeg", "etag": '"e"'}
+
+
+class MediaCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_single_flight_fill(self):
+        upstream = _FakeUpstream({"u/a": 100})
+        cache = MediaCache(self.dir, 1000, upstream.fetch)
+
+        async def run():
+            return await asyncio.gather(*(cache.get("a", "u/a") for _ in range(10)))
+
+        results = asyncio.run(run())
+        self.assertEqual(upstream.calls, ["u/a"])
+        self.assertEqual({r[0] for r in results}, {os.path.join(self.dir, "a")})
+        self.assertEqual(results[0][1]["size"], 100)
+        asyncio.run(cache.get("a", "u/a"))
+        self.assertEqual((cache.stats()["misses"], cache.stats()["hits"]), (1, 1))
+
+    def test_lru_eviction_and_restart(self):
+        upstream = _FakeUpstream({"u/a": 400, "u/b": 400, "u/c": 400, "u/big": 5000})
+        cache = MediaCache(self.dir, 1000, upstream.fetch)
+        asyncio.run(cache.get("a", "u/a"))
+        asyncio.run(cache.get("b", "u/b"))
+        cache.lookup("a")  # a свежее b
+        asyncio.run(cache.get("c", "u/c"))
+        self.assertEqual(sorted(cache._lru), ["a", "c"])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "b")))
+        self.assertIsNone(asyncio.run(cache.get("big", "u/big")))
+        self.assertIsNone(asyncio.run(cache.get("big", "u/big")))
+        self.assertEqual(upstream.calls.count("u/big"), 1)
+        self.assertEqual(cache.stats()["uncacheable"], 1)
+
+        restarted = MediaCache(self.dir, 1000, upstream.fetch)
+        self.assertEqual(sorted(restarted._lru), ["a", "c"])
+        self.assertEqual(restarted.used_bytes, 800)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from rate_limit import MemoryBackend, RateLimiter, SharedBackend, parse_limits
+
+
+def _hits(limiter, endpoint, user_id, times):
+    return [asyncio.run(limiter.is_limited(endpoint, user_id, now=t)) for t in times]
+
+
+class RateLimitTests(unittest.TestCase):
+    def test_parse_limits_overrides_defaults(self):
+        limits = parse_limits("game_state=120/30, game_sync=10, bad=x, =5, game_reset=0")
+        self.assertEqual(limits["game_state"], (120, 30))
+        self.assertEqual(limits["game_sync"], (10, 60))
+        self.assertEqual(limits["game_sync_batch"], (30, 60))
+        self.assertNotIn("bad", limits)
+        self.assertNotIn("game_reset", limits)
+
+    def test_limit_within_window(self):
+        limiter = RateLimiter(MemoryBackend(), {"game_sync": (3, 60)})
+        self.assertEqual(_hits(limiter, "game_sync", 1, [0, 1, 2, 3]), [False, False, False, True])
+        # Другой пользователь и endpoint без лимита не затронуты.
+        self.assertEqual(_hits(limiter, "game_sync", 2, [4]), [False])
+        self.assertEqual(_hits(limiter, "game_state", 1, [4] * 10), [False] * 10)
+
+    def test_previous_window_decays(self):
+        limiter = RateLimiter(MemoryBackend(), {"game_sync": (4, 60)})
+        _hits(limiter, "game_sync", 1, [10, 20, 30, 40])
+        # Начало следующего окна: 4 * (1 - 6/60) + 1 > 4.
+        self.assertEqual(_hits(limiter, "game_sync", 1, [66]), [True])
+        # Ближе к концу окна вес предыдущего падает.
+        self.assertEqual(_hits(limiter, "game_sync", 1, [115]), [False])
+        self.assertEqual(limiter.stats()["rejected"], 1)
+
+    def test_sweep_drops_stale_keys(self):
+        backend = MemoryBackend()
+        limiter = RateLimiter(backend, {"game_sync": (3, 60)})
+        _hits(limiter, "game_sync", 1, [0])
+        _hits(limiter, "game_sync", 2, [100])
+        self.assertEqual(backend.sweep(now=130), 1)
+        self.assertEqual(backend.size(), 1)
+
+    def test_shared_backend_fails_open(self):
+        calls = []
+
+        async def hit(key, window_start, window_sec):
+            calls.append((key, window_start, window_sec))
+            return None if len(calls) > 1 else (31, 0)
+
+        limiter = RateLimiter(SharedBackend(hit), {"game_sync": (30, 60)})
+        self.assertEqual(_hits(limiter, "game_sync", 7, [125, 126]), [True, False])
+        self.assertEqual(calls[0], ("game_sync:7", 120, 60))
+        self.assertEqual(limiter.stats()["errors"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
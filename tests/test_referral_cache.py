@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+
+import referral_cache
+from referral_cache import ReferralCache
+
+
+def _agents(n):
+    return [{"user_id": i, "name": f"p{i}"} for i in range(n)]
+
+
+class ReferralCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = ReferralCache(ttl_sec=60, max_users=3)
+
+    def test_miss_then_hit_returns_copy(self):
+        self.assertIsNone(self.cache.summary(1))
+        self.assertTrue(self.cache.put(1, self.cache.token(), summary={"invited_count": 2}))
+        got = self.cache.summary(1)
+        self.assertEqual(got, {"invited_count": 2})
+        got["invited_count"] = 99
+        self.assertEqual(self.cache.summary(1), {"invited_count": 2})
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertEqual(stats["hit_rate"], round(2 / 3, 4))
+
+    def test_put_after_invalidate_is_rejected(self):
+        token = self.cache.token()
+        self.cache.invalidate([1])
+        self.assertFalse(self.cache.put(1, token, summary={"invited_count": 1}))
+        self.assertIsNone(self.cache.summary(1))
+        self.assertTrue(self.cache.put(1, self.cache.token(), summary={"invited_count": 2}))
+        self.assertEqual(self.cache.summary(1), {"invited_count": 2})
+        self.assertEqual(self.cache.stats()["rejected"], 1)
+
+    def test_invalidate_drops_both_parts(self):
+        token = self.cache.token()
+        self.cache.put(1, token, summary={"a": 1}, agents=_agents(2), limit=12)
+        self.cache.invalidate([1])
+        self.assertIsNone(self.cache.summary(1))
+        self.assertIsNone(self.cache.agents(1, 12))
+
+    def test_other_user_invalidation_keeps_token_valid(self):
+        token = self.cache.token()
+        self.cache.invalidate([2])
+        self.assertTrue(self.cache.put(1, token, summary={"a": 1}))
+
+    def test_agents_served_for_smaller_or_complete_limit(self):
+        self.cache.put(1, self.cache.token(), agents=_agents(15), limit=15)
+        self.assertEqual(len(self.cache.agents(1, 12)), 12)
+        self.assertIsNone(self.cache.agents(1, 20))
+        self.cache.put(2, self.cache.token(), agents=_agents(3), limit=12)
+        self.assertEqual(len(self.cache.agents(2, 15)), 3)
+
+    def test_section_version_follows_invalidation(self):
+        token = self.cache.token()
+        self.assertTrue(self.cache.put(1, token, version="ab12"))
+        self.assertEqual(self.cache.version(1), "ab12")
+        self.cache.invalidate([1])
+        self.assertIsNone(self.cache.version(1))
+        self.assertFalse(self.cache.put(1, token, version="ab12"))
+        with mock.patch.object(referral_cache.time, "monotonic", return_value=100.0):
+            self.cache.put(1, self.cache.token(), version="cd34")
+        with mock.patch.object(referral_cache.time, "monotonic", return_value=161.0):
+            self.assertIsNone(self.cache.version(1))
+
+    def test_clear_rejects_older_tokens(self):
+        token = self.cache.token()
+        self.cache.put(1, token, summary={"a": 1})
+        self.cache.clear()
+        self.assertIsNone(self.cache.summary(1))
+        self.assertFalse(self.cache.put(1, token, summary={"a": 1}))
+        self.assertFalse(self.cache.put(5, token, summary={"a": 1}))
+
+    def test_eviction_keeps_stamp_floor(self):
+        token = self.cache.token()
+        self.cache.invalidate([1])
+        for uid in (2, 3, 4):
+            self.cache.put(uid, self.cache.token(), summary={"a": uid})
+        self.assertEqual(self.cache.stats()["size"], 3)
+        self.assertFalse(self.cache.put(1, token, summary={"a": 1}))
+
+    def test_ttl_expiry(self):
+        with mock.patch.object(referral_cache.time, "monotonic", return_value=100.0):
+            self.cache.put(1, self.cache.token(), summary={"a": 1})
+        with mock.patch.object(referral_cache.time, "monotonic", return_value=161.0):
+            self.assertIsNone(self.cache.summary(1))
+
+    def test_disabled_cache_never_hits(self):
+        cache = ReferralCache(ttl_sec=0)
+        self.assertFalse(cache.put(1, cache.token(), summary={"a": 1}))
+        self.assertIsNone(cache.summary(1))
+        self.assertEqual(cache.stats()["misses"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
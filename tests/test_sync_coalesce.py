@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+
+import sync_coalesce
+from sync_coalesce import SyncCoalescer, collapse, mergeable
+
+
+def _tick(score, cipher_idx, **extra):
+    event = {
+        "event_type": "sync", "chapter": 2, "chapter_idx": 1, "chapter_in_progress": True,
+        "client_reset_token": "r1", "secret_mode": "none", "score": score, "total_score": 100 + score,
+        "completed": 1, "cipher_idx": cipher_idx, "achievement_count": 0, "achievement_pts": 0,
+        "game_over": False, "restart_penalty_points": 0, "mission_answer_token": "",
+    }
+    event.update(extra)
+    return event
+
+
+class SyncCoalesceTests(unittest.TestCase):
+    def test_mergeable_rules(self):
+        self.assertTrue(mergeable(_tick(10, 1), _tick(20, 2)))
+        # Падение очков — сигнал авто-детекта перезапуска, не сливаем.
+        self.assertFalse(mergeable(_tick(20, 2), _tick(5, 0)))
+        self.assertFalse(mergeable(_tick(10, 1), _tick(20, 2, event_type="chapter_complete")))
+        self.assertFalse(mergeable(_tick(10, 1), _tick(20, 2, restart_penalty_points=5)))
+        # В секретном режиме новый ответ миссии — отдельное событие.
+        secret = {"secret_mode": "on"}
+        self.assertFalse(mergeable(
+            _tick(10, 1, mission_answer_token="a", **secret), _tick(20, 2, mission_answer_token="b", **secret)))
+        self.assertTrue(mergeable(_tick(10, 1, **secret), _tick(20, 2, **secret)))
+
+    def test_collapse_keeps_order_and_ids(self):
+        events = [
+            (1, _tick(10, 1), ("a",)),
+            (2, _tick(20, 2), ("b",)),
+            (3, _tick(20, 2, event_type="chapter_complete"), ()),
+            (4, _tick(0, 0, chapter=3), ("c",)),
+            (5, _tick(5, 1, chapter=3), ()),
+        ]
+        got = collapse(events)
+        self.assertEqual([(seq, ids) for seq, _, ids in got], [(2, ("a", "b")), (3, ()), (5, ("c",))])
+
+    def test_deferred_ticks_are_written_once(self):
+        writes = []
+
+        async def apply(user_id, init_data_raw, event, ids):
+            writes.append((event["score"], ids))
+            return {"ok": True, "db_score": event["total_score"], "db_completed": 1}, 200
+
+        async def run():
+            coalescer = SyncCoalescer(0.05, apply)
+            # Без базы (первый тик) — запись сразу.
+            self.assertIsNone(coalescer.try_defer(1, "", _tick(10, 1), "a"))
+            coalescer.remember(1, _tick(10, 1), {"ok": True, "db_score": 110, "ref_bonus_awarded": 3})
+            first = coalescer.try_defer(1, "", _tick(20, 2), "b")
+            second = coalescer.try_defer(1, "", _tick(30, 3), "c")
+            self.assertEqual((first["db_score"], second["db_score"]), (120, 130))
+            self.assertEqual(second["ref_bonus_awarded"], 0)
+            self.assertTrue(second["deferred"])
+            # Повтор отложенного тика не создаёт новой записи.
+            self.assertIsNotNone(coalescer.try_defer(1, "", _tick(20, 2), "b"))
+            self.assertEqual(len(coalescer._tasks), 0)
+            await asyncio.sleep(0.1)
+            self.assertEqual(writes, [(30, ("b", "c"))])
+            # Запись по таймеру завершена: ни задачи, ни замка игрока не осталось.
+            self.assertEqual((len(coalescer._tasks), coalescer.stats()["locks"]), (0, 0))
+            # Откат очков сливать нельзя: буфер пуст, событие применяет вызывающий.
+            self.assertIsNone(coalescer.try_defer(1, "", _tick(0, 0), "d"))
+            self.assertEqual(coalescer.stats()["deferred"], 2)
+
+        asyncio.run(run())
+
+    def test_lock_is_dropped_when_idle(self):
+        async def apply(user_id, init_data_raw, event, ids):
+            return {"ok": True}, 200
+
+        async def run():
+            coalescer = SyncCoalescer(0.05, apply)
+            order = []
+
+            async def hold(tag):
+                async with coalescer.lock(1):
+                    order.append(tag)
+                    await asyncio.sleep(0.01)
+
+            await asyncio.gather(hold("a"), hold("b"))
+            self.assertEqual(order, ["a", "b"])
+            self.assertEqual(coalescer.stats()["locks"], 0)
+
+        asyncio.run(run())
+
+    def test_award_fields_cover_batch_sums(self):
+        self.assertIn("secret_awarded_points", sync_coalesce.AWARD_FIELDS)
+
+
+if __name__ == "__main__":
+    unittest.main()